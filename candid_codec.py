@@ -0,0 +1,963 @@
+#!/usr/bin/env python3
+"""
+Minimal Candid codec for the Python test harnesses.
+
+Covers what the harness scripts need to talk to a replica without dfx:
+- Encoding Candid *text* arguments (the same strings we used to hand to
+  `dfx canister call`) into the binary DIDL wire format.
+- Decoding binary replies into plain Python values.
+- Rendering decoded replies back into dfx-style Candid text, so code that
+  parses dfx output keeps working unchanged regardless of transport.
+- Parsing dfx-style Candid text (dfx stdout, recorded replies) into the same
+  Python values the binary decoder produces, so callers read typed fields
+  instead of regex-scraping text.
+
+Python value mapping for decoded (and parsed) replies:
+  nat/int/natN/intN -> int        float32/float64 -> float
+  text -> str                     bool -> bool
+  null/reserved -> None           principal -> Principal (str subclass)
+  opt T -> None or value          vec nat8 -> bytes, vec T -> list
+  record -> dict (field name -> value), tuple records -> tuple
+  variant -> {tag: value}         func -> (Principal, method)
+"""
+
+import base64
+import glob
+import os
+import re
+import struct
+import zlib
+from typing import Any, Dict, List, Optional, Tuple
+
+# ============================================
+# Type opcodes (Candid spec)
+# ============================================
+
+T_NULL = -1
+T_BOOL = -2
+T_NAT = -3
+T_INT = -4
+T_NAT8 = -5
+T_NAT16 = -6
+T_NAT32 = -7
+T_NAT64 = -8
+T_INT8 = -9
+T_INT16 = -10
+T_INT32 = -11
+T_INT64 = -12
+T_FLOAT32 = -13
+T_FLOAT64 = -14
+T_TEXT = -15
+T_RESERVED = -16
+T_EMPTY = -17
+T_OPT = -18
+T_VEC = -19
+T_RECORD = -20
+T_VARIANT = -21
+T_FUNC = -22
+T_SERVICE = -23
+T_PRINCIPAL = -24
+
+PRIMITIVE_NAMES = {
+    T_NULL: "null", T_BOOL: "bool", T_NAT: "nat", T_INT: "int",
+    T_NAT8: "nat8", T_NAT16: "nat16", T_NAT32: "nat32", T_NAT64: "nat64",
+    T_INT8: "int8", T_INT16: "int16", T_INT32: "int32", T_INT64: "int64",
+    T_FLOAT32: "float32", T_FLOAT64: "float64", T_TEXT: "text",
+    T_RESERVED: "reserved", T_EMPTY: "empty", T_PRINCIPAL: "principal",
+}
+PRIMITIVE_BY_NAME = {v: k for k, v in PRIMITIVE_NAMES.items()}
+
+# Fixed-width integer layouts: opcode -> (struct format, byte size)
+FIXED_INTS = {
+    T_NAT8: ("<B", 1), T_NAT16: ("<H", 2), T_NAT32: ("<I", 4), T_NAT64: ("<Q", 8),
+    T_INT8: ("<b", 1), T_INT16: ("<h", 2), T_INT32: ("<i", 4), T_INT64: ("<q", 8),
+}
+
+
+class CandidError(ValueError):
+    """Raised for malformed Candid text or binary data."""
+
+
+# ============================================
+# Principal
+# ============================================
+
+class Principal(str):
+    """Textual principal id that also knows its raw byte form."""
+
+    @classmethod
+    def from_bytes(cls, raw: bytes) -> "Principal":
+        checksum = struct.pack(">I", zlib.crc32(raw) & 0xFFFFFFFF)
+        b32 = base64.b32encode(checksum + raw).decode().lower().rstrip("=")
+        return cls("-".join(b32[i:i + 5] for i in range(0, len(b32), 5)))
+
+    def to_bytes(self) -> bytes:
+        b32 = self.replace("-", "").upper()
+        b32 += "=" * (-len(b32) % 8)
+        try:
+            data = base64.b32decode(b32)
+        except Exception as e:
+            raise CandidError(f"Invalid principal {str(self)!r}: {e}")
+        if len(data) < 4:
+            raise CandidError(f"Invalid principal {str(self)!r}")
+        return data[4:]
+
+
+ANONYMOUS_PRINCIPAL = Principal.from_bytes(b"\x04")
+
+
+# ============================================
+# Field name hashing
+# ============================================
+
+def idl_hash(name: str) -> int:
+    """Candid field id: h = h * 223 + byte (mod 2^32)."""
+    h = 0
+    for b in name.encode():
+        h = (h * 223 + b) & 0xFFFFFFFF
+    return h
+
+
+# Names of fields in responses from canisters we don't have .did files for
+# (mainnet KongSwap, ICPSwap pools/factory, ICRC-3 ledgers, DAO/treasury).
+# Names from src/declarations/**/*.did are added on first use.
+_BUILTIN_FIELD_NAMES = [
+    "Ok", "Err", "ok", "err",
+    # KongSwap swap_amounts / pools
+    "mid_price", "pay_address", "pay_amount", "pay_chain", "pay_symbol", "price",
+    "receive_address", "receive_amount", "receive_chain", "receive_symbol",
+    "slippage", "txs", "gas_fee", "lp_fee", "pool_symbol", "pools", "balance_0",
+    "balance_1", "lp_fee_bps", "symbol_0", "symbol_1", "address_0", "address_1",
+    "lp_fee_0", "lp_fee_1", "is_removed", "pool_id", "chain_0", "chain_1", "name",
+    "symbol", "tvl", "lp_token_symbol",
+    # ICPSwap factory / pool
+    "canisterId", "fee", "key", "tickSpacing", "token0", "token1", "address",
+    "standard", "sqrtPriceX96", "tick", "liquidity", "maxLiquidityPerTick",
+    "nextPositionId", "tickIndex", "liquidityNet", "liquidityGross", "price0",
+    "price1", "price0Decimal", "price1Decimal", "content", "totalElements",
+    "offset", "limit",
+    # ICRC-3
+    "log_length", "blocks", "archived_blocks", "callback", "args", "start",
+    "length", "id", "block", "canister_id", "end", "Nat", "Int", "Text", "Blob",
+    "Map", "Array",
+    # DAO / treasury
+    "priceInICP", "priceInUSD", "tokenDecimals", "balance", "tokenSymbol",
+    "tokenName", "Active", "isPaused", "tokenTransferFee", "tokenType",
+    "maxSlippageBasisPoints", "maxTradeValueICP", "minTradeValueICP",
+    "maxTradeAttemptsPerInterval",
+]
+
+FIELD_NAMES: Dict[int, str] = {}
+_declarations_loaded = False
+
+
+def register_field_names(names) -> None:
+    """Teach the decoder field names so replies render with names instead of hashes."""
+    for name in names:
+        FIELD_NAMES[idl_hash(name)] = name
+
+
+def _load_field_names() -> None:
+    """Populate FIELD_NAMES from builtins and the repo's generated .did files."""
+    global _declarations_loaded
+    if _declarations_loaded:
+        return
+    _declarations_loaded = True
+    register_field_names(_BUILTIN_FIELD_NAMES)
+    root = os.path.dirname(os.path.abspath(__file__))
+    label = re.compile(r'(?:^|[{;\s])"?([A-Za-z_][A-Za-z0-9_]*)"?\s*:(?!:)', re.M)
+    for path in glob.glob(os.path.join(root, "src", "declarations", "*", "*.did")):
+        try:
+            with open(path) as f:
+                register_field_names(label.findall(f.read()))
+        except OSError:
+            continue
+
+
+def field_name(field_id: int) -> Optional[str]:
+    _load_field_names()
+    return FIELD_NAMES.get(field_id)
+
+
+# ============================================
+# LEB128
+# ============================================
+
+def _uleb(n: int) -> bytes:
+    out = bytearray()
+    while True:
+        b = n & 0x7F
+        n >>= 7
+        if n:
+            out.append(b | 0x80)
+        else:
+            out.append(b)
+            return bytes(out)
+
+
+def _sleb(n: int) -> bytes:
+    out = bytearray()
+    while True:
+        b = n & 0x7F
+        n >>= 7
+        if (n == 0 and not b & 0x40) or (n == -1 and b & 0x40):
+            out.append(b)
+            return bytes(out)
+        out.append(b | 0x80)
+
+
+# For callers that hand-build messages the text encoder can't express (recursive types)
+encode_nat = _uleb
+encode_int = _sleb
+
+
+class _Reader:
+    __slots__ = ("data", "pos")
+
+    def __init__(self, data: bytes):
+        self.data = data
+        self.pos = 0
+
+    def byte(self) -> int:
+        if self.pos >= len(self.data):
+            raise CandidError("Unexpected end of Candid data")
+        b = self.data[self.pos]
+        self.pos += 1
+        return b
+
+    def take(self, n: int) -> bytes:
+        if self.pos + n > len(self.data):
+            raise CandidError("Unexpected end of Candid data")
+        chunk = self.data[self.pos:self.pos + n]
+        self.pos += n
+        return chunk
+
+    def uleb(self) -> int:
+        data, pos = self.data, self.pos
+        result = shift = 0
+        try:
+            while True:
+                b = data[pos]
+                pos += 1
+                result |= (b & 0x7F) << shift
+                if b < 0x80:
+                    self.pos = pos
+                    return result
+                shift += 7
+        except IndexError:
+            raise CandidError("Unexpected end of Candid data") from None
+
+    def text(self) -> str:
+        n = self.uleb()
+        pos = self.pos
+        if pos + n > len(self.data):
+            raise CandidError("Unexpected end of Candid data")
+        self.pos = pos + n
+        return self.data[pos:pos + n].decode()
+
+    def blob(self) -> bytes:
+        n = self.uleb()
+        pos = self.pos
+        if pos + n > len(self.data):
+            raise CandidError("Unexpected end of Candid data")
+        self.pos = pos + n
+        return self.data[pos:pos + n]
+
+    def sleb(self) -> int:
+        data, pos = self.data, self.pos
+        result = shift = 0
+        try:
+            while True:
+                b = data[pos]
+                pos += 1
+                result |= (b & 0x7F) << shift
+                shift += 7
+                if b < 0x80:
+                    self.pos = pos
+                    return result - (1 << shift) if b & 0x40 else result
+        except IndexError:
+            raise CandidError("Unexpected end of Candid data") from None
+
+
+# ============================================
+# Binary decoding
+# ============================================
+
+def decode(data: bytes) -> Tuple[List[tuple], List[int], List[Any]]:
+    """Decode a DIDL message.
+
+    Returns: (type_table, arg_types, values)
+    """
+    r = _Reader(data)
+    if r.take(4) != b"DIDL":
+        raise CandidError("Missing DIDL magic")
+
+    table: List[tuple] = []
+    for _ in range(r.uleb()):
+        op = r.sleb()
+        if op in (T_OPT, T_VEC):
+            table.append((op, r.sleb()))
+        elif op in (T_RECORD, T_VARIANT):
+            fields = [(r.uleb(), r.sleb()) for _ in range(r.uleb())]
+            table.append((op, fields))
+        elif op == T_FUNC:
+            arg_ts = [r.sleb() for _ in range(r.uleb())]
+            ret_ts = [r.sleb() for _ in range(r.uleb())]
+            annotations = r.take(r.uleb())
+            table.append((op, (arg_ts, ret_ts, annotations)))
+        elif op == T_SERVICE:
+            methods = []
+            for _ in range(r.uleb()):
+                name = r.take(r.uleb()).decode()
+                methods.append((name, r.sleb()))
+            table.append((op, methods))
+        else:
+            raise CandidError(f"Unsupported type opcode {op}")
+
+    arg_types = [r.sleb() for _ in range(r.uleb())]
+    decoders = _compile_decoders(table)
+    values = [(decoders[t] if t >= 0 else _primitive_decoder(t))(r) for t in arg_types]
+    return table, arg_types, values
+
+
+def _is_tuple_record(fields) -> bool:
+    return bool(fields) and all(fid == i for i, (fid, _) in enumerate(fields))
+
+
+def _primitive_decoder(t: int):
+    if t == T_NAT:
+        return _Reader.uleb
+    if t == T_INT:
+        return _Reader.sleb
+    if t in FIXED_INTS:
+        unpack, size = struct.Struct(FIXED_INTS[t][0]).unpack, FIXED_INTS[t][1]
+        return lambda r: unpack(r.take(size))[0]
+    if t == T_TEXT:
+        return _Reader.text
+    if t == T_BOOL:
+        return lambda r: r.byte() == 1
+    if t in (T_NULL, T_RESERVED):
+        return lambda r: None
+    if t == T_FLOAT64:
+        return lambda r: struct.unpack("<d", r.take(8))[0]
+    if t == T_FLOAT32:
+        return lambda r: struct.unpack("<f", r.take(4))[0]
+    if t == T_PRINCIPAL:
+        return _decode_principal
+
+    def unsupported(r):
+        raise CandidError(f"Cannot decode value of type {t}")
+    return unsupported
+
+
+def _compile_decoders(table: List[tuple]) -> List[Any]:
+    """One decoder function per type table entry, with field names and record shapes resolved up front.
+
+    Decoding a large reply (thousands of ICRC-3 blocks) calls these hundreds of
+    thousands of times, so nothing is looked up per value that can be looked up per type.
+    """
+    decoders: List[Any] = [None] * len(table)
+    building = set()
+
+    def ref(t: int):
+        if t < 0:
+            return _primitive_decoder(t)
+        if decoders[t] is None:
+            if t in building:
+                return lambda r: decoders[t](r)  # Recursive type (e.g. ICRC-3 Value): bind late
+            build(t)
+        return decoders[t]
+
+    def name(fid: int) -> str:
+        return field_name(fid) or f"_{fid}_"
+
+    def build(i: int) -> None:
+        building.add(i)
+        op, spec = table[i]
+        if op == T_OPT:
+            def dec(r, inner=ref(spec)):
+                return inner(r) if r.byte() else None
+        elif op == T_VEC:
+            if spec == T_NAT8:
+                dec = _Reader.blob
+            else:
+                def dec(r, item=ref(spec)):
+                    return [item(r) for _ in range(r.uleb())]
+        elif op == T_RECORD and _is_tuple_record(spec) and len(spec) == 2:
+            def dec(r, first=ref(spec[0][1]), second=ref(spec[1][1])):  # (key, value) pairs of Maps
+                return (first(r), second(r))
+        elif op == T_RECORD and _is_tuple_record(spec):
+            def dec(r, items=[ref(ft) for _, ft in spec]):
+                return tuple([item(r) for item in items])
+        elif op == T_RECORD:
+            def dec(r, fields=[(name(fid), ref(ft)) for fid, ft in spec]):
+                return {key: item(r) for key, item in fields}
+        elif op == T_VARIANT:
+            def dec(r, arms=[(name(fid), ref(ft)) for fid, ft in spec]):
+                idx = r.uleb()
+                if idx >= len(arms):
+                    raise CandidError(f"Variant index {idx} out of range")
+                key, item = arms[idx]
+                return {key: item(r)}
+        elif op == T_FUNC:
+            def dec(r):
+                if r.byte() != 1:
+                    raise CandidError("Opaque func reference")
+                principal = _decode_principal(r)
+                return (principal, r.take(r.uleb()).decode())
+        elif op == T_SERVICE:
+            dec = _decode_principal
+        else:
+            def dec(r, op=op):
+                raise CandidError(f"Unsupported type opcode {op}")
+        decoders[i] = dec
+
+    for i in range(len(table)):
+        if decoders[i] is None:
+            build(i)
+    return decoders
+
+
+def _decode_principal(r: _Reader) -> Principal:
+    if r.byte() != 1:
+        raise CandidError("Opaque principal reference")
+    return Principal.from_bytes(r.take(r.uleb()))
+
+
+# ============================================
+# Rendering (dfx-style Candid text)
+# ============================================
+
+def render(table: List[tuple], arg_types: List[int], values: List[Any]) -> str:
+    """Render decoded values the way `dfx canister call` prints them."""
+    lines = ["("]
+    for t, v in zip(arg_types, values):
+        lines.append("  " + _render_value(t, v, table, "  ") + ",")
+    lines.append(")")
+    return "\n".join(lines) + "\n"
+
+
+def _group_digits(n: int) -> str:
+    s = str(abs(n))
+    head = len(s) % 3 or 3
+    parts = [s[:head]] + [s[i:i + 3] for i in range(head, len(s), 3)]
+    return ("-" if n < 0 else "") + "_".join(parts)
+
+
+def _render_text(s: str) -> str:
+    out = []
+    for ch in s:
+        if ch == '"':
+            out.append('\\"')
+        elif ch == "\\":
+            out.append("\\\\")
+        elif ch == "\n":
+            out.append("\\n")
+        elif ch == "\t":
+            out.append("\\t")
+        elif ord(ch) < 0x20 or ord(ch) == 0x7F:
+            out.append(f"\\{ord(ch):02x}")
+        else:
+            out.append(ch)
+    return '"' + "".join(out) + '"'
+
+
+def _render_value(t: int, v: Any, table: List[tuple], indent: str) -> str:
+    inner = indent + "  "
+    if t >= 0:
+        op, spec = table[t]
+        if op == T_OPT:
+            return "null" if v is None else "opt " + _render_value(spec, v, table, indent)
+        if op == T_VEC:
+            if spec == T_NAT8:
+                return 'blob "' + "".join(f"\\{b:02x}" for b in v) + '"'
+            if not v:
+                return "vec {}"
+            items = [inner + _render_value(spec, x, table, inner) + ";" for x in v]
+            return "vec {\n" + "\n".join(items) + "\n" + indent + "}"
+        if op == T_RECORD:
+            if not spec:
+                return "record {}"
+            items = []
+            if _is_tuple_record(spec):
+                for (_, ft), x in zip(spec, v):
+                    items.append(inner + _render_value(ft, x, table, inner) + ";")
+            else:
+                for fid, ft in spec:
+                    name = field_name(fid) or f"_{fid}_"
+                    items.append(f"{inner}{name} = {_render_value(ft, v[name], table, inner)};")
+            return "record {\n" + "\n".join(items) + "\n" + indent + "}"
+        if op == T_VARIANT:
+            tag, x = next(iter(v.items()))
+            ft = next(ft for fid, ft in spec if (field_name(fid) or f"_{fid}_") == tag)
+            if ft == T_NULL:
+                return f"variant {{ {tag} }}"
+            return f"variant {{ {tag} = {_render_value(ft, x, table, indent)} }}"
+        if op == T_FUNC:
+            return f'func "{v[0]}".{v[1]}'
+        if op == T_SERVICE:
+            return f'service "{v}"'
+    if t in (T_NAT, T_INT) or t in FIXED_INTS:
+        return f"{_group_digits(v)} : {PRIMITIVE_NAMES[t]}"
+    if t in (T_FLOAT32, T_FLOAT64):
+        return f"{v!r} : {PRIMITIVE_NAMES[t]}"
+    if t == T_TEXT:
+        return _render_text(v)
+    if t == T_BOOL:
+        return "true" if v else "false"
+    if t == T_PRINCIPAL:
+        return f'principal "{v}"'
+    return "null"
+
+
+# ============================================
+# Text arguments -> binary
+# ============================================
+
+_ARG_TOKEN = re.compile(r'''
+    \s*(?:
+        (?P<str>"(?:[^"\\]|\\.)*")
+      | (?P<num>[+-]?\d[\d_]*(?:\.\d[\d_]*)?(?:[eE][+-]?\d+)?)
+      | (?P<id>[A-Za-z_][A-Za-z0-9_]*)
+      | (?P<punct>[(){};,=:])
+    )''', re.X)
+
+
+def _tokenize_args(text: str) -> List[Tuple[str, str]]:
+    tokens = []
+    pos = 0
+    text = text.strip()
+    while pos < len(text):
+        m = _ARG_TOKEN.match(text, pos)
+        if not m or m.end() == pos:
+            raise CandidError(f"Cannot tokenize Candid args at {text[pos:pos + 20]!r}")
+        pos = m.end()
+        kind = m.lastgroup
+        tokens.append((kind, m.group(kind)))
+    return tokens
+
+
+def _unescape(s: str) -> str:
+    body = s[1:-1]
+    if "\\" not in body:
+        return body
+    out = bytearray()
+    i = 0
+    while i < len(body):
+        ch = body[i]
+        if ch != "\\":
+            out += ch.encode()
+            i += 1
+            continue
+        nxt = body[i + 1]
+        simple = {"n": b"\n", "t": b"\t", "r": b"\r", '"': b'"', "'": b"'", "\\": b"\\"}
+        if nxt in simple:
+            out += simple[nxt]
+            i += 2
+        elif nxt == "u":
+            end = body.index("}", i)
+            out += chr(int(body[i + 3:end], 16)).encode()
+            i = end + 1
+        else:
+            out.append(int(body[i + 1:i + 3], 16))
+            i += 3
+    return out.decode()
+
+
+class _ArgParser:
+    """Recursive-descent parser for Candid argument literals.
+
+    Produces (type, value) pairs where `type` uses the same representation
+    as the encoder: primitive opcodes, or ('opt'|'vec', t) / ('record'|'variant', [(id, t)]).
+    Unannotated numbers are typed as nat (int when negative, float64 with a '.'),
+    which is what every canister method we call expects.
+    """
+
+    def __init__(self, text: str):
+        self.tokens = _tokenize_args(text)
+        self.i = 0
+
+    def peek(self) -> Optional[Tuple[str, str]]:
+        return self.tokens[self.i] if self.i < len(self.tokens) else None
+
+    def next(self) -> Tuple[str, str]:
+        tok = self.peek()
+        if tok is None:
+            raise CandidError("Unexpected end of Candid args")
+        self.i += 1
+        return tok
+
+    def expect(self, value: str) -> None:
+        tok = self.next()
+        if tok[1] != value:
+            raise CandidError(f"Expected {value!r}, got {tok[1]!r}")
+
+    def parse_args(self) -> List[Tuple[Any, Any]]:
+        self.expect("(")
+        args = []
+        while self.peek() and self.peek()[1] != ")":
+            args.append(self.parse_value())
+            if self.peek() and self.peek()[1] == ",":
+                self.next()
+        self.expect(")")
+        return args
+
+    def parse_value(self) -> Tuple[Any, Any]:
+        kind, tok = self.next()
+        if kind == "str":
+            return T_TEXT, _unescape(tok)
+        if kind == "num":
+            return self._annotate(self._number(tok))
+        if tok == "(":
+            t, v = self.parse_value()
+            self.expect(")")
+            return t, v
+        if tok in ("true", "false"):
+            return T_BOOL, tok == "true"
+        if tok == "null":
+            return T_NULL, None
+        if tok == "principal":
+            return T_PRINCIPAL, Principal(_unescape(self.next()[1]))
+        if tok == "opt":
+            t, v = self.parse_value()
+            return ("opt", t), v
+        if tok == "vec":
+            return self._vec()
+        if tok == "record":
+            return self._record()
+        if tok == "variant":
+            return self._variant()
+        raise CandidError(f"Unexpected token {tok!r} in Candid args")
+
+    def _number(self, tok: str) -> Tuple[Any, Any]:
+        clean = tok.replace("_", "")
+        if "." in clean or "e" in clean.lower():
+            return T_FLOAT64, float(clean)
+        n = int(clean)
+        return (T_INT if n < 0 else T_NAT), n
+
+    def _annotate(self, tv: Tuple[Any, Any]) -> Tuple[Any, Any]:
+        if self.peek() and self.peek()[1] == ":":
+            self.next()
+            name = self.next()[1]
+            if name not in PRIMITIVE_BY_NAME:
+                raise CandidError(f"Unsupported annotation {name!r}")
+            t = PRIMITIVE_BY_NAME[name]
+            v = tv[1]
+            return t, (float(v) if t in (T_FLOAT32, T_FLOAT64) else v)
+        return tv
+
+    def _label(self) -> Optional[int]:
+        """Return a field id if the next tokens are `label =`, else None."""
+        tok = self.peek()
+        if tok and tok[0] in ("id", "num", "str") and self.i + 1 < len(self.tokens) \
+                and self.tokens[self.i + 1][1] == "=":
+            self.i += 2
+            if tok[0] == "num":
+                return int(tok[1].replace("_", ""))
+            return idl_hash(_unescape(tok[1]) if tok[0] == "str" else tok[1])
+        return None
+
+    def _vec(self):
+        self.expect("{")
+        items = []
+        while self.peek()[1] != "}":
+            items.append(self.parse_value())
+            if self.peek()[1] in (";", ","):
+                self.next()
+        self.expect("}")
+        elem_t = items[0][0] if items else T_EMPTY
+        return ("vec", elem_t), [v for _, v in items]
+
+    def _record(self):
+        self.expect("{")
+        fields = []
+        pos = 0
+        while self.peek()[1] != "}":
+            fid = self._label()
+            if fid is None:
+                fid = pos
+                pos += 1
+            t, v = self.parse_value()
+            fields.append((fid, t, v))
+            if self.peek()[1] in (";", ","):
+                self.next()
+        self.expect("}")
+        fields.sort(key=lambda f: f[0])
+        return ("record", [(fid, t) for fid, t, _ in fields]), [v for _, _, v in fields]
+
+    def _variant(self):
+        self.expect("{")
+        fid = self._label()
+        if fid is None:
+            kind, tok = self.next()
+            fid = idl_hash(tok)
+            t, v = T_NULL, None
+        else:
+            t, v = self.parse_value()
+        if self.peek()[1] == ";":
+            self.next()
+        self.expect("}")
+        return ("variant", [(fid, t)]), (0, v)
+
+
+class _TypeTable:
+    """Builds the DIDL type table, deduplicating identical compound types."""
+
+    def __init__(self):
+        self.entries: List[bytes] = []
+        self.index: Dict[Any, int] = {}
+
+    def ref(self, t: Any) -> int:
+        if isinstance(t, int):
+            return t
+        key = _freeze(t)
+        if key in self.index:
+            return self.index[key]
+        kind, spec = t
+        if kind in ("opt", "vec"):
+            inner = self.ref(spec)
+            entry = _sleb(T_OPT if kind == "opt" else T_VEC) + _sleb(inner)
+        else:
+            refs = [(fid, self.ref(ft)) for fid, ft in spec]
+            entry = _sleb(T_RECORD if kind == "record" else T_VARIANT) + _uleb(len(refs))
+            for fid, r in refs:
+                entry += _uleb(fid) + _sleb(r)
+        self.index[key] = len(self.entries)
+        self.entries.append(entry)
+        return self.index[key]
+
+
+def _freeze(t: Any) -> Any:
+    if isinstance(t, int):
+        return t
+    kind, spec = t
+    if kind in ("opt", "vec"):
+        return (kind, _freeze(spec))
+    return (kind, tuple((fid, _freeze(ft)) for fid, ft in spec))
+
+
+def _encode_value(t: Any, v: Any) -> bytes:
+    if isinstance(t, int):
+        if t == T_NAT:
+            return _uleb(v)
+        if t == T_INT:
+            return _sleb(v)
+        if t in FIXED_INTS:
+            return struct.pack(FIXED_INTS[t][0], v)
+        if t == T_TEXT:
+            raw = v.encode()
+            return _uleb(len(raw)) + raw
+        if t == T_BOOL:
+            return b"\x01" if v else b"\x00"
+        if t == T_FLOAT64:
+            return struct.pack("<d", v)
+        if t == T_FLOAT32:
+            return struct.pack("<f", v)
+        if t == T_PRINCIPAL:
+            raw = Principal(v).to_bytes()
+            return b"\x01" + _uleb(len(raw)) + raw
+        return b""
+    kind, spec = t
+    if kind == "opt":
+        return b"\x00" if v is None else b"\x01" + _encode_value(spec, v)
+    if kind == "vec":
+        return _uleb(len(v)) + b"".join(_encode_value(spec, x) for x in v)
+    if kind == "record":
+        return b"".join(_encode_value(ft, x) for (_, ft), x in zip(spec, v))
+    idx, x = v
+    return _uleb(idx) + _encode_value(spec[idx][1], x)
+
+
+def encode_args(text: str) -> bytes:
+    """Encode a Candid text argument tuple, e.g. '("IC.ICP", 100, "IC.TACO")'."""
+    args = _ArgParser(text).parse_args()
+    table = _TypeTable()
+    refs = [table.ref(t) for t, _ in args]
+    out = b"DIDL" + _uleb(len(table.entries)) + b"".join(table.entries)
+    out += _uleb(len(refs)) + b"".join(_sleb(r) for r in refs)
+    out += b"".join(_encode_value(t, v) for t, v in args)
+    return out
+
+
+def decode_to_text(data: bytes) -> str:
+    """Decode a binary reply and render it as dfx-style Candid text."""
+    return render(*decode(data))
+
+
+# ============================================
+# Candid text -> Python values
+# ============================================
+
+# One token per match: a quoted string, a punctuation char, or a bare word
+# (keyword, label, number with `_` separators, `.method` after a func reference)
+_TEXT_TOKEN = re.compile(r'[(){};,=:]|[^\s(){};,=:"]+|"[^"\\]*(?:\\.[^"\\]*)*"|"')
+_NUMBER_START = frozenset("0123456789+-")
+_EOF = ""  # Sentinel appended after the last token
+
+
+def _text_tokens(text: str) -> List[str]:
+    tokens = _TEXT_TOKEN.findall(text)
+    tokens.append(_EOF)
+    tokens.append(_EOF)  # Room for the one-token lookahead after a final value
+    return tokens
+
+
+def _unescape_blob(s: str) -> bytes:
+    body = s[1:-1]
+    out = bytearray()
+    i = 0
+    while i < len(body):
+        ch = body[i]
+        if ch == "\\":
+            nxt = body[i + 1]
+            if nxt in "0123456789abcdefABCDEF" and i + 2 < len(body):
+                out.append(int(body[i + 1:i + 3], 16))
+                i += 3
+                continue
+            out += _unescape('"\\' + nxt + '"').encode()
+            i += 2
+            continue
+        out += ch.encode()
+        i += 1
+    return bytes(out)
+
+
+def _text_label(tok: str) -> str:
+    if tok[0] == '"':
+        return _unescape(tok)
+    if tok[0] in _NUMBER_START:
+        fid = int(tok.replace("_", ""))
+        return field_name(fid) or f"_{fid}_"
+    return tok
+
+
+def _text_number(tok: str) -> Any:
+    clean = tok.replace("_", "")
+    try:
+        return int(clean)
+    except ValueError:
+        pass
+    try:
+        return float(clean)
+    except ValueError:
+        raise CandidError(f"Bad number {tok!r} in Candid text") from None
+
+
+def _text_value(toks: List[str], i: int) -> Tuple[Any, int]:
+    """Parse one value starting at toks[i]; returns (value, index after it).
+
+    A single recursive-descent pass over the token list. Written as a plain
+    function over (tokens, index) rather than a parser object because it runs
+    once per token of multi-megabyte replies (e.g. ICPSwap getPools).
+    """
+    tok = toks[i]
+    i += 1
+    if not tok:
+        raise CandidError("Unexpected end of Candid text")
+    first = tok[0]
+    if first == '"':
+        if len(tok) == 1:
+            raise CandidError("Unterminated string in Candid text")
+        return _unescape(tok), i
+    if first in _NUMBER_START or tok in ("inf", "nan"):
+        v = _text_number(tok)
+        if toks[i] == ":":
+            if toks[i + 1] in ("float32", "float64"):
+                v = float(v)
+            i += 2
+        return v, i
+    if tok == "record":
+        if toks[i] != "{":
+            raise CandidError(f"Expected '{{' after record, got {toks[i]!r}")
+        i += 1
+        fields = {}
+        positional = []
+        while True:
+            tok = toks[i]
+            if tok == "}":
+                i += 1
+                break
+            if toks[i + 1] == "=":
+                v, i = _text_value(toks, i + 2)
+                fields[_text_label(tok)] = v
+            else:
+                v, i = _text_value(toks, i)
+                positional.append(v)
+            tok = toks[i]
+            if tok == ";" or tok == ",":
+                i += 1
+        if positional and not fields:
+            return tuple(positional), i
+        for n, v in enumerate(positional):
+            fields[f"_{n}_"] = v
+        return fields, i
+    if tok == "vec":
+        if toks[i] != "{":
+            raise CandidError(f"Expected '{{' after vec, got {toks[i]!r}")
+        i += 1
+        items = []
+        while toks[i] != "}":
+            v, i = _text_value(toks, i)
+            items.append(v)
+            tok = toks[i]
+            if tok == ";" or tok == ",":
+                i += 1
+        return items, i + 1
+    if tok == "variant":
+        if toks[i] != "{":
+            raise CandidError(f"Expected '{{' after variant, got {toks[i]!r}")
+        label = _text_label(toks[i + 1])
+        if toks[i + 2] == "=":
+            v, i = _text_value(toks, i + 3)
+        else:
+            v, i = None, i + 2
+        if toks[i] == ";":
+            i += 1
+        if toks[i] != "}":
+            raise CandidError(f"Expected '}}' closing variant, got {toks[i]!r}")
+        return {label: v}, i + 1
+    if tok == "opt":
+        return _text_value(toks, i)
+    if tok == "null":
+        return None, i
+    if tok == "true" or tok == "false":
+        return tok == "true", i
+    if tok == "principal" or tok == "service":
+        return Principal(_unescape(toks[i])), i + 1
+    if tok == "blob":
+        return _unescape_blob(toks[i]), i + 1
+    if tok == "func":
+        method = toks[i + 1]
+        if not method.startswith("."):
+            raise CandidError(f"Expected .method after func reference, got {method!r}")
+        return (Principal(_unescape(toks[i])), method[1:]), i + 2
+    if tok == "(":
+        v, i = _text_value(toks, i)
+        if toks[i] != ")":
+            raise CandidError(f"Expected ')', got {toks[i]!r}")
+        return v, i + 1
+    raise CandidError(f"Unexpected token {tok!r} in Candid text")
+
+
+def parse_text(text: str) -> List[Any]:
+    """Parse dfx-style Candid text, e.g. `(variant { Ok = record { x = 1_000 : nat } })`,
+    into a list of Python values (same mapping as decode())."""
+    toks = _text_tokens(text)
+    if len(toks) == 2:
+        return []
+    if toks[0] != "(":
+        value, i = _text_value(toks, 0)
+        values = [value]
+    else:
+        values = []
+        i = 1
+        while toks[i] != ")":
+            value, i = _text_value(toks, i)
+            values.append(value)
+            if toks[i] == ",":
+                i += 1
+        i += 1
+    if toks[i]:
+        raise CandidError(f"Trailing Candid text at {toks[i]!r}")
+    return values
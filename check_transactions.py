@@ -1,52 +1,91 @@
 #!/usr/bin/env python3
-"""Count transactions in the last 30 days for an ICRC-3 ledger canister."""
+"""Count transactions in the last 30 days for an ICRC-3 ledger canister.
 
-import subprocess
-import re
+The 30-day boundary block is found by interpolation search from the recent block
+rate (--bisect: plain binary search over the whole log, for comparison).
+"""
+
+import math
 import sys
+import time
 from datetime import datetime, timedelta
 
+import candid_codec
+import ic_agent
+
 CANISTER_ID = "um5iw-rqaaa-aaaaq-qaaba-cai"
 NETWORK = "ic"
+SCAN_BLOCKS = 100  # A bracket this narrow is fetched with one icrc3_get_blocks range instead of probed
+ITP_SLACK = 1      # Probes interpolation_search may spend inside a bracket beyond what bisection would
+ITP_K1 = 0.05      # Truncation towards the midpoint, relative to the first bracket (kappa1 * width)
+
+# Native HTTP query calls with dfx fallback; main() applies --transport / --ic-url / --record / --replay
+transport = ic_agent.make_transport("auto", NETWORK, identity=None)
+call_count = 0  # Canister round trips so far (the searches report their share)
 
 
 def dfx_call(canister_id, method, args, timeout=30):
-    """Call a canister method via dfx and return stdout."""
-    cmd = (
-        f"dfx canister call {canister_id} {method} "
-        f"'{args}' --network {NETWORK}"
-    )
-    result = subprocess.run(
-        cmd, shell=True, capture_output=True, text=True, timeout=timeout
-    )
-    if result.returncode != 0:
-        print(f"  dfx error: {result.stderr.strip()}", file=sys.stderr)
-    return result.stdout
+    """Call a canister method via the active transport and return the first reply value.
+
+    Returns None if the call failed or the reply is not valid Candid.
+    """
+    global call_count
+    call_count += 1
+    result = transport.call(canister_id, method, args, timeout)
+    if not result.ok:
+        print(f"  {transport.name} error: {result.error}", file=sys.stderr)
+        return None
+    try:
+        reply = result.reply()
+    except candid_codec.CandidError as e:
+        print(f"  Could not parse {method} reply: {e}", file=sys.stderr)
+        return None
+    return reply[0] if reply else None
+
+
+def _block_ts(block):
+    """Timestamp of an ICRC-3 block value (variant { Map = vec { record { "ts"; variant { Nat } } } })."""
+    entries = block.get("Map", []) if isinstance(block, dict) else []
+    for key, value in entries:
+        if key == "ts" and "Nat" in value:
+            return value["Nat"]
+    for _, value in entries:  # Some ledgers only carry ts inside the tx map
+        ts = _block_ts(value)
+        if ts is not None:
+            return ts
+    return None
+
+
+def _first_block_ts(res):
+    """Timestamp of the first block in an icrc3_get_blocks result, or None."""
+    for entry in (res or {}).get("blocks", []):
+        ts = _block_ts(entry.get("block"))
+        if ts is not None:
+            return ts
+    return None
 
 
 def get_log_length_and_latest_ts():
     """Get total blocks and latest block timestamp."""
     # Get log_length
-    out = dfx_call(CANISTER_ID, "icrc3_get_blocks",
+    res = dfx_call(CANISTER_ID, "icrc3_get_blocks",
                    '(vec { record { start = 0 : nat; length = 0 : nat } })')
-    m = re.search(r'log_length\s*=\s*([\d_]+)', out)
-    if not m:
-        raise ValueError(f"Could not parse log_length: {out}")
-    log_length = int(m.group(1).replace('_', ''))
-    return log_length
+    if not res or "log_length" not in res:
+        raise ValueError(f"Could not parse log_length: {res}")
+    return res["log_length"]
 
 
 def get_block_timestamp(block_id):
     """Get timestamp (nanoseconds) of a block. Returns None if archived."""
-    out = dfx_call(CANISTER_ID, "icrc3_get_blocks",
+    res = dfx_call(CANISTER_ID, "icrc3_get_blocks",
                    f'(vec {{ record {{ start = {block_id} : nat; length = 1 : nat }} }})')
     # Check if block was returned directly
-    ts_match = re.search(r'"ts";\s*variant\s*\{\s*Nat\s*=\s*([\d_]+)', out)
-    if ts_match:
-        return int(ts_match.group(1).replace('_', ''))
+    ts = _first_block_ts(res)
+    if ts is not None:
+        return ts
 
     # Check if it's in archived_blocks (has a callback reference)
-    if 'callback' in out and 'archived_blocks' in out:
+    if res and res.get("archived_blocks"):
         return "ARCHIVED"
 
     return None
@@ -54,29 +93,17 @@ def get_block_timestamp(block_id):
 
 def get_archives():
     """Get archive canister ranges."""
-    out = dfx_call(CANISTER_ID, "icrc3_get_archives", '(record {})')
-    # Parse archive entries: record { end = N; canister_id = principal "xxx"; start = M }
-    archives = []
-    for m in re.finditer(
-        r'record\s*\{\s*end\s*=\s*([\d_]+)\s*:\s*nat;\s*canister_id\s*=\s*principal\s*"([^"]+)";\s*start\s*=\s*([\d_]+)',
-        out
-    ):
-        archives.append({
-            'end': int(m.group(1).replace('_', '')),
-            'canister_id': m.group(2),
-            'start': int(m.group(3).replace('_', '')),
-        })
-    return archives
+    res = dfx_call(CANISTER_ID, "icrc3_get_archives", '(record {})')
+    # Archive entries: record { end = N; canister_id = principal "xxx"; start = M }
+    return [{'end': arc['end'], 'canister_id': str(arc['canister_id']), 'start': arc['start']}
+            for arc in (res or [])]
 
 
 def get_block_timestamp_from_archive(archive_canister_id, block_id):
     """Get timestamp from an archive canister."""
-    out = dfx_call(archive_canister_id, "icrc3_get_blocks",
+    res = dfx_call(archive_canister_id, "icrc3_get_blocks",
                    f'(vec {{ record {{ start = {block_id} : nat; length = 1 : nat }} }})')
-    ts_match = re.search(r'"ts";\s*variant\s*\{\s*Nat\s*=\s*([\d_]+)', out)
-    if ts_match:
-        return int(ts_match.group(1).replace('_', ''))
-    return None
+    return _first_block_ts(res)
 
 
 def get_timestamp(block_id, archives):
@@ -93,29 +120,50 @@ def get_timestamp(block_id, archives):
     return ts
 
 
-def binary_search(target_ts_ns, log_length, archives):
-    """Find first block with timestamp >= target_ts_ns."""
-    lo, hi = 0, log_length - 1
-    result = log_length
+def get_timestamps(start, length, archives):
+    """Timestamps of blocks [start, start + length) by block id, from the ledger and its archives.
+
+    A canister may return fewer blocks than asked for; the missing ids are simply absent.
+    """
+    res = dfx_call(CANISTER_ID, "icrc3_get_blocks",
+                   f'(vec {{ record {{ start = {start} : nat; length = {length} : nat }} }})')
+    results = [res]
+    if res and res.get("archived_blocks"):
+        for arc in archives:
+            first, last = max(start, arc['start']), min(start + length - 1, arc['end'])
+            if first <= last:
+                results.append(dfx_call(arc['canister_id'], "icrc3_get_blocks",
+                                        f'(vec {{ record {{ start = {first} : nat; length = {last - first + 1} : nat }} }})'))
+    timestamps = {}
+    for result in results:
+        for entry in (result or {}).get("blocks", []):
+            ts = _block_ts(entry.get("block"))
+            if ts is not None:
+                timestamps[entry["id"]] = ts
+    return timestamps
+
+
+def probe_timestamp(block_id, archives):
+    """(block, timestamp) of block_id, or of a nearby block if it has none; (block_id, None) if none do."""
+    for offset in [0, 1, -1, 2, -2, 5, -5, 10, -10]:
+        ts = get_timestamp(block_id + offset, archives)
+        if ts is not None:
+            return block_id + offset, ts
+    return block_id, None
+
+
+def binary_search(target_ts_ns, log_length, archives, lo=0, hi=None):
+    """Find first block with timestamp >= target_ts_ns (in [lo, hi], else hi + 1)."""
+    hi = log_length - 1 if hi is None else hi
+    result = hi + 1
 
     iterations = 0
     while lo <= hi:
         iterations += 1
-        mid = (lo + hi) // 2
-        ts = get_timestamp(mid, archives)
-
+        mid, ts = probe_timestamp((lo + hi) // 2, archives)
         if ts is None:
-            # Try a few nearby blocks
-            found = False
-            for offset in [1, -1, 2, -2, 5, -5, 10, -10]:
-                ts = get_timestamp(mid + offset, archives)
-                if ts is not None:
-                    mid = mid + offset
-                    found = True
-                    break
-            if not found:
-                lo = mid + 100
-                continue
+            lo = mid + 100
+            continue
 
         mid_dt = datetime.utcfromtimestamp(ts / 1e9)
         print(f"  iteration {iterations}: block {mid:,} -> {mid_dt.strftime('%Y-%m-%d %H:%M:%S')} UTC")
@@ -129,9 +177,106 @@ def binary_search(target_ts_ns, log_length, archives):
     return result
 
 
+def interpolation_search(target_ts_ns, log_length, archives, known, guess=None):
+    """Find first block with timestamp >= target_ts_ns, probing where the block rate says it is.
+
+    known: {block: timestamp} already fetched (at least the latest block); guess: the
+    first block to probe. Until the target is bracketed, each probe extrapolates from
+    the two known blocks nearest the target, overshooting by a growing margin so it
+    lands on the far side. Inside the bracket, ITP steps (interpolate, truncate,
+    project: Oliveira & Takahashi, 2020) interpolate between the ends, with the
+    Illinois halving for an end that stays put, while the rate looks uniform, and are
+    pulled towards bisection when it doesn't, so they never take more than ITP_SLACK
+    probes beyond bisection of the first bracket. A bracket of SCAN_BLOCKS or fewer is
+    fetched in one call.
+    """
+    points = {b: ts for b, ts in known.items() if ts is not None}
+    lo, hi = -1, log_length  # Last block before the target, first block at or after it
+    for block, ts in points.items():
+        if ts < target_ts_ns:
+            lo = max(lo, block)
+        else:
+            hi = min(hi, block)
+    eps = SCAN_BLOCKS / 2
+    itp = None  # (k1, step budget) once both ends are known
+    step = 0
+    overshoot = 0.25
+    weight = {"lo": 1.0, "hi": 1.0}  # Illinois: an end kept for two steps running counts half
+    moved = None
+
+    probes = 0
+    while hi - lo > 1:
+        if hi - lo - 1 <= SCAN_BLOCKS:
+            probes += 1
+            fetched = get_timestamps(lo + 1, hi - lo - 1, archives)
+            print(f"  probe {probes}: blocks {lo + 1:,}-{hi - 1:,} ({len(fetched)} returned)")
+            before = (lo, hi)
+            for block, ts in fetched.items():
+                if ts < target_ts_ns:
+                    lo = max(lo, block)
+                else:
+                    hi = min(hi, block)
+            if (lo, hi) == before:
+                return binary_search(target_ts_ns, log_length, archives, lo + 1, hi - 1)
+            continue
+
+        if guess is not None:
+            mid, guess = guess, None
+        elif lo in points and hi in points:
+            if itp is None:
+                itp = (ITP_K1 / (hi - lo), math.ceil(math.log2((hi - lo) / (2 * eps))) + ITP_SLACK)
+            k1, budget = itp
+            below = (target_ts_ns - points[lo]) * weight["lo"]
+            above = (points[hi] - target_ts_ns) * weight["hi"]
+            half = (lo + hi) / 2
+            falsi = lo + (hi - lo) * below / (below + above)
+            sigma = 1 if half >= falsi else -1
+            delta = max(k1 * (hi - lo) ** 2, eps / 2)
+            truncated = falsi + sigma * delta if delta <= abs(half - falsi) else half
+            radius = eps * 2 ** max(budget - step, 0) - (hi - lo) / 2
+            mid = round(truncated if abs(truncated - half) <= radius else half - sigma * radius)
+            step += 1
+        else:
+            # Only one side known: extrapolate, overshooting more each time it falls short
+            nearest = sorted(points, key=lambda b: abs(points[b] - target_ts_ns))[:2]
+            (b1, t1), (b2, t2) = sorted((b, points[b]) for b in nearest) if len(nearest) == 2 else ((0, 0), (0, 0))
+            estimate = b1 + (target_ts_ns - t1) * (b2 - b1) / (t2 - t1) if t2 > t1 else (lo + hi) / 2
+            near = lo if lo in points else hi
+            mid = round(estimate + (estimate - near) * overshoot)
+            overshoot *= 2
+        mid = min(max(mid, lo + 1), hi - 1)
+
+        probes += 1
+        mid, ts = probe_timestamp(mid, archives)
+        if ts is None or not lo < mid < hi:
+            return binary_search(target_ts_ns, log_length, archives, lo + 1, hi - 1)
+        points[mid] = ts
+        mid_dt = datetime.utcfromtimestamp(ts / 1e9)
+        print(f"  probe {probes}: block {mid:,} -> {mid_dt.strftime('%Y-%m-%d %H:%M:%S')} UTC")
+        side = "hi" if ts >= target_ts_ns else "lo"
+        if side == "hi":
+            hi = mid
+        else:
+            lo = mid
+        weight[side] = 1.0
+        if side == moved:
+            weight["lo" if side == "hi" else "hi"] /= 2
+        moved = side
+
+    return hi
+
+
 def main():
+    global transport
+
+    args = sys.argv[1:]
+    transport_opts = ic_agent.pop_transport_flags(args)
+    use_bisection = "--bisect" in args  # Plain binary search over the whole log, for comparison
+    transport = ic_agent.make_transport(network=NETWORK, identity=None, **transport_opts)
+
     print(f"Canister: {CANISTER_ID}")
     print(f"Network:  {NETWORK}")
+    print(f"Transport: {transport.name}")
     print()
 
     # Step 1: Get total blocks
@@ -159,16 +304,25 @@ def main():
 
     # Step 4: Calculate target timestamp (30 days ago)
     now = datetime.utcnow()
+    if transport_opts["replay"]:
+        # Measure relative to when the replayed snapshot was recorded
+        recorded_at = ic_agent.read_recording_meta(transport_opts["replay"]).get("recorded_at")
+        if recorded_at:
+            now = datetime.utcfromtimestamp(recorded_at)
     one_month_ago = now - timedelta(days=30)
     target_ts_ns = int(one_month_ago.timestamp() * 1e9)
     print(f"\nStep 4: Target date: {one_month_ago.strftime('%Y-%m-%d %H:%M:%S')} UTC (30 days ago)")
 
-    # Step 5: Estimate starting point for binary search
+    # Step 5: Estimate where the boundary is from the recent block rate
+    known = {}
+    estimated_start = None
     if latest_ts and latest_ts != "ARCHIVED":
+        known[log_length - 1] = latest_ts
         # Try to estimate block rate using a block from ~1 day ago
         recent_block = max(0, log_length - 10000)
         recent_ts = get_timestamp(recent_block, archives)
         if recent_ts:
+            known[recent_block] = recent_ts
             time_diff = latest_ts - recent_ts  # nanoseconds
             block_diff = (log_length - 1) - recent_block
             if time_diff > 0:
@@ -179,14 +333,21 @@ def main():
                 print(f"  Estimated block rate: ~{block_diff / (time_diff / 1e9 / 86400):.0f} blocks/day")
                 print(f"  Estimated boundary: ~block {estimated_start:,}")
 
-    # Step 6: Binary search
-    print(f"\nStep 5: Binary searching for 30-day boundary...")
-    boundary = binary_search(target_ts_ns, log_length, archives)
+    # Step 6: Search from the estimate (bisection of the whole log without one, or with --bisect)
+    calls_before, started = call_count, time.perf_counter()
+    if use_bisection or not known:
+        print("\nStep 5: Binary searching for 30-day boundary...")
+        boundary = binary_search(target_ts_ns, log_length, archives)
+    else:
+        print("\nStep 5: Interpolation search for 30-day boundary from the estimate...")
+        boundary = interpolation_search(target_ts_ns, log_length, archives, known, estimated_start)
+    print(f"  {call_count - calls_before} canister calls in {time.perf_counter() - started:.2f}s "
+          f"(bisection: ~{math.ceil(math.log2(max(log_length, 2)))} probes)")
 
     # Step 7: Results
     transactions_last_month = log_length - boundary
     print(f"\n{'='*60}")
-    print(f"RESULTS")
+    print("RESULTS")
     print(f"{'='*60}")
     print(f"  Total blocks in ledger:          {log_length:,}")
     print(f"  Boundary block (30 days ago):     {boundary:,}")
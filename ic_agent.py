@@ -0,0 +1,1402 @@
+#!/usr/bin/env python3
+"""
+Pluggable canister-call transports for the Python test harnesses.
+
+Backends:
+- HttpTransport: anonymous query calls sent straight to a replica / boundary
+  node over pooled keep-alive HTTP connections. Requests are CBOR envelopes,
+  replies are decoded in-process with candid_codec. No dfx, no subprocess.
+- DfxTransport: the original `dfx canister call` subprocess path.
+- FallbackTransport: tries the first backend and falls back to the second
+  when the first is unreachable (connection refused, protocol errors).
+- SingleFlightTransport: wraps any backend so identical concurrent calls
+  share one outstanding request.
+- RecordingTransport / ReplayTransport: capture every reply of a run into a
+  directory (--record DIR) and serve them back later with no network I/O
+  (--replay DIR), so a run can be repeated against the same market snapshot.
+- AdaptiveLimitTransport: per-canister in-flight limit (AIMD with a latency
+  gradient) and token-bucket rate, so each target settles at the highest
+  rate it serves without timeouts (--fixed-concurrency turns it off).
+- TailLatencyTransport: per-method latency percentiles, a timeout that
+  follows p99 instead of a fixed worst case (--fixed-timeouts turns it off),
+  and optional hedging (--hedge): a call still pending at its method's p95
+  gets a duplicate, the first answer wins and the loser is dropped.
+
+Every backend offers call() (blocking) and acall() (asyncio) and returns a
+CallResult whose `output` is dfx-style Candid text and whose reply() gives
+the typed values (decoded from binary, or parsed once from text), so callers
+read replies the same way whichever backend produced them.
+
+NOTE: Query replies are not certificate-verified. These are anonymous,
+read-only quote calls used for testing; don't reuse this for anything that
+moves funds.
+
+Offline benchmarking:
+    python ic_agent.py stub --port 8080 --reply '(variant { Ok = 42 : nat })'
+    python ic_agent.py bench --url http://127.0.0.1:8080 -n 500 --threads 8
+    python ic_agent.py parse-bench [--file getpools.txt]
+"""
+
+import asyncio
+import atexit
+import glob
+import gzip
+import http.client
+import json
+import os
+import queue
+import random
+import re
+import shlex
+import socket
+import ssl
+import struct
+import subprocess
+import sys
+import threading
+import time
+from collections import deque
+from concurrent import futures
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from urllib.parse import urlparse
+
+import candid_codec
+
+# ============================================
+# Configuration
+# ============================================
+
+# Where HttpTransport sends calls for each dfx network name
+NETWORK_URLS = {
+    "ic": "https://icp-api.io",
+    "local": "http://127.0.0.1:4943",
+}
+
+INGRESS_EXPIRY_NS = 3 * 60 * 1_000_000_000  # Must be within the replica's 5 minute window
+HTTP_POOL_SIZE = 64  # Max idle keep-alive connections kept per transport
+
+# Files inside a --record / --replay directory
+RECORDING_FILE = "responses.jsonl.gz"  # Append-only, one JSON line per reply
+RECORDING_PART_FILE = "responses.{}.jsonl.gz"  # Same, one per extra process recording alongside (--shards workers)
+RECORDING_META_FILE = "meta.json"      # recorded_at + anything the harness needs to replay (seeds)
+RECORDING_FLUSH_EVERY = 100            # Replies buffered before a gzip sync flush
+
+# AdaptiveLimitTransport: per-canister concurrency (AIMD) and request rate (token bucket)
+LIMIT_INITIAL = 8          # In-flight calls allowed per canister at start
+LIMIT_MIN, LIMIT_MAX = 1, 64
+RATE_INITIAL = 50.0        # Calls/second per canister at start
+RATE_MIN, RATE_MAX = 1.0, 1000.0
+RATE_STEP = 1.0            # Calls/second added per successful call while the rate is the bottleneck
+RATE_BURST_SECONDS = 0.5   # Token bucket depth, in seconds of the current rate
+LATENCY_TOLERANCE = 2.0    # Shrink the limit when smoothed latency exceeds this multiple of the best seen
+
+# TailLatencyTransport: per-method timeouts from observed latency, and hedged calls
+LATENCY_WINDOW = 512       # Recent latencies kept per method
+LATENCY_MIN_SAMPLES = 30   # Below this the caller's timeout is used as is, and nothing is hedged
+TIMEOUT_MULTIPLIER = 3.0   # Timeout = p99 x this, ...
+TIMEOUT_FLOOR = 2.0        # ... but never below this many seconds (nor above the caller's timeout)
+HEDGE_PERCENTILE = 0.95    # A call still pending at this latency percentile gets a duplicate
+HEDGE_MAX_FRACTION = 0.05  # At most this share of calls is hedged, so a slow target isn't sent twice the load
+HEDGE_THREADS = 128        # Worker threads running hedged blocking calls
+
+
+class TransportUnavailable(Exception):
+    """The backend could not be reached at all (as opposed to a canister reject)."""
+
+
+@dataclass
+class CallResult:
+    ok: bool
+    output: str = ""  # dfx-style Candid text of the reply
+    error: str = ""   # stderr / reject message when not ok
+    values: Optional[List[Any]] = None  # Typed reply values, when the backend decoded them
+
+    def reply(self) -> List[Any]:
+        """The reply as Python values (see candid_codec), parsing `output` once if needed.
+
+        Raises candid_codec.CandidError if the output is not valid Candid text.
+        """
+        if self.values is None:
+            self.values = candid_codec.parse_text(self.output) if self.ok else []
+        return self.values
+
+
+class _DecodedCallResult(CallResult):
+    """Successful binary reply: typed values up front, dfx-style text rendered on first use.
+
+    Rendering a large reply (e.g. getPools) costs more than decoding it, and
+    callers that use reply() never need the text.
+    """
+
+    def __init__(self, table: List[tuple], arg_types: List[int], values: List[Any]):
+        self.ok = True
+        self.error = ""
+        self.values = values
+        self._types = (table, arg_types)
+        self._output: Optional[str] = None
+
+    @property
+    def output(self) -> str:
+        if self._output is None:
+            self._output = candid_codec.render(*self._types, self.values)
+        return self._output
+
+    @output.setter
+    def output(self, text: str) -> None:
+        self._output = text
+
+
+# ============================================
+# CBOR (just enough for the HTTP interface spec)
+# ============================================
+
+def _cbor_head(major: int, n: int) -> bytes:
+    if n < 24:
+        return bytes([(major << 5) | n])
+    if n < 0x100:
+        return bytes([(major << 5) | 24, n])
+    if n < 0x10000:
+        return bytes([(major << 5) | 25]) + struct.pack(">H", n)
+    if n < 0x100000000:
+        return bytes([(major << 5) | 26]) + struct.pack(">I", n)
+    return bytes([(major << 5) | 27]) + struct.pack(">Q", n)
+
+
+def cbor_encode(obj: Any) -> bytes:
+    if isinstance(obj, bool):
+        return b"\xf5" if obj else b"\xf4"
+    if isinstance(obj, int):
+        return _cbor_head(0, obj) if obj >= 0 else _cbor_head(1, -1 - obj)
+    if isinstance(obj, bytes):
+        return _cbor_head(2, len(obj)) + obj
+    if isinstance(obj, str):
+        raw = obj.encode()
+        return _cbor_head(3, len(raw)) + raw
+    if isinstance(obj, (list, tuple)):
+        return _cbor_head(4, len(obj)) + b"".join(cbor_encode(x) for x in obj)
+    if isinstance(obj, dict):
+        out = _cbor_head(5, len(obj))
+        for k, v in obj.items():
+            out += cbor_encode(k) + cbor_encode(v)
+        return out
+    if obj is None:
+        return b"\xf6"
+    raise TypeError(f"Cannot CBOR-encode {type(obj).__name__}")
+
+
+def cbor_decode(data: bytes) -> Any:
+    value, _ = _cbor_item(data, 0)
+    return value
+
+
+def _cbor_item(data: bytes, pos: int):
+    ib = data[pos]
+    major, info = ib >> 5, ib & 0x1F
+    pos += 1
+    if major == 7:
+        if info == 20:
+            return False, pos
+        if info == 21:
+            return True, pos
+        if info in (22, 23):
+            return None, pos
+        if info == 25:
+            return struct.unpack(">e", data[pos:pos + 2])[0], pos + 2
+        if info == 26:
+            return struct.unpack(">f", data[pos:pos + 4])[0], pos + 4
+        if info == 27:
+            return struct.unpack(">d", data[pos:pos + 8])[0], pos + 8
+        raise ValueError(f"Unsupported CBOR simple value {info}")
+
+    if info < 24:
+        n = info
+    elif info == 24:
+        n, pos = data[pos], pos + 1
+    elif info == 25:
+        n, pos = struct.unpack(">H", data[pos:pos + 2])[0], pos + 2
+    elif info == 26:
+        n, pos = struct.unpack(">I", data[pos:pos + 4])[0], pos + 4
+    elif info == 27:
+        n, pos = struct.unpack(">Q", data[pos:pos + 8])[0], pos + 8
+    else:
+        raise ValueError("Indefinite-length CBOR is not supported")
+
+    if major == 0:
+        return n, pos
+    if major == 1:
+        return -1 - n, pos
+    if major == 2:
+        return data[pos:pos + n], pos + n
+    if major == 3:
+        return data[pos:pos + n].decode(), pos + n
+    if major == 4:
+        items = []
+        for _ in range(n):
+            item, pos = _cbor_item(data, pos)
+            items.append(item)
+        return items, pos
+    if major == 5:
+        out = {}
+        for _ in range(n):
+            k, pos = _cbor_item(data, pos)
+            v, pos = _cbor_item(data, pos)
+            out[k] = v
+        return out, pos
+    # major 6: tag - the value is all we need (e.g. self-describe 55799)
+    return _cbor_item(data, pos)
+
+
+SELF_DESCRIBE_TAG = b"\xd9\xd9\xf7"
+
+
+# ============================================
+# Backends
+# ============================================
+
+class DfxTransport:
+    """Original path: one `dfx canister call` subprocess per call."""
+
+    name = "dfx"
+
+    def __init__(self, network: str = "ic", identity: Optional[str] = "anonymous"):
+        self.network = network
+        self.identity = identity
+
+    def _command(self, canister_id: str, method: str, args: str) -> str:
+        cmd = f"dfx canister call {canister_id} {method} {shlex.quote(args)} --network {self.network}"
+        if self.identity:
+            cmd += f" --identity {self.identity}"
+        return cmd
+
+    def call(self, canister_id: str, method: str, args: str = "()", timeout: float = 30) -> CallResult:
+        cmd = self._command(canister_id, method, args)
+        try:
+            result = subprocess.run(cmd, shell=True, capture_output=True, text=True, timeout=timeout)
+        except subprocess.TimeoutExpired:
+            raise TimeoutError(f"dfx call {method} timed out after {timeout}s")
+        return CallResult(result.returncode == 0, result.stdout, result.stderr.strip())
+
+    async def acall(self, canister_id: str, method: str, args: str = "()", timeout: float = 30) -> CallResult:
+        proc = await asyncio.create_subprocess_shell(
+            self._command(canister_id, method, args),
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        try:
+            stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+            raise TimeoutError(f"dfx call {method} timed out after {timeout}s")
+        except asyncio.CancelledError:
+            proc.kill()
+            raise
+        return CallResult(proc.returncode == 0, stdout.decode(), stderr.decode().strip())
+
+
+class HttpTransport:
+    """Anonymous query calls over pooled keep-alive HTTP(S) connections."""
+
+    name = "http"
+
+    def __init__(self, url: str, pool_size: int = HTTP_POOL_SIZE):
+        parsed = urlparse(url)
+        self.url = url
+        self.https = parsed.scheme == "https"
+        self.host = parsed.hostname
+        self.port = parsed.port or (443 if self.https else 80)
+        self.pool_size = pool_size
+        self._pool: "queue.LifoQueue[http.client.HTTPConnection]" = queue.LifoQueue(maxsize=pool_size)
+        # Idle (reader, writer) stream pairs for acall(); bound to the loop that opened them
+        self._apool: list = []
+        self._apool_loop = None
+
+    def _connect(self, timeout: float) -> http.client.HTTPConnection:
+        cls = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+        conn = cls(self.host, self.port, timeout=timeout)
+        conn.connect()
+        # Small request/reply pairs: don't let Nagle + delayed ACK add ~40ms per call
+        conn.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return conn
+
+    def _release(self, conn: http.client.HTTPConnection) -> None:
+        try:
+            self._pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def _post(self, path: str, body: bytes, timeout: float) -> bytes:
+        headers = {"Content-Type": "application/cbor", "Connection": "keep-alive"}
+        # A pooled connection may have been closed by the server while idle;
+        # retry once on a fresh connection before giving up.
+        for attempt in range(2):
+            try:
+                conn = self._pool.get_nowait()
+                reused = True
+            except queue.Empty:
+                conn = None
+                reused = False
+            try:
+                if conn is None:
+                    conn = self._connect(timeout)
+                else:
+                    conn.sock.settimeout(timeout)
+                conn.request("POST", path, body, headers)
+                resp = conn.getresponse()
+                data = resp.read()
+            except TimeoutError:
+                if conn is not None:
+                    conn.close()
+                raise
+            except (OSError, http.client.HTTPException) as e:
+                if conn is not None:
+                    conn.close()
+                if reused and attempt == 0:
+                    continue
+                raise TransportUnavailable(f"{self.url}: {e}")
+            if resp.will_close:
+                conn.close()
+            else:
+                self._release(conn)
+            if resp.status not in (200, 202):
+                raise _HttpStatus(resp.status, data[:200].decode(errors="replace"))
+            return data
+        raise TransportUnavailable(self.url)
+
+    async def _apost(self, path: str, body: bytes) -> bytes:
+        loop = asyncio.get_running_loop()
+        if self._apool_loop is not loop:
+            self._apool, self._apool_loop = [], loop
+        request = (f"POST {path} HTTP/1.1\r\nHost: {self.host}\r\n"
+                   f"Content-Type: application/cbor\r\nContent-Length: {len(body)}\r\n"
+                   f"Connection: keep-alive\r\n\r\n").encode() + body
+        for attempt in range(2):
+            reused = bool(self._apool)
+            writer = None
+            try:
+                if reused:
+                    reader, writer = self._apool.pop()
+                else:
+                    ssl_ctx = ssl.create_default_context() if self.https else None
+                    reader, writer = await asyncio.open_connection(self.host, self.port, ssl=ssl_ctx)
+                writer.write(request)
+                await writer.drain()
+                status, data, keep_alive = await _read_http_response(reader)
+            except asyncio.CancelledError:
+                if writer is not None:
+                    writer.close()
+                raise
+            except (OSError, asyncio.IncompleteReadError, ValueError) as e:
+                if writer is not None:
+                    writer.close()
+                if reused and attempt == 0:
+                    continue
+                raise TransportUnavailable(f"{self.url}: {e}")
+            if keep_alive and len(self._apool) < self.pool_size:
+                self._apool.append((reader, writer))
+            else:
+                writer.close()
+            if status not in (200, 202):
+                raise _HttpStatus(status, data[:200].decode(errors="replace"))
+            return data
+        raise TransportUnavailable(self.url)
+
+    def _envelope(self, canister_id: str, method: str, args: str) -> bytes:
+        content = {
+            "request_type": "query",
+            "canister_id": candid_codec.Principal(canister_id).to_bytes(),
+            "method_name": method,
+            "arg": candid_codec.encode_args(args),
+            "sender": b"\x04",  # anonymous
+            "ingress_expiry": time.time_ns() + INGRESS_EXPIRY_NS,
+        }
+        return SELF_DESCRIBE_TAG + cbor_encode({"content": content})
+
+    def call(self, canister_id: str, method: str, args: str = "()", timeout: float = 30) -> CallResult:
+        body = self._envelope(canister_id, method, args)
+        try:
+            data = self._post(f"/api/v2/canister/{canister_id}/query", body, timeout)
+        except _HttpStatus as e:
+            return CallResult(False, "", f"HTTP {e.status}: {e.body}")
+        return self._result(data)
+
+    async def acall(self, canister_id: str, method: str, args: str = "()", timeout: float = 30) -> CallResult:
+        body = self._envelope(canister_id, method, args)
+        try:
+            data = await asyncio.wait_for(self._apost(f"/api/v2/canister/{canister_id}/query", body), timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError(f"{method} timed out after {timeout}s")
+        except _HttpStatus as e:
+            return CallResult(False, "", f"HTTP {e.status}: {e.body}")
+        return self._result(data)
+
+    def _result(self, data: bytes) -> CallResult:
+        reply = cbor_decode(data)
+        if reply.get("status") == "replied":
+            return _DecodedCallResult(*candid_codec.decode(reply["reply"]["arg"]))
+        return CallResult(False, "", f"Reject code {reply.get('reject_code')}: {reply.get('reject_message')}")
+
+
+async def _read_http_response(reader: asyncio.StreamReader):
+    """Read one HTTP/1.1 response. Returns (status, body, keep_alive)."""
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionResetError("Connection closed by server")
+    version, status = status_line.split(b" ", 2)[:2]
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        key, _, value = line.decode("latin-1").partition(":")
+        headers[key.strip().lower()] = value.strip()
+
+    if headers.get("transfer-encoding", "").lower() == "chunked":
+        body = bytearray()
+        while True:
+            size = int((await reader.readline()).split(b";")[0], 16)
+            if size == 0:
+                while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    pass  # Trailers
+                break
+            body += await reader.readexactly(size)
+            await reader.readline()
+        data = bytes(body)
+    else:
+        data = await reader.readexactly(int(headers.get("content-length", 0)))
+
+    keep_alive = headers.get("connection", "").lower() != "close" and version != b"HTTP/1.0"
+    return int(status), data, keep_alive
+
+
+class _HttpStatus(Exception):
+    def __init__(self, status: int, body: str):
+        super().__init__(f"HTTP {status}")
+        self.status = status
+        self.body = body
+
+
+class FallbackTransport:
+    """Use `primary`, switching to `fallback` for good once primary is unreachable.
+
+    A Candid codec error (an argument encode_args can't handle, a reply it can't
+    decode) sends only that call to `fallback`; it is counted for summary().
+    """
+
+    def __init__(self, primary, fallback):
+        self.primary = primary
+        self.fallback = fallback
+        self._use_fallback = False
+        self._lock = threading.Lock()
+        self.codec_fallbacks = 0
+        self.last_codec_error = ""
+
+    @property
+    def name(self) -> str:
+        active = self.fallback if self._use_fallback else self.primary
+        return f"{active.name} (fallback: {self.fallback.name})"
+
+    def _unavailable(self, e: TransportUnavailable) -> None:
+        with self._lock:
+            if not self._use_fallback:
+                print(f"\n  [transport] {self.primary.name} unavailable ({e}), using {self.fallback.name}",
+                      file=sys.stderr)
+            self._use_fallback = True
+
+    def _codec_error(self, method: str, e: candid_codec.CandidError) -> None:
+        with self._lock:
+            self.codec_fallbacks += 1
+            self.last_codec_error = f"{method}: {e}"
+
+    def call(self, canister_id: str, method: str, args: str = "()", timeout: float = 30) -> CallResult:
+        if not self._use_fallback:
+            try:
+                return self.primary.call(canister_id, method, args, timeout)
+            except TransportUnavailable as e:
+                self._unavailable(e)
+            except candid_codec.CandidError as e:
+                self._codec_error(method, e)
+        return self.fallback.call(canister_id, method, args, timeout)
+
+    async def acall(self, canister_id: str, method: str, args: str = "()", timeout: float = 30) -> CallResult:
+        if not self._use_fallback:
+            try:
+                return await self.primary.acall(canister_id, method, args, timeout)
+            except TransportUnavailable as e:
+                self._unavailable(e)
+            except candid_codec.CandidError as e:
+                self._codec_error(method, e)
+        return await self.fallback.acall(canister_id, method, args, timeout)
+
+    def summary(self) -> str:
+        line = (f"Transport fallback: {self.codec_fallbacks} calls sent via {self.fallback.name} "
+                f"after a Candid codec error on {self.primary.name}")
+        if self.last_codec_error:
+            line += f" (last: {self.last_codec_error})"
+        if self._use_fallback:
+            line += f"; {self.primary.name} unavailable, all later calls via {self.fallback.name}"
+        return line
+
+
+class SingleFlightTransport:
+    """Coalesce identical concurrent calls: callers asking for the same
+    (canister, method, args) while one is outstanding share its result."""
+
+    def __init__(self, inner):
+        self.inner = inner
+        self.calls = 0
+        self.collapsed = 0
+        self._flights: Dict[Tuple[str, str, str], "_Flight"] = {}
+        self._aflights: Dict[Tuple[str, str, str], "asyncio.Task"] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def name(self) -> str:
+        return self.inner.name
+
+    def call(self, canister_id: str, method: str, args: str = "()", timeout: float = 30) -> CallResult:
+        key = (canister_id, method, args)
+        with self._lock:
+            self.calls += 1
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+            else:
+                self.collapsed += 1
+        if not leader:
+            if not flight.done.wait(timeout):
+                raise TimeoutError(f"{method} timed out waiting on an identical in-flight call")
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        try:
+            flight.result = self.inner.call(canister_id, method, args, timeout)
+            return flight.result
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    async def acall(self, canister_id: str, method: str, args: str = "()", timeout: float = 30) -> CallResult:
+        key = (canister_id, method, args)
+        self.calls += 1
+        task = self._aflights.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self.inner.acall(canister_id, method, args, timeout))
+            self._aflights[key] = task
+            task.add_done_callback(lambda _t, key=key: self._aflights.pop(key, None))
+        else:
+            self.collapsed += 1
+        # Shielded so one cancelled caller does not cancel the call for the others
+        return await asyncio.shield(task)
+
+    def summary(self) -> str:
+        rate = self.collapsed / self.calls * 100 if self.calls else 0.0
+        return f"Single-flight: {self.collapsed}/{self.calls} canister calls collapsed into an in-flight twin ({rate:.1f}%)"
+
+
+class _Flight:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Optional[CallResult] = None
+        self.error: Optional[BaseException] = None
+
+
+# ============================================
+# Adaptive concurrency / rate limiting
+# ============================================
+
+_backoff_rng = random.Random()  # Private, so retries never perturb a seeded global `random`
+
+
+def backoff_delay(attempt: int, base: float = 0.5, cap: float = 10.0) -> float:
+    """Retry delay with "equal jitter": half of base * 2**attempt, plus up to the other half at random."""
+    ceiling = min(cap, base * (2 ** attempt))
+    return ceiling / 2 + _backoff_rng.uniform(0, ceiling / 2)
+
+
+def is_overload(error: str) -> bool:
+    """Whether a failed call's error means the target (or boundary node) is overloaded."""
+    return error.startswith(("HTTP 429", "HTTP 502", "HTTP 503", "HTTP 504")) or error.startswith("Reject code 2:")
+
+
+class CanisterLimiter:
+    """In-flight limit and token-bucket rate for one canister.
+
+    Successes raise whichever of the two has been holding callers back: the limit
+    additively (about +1 per round trip), the rate by a fixed step. Timeouts and
+    overload errors halve the limit and cut the rate (at most once per round trip,
+    so one burst of failures counts once). Smoothed latency growing past
+    LATENCY_TOLERANCE x the best observed latency shrinks the limit gently before
+    timeouts start.
+    """
+
+    def __init__(self, limit: float = LIMIT_INITIAL, rate: float = RATE_INITIAL):
+        self.limit = float(limit)
+        self.rate = float(rate)
+        self.tokens = max(1.0, self.rate * RATE_BURST_SECONDS)
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.best_latency: Optional[float] = None
+        self.latency: Optional[float] = None  # EWMA of successful call latency
+        self.calls = 0
+        self.timeouts = 0
+        self.overloads = 0
+        self._refilled = time.monotonic()
+        self._hold_until = 0.0
+        self._limit_bound = False  # Callers waited on the in-flight limit since the last increase
+        self._rate_bound = False   # ... or on the token bucket
+        self._cond = threading.Condition()
+
+    def _try_acquire(self) -> float:
+        """Take a slot if one is free (returns 0), else the seconds to wait before retrying. Lock held."""
+        now = time.monotonic()
+        self.tokens = min(max(1.0, self.rate * RATE_BURST_SECONDS), self.tokens + (now - self._refilled) * self.rate)
+        self._refilled = now
+        if self.in_flight >= int(self.limit):
+            self._limit_bound = True
+            return 0.01  # Threads are woken early by release(); coroutines poll
+        if self.tokens < 1:
+            self._rate_bound = True
+            return (1 - self.tokens) / self.rate
+        self.tokens -= 1
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        return 0.0
+
+    def acquire(self, timeout: float) -> bool:
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                wait = self._try_acquire()
+                if wait == 0:
+                    return True
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(min(wait, remaining))
+
+    async def aacquire(self, timeout: float) -> bool:
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._cond:
+                wait = self._try_acquire()
+            if wait == 0:
+                return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            await asyncio.sleep(min(wait, remaining))
+
+    def release(self, latency: float, outcome: str) -> None:
+        """outcome: 'ok', 'timeout', 'overload' or 'error' (a normal failure: no signal)."""
+        with self._cond:
+            self.in_flight -= 1
+            self.calls += 1
+            now = time.monotonic()
+            if outcome == "ok":
+                # Let the baseline drift up slowly so a permanently slower target isn't punished forever
+                self.best_latency = latency if self.best_latency is None else min(self.best_latency * 1.001, latency)
+                self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+                if self.latency > LATENCY_TOLERANCE * self.best_latency:
+                    if now >= self._hold_until:
+                        self.limit = max(LIMIT_MIN, self.limit * 0.9)
+                        self._hold_until = now + self.latency
+                else:
+                    if self._limit_bound:
+                        self.limit = min(LIMIT_MAX, self.limit + 1 / self.limit)
+                        self._limit_bound = False
+                    if self._rate_bound:
+                        self.rate = min(RATE_MAX, self.rate + RATE_STEP)
+                        self._rate_bound = False
+            elif outcome in ("timeout", "overload"):
+                if outcome == "timeout":
+                    self.timeouts += 1
+                else:
+                    self.overloads += 1
+                if now >= self._hold_until:
+                    self.limit = max(LIMIT_MIN, self.limit / 2)
+                    self.rate = max(RATE_MIN, self.rate * 0.7)
+                    self._hold_until = now + (self.latency or 1.0)
+            self._cond.notify_all()
+
+    def hold(self) -> None:
+        """Count a call that outlived its caller's slot (a hedge's loser) as in flight, until unhold()."""
+        with self._cond:
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+
+    def unhold(self) -> None:
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+
+
+class AdaptiveLimitTransport:
+    """Pass calls through to `inner` under a CanisterLimiter per target canister."""
+
+    def __init__(self, inner):
+        self.inner = inner
+        self.limiters: Dict[str, CanisterLimiter] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def name(self) -> str:
+        return self.inner.name
+
+    def _limiter(self, canister_id: str) -> CanisterLimiter:
+        limiter = self.limiters.get(canister_id)
+        if limiter is None:
+            with self._lock:
+                limiter = self.limiters.setdefault(canister_id, CanisterLimiter())
+        return limiter
+
+    def call(self, canister_id: str, method: str, args: str = "()", timeout: float = 30) -> CallResult:
+        limiter = self._limiter(canister_id)
+        start = time.monotonic()
+        if not limiter.acquire(timeout):
+            raise TimeoutError(f"{method} on {canister_id} timed out waiting for a concurrency slot")
+        sent = time.monotonic()
+        outcome = "error"
+        try:
+            result = self.inner.call(canister_id, method, args, max(0.1, timeout - (sent - start)))
+            outcome = "ok" if result.ok else "overload" if is_overload(result.error) else "error"
+            return result
+        except TimeoutError:
+            outcome = "timeout"
+            raise
+        finally:
+            limiter.release(time.monotonic() - sent, outcome)
+
+    async def acall(self, canister_id: str, method: str, args: str = "()", timeout: float = 30) -> CallResult:
+        limiter = self._limiter(canister_id)
+        start = time.monotonic()
+        if not await limiter.aacquire(timeout):
+            raise TimeoutError(f"{method} on {canister_id} timed out waiting for a concurrency slot")
+        sent = time.monotonic()
+        outcome = "error"
+        try:
+            result = await self.inner.acall(canister_id, method, args, max(0.1, timeout - (sent - start)))
+            outcome = "ok" if result.ok else "overload" if is_overload(result.error) else "error"
+            return result
+        except (TimeoutError, asyncio.TimeoutError):
+            outcome = "timeout"
+            raise
+        finally:
+            limiter.release(time.monotonic() - sent, outcome)
+
+    def hold_slot(self, canister_id: str) -> Callable[[], None]:
+        """Count one more call in flight to canister_id until the returned function is called."""
+        limiter = self._limiter(canister_id)
+        limiter.hold()
+        return limiter.unhold
+
+    def summary(self, top: int = 5) -> str:
+        busiest = sorted(self.limiters.items(), key=lambda kv: -kv[1].calls)[:top]
+        lines = [f"Adaptive limits: {len(self.limiters)} canisters"]
+        for canister_id, lim in busiest:
+            latency = f"{lim.latency * 1000:.0f}ms" if lim.latency is not None else "-"
+            lines.append(f"  {canister_id}: {lim.calls} calls, limit {lim.limit:.1f} (peak {lim.peak_in_flight} in flight), "
+                         f"rate {lim.rate:.0f}/s, latency {latency}, timeouts {lim.timeouts}, overloads {lim.overloads}")
+        return "\n".join(lines)
+
+
+def find_layer(transport, cls):
+    """The first layer of a wrapped transport (following .inner) that is a `cls`, or None."""
+    while transport is not None:
+        if isinstance(transport, cls):
+            return transport
+        transport = getattr(transport, "inner", None)
+    return None
+
+
+# ============================================
+# Tail latency: adaptive timeouts + hedging
+# ============================================
+
+class LatencyWindow:
+    """Recent call latencies of one method; percentiles are re-sorted every few samples."""
+
+    def __init__(self):
+        self.samples: deque = deque(maxlen=LATENCY_WINDOW)
+        self.count = 0
+        self.timeouts = 0
+        self._sorted: List[float] = []
+        self._unsorted = 0
+
+    def add(self, latency: float) -> None:
+        self.samples.append(latency)
+        self.count += 1
+        self._unsorted += 1
+
+    def _ordered(self) -> List[float]:
+        if self._unsorted >= 16 or len(self._sorted) < min(len(self.samples), LATENCY_MIN_SAMPLES):
+            self._sorted = sorted(self.samples)
+            self._unsorted = 0
+        return self._sorted
+
+    def percentile(self, q: float) -> float:
+        ordered = self._ordered()
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def expected_remaining(self, elapsed: float) -> float:
+        """Mean further wait for a call that has already taken `elapsed` seconds (0 if none ran that long)."""
+        longer = [x for x in self._ordered() if x > elapsed]
+        return sum(longer) / len(longer) - elapsed if longer else 0.0
+
+
+class TailLatencyTransport:
+    """Timeouts and hedging driven by each method's observed latency.
+
+    Once a method has LATENCY_MIN_SAMPLES latencies, its calls time out after
+    p99 x TIMEOUT_MULTIPLIER (at least TIMEOUT_FLOOR, at most the caller's
+    timeout) rather than the caller's fixed worst case, so a stuck call is
+    retried after seconds. Timeouts are recorded at the timeout value, which
+    pushes p99 (and the next timeout) up when a target really slows down.
+
+    With hedge=True, a call still pending at p95 gets a duplicate; the first
+    answer wins. Blocking losers can't be interrupted and are left to finish
+    unread (which measures the time the hedge saved); async losers are
+    cancelled and the saving is estimated from the latency window.
+
+    make_transport puts this layer under the AdaptiveLimitTransport: only sent
+    calls are timed or hedged, and a hedge shares its primary's slot
+    (HEDGE_MAX_FRACTION bounds the extra load). A blocking loser still running
+    when the call returns is counted in flight through hold_slot (the
+    limiter's AdaptiveLimitTransport.hold_slot) until it finishes.
+    """
+
+    def __init__(self, inner, hedge: bool = False, adaptive_timeouts: bool = True):
+        self.inner = inner
+        self.hedge = hedge
+        self.adaptive_timeouts = adaptive_timeouts
+        self.windows: Dict[str, LatencyWindow] = {}
+        self.calls = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.saved = 0.0        # Seconds callers did not wait thanks to a winning hedge
+        self.saved_measured = 0  # Wins whose losing primary finished later (exact saving)
+        self.saved_estimated = 0  # Wins whose primary was cancelled (saving from the window)
+        self.hold_slot: Optional[Callable[[str], Callable[[], None]]] = None
+        self._lock = threading.Lock()
+        self._executor: Optional[futures.ThreadPoolExecutor] = None
+
+    @property
+    def name(self) -> str:
+        return self.inner.name
+
+    def _plan(self, method: str, timeout: float) -> Tuple[float, Optional[float]]:
+        """(timeout to use, seconds after which to hedge or None)."""
+        with self._lock:
+            self.calls += 1
+            window = self.windows.get(method)
+            if window is None:
+                window = self.windows[method] = LatencyWindow()
+            if len(window.samples) < LATENCY_MIN_SAMPLES:
+                return timeout, None
+            if self.adaptive_timeouts:
+                timeout = min(timeout, max(TIMEOUT_FLOOR, window.percentile(0.99) * TIMEOUT_MULTIPLIER))
+            if not self.hedge or self.hedged >= HEDGE_MAX_FRACTION * self.calls:
+                return timeout, None
+            hedge_after = window.percentile(HEDGE_PERCENTILE)
+            return timeout, (hedge_after if hedge_after < timeout else None)
+
+    def _record(self, method: str, latency: float, timed_out: bool = False) -> None:
+        with self._lock:
+            window = self.windows[method]
+            window.add(latency)
+            if timed_out:
+                window.timeouts += 1
+
+    def _attempt(self, canister_id: str, method: str, args: str, timeout: float) -> CallResult:
+        start = time.monotonic()
+        try:
+            result = self.inner.call(canister_id, method, args, timeout)
+        except TimeoutError:
+            self._record(method, timeout, timed_out=True)
+            raise
+        self._record(method, time.monotonic() - start)
+        return result
+
+    async def _aattempt(self, canister_id: str, method: str, args: str, timeout: float) -> CallResult:
+        start = time.monotonic()
+        try:
+            result = await self.inner.acall(canister_id, method, args, timeout)
+        except (TimeoutError, asyncio.TimeoutError):
+            self._record(method, timeout, timed_out=True)
+            raise
+        self._record(method, time.monotonic() - start)
+        return result
+
+    def _hedge_won(self, saved: float, measured: bool) -> None:
+        with self._lock:
+            self.saved += max(0.0, saved)
+            if measured:
+                self.saved_measured += 1
+            else:
+                self.saved_estimated += 1
+
+    def call(self, canister_id: str, method: str, args: str = "()", timeout: float = 30) -> CallResult:
+        timeout, hedge_after = self._plan(method, timeout)
+        if hedge_after is None:
+            return self._attempt(canister_id, method, args, timeout)
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = futures.ThreadPoolExecutor(HEDGE_THREADS, thread_name_prefix="hedge")
+        primary = self._executor.submit(self._attempt, canister_id, method, args, timeout)
+        done, _ = futures.wait([primary], timeout=hedge_after)
+        if done:
+            return primary.result()
+
+        with self._lock:
+            self.hedged += 1
+        hedge = self._executor.submit(self._attempt, canister_id, method, args, max(0.1, timeout - hedge_after))
+        winner, error, pending = None, None, {primary, hedge}
+        while pending and winner is None:
+            done, pending = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+            for f in done:
+                if f.exception() is None:
+                    winner = f
+                    break
+                error = error or f.exception()
+        if winner is None:
+            raise error
+        if winner is hedge:
+            with self._lock:
+                self.hedge_wins += 1
+            won_at = time.monotonic()
+            # The primary's request is already out; let it finish unread and time what waiting would have cost
+            primary.add_done_callback(lambda _f: self._hedge_won(time.monotonic() - won_at, measured=True))
+            self._linger(canister_id, primary)
+        elif not hedge.cancel():  # Only succeeds if the duplicate hasn't started yet
+            self._linger(canister_id, hedge)
+        return winner.result()
+
+    def _linger(self, canister_id: str, loser: futures.Future) -> None:
+        """Keep a loser that can't be interrupted counted in flight until it finishes."""
+        if self.hold_slot is not None and not loser.done():
+            unhold = self.hold_slot(canister_id)
+            loser.add_done_callback(lambda _f: unhold())
+
+    async def acall(self, canister_id: str, method: str, args: str = "()", timeout: float = 30) -> CallResult:
+        timeout, hedge_after = self._plan(method, timeout)
+        if hedge_after is None:
+            return await self._aattempt(canister_id, method, args, timeout)
+        start = time.monotonic()
+        primary = asyncio.ensure_future(self._aattempt(canister_id, method, args, timeout))
+        pending = {primary}
+        try:
+            done, _ = await asyncio.wait(pending, timeout=hedge_after)
+            if done:
+                return primary.result()
+
+            with self._lock:
+                self.hedged += 1
+            hedge = asyncio.ensure_future(self._aattempt(canister_id, method, args, max(0.1, timeout - hedge_after)))
+            winner, error, pending = None, None, {primary, hedge}
+            while pending and winner is None:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for f in done:
+                    if f.exception() is None:
+                        winner = f
+                        break
+                    error = error or f.exception()
+            if winner is None:
+                raise error
+            if winner is hedge:
+                with self._lock:
+                    self.hedge_wins += 1
+                if primary in pending:
+                    elapsed = time.monotonic() - start
+                    with self._lock:
+                        remaining = self.windows[method].expected_remaining(elapsed)
+                    self._hedge_won(remaining, measured=False)
+                    self._record(method, elapsed)  # Lower bound, but keeps the slow tail in the window
+            return winner.result()
+        finally:
+            for f in pending:
+                f.cancel()
+
+    def summary(self, top: int = 5) -> str:
+        with self._lock:
+            busiest = sorted(self.windows.items(), key=lambda kv: -kv[1].count)[:top]
+            lines = []
+            if self.hedge:
+                rate = self.hedged / self.calls * 100 if self.calls else 0.0
+                lines.append(f"Hedging: {self.hedged}/{self.calls} calls hedged ({rate:.1f}%), {self.hedge_wins} won by the hedge, "
+                             f"~{self.saved:.1f}s wall-clock saved ({self.saved_measured} measured, {self.saved_estimated} estimated)")
+            lines.append(f"Call latency ({'adaptive' if self.adaptive_timeouts else 'fixed'} timeouts):")
+            for method, window in busiest:
+                if len(window.samples) < LATENCY_MIN_SAMPLES:
+                    lines.append(f"  {method}: {window.count} calls, too few for percentiles, {window.timeouts} timeouts")
+                    continue
+                p50, p95, p99 = (window.percentile(q) for q in (0.5, 0.95, 0.99))
+                timeout = f", timeout {max(TIMEOUT_FLOOR, p99 * TIMEOUT_MULTIPLIER):.1f}s" if self.adaptive_timeouts else ""
+                lines.append(f"  {method}: {window.count} calls, p50 {p50 * 1000:.0f}ms p95 {p95 * 1000:.0f}ms "
+                             f"p99 {p99 * 1000:.0f}ms{timeout}, {window.timeouts} timeouts")
+        return "\n".join(lines)
+
+
+# ============================================
+# Record / replay
+# ============================================
+
+def read_recording_meta(directory: str) -> Dict[str, Any]:
+    try:
+        with open(os.path.join(directory, RECORDING_META_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def update_recording_meta(directory: str, **values) -> None:
+    """Merge values into a recording's meta.json (e.g. the harness's random seed)."""
+    meta = read_recording_meta(directory)
+    meta.update(values)
+    with open(os.path.join(directory, RECORDING_META_FILE), "w") as f:
+        json.dump(meta, f, indent=2)
+
+
+class RecordingTransport:
+    """Pass calls through to `inner` and append every reply (or timeout) to DIR/responses.jsonl.gz.
+
+    Processes recording into one directory at the same time (sweep workers) each pass
+    their own `part`, which writes DIR/responses.<part>.jsonl.gz instead: gzip appends
+    from several processes would interleave. ReplayTransport reads all of them.
+    """
+
+    def __init__(self, inner, directory: str, part: Optional[str] = None):
+        self.inner = inner
+        self.directory = directory
+        self.recorded = 0
+        os.makedirs(directory, exist_ok=True)
+        if not read_recording_meta(directory):
+            update_recording_meta(directory, recorded_at=time.time())
+        # Each run appends one gzip member; readers see the members as one stream
+        filename = RECORDING_PART_FILE.format(part) if part else RECORDING_FILE
+        self._file = gzip.open(os.path.join(directory, filename), "at", encoding="utf-8")
+        self._lock = threading.Lock()
+        atexit.register(self.close)
+
+    @property
+    def name(self) -> str:
+        return f"{self.inner.name} (recording to {self.directory})"
+
+    def call(self, canister_id: str, method: str, args: str = "()", timeout: float = 30) -> CallResult:
+        try:
+            result = self.inner.call(canister_id, method, args, timeout)
+        except TimeoutError:
+            self._write({"c": canister_id, "m": method, "a": args, "timeout": True})
+            raise
+        self._write({"c": canister_id, "m": method, "a": args,
+                     "ok": result.ok, "out": result.output, "err": result.error})
+        return result
+
+    async def acall(self, canister_id: str, method: str, args: str = "()", timeout: float = 30) -> CallResult:
+        try:
+            result = await self.inner.acall(canister_id, method, args, timeout)
+        except TimeoutError:
+            self._write({"c": canister_id, "m": method, "a": args, "timeout": True})
+            raise
+        self._write({"c": canister_id, "m": method, "a": args,
+                     "ok": result.ok, "out": result.output, "err": result.error})
+        return result
+
+    def _write(self, entry: Dict[str, Any]) -> None:
+        line = json.dumps(entry, separators=(",", ":")) + "\n"
+        with self._lock:
+            if self._file.closed:
+                return
+            self._file.write(line)
+            self.recorded += 1
+            if self.recorded % RECORDING_FLUSH_EVERY == 0:
+                self._file.flush()  # Sync flush: an interrupted run keeps what it recorded
+
+    def close(self) -> None:
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
+
+
+class ReplayTransport:
+    """Serve replies from a --record directory with no network I/O.
+
+    Replies for the same (canister, method, args) are served in recorded order;
+    once they run out the last one is repeated. Calls that were never recorded
+    fail like a canister error ("replay miss").
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.meta = read_recording_meta(directory)
+        self.served = 0
+        self.misses = 0
+        self._responses: Dict[Tuple[str, str, str], List[Dict[str, Any]]] = {}
+        self._cursor: Dict[Tuple[str, str, str], int] = {}
+        self._lock = threading.Lock()
+        path = os.path.join(directory, RECORDING_FILE)
+        parts = sorted(glob.glob(os.path.join(glob.escape(directory), RECORDING_PART_FILE.format("*"))))
+        paths = ([path] if os.path.exists(path) else []) + parts
+        if not paths:
+            raise FileNotFoundError(f"No recording at {path}")
+        for path in paths:
+            try:
+                with gzip.open(path, "rt", encoding="utf-8") as f:
+                    for line in f:
+                        entry = json.loads(line)
+                        self._responses.setdefault((entry["c"], entry["m"], entry["a"]), []).append(entry)
+            except (EOFError, ValueError, gzip.BadGzipFile):
+                pass  # Recording was interrupted mid-write; keep the complete lines
+
+    @property
+    def name(self) -> str:
+        total = sum(len(v) for v in self._responses.values())
+        return f"replay of {self.directory} ({total} replies)"
+
+    def call(self, canister_id: str, method: str, args: str = "()", timeout: float = 30) -> CallResult:
+        key = (canister_id, method, args)
+        with self._lock:
+            entries = self._responses.get(key)
+            if not entries:
+                self.misses += 1
+                return CallResult(False, "", f"replay miss: {method} on {canister_id} was not recorded")
+            i = self._cursor.get(key, 0)
+            self._cursor[key] = i + 1
+            self.served += 1
+        entry = entries[min(i, len(entries) - 1)]
+        if entry.get("timeout"):
+            raise TimeoutError(f"{method} timed out (recorded)")
+        return CallResult(entry["ok"], entry["out"], entry["err"])
+
+    async def acall(self, canister_id: str, method: str, args: str = "()", timeout: float = 30) -> CallResult:
+        return self.call(canister_id, method, args, timeout)
+
+    def summary(self) -> str:
+        return f"Replay: {self.served} replies served, {self.misses} calls not in the recording"
+
+
+def make_transport(backend: str = "auto", network: str = "ic", url: Optional[str] = None,
+                   identity: Optional[str] = "anonymous", record: Optional[str] = None,
+                   replay: Optional[str] = None, adaptive_limits: bool = True,
+                   adaptive_timeouts: bool = True, hedge: bool = False, record_part: Optional[str] = None):
+    """Build a transport.
+
+    backend: 'http' (native only), 'dfx' (subprocess only) or 'auto' (http, dfx fallback)
+    url: replica URL for http; defaults to NETWORK_URLS[network]
+    record: directory to record every reply into; replay: directory to serve replies from
+    record_part: record into the directory's own file for this process (see RecordingTransport)
+    adaptive_timeouts / hedge: wrap the network backend in a TailLatencyTransport (see there)
+    adaptive_limits: wrap that in an AdaptiveLimitTransport
+
+    The limiter goes outside, so call latencies (and the p99 timeouts and p95 hedges
+    built on them) start once a concurrency slot is held, not while a call is queued.
+    """
+    if replay:
+        return ReplayTransport(replay)
+    dfx = DfxTransport(network, identity)
+    if backend == "dfx":
+        transport = dfx
+    elif backend == "http":
+        transport = HttpTransport(url or NETWORK_URLS.get(network, NETWORK_URLS["ic"]))
+    elif backend == "auto":
+        transport = FallbackTransport(HttpTransport(url or NETWORK_URLS.get(network, NETWORK_URLS["ic"])), dfx)
+    else:
+        raise ValueError(f"Unknown transport backend {backend!r} (expected http, dfx or auto)")
+    tail = None
+    if adaptive_timeouts or hedge:
+        transport = tail = TailLatencyTransport(transport, hedge, adaptive_timeouts)
+    if adaptive_limits:
+        transport = AdaptiveLimitTransport(transport)
+        if tail is not None:
+            tail.hold_slot = transport.hold_slot
+    return RecordingTransport(transport, record, record_part) if record else transport
+
+
+def pop_transport_flags(args: list) -> Dict[str, Optional[str]]:
+    """Strip --transport X / --ic-url URL / --record DIR / --replay DIR / --fixed-concurrency /
+    --fixed-timeouts / --hedge from an argv list (in place) and return them as make_transport
+    keyword arguments."""
+    opts = {"backend": "auto", "url": None, "record": None, "replay": None, "adaptive_limits": True,
+            "adaptive_timeouts": True, "hedge": False}
+    for flag, key, value in (("--fixed-concurrency", "adaptive_limits", False),
+                             ("--fixed-timeouts", "adaptive_timeouts", False),
+                             ("--hedge", "hedge", True)):
+        if flag in args:
+            args.remove(flag)
+            opts[key] = value
+    for flag, key in (("--transport", "backend"), ("--ic-url", "url"),
+                      ("--record", "record"), ("--replay", "replay")):
+        if flag in args:
+            i = args.index(flag)
+            if i + 1 >= len(args):
+                raise SystemExit(f"{flag} needs a value")
+            opts[key] = args[i + 1]
+            del args[i:i + 2]
+    if opts["record"] and opts["replay"]:
+        raise SystemExit("--record and --replay are mutually exclusive")
+    return opts
+
+
+# ============================================
+# Offline stub server + benchmark
+# ============================================
+
+def serve_stub(port: int, reply_text: str, delay: float = 0.0) -> None:
+    """Serve every query with a fixed Candid reply (HTTP/1.1 keep-alive)."""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    body = SELF_DESCRIBE_TAG + cbor_encode({
+        "status": "replied",
+        "reply": {"arg": candid_codec.encode_args(reply_text)},
+    })
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            if delay:
+                time.sleep(delay)
+            self.send_response(200)
+            self.send_header("Content-Type", "application/cbor")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    print(f"Stub replica on http://127.0.0.1:{port} (reply: {reply_text})")
+    server.serve_forever()
+
+
+def bench(transport, canister_id: str, method: str, args: str, n: int, threads: int) -> None:
+    from concurrent.futures import ThreadPoolExecutor
+
+    latencies = []
+    lock = threading.Lock()
+
+    def one(_):
+        t0 = time.perf_counter()
+        result = transport.call(canister_id, method, args)
+        dt = time.perf_counter() - t0
+        with lock:
+            latencies.append(dt)
+        return result.ok
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        ok = sum(pool.map(one, range(n)))
+    wall = time.perf_counter() - start
+
+    latencies.sort()
+    print(f"{transport.name}: {n} calls ({ok} ok) in {wall:.2f}s = {n / wall:.0f} calls/s")
+    print(f"  latency p50={latencies[n // 2] * 1000:.1f}ms "
+          f"p95={latencies[int(n * 0.95)] * 1000:.1f}ms max={latencies[-1] * 1000:.1f}ms")
+
+
+# (fee, token0, token1, canisterId) of each pool in a getPools reply rendered as dfx-style text
+# (dfx transport, text recordings): the fields fetch_icpswap_pools needs, without a full parse_text
+GETPOOLS_TEXT_RE = re.compile(
+    r'fee\s*=\s*([\d_]+)\s*:\s*nat\s*;[^{}]*?'
+    r'token0\s*=\s*record\s*\{\s*address\s*=\s*"([^"]+)"[^}]*\}\s*;\s*'
+    r'token1\s*=\s*record\s*\{\s*address\s*=\s*"([^"]+)"[^}]*\}\s*;\s*'
+    r'canisterId\s*=\s*principal\s*"([^"]+)"'
+)
+
+
+def synthetic_getpools_reply(pools: int) -> bytes:
+    """Binary (DIDL) ICPSwap factory getPools reply with `pools` entries."""
+    principals = [candid_codec.Principal.from_bytes(i.to_bytes(4, "big") + b"\x01\x01") for i in range(pools + 2)]
+    records = []
+    for i in range(pools):
+        records.append(
+            f'record {{ fee = 3_000 : nat; key = "pool-{i}"; tickSpacing = 60 : int; '
+            f'token0 = record {{ address = "{principals[i]}"; standard = "ICRC1" }}; '
+            f'token1 = record {{ address = "{principals[i + 1]}"; standard = "ICRC2" }}; '
+            f'canisterId = principal "{principals[i + 2]}" }}')
+    arg = "(variant { ok = vec { " + "; ".join(records) + " } })"
+    return candid_codec.encode_args(arg)
+
+
+def bench_parse(text: str, rounds: int, binary: Optional[bytes] = None) -> None:
+    """Time candid_codec.parse_text (and binary decode, if given) against the GETPOOLS_TEXT_RE fast path."""
+    def best(fn):
+        times = []
+        for _ in range(rounds):
+            t0 = time.perf_counter()
+            out = fn()
+            times.append(time.perf_counter() - t0)
+        return min(times), out
+
+    t_regex, fast = best(lambda: GETPOOLS_TEXT_RE.findall(text))
+    t_parse, values = best(lambda: candid_codec.parse_text(text))
+    pools = values[0].get("ok", []) if values and isinstance(values[0], dict) else []
+    print(f"getPools payload: {len(text) / 1e6:.2f} MB, {len(pools)} pools (text fast path matched {len(fast)})")
+    print(f"  text fast path (4 fields, fetch_icpswap_pools over dfx): {t_regex * 1000:.1f}ms")
+    print(f"  parse_text (full typed): {t_parse * 1000:.1f}ms = {len(text) / t_parse / 1e6:.1f} MB/s")
+    if binary is not None:
+        t_decode, _ = best(lambda: candid_codec.decode(binary))
+        print(f"  binary decode (HTTP transport, no text): {t_decode * 1000:.1f}ms for {len(binary) / 1e6:.2f} MB")
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    p_stub = sub.add_parser("stub", help="Run a stub replica that answers every query")
+    p_stub.add_argument("--port", type=int, default=8080)
+    p_stub.add_argument("--reply", default="(variant { Ok = 42 : nat })")
+    p_stub.add_argument("--delay", type=float, default=0.0, help="Seconds to wait before replying")
+
+    p_bench = sub.add_parser("bench", help="Measure call throughput/latency")
+    p_bench.add_argument("--transport", default="http", choices=["http", "dfx"])
+    p_bench.add_argument("--url", default=None)
+    p_bench.add_argument("--network", default="ic")
+    p_bench.add_argument("--canister", default="2ipq2-uqaaa-aaaar-qailq-cai")
+    p_bench.add_argument("--method", default="swap_amounts")
+    p_bench.add_argument("--args", default='("IC.ICP", 100000000, "IC.ckUSDT")')
+    p_bench.add_argument("-n", type=int, default=200)
+    p_bench.add_argument("--threads", type=int, default=8)
+    p_bench.add_argument("--adaptive", action="store_true", help="Go through AdaptiveLimitTransport")
+    p_bench.add_argument("--hedge", action="store_true", help="Go through TailLatencyTransport with hedging")
+
+    p_parse = sub.add_parser("parse-bench", help="Measure Candid text parsing on a getPools reply")
+    p_parse.add_argument("--file", help="Recorded getPools output (dfx-style text); synthesized if omitted")
+    p_parse.add_argument("--pools", type=int, default=3000, help="Pools in the synthesized payload")
+    p_parse.add_argument("--rounds", type=int, default=3)
+
+    opts = parser.parse_args()
+    if opts.cmd == "stub":
+        serve_stub(opts.port, opts.reply, opts.delay)
+    elif opts.cmd == "parse-bench":
+        binary = None
+        if opts.file:
+            with open(opts.file) as f:
+                text = f.read()
+        else:
+            binary = synthetic_getpools_reply(opts.pools)
+            text = candid_codec.decode_to_text(binary)
+        bench_parse(text, opts.rounds, binary)
+    else:
+        transport = make_transport(opts.transport, opts.network, opts.url, adaptive_limits=opts.adaptive,
+                                   adaptive_timeouts=opts.hedge, hedge=opts.hedge)
+        bench(transport, opts.canister, opts.method, opts.args, opts.n, opts.threads)
+        for layer in (TailLatencyTransport, AdaptiveLimitTransport, FallbackTransport):
+            found = find_layer(transport, layer)
+            if found is not None:
+                print(found.summary())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,408 @@
+#!/usr/bin/env python3
+"""
+In-process DEX quote engines for the Python test harnesses.
+
+Instead of one remote query per quote, pool state is fetched in bulk and
+quotes are computed locally:
+- KongPoolBook: constant-product (x*y=k) pools from one KongSwap `pools`
+  call, answering `swap_amounts` with the same record shape the canister
+  returns (see examples/mockKongswap.mo / src/swap/swap_types.mo), including
+  multi-hop routes through hub tokens.
+- V3Pool: an ICPSwap (Uniswap-v3 style) pool rebuilt from `metadata` and
+  its initialized ticks (`getTickInfos`), answering `quote` with the same
+  integer math as the pool's swap loop.
+
+QuoteValidation compares local answers with live quotes so drift from the
+canister's math is measured, not assumed.
+"""
+
+import threading
+from dataclasses import dataclass
+from bisect import bisect_left, bisect_right
+from typing import Any, Dict, List, Optional, Tuple
+
+# ============================================
+# KongSwap: constant-product pools
+# ============================================
+
+# Intermediate tokens Kong routes through when there is no direct pool
+KONG_HUB_TOKENS = ("ckUSDT", "ICP")
+
+
+@dataclass
+class KongPool:
+    symbol_0: str
+    symbol_1: str
+    address_0: str
+    address_1: str
+    reserve_0: int  # balance_0 + lp_fee_0 (accrued LP fees stay in the pool)
+    reserve_1: int
+    lp_fee_bps: int
+
+
+class KongPoolBook:
+    """Snapshot of KongSwap pools that answers swap_amounts locally.
+
+    Per hop (as kong_backend computes it):
+        amount_out = amount_in * reserve_out // (reserve_in + amount_in)
+        lp_fee     = amount_out * lp_fee_bps // 10000
+        gas_fee    = transfer fee of the token received
+        receive    = amount_out - lp_fee - gas_fee
+    The best-output route among direct, 2-hop and 3-hop paths via
+    KONG_HUB_TOKENS is used.
+    """
+
+    def __init__(self, pools: List[KongPool], token_fees: Optional[Dict[str, int]] = None,
+                 decimals: Optional[Dict[str, int]] = None, hubs: Tuple[str, ...] = KONG_HUB_TOKENS):
+        self.pools = pools
+        self.token_fees = token_fees or {}
+        self.decimals = decimals or {}
+        self.hubs = hubs
+        self._by_pair: Dict[Tuple[str, str], Tuple[KongPool, bool]] = {}
+        self.addresses: Dict[str, str] = {}
+        for pool in pools:
+            self._by_pair[(pool.symbol_0, pool.symbol_1)] = (pool, True)
+            self._by_pair[(pool.symbol_1, pool.symbol_0)] = (pool, False)
+            self.addresses[pool.symbol_0] = pool.address_0
+            self.addresses[pool.symbol_1] = pool.address_1
+
+    @classmethod
+    def from_reply(cls, reply: List[Any], token_fees: Optional[Dict[str, int]] = None,
+                   decimals: Optional[Dict[str, int]] = None) -> "KongPoolBook":
+        """Build from a `pools` reply: variant { Ok = vec PoolReply } or Ok = PoolsReply { pools }."""
+        result = reply[0] if reply and isinstance(reply[0], dict) else {}
+        if "Ok" not in result:
+            raise ValueError(f"Unexpected Kong pools reply: {str(result)[:100]}")
+        entries = result["Ok"]
+        if isinstance(entries, dict):
+            entries = entries.get("pools", [])
+        pools = [KongPool(p["symbol_0"], p["symbol_1"], p.get("address_0", ""), p.get("address_1", ""),
+                          p["balance_0"] + p.get("lp_fee_0", 0), p["balance_1"] + p.get("lp_fee_1", 0),
+                          p.get("lp_fee_bps", 30))
+                 for p in entries if not p.get("is_removed", False)]
+        return cls(pools, token_fees, decimals)
+
+    def routes(self, pay: str, receive: str) -> List[List[str]]:
+        """Candidate token paths from pay to receive (direct first)."""
+        paths = []
+        if (pay, receive) in self._by_pair:
+            paths.append([pay, receive])
+        for hub in self.hubs:
+            if hub not in (pay, receive) and (pay, hub) in self._by_pair and (hub, receive) in self._by_pair:
+                paths.append([pay, hub, receive])
+        for h1 in self.hubs:
+            for h2 in self.hubs:
+                if h1 != h2 and {h1, h2}.isdisjoint((pay, receive)) and (pay, h1) in self._by_pair \
+                        and (h1, h2) in self._by_pair and (h2, receive) in self._by_pair:
+                    paths.append([pay, h1, h2, receive])
+        return paths
+
+    def _hop(self, pay: str, receive: str, amount_in: int) -> Dict[str, Any]:
+        pool, forward = self._by_pair[(pay, receive)]
+        r_in, r_out = (pool.reserve_0, pool.reserve_1) if forward else (pool.reserve_1, pool.reserve_0)
+        amount_out = amount_in * r_out // (r_in + amount_in) if r_in + amount_in > 0 else 0
+        lp_fee = amount_out * pool.lp_fee_bps // 10000
+        gas_fee = self.token_fees.get(receive, 0)
+        return {
+            "pool_symbol": f"{pool.symbol_0}_{pool.symbol_1}",
+            "pay_chain": "IC", "pay_symbol": pay, "pay_address": self.addresses.get(pay, ""),
+            "pay_amount": amount_in,
+            "receive_chain": "IC", "receive_symbol": receive, "receive_address": self.addresses.get(receive, ""),
+            "receive_amount": max(0, amount_out - lp_fee - gas_fee),
+            "price": amount_out / amount_in if amount_in else 0.0,
+            "lp_fee": lp_fee, "gas_fee": gas_fee,
+            "_raw_ratio": r_out / r_in if r_in else 0.0,
+        }
+
+    def swap_amounts(self, pay: str, amount: int, receive: str) -> Dict[str, Any]:
+        """Local equivalent of Kong's swap_amounts(pay, amount, receive): {'Ok': record} or {'Err': text}."""
+        best = None
+        for path in self.routes(pay, receive):
+            txs = []
+            amount_in = amount
+            for a, b in zip(path, path[1:]):
+                tx = self._hop(a, b, amount_in)
+                txs.append(tx)
+                amount_in = tx["receive_amount"]
+            if best is None or amount_in > best[0]:
+                best = (amount_in, txs)
+        if best is None:
+            return {"Err": f"No pool found for {pay}/{receive}"}
+
+        receive_amount, txs = best
+        raw_mid = 1.0
+        for tx in txs:
+            raw_mid *= tx.pop("_raw_ratio")
+        # mid_price is in human units (receive per pay), like the canister reports it
+        scale = 10 ** (self.decimals.get(pay, 8) - self.decimals.get(receive, 8))
+        mid_price = raw_mid * scale
+        price = receive_amount / amount * scale if amount else 0.0
+        slippage = max(0.0, (mid_price - price) / mid_price * 100) if mid_price > 0 else 100.0
+        return {"Ok": {
+            "pay_chain": "IC", "pay_symbol": pay, "pay_address": self.addresses.get(pay, ""),
+            "pay_amount": amount,
+            "receive_chain": "IC", "receive_symbol": receive, "receive_address": self.addresses.get(receive, ""),
+            "receive_amount": receive_amount,
+            "price": price, "mid_price": mid_price, "slippage": slippage,
+            "txs": txs,
+        }}
+
+    def apply_swap(self, record: Dict[str, Any]) -> None:
+        """Move the reserves as if the swap_amounts record was executed (simulations).
+
+        Each hop's pool takes pay_amount and pays out receive_amount plus the gas fee;
+        the LP fee stays in the pool.
+        """
+        for tx in record["txs"]:
+            pool, forward = self._by_pair[(tx["pay_symbol"], tx["receive_symbol"])]
+            paid_out = tx["receive_amount"] + tx["gas_fee"]
+            if forward:
+                pool.reserve_0 += tx["pay_amount"]
+                pool.reserve_1 -= paid_out
+            else:
+                pool.reserve_1 += tx["pay_amount"]
+                pool.reserve_0 -= paid_out
+
+
+# ============================================
+# ICPSwap: concentrated-liquidity (v3) pools
+# ============================================
+#
+# Integer math ported from Uniswap v3 core (TickMath, SqrtPriceMath, SwapMath,
+# TickBitmap), which ICPSwap's SwapPool implements. Results are exact, including
+# the per-word stepping of the tick bitmap (each step rounds separately).
+
+Q96 = 1 << 96
+UINT256_MAX = (1 << 256) - 1
+MIN_TICK = -887272
+MAX_TICK = 887272
+MIN_SQRT_RATIO = 4295128739
+MAX_SQRT_RATIO = 1461446703485210103287273052203988822378723970342
+FEE_DENOMINATOR = 1_000_000  # Pool fee is in hundredths of a bip (3000 = 0.3%)
+
+_TICK_RATIO_FACTORS = (
+    (0x2, 0xfff97272373d413259a46990580e213a), (0x4, 0xfff2e50f5f656932ef12357cf3c7fdcc),
+    (0x8, 0xffe5caca7e10e4e61c3624eaa0941cd0), (0x10, 0xffcb9843d60f6159c9db58835c926644),
+    (0x20, 0xff973b41fa98c081472e6896dfb254c0), (0x40, 0xff2ea16466c96a3843ec78b326b52861),
+    (0x80, 0xfe5dee046a99a2a811c461f1969c3053), (0x100, 0xfcbe86c7900a88aedcffc83b479aa3a4),
+    (0x200, 0xf987a7253ac413176f2b074cf7815e54), (0x400, 0xf3392b0822b70005940c7a398e4b70f3),
+    (0x800, 0xe7159475a2c29b7443b29c7fa6e889d9), (0x1000, 0xd097f3bdfd2022b8845ad8f792aa5825),
+    (0x2000, 0xa9f746462d870fdf8a65dc1f90e061e5), (0x4000, 0x70d869a156d2a1b890bb3df62baf32f7),
+    (0x8000, 0x31be135f97d08fd981231505542fcfa6), (0x10000, 0x9aa508b5b7a84e1c677de54f3e99bc9),
+    (0x20000, 0x5d6af8dedb81196699c329225ee604), (0x40000, 0x2216e584f5fa1ea926041bedfe98),
+    (0x80000, 0x48a170391f7dc42444e8fa2),
+)
+
+
+def sqrt_ratio_at_tick(tick: int) -> int:
+    """TickMath.getSqrtRatioAtTick: sqrt(1.0001^tick) as a Q64.96."""
+    abs_tick = abs(tick)
+    if abs_tick > MAX_TICK:
+        raise ValueError(f"tick {tick} out of range")
+    ratio = 0xfffcb933bd6fad37aa2d162d1a594001 if abs_tick & 0x1 else 1 << 128
+    for bit, factor in _TICK_RATIO_FACTORS:
+        if abs_tick & bit:
+            ratio = (ratio * factor) >> 128
+    if tick > 0:
+        ratio = UINT256_MAX // ratio
+    return (ratio >> 32) + (0 if ratio % (1 << 32) == 0 else 1)
+
+
+def tick_at_sqrt_ratio(sqrt_price_x96: int) -> int:
+    """TickMath.getTickAtSqrtRatio: greatest tick whose sqrt ratio is <= sqrt_price_x96."""
+    lo, hi = MIN_TICK, MAX_TICK
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if sqrt_ratio_at_tick(mid) <= sqrt_price_x96:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def _div_up(a: int, b: int) -> int:
+    return -(-a // b)
+
+
+def _amount0_delta(sqrt_a: int, sqrt_b: int, liquidity: int, round_up: bool) -> int:
+    if sqrt_a > sqrt_b:
+        sqrt_a, sqrt_b = sqrt_b, sqrt_a
+    numerator1 = liquidity << 96
+    numerator2 = sqrt_b - sqrt_a
+    if round_up:
+        return _div_up(_div_up(numerator1 * numerator2, sqrt_b), sqrt_a)
+    return numerator1 * numerator2 // sqrt_b // sqrt_a
+
+
+def _amount1_delta(sqrt_a: int, sqrt_b: int, liquidity: int, round_up: bool) -> int:
+    if sqrt_a > sqrt_b:
+        sqrt_a, sqrt_b = sqrt_b, sqrt_a
+    if round_up:
+        return _div_up(liquidity * (sqrt_b - sqrt_a), Q96)
+    return liquidity * (sqrt_b - sqrt_a) // Q96
+
+
+def _next_sqrt_price_from_input(sqrt_price: int, liquidity: int, amount_in: int, zero_for_one: bool) -> int:
+    if zero_for_one:
+        # getNextSqrtPriceFromAmount0RoundingUp (add)
+        if amount_in == 0:
+            return sqrt_price
+        numerator1 = liquidity << 96
+        product = amount_in * sqrt_price
+        if product <= UINT256_MAX and numerator1 + product <= UINT256_MAX:
+            return _div_up(numerator1 * sqrt_price, numerator1 + product)
+        return _div_up(numerator1, numerator1 // sqrt_price + amount_in)
+    # getNextSqrtPriceFromAmount1RoundingDown (add)
+    return sqrt_price + (amount_in << 96) // liquidity
+
+
+def _swap_step(sqrt_current: int, sqrt_target: int, liquidity: int, remaining: int, fee: int) -> Tuple[int, int, int, int]:
+    """SwapMath.computeSwapStep for exact input: (sqrt_next, amount_in, amount_out, fee_amount)."""
+    zero_for_one = sqrt_current >= sqrt_target
+    remaining_less_fee = remaining * (FEE_DENOMINATOR - fee) // FEE_DENOMINATOR
+    if zero_for_one:
+        amount_in = _amount0_delta(sqrt_target, sqrt_current, liquidity, True)
+    else:
+        amount_in = _amount1_delta(sqrt_current, sqrt_target, liquidity, True)
+    if remaining_less_fee >= amount_in:
+        sqrt_next = sqrt_target
+    else:
+        sqrt_next = _next_sqrt_price_from_input(sqrt_current, liquidity, remaining_less_fee, zero_for_one)
+    reached_target = sqrt_next == sqrt_target
+    if zero_for_one:
+        if not reached_target:
+            amount_in = _amount0_delta(sqrt_next, sqrt_current, liquidity, True)
+        amount_out = _amount1_delta(sqrt_next, sqrt_current, liquidity, False)
+    else:
+        if not reached_target:
+            amount_in = _amount1_delta(sqrt_current, sqrt_next, liquidity, True)
+        amount_out = _amount0_delta(sqrt_current, sqrt_next, liquidity, False)
+    if reached_target:
+        fee_amount = _div_up(amount_in * fee, FEE_DENOMINATOR - fee)
+    else:
+        fee_amount = remaining - amount_in
+    return sqrt_next, amount_in, amount_out, fee_amount
+
+
+class V3Pool:
+    """Snapshot of one ICPSwap pool (price, in-range liquidity, initialized ticks)."""
+
+    def __init__(self, sqrt_price_x96: int, tick: int, liquidity: int, fee: int, tick_spacing: int,
+                 liquidity_net: Dict[int, int]):
+        self.sqrt_price_x96 = sqrt_price_x96
+        self.tick = tick
+        self.liquidity = liquidity
+        self.fee = fee
+        self.tick_spacing = tick_spacing
+        self.liquidity_net = liquidity_net
+        self._compressed = sorted(t // tick_spacing for t in liquidity_net)
+
+    @classmethod
+    def from_replies(cls, metadata_reply: List[Any], tick_pages: List[List[Any]]) -> "V3Pool":
+        """Build from a `metadata` reply and `getTickInfos` page replies."""
+        result = metadata_reply[0] if metadata_reply and isinstance(metadata_reply[0], dict) else {}
+        meta = result.get("ok")
+        if not isinstance(meta, dict):
+            raise ValueError(f"Unexpected ICPSwap metadata reply: {str(result)[:100]}")
+        liquidity_net = {}
+        for page in tick_pages:
+            for info in parse_tick_page(page)[0]:
+                tick = int(info.get("tickIndex", info.get("id", 0)))
+                if info.get("liquidityGross", 1) > 0:
+                    liquidity_net[tick] = info["liquidityNet"]
+        return cls(meta["sqrtPriceX96"], meta["tick"], meta["liquidity"], meta["fee"],
+                   meta.get("tickSpacing", 60), liquidity_net)
+
+    def _next_initialized_tick(self, tick: int, lte: bool) -> Tuple[int, bool]:
+        """TickBitmap.nextInitializedTickWithinOneWord."""
+        spacing = self.tick_spacing
+        compressed = tick // spacing  # Floor division matches the bitmap's round-toward-negative
+        if lte:
+            word_start = (compressed >> 8) << 8
+            i = bisect_right(self._compressed, compressed) - 1
+            if i >= 0 and self._compressed[i] >= word_start:
+                return self._compressed[i] * spacing, True
+            return word_start * spacing, False
+        compressed += 1
+        word_end = ((compressed >> 8) << 8) + 255
+        i = bisect_left(self._compressed, compressed)
+        if i < len(self._compressed) and self._compressed[i] <= word_end:
+            return self._compressed[i] * spacing, True
+        return word_end * spacing, False
+
+    def quote(self, amount_in: int, zero_for_one: bool) -> int:
+        """Output amount of an exact-input swap with no price limit (what the pool's `quote` returns)."""
+        if amount_in <= 0:
+            return 0
+        limit = MIN_SQRT_RATIO + 1 if zero_for_one else MAX_SQRT_RATIO - 1
+        sqrt_price, tick, liquidity = self.sqrt_price_x96, self.tick, self.liquidity
+        remaining, amount_out = amount_in, 0
+        while remaining != 0 and sqrt_price != limit:
+            start_price = sqrt_price
+            tick_next, initialized = self._next_initialized_tick(tick, zero_for_one)
+            tick_next = max(MIN_TICK, min(MAX_TICK, tick_next))
+            sqrt_next = sqrt_ratio_at_tick(tick_next)
+            if zero_for_one:
+                target = limit if sqrt_next < limit else sqrt_next
+            else:
+                target = limit if sqrt_next > limit else sqrt_next
+            sqrt_price, step_in, step_out, fee_amount = _swap_step(sqrt_price, target, liquidity, remaining, self.fee)
+            remaining -= step_in + fee_amount
+            amount_out += step_out
+            if sqrt_price == sqrt_next:
+                if initialized:
+                    net = self.liquidity_net[tick_next]
+                    liquidity += -net if zero_for_one else net
+                tick = tick_next - 1 if zero_for_one else tick_next
+            elif sqrt_price != start_price:
+                tick = tick_at_sqrt_ratio(sqrt_price)
+        return amount_out
+
+
+def parse_tick_page(reply: List[Any]) -> Tuple[List[Dict[str, Any]], int]:
+    """(tick infos, totalElements) from a getTickInfos reply (ok = Page or a bare vec)."""
+    result = reply[0] if reply and isinstance(reply[0], dict) else {}
+    if "ok" not in result:
+        raise ValueError(f"Unexpected ICPSwap getTickInfos reply: {str(result)[:100]}")
+    page = result["ok"]
+    if isinstance(page, dict):
+        content = page.get("content", [])
+        return content, page.get("totalElements", len(content))
+    return page, len(page)
+
+
+# ============================================
+# Validation against live quotes
+# ============================================
+
+class QuoteValidation:
+    """Running comparison of local vs live quote outputs, per exchange."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stats: Dict[str, Dict[str, Any]] = {}
+
+    def record(self, exchange: str, label: str, local_out: int, live_out: int) -> float:
+        """Record one comparison; returns the deviation in bp of the live output
+        (10000 when exactly one side produced no output)."""
+        if live_out <= 0 and local_out <= 0:
+            deviation = 0.0
+        elif live_out <= 0 or local_out <= 0:
+            deviation = 10000.0
+        else:
+            deviation = abs(local_out - live_out) / live_out * 10000
+        with self._lock:
+            s = self.stats.setdefault(exchange, {"n": 0, "total_bp": 0.0, "max_bp": 0.0, "worst": ""})
+            s["n"] += 1
+            s["total_bp"] += deviation
+            if deviation >= s["max_bp"]:
+                s["max_bp"] = deviation
+                s["worst"] = f"{label}: local={local_out:,} live={live_out:,}"
+        return deviation
+
+    def summary(self) -> List[str]:
+        lines = []
+        for exchange, s in sorted(self.stats.items()):
+            lines.append(f"Local {exchange} vs live: {s['n']} quotes, avg deviation {s['total_bp'] / s['n']:.2f}bp, "
+                         f"max {s['max_bp']:.2f}bp ({s['worst']})")
+        return lines
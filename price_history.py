@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+"""
+Local copy of the price_archive canister's ICRC-3 price history.
+
+The archive (src/archives/price_archive) stores one block per price
+observation: tx = { operation = "3price"; timestamp; data = { token; ts;
+price_icp; price_usd; source; ... } }. sync() pages through
+icrc3_get_blocks on a thread pool (FETCH_WORKERS pages of PAGE_SIZE blocks
+in flight) and appends the decoded rows to a store directory, so
+backtests (test_exchange_selection.py --backtest) read history from disk.
+
+The store is a directory of part files, one per sync, named after the block
+range they cover (blocks_<start>_<end>.parquet, or .jsonl.gz without
+pyarrow). A rerun fetches only blocks from the highest covered end onwards.
+A part is written under a temporary name and renamed when complete, so an
+interrupted sync leaves no gap. Once more than COMPACT_PARTS parts pile up
+they are merged into one.
+
+Run standalone to sync and summarize the store:
+    python price_history.py [STORE_DIR] [--transport ...] [--record/--replay DIR]
+"""
+
+import glob
+import os
+import re
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+import candid_codec
+import ic_agent
+import result_sink
+
+PRICE_ARCHIVE_CANISTER_ID = "bm6rl-3qaaa-aaaan-qz5ba-cai"
+NETWORK = "ic"
+DEFAULT_STORE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "price_history")
+
+PAGE_SIZE = 1000     # Blocks per icrc3_get_blocks range (~300 bytes each, well under the reply limit)
+FETCH_WORKERS = 8    # Pages in flight
+COMPACT_PARTS = 32   # Merge the store into one part when it has more than this
+
+COLUMNS = [
+    ("block", "int"),
+    ("ts", "int"),          # Observation time, ns since epoch
+    ("token", "str"),       # Token principal
+    ("price_icp", "bigint"),  # e8s ICP per whole token
+    ("price_usd", "float"),
+    ("source", "str"),
+]
+
+_PART = re.compile(r"blocks_(\d+)_(\d+)\.(parquet|jsonl\.gz)$")
+
+
+def _part_ext() -> str:
+    return "parquet" if result_sink.pa is not None else "jsonl.gz"
+
+
+def parts(store: str) -> List[Tuple[int, int, str]]:
+    """(start, end, path) of the store's part files, by start block; end is exclusive."""
+    found = []
+    for path in glob.glob(os.path.join(store, "blocks_*")):
+        m = _PART.search(os.path.basename(path))
+        if m:
+            found.append((int(m.group(1)), int(m.group(2)), path))
+    return sorted(found)
+
+
+def synced_until(store: str) -> int:
+    """First block index not in the store."""
+    end = 0
+    for start, part_end, _ in parts(store):
+        if start > end:
+            break  # Never happens for stores written by sync(); don't skip over a hole
+        end = max(end, part_end)
+    return end
+
+
+def read_rows(store: str) -> Iterator[Dict[str, Any]]:
+    """Every stored price row, in block order."""
+    for _, _, path in parts(store):
+        yield from result_sink.read_records(path)
+
+
+# ============================================
+# ICRC-3 decoding
+# ============================================
+
+def map_entries(value) -> List[Tuple[str, Any]]:
+    """The (key, value) entries of a Map Value ([] for anything else)."""
+    return value.get("Map", []) if isinstance(value, dict) else []
+
+
+def variant_value(value):
+    """The payload of a Value variant (Nat / Int / Text / Blob)."""
+    return next(iter(value.values())) if isinstance(value, dict) and len(value) == 1 else None
+
+
+def price_row(block_id: int, block) -> Optional[Dict[str, Any]]:
+    """Decode a 3price block into a row, or None for any other block."""
+    tx = dict(map_entries(block)).get("tx")
+    fields = dict(map_entries(tx))
+    if variant_value(fields.get("operation", {})) != "3price":
+        return None
+    data = {k: variant_value(v) for k, v in map_entries(fields.get("data"))}
+    token, price_icp = data.get("token"), data.get("price_icp")
+    if not isinstance(token, bytes) or price_icp is None:
+        return None
+    try:
+        price_usd = float(data.get("price_usd") or 0)
+    except ValueError:
+        price_usd = None
+    return {
+        "block": block_id,
+        "ts": data.get("ts", variant_value(fields.get("timestamp", {}))),
+        "token": str(candid_codec.Principal.from_bytes(token)),
+        "price_icp": price_icp,
+        "price_usd": price_usd,
+        "source": data.get("source"),
+    }
+
+
+# ============================================
+# Fetching
+# ============================================
+
+class ArchiveReader:
+    """icrc3_get_blocks reader for one archive canister (and the archives it points to).
+
+    decode(block_id, block) turns a block into a row, or None to skip it.
+    """
+
+    def __init__(self, transport, canister_id: str = PRICE_ARCHIVE_CANISTER_ID,
+                 decode: Callable[[int, Any], Optional[Dict[str, Any]]] = price_row):
+        self.transport = transport
+        self.canister_id = canister_id
+        self.decode = decode
+
+    def _get_blocks(self, canister_id: str, start: int, length: int, method: str = "icrc3_get_blocks"):
+        result = self.transport.call(
+            canister_id, method, f"(vec {{ record {{ start = {start} : nat; length = {length} : nat }} }})", 60)
+        if not result.ok:
+            raise RuntimeError(f"{canister_id}.{method}({start}, {length}): {result.error}")
+        reply = result.reply()
+        if not reply or not isinstance(reply[0], dict):
+            raise RuntimeError(f"{canister_id}.{method}({start}, {length}): unexpected reply {reply!r}")
+        return reply[0]
+
+    def log_length(self) -> int:
+        return self._get_blocks(self.canister_id, 0, 0)["log_length"]
+
+    def fetch(self, start: int, length: int) -> List[Dict[str, Any]]:
+        """Decoded rows of blocks [start, start + length), following archived_blocks callbacks.
+
+        Canisters may return fewer blocks than asked for; the rest is requested
+        again until the range is covered. Raises RuntimeError if it can't be.
+        """
+        blocks: Dict[int, Any] = {}
+        end = start + length
+        while start < end:
+            res = self._get_blocks(self.canister_id, start, end - start)
+            for entry in res.get("blocks", []):
+                blocks[entry["id"]] = entry["block"]
+            for archived in res.get("archived_blocks", []):
+                archive_id, method = archived["callback"]
+                for rng in archived["args"]:
+                    sub = self._get_blocks(str(archive_id), rng["start"], rng["length"], method)
+                    for entry in sub.get("blocks", []):
+                        blocks[entry["id"]] = entry["block"]
+            covered = start
+            while covered < end and covered in blocks:
+                covered += 1
+            if covered == start:
+                raise RuntimeError(f"{self.canister_id}: block {start} not returned")
+            start = covered
+        rows = (self.decode(i, blocks[i]) for i in sorted(blocks))
+        return [row for row in rows if row is not None]
+
+
+def fetch_pages(reader: ArchiveReader, start: int, end: int, log=print) -> Iterator[Tuple[int, List[Dict[str, Any]]]]:
+    """(page end, rows) for blocks [start, end), in block order, fetched FETCH_WORKERS pages at a time.
+
+    Stops after the last page before one that failed, so a caller that stores
+    every page it gets never leaves a gap.
+    """
+    pages = [(s, min(PAGE_SIZE, end - s)) for s in range(start, end, PAGE_SIZE)]
+    log(f"{reader.canister_id}: fetching blocks {start:,}-{end - 1:,} ({len(pages)} pages, {FETCH_WORKERS} in flight)")
+    with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as pool:
+        futures = [pool.submit(reader.fetch, s, n) for s, n in pages]
+        for (s, n), future in zip(pages, futures):
+            try:
+                rows = future.result()
+            except (RuntimeError, candid_codec.CandidError) as e:
+                log(f"  stopped at block {s:,}: {e}")
+                for later in futures:
+                    later.cancel()
+                return
+            yield s + n, rows
+
+
+def _write_part(store: str, start: int, end: int, rows) -> str:
+    path = os.path.join(store, f"blocks_{start:012d}_{end:012d}.{_part_ext()}")
+    tmp = os.path.join(store, f".tmp-{os.path.basename(path)}")
+    sink = result_sink.ResultSink([tmp], COLUMNS)
+    for row in rows:
+        sink.write(row)
+    sink.close()
+    os.replace(tmp, path)
+    return path
+
+
+def compact(store: str) -> None:
+    """Merge all parts into one (streams the rows; the old parts go once the new one is in place)."""
+    old = parts(store)
+    if len(old) < 2:
+        return
+    _write_part(store, old[0][0], synced_until(store), read_rows(store))
+    for _, _, path in old:
+        os.remove(path)
+
+
+def sync(transport, store: str = DEFAULT_STORE, canister_id: str = PRICE_ARCHIVE_CANISTER_ID,
+         log=print) -> Tuple[int, int]:
+    """Fetch the blocks the store doesn't have yet. Returns (new blocks, new price rows).
+
+    Pages are fetched in parallel and written in order; a failed page ends the
+    part at the last contiguous block, so the next sync starts there.
+    """
+    os.makedirs(store, exist_ok=True)
+    reader = ArchiveReader(transport, canister_id)
+    start = synced_until(store)
+    end = reader.log_length()
+    if end <= start:
+        log(f"Price history: {start:,} blocks, up to date")
+        return 0, 0
+
+    rows: List[Dict[str, Any]] = []
+    fetched_until = start
+    for fetched_until, page in fetch_pages(reader, start, end, log):
+        rows.extend(page)
+
+    if fetched_until > start:
+        _write_part(store, start, fetched_until, rows)
+        if len(parts(store)) > COMPACT_PARTS:
+            compact(store)
+    log(f"Price history: +{fetched_until - start:,} blocks, +{len(rows):,} prices (store: {store})")
+    return fetched_until - start, len(rows)
+
+
+def load_price_series(store: str = DEFAULT_STORE) -> Dict[str, List[Tuple[int, int]]]:
+    """token principal -> [(ts_ns, price_icp e8s)] sorted by time."""
+    series: Dict[str, List[Tuple[int, int]]] = {}
+    for row in read_rows(store):
+        if row.get("ts") is not None and row.get("price_icp"):
+            series.setdefault(row["token"], []).append((int(row["ts"]), int(row["price_icp"])))
+    for points in series.values():
+        points.sort()
+    return series
+
+
+def main():
+    args = sys.argv[1:]
+    transport_opts = ic_agent.pop_transport_flags(args)
+    transport = ic_agent.make_transport(network=NETWORK, identity=None, **transport_opts)
+    store = args[0] if args else DEFAULT_STORE
+
+    sync(transport, store)
+    series = load_price_series(store)
+    if not series:
+        print("No prices stored")
+        return
+    print(f"\n{'Token':<30} {'Prices':>8}  {'From':<16}  {'To':<16}")
+    for token, points in sorted(series.items(), key=lambda kv: -len(kv[1])):
+        first, last = (datetime.utcfromtimestamp(p[0] / 1e9).strftime("%Y-%m-%d %H:%M") for p in (points[0], points[-1]))
+        print(f"{token:<30} {len(points):8,}  {first:<16}  {last:<16}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+"""
+Streaming result files for the exchange selection harness.
+
+Sweep TestResults and --full trade records are appended to disk as they
+complete (--results PATH), so a crash loses at most the last unflushed batch,
+and a finished file can be summarized again later (--summary-from PATH)
+without holding the run in memory.
+
+Formats, chosen by file extension:
+- .jsonl / .jsonl.gz: one JSON object per line, flushed every FLUSH_EVERY
+  records or FLUSH_SECONDS, whichever comes first. Crash-safe: every
+  complete line is readable, and a sweep can be resumed from the file
+  (--resume PATH appends to it).
+- .parquet: columnar, one row group per ROW_GROUP_SIZE records (needs
+  pyarrow). The footer is written on close(), so an interrupted file is
+  unreadable; pair it with a .jsonl file for long runs.
+
+Columns are declared up front as (name, type) with type one of 'str', 'int'
+(int64), 'bigint' (token amounts that can exceed int64: decimal128(38, 0)),
+'float', 'bool' or 'int_pair' (list<int64>, e.g. split_pct), so every row
+group of a Parquet file has the same schema however sparse a column is.
+"""
+
+import gzip
+import json
+import os
+import time
+import zlib
+from decimal import Decimal
+from typing import Any, Dict, Iterator, List, Sequence, Tuple
+
+try:
+    import pyarrow as pa  # Optional: only .parquet files need it
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+FLUSH_EVERY = 100        # JSONL records buffered before a flush ...
+FLUSH_SECONDS = 2.0      # ... or seconds since the last one (bounds what a crash can lose)
+ROW_GROUP_SIZE = 10_000  # Parquet records per row group
+
+Columns = Sequence[Tuple[str, str]]
+
+
+class JsonlSink:
+    """Append records as JSON lines (gzip-compressed when the path ends in .gz)."""
+
+    def __init__(self, path: str, columns: Columns):
+        self.path = path
+        self.columns = [name for name, _ in columns]
+        if path.endswith(".gz"):
+            self._file = gzip.open(path, "at", encoding="utf-8")  # Appending starts a new gzip member
+        else:
+            torn = False
+            if os.path.exists(path) and os.path.getsize(path) > 0:
+                with open(path, "rb") as f:
+                    f.seek(-1, os.SEEK_END)
+                    torn = f.read(1) != b"\n"
+            self._file = open(path, "a", encoding="utf-8")
+            if torn:
+                self._file.write("\n")  # Keep the first new record off an interrupted run's torn last line
+        self._pending = 0
+        self._flushed = time.monotonic()
+        self.written = 0
+
+    def write(self, record: Dict[str, Any]) -> None:
+        self._file.write(json.dumps({name: record.get(name) for name in self.columns}) + "\n")
+        self.written += 1
+        self._pending += 1
+        if self._pending >= FLUSH_EVERY or time.monotonic() - self._flushed >= FLUSH_SECONDS:
+            self.flush()
+
+    def flush(self) -> None:
+        self._file.flush()
+        self._pending = 0
+        self._flushed = time.monotonic()
+
+    def close(self) -> None:
+        self._file.close()
+
+
+def _arrow_type(kind: str):
+    return {
+        "str": pa.string(),
+        "int": pa.int64(),
+        "bigint": pa.decimal128(38, 0),
+        "float": pa.float64(),
+        "bool": pa.bool_(),
+        "int_pair": pa.list_(pa.int64()),
+    }[kind]
+
+
+def _arrow_value(value, kind: str):
+    if value is None:
+        return None
+    if kind == "bigint":
+        return Decimal(int(value))
+    if kind == "int_pair":
+        return [int(v) for v in value]
+    if kind == "str":
+        return str(value)
+    return value
+
+
+class ParquetSink:
+    """Buffer records and write them as Parquet row groups of ROW_GROUP_SIZE."""
+
+    def __init__(self, path: str, columns: Columns):
+        if pa is None:
+            raise RuntimeError(f"{path}: Parquet output needs pyarrow (pip install pyarrow); use .jsonl instead")
+        self.path = path
+        self.columns = list(columns)
+        self.schema = pa.schema([(name, _arrow_type(kind)) for name, kind in self.columns])
+        self._writer = pq.ParquetWriter(path, self.schema)
+        self._rows: List[Dict[str, Any]] = []
+        self.written = 0
+
+    def write(self, record: Dict[str, Any]) -> None:
+        self._rows.append({name: _arrow_value(record.get(name), kind) for name, kind in self.columns})
+        self.written += 1
+        if len(self._rows) >= ROW_GROUP_SIZE:
+            self.flush()
+
+    def flush(self) -> None:
+        if self._rows:
+            self._writer.write_table(pa.Table.from_pylist(self._rows, schema=self.schema))
+            self._rows = []
+
+    def close(self) -> None:
+        self.flush()
+        self._writer.close()
+
+
+class ResultSink:
+    """Fan records out to any number of files (one per --results PATH)."""
+
+    def __init__(self, paths: Sequence[str], columns: Columns):
+        self.paths = list(paths)
+        self._sinks = [ParquetSink(p, columns) if p.endswith(".parquet") else JsonlSink(p, columns) for p in paths]
+
+    def write(self, record: Dict[str, Any]) -> None:
+        for sink in self._sinks:
+            sink.write(record)
+
+    def flush(self) -> None:
+        for sink in self._sinks:
+            sink.flush()
+
+    def close(self) -> None:
+        for sink in self._sinks:
+            sink.close()
+
+    @property
+    def written(self) -> int:
+        return self._sinks[0].written if self._sinks else 0
+
+
+def read_records(path: str) -> Iterator[Dict[str, Any]]:
+    """Stream the records of a .jsonl(.gz) or .parquet result file, one batch in memory at a time."""
+    if path.endswith(".parquet"):
+        if pq is None:
+            raise RuntimeError(f"{path}: reading Parquet needs pyarrow (pip install pyarrow)")
+        for batch in pq.ParquetFile(path).iter_batches():
+            for row in batch.to_pylist():
+                yield {k: int(v) if isinstance(v, Decimal) else v for k, v in row.items()}
+        return
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8") as f:
+        try:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue  # Torn last line of an interrupted run
+        except (EOFError, OSError, zlib.error):
+            return  # Truncated gzip member of an interrupted run: everything before it was read
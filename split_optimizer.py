@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+"""
+Continuous Kong/ICPSwap split optimizer for the exchange selection harness.
+
+run_algorithm only considers splits on its step_bp grid. Here each exchange's
+quote points are fitted with a monotone, concave price-impact curve:
+
+    out(x) = a * x / (1 + b * x)       (a > 0, b >= 0: constant-product shape)
+    slippage_bp(x) = c0 + c1 * x       (c1 >= 0)
+
+and the output-maximizing split is solved for directly at 1bp resolution. A
+few quote points per exchange are enough to place the split anywhere, so the
+harness fetches fewer quotes and checks the answer with one verify quote.
+
+concave_bounds gives the range an unquoted point can still take under the same
+shape assumption; the adaptive sampler uses it to skip quotes that cannot
+change the decision.
+"""
+
+from dataclasses import dataclass
+from typing import List, Optional, Sequence, Tuple
+
+
+@dataclass
+class ImpactCurve:
+    """Fitted output and slippage of one exchange as a function of input amount."""
+    a: float
+    b: float
+    c0: float
+    c1: float
+    max_sampled: int  # Largest input that was quoted (extrapolation beyond it is less trustworthy)
+
+    def output(self, amount_in: int) -> float:
+        if amount_in <= 0:
+            return 0.0
+        return self.a * amount_in / (1 + self.b * amount_in)
+
+    def slippage_bp(self, amount_in: int) -> float:
+        return self.c0 + self.c1 * amount_in
+
+    def max_input(self, max_slippage_bp: int) -> float:
+        """Largest input whose predicted slippage is within max_slippage_bp (0 if none)."""
+        if self.c0 > max_slippage_bp:
+            return 0.0
+        if self.c1 <= 0:
+            return float("inf")
+        return (max_slippage_bp - self.c0) / self.c1
+
+
+def _least_squares(xs: Sequence[float], ys: Sequence[float]) -> Tuple[float, float]:
+    """Intercept and slope of the least-squares line through (xs, ys)."""
+    n = len(xs)
+    mean_x = sum(xs) / n
+    mean_y = sum(ys) / n
+    var_x = sum((x - mean_x) ** 2 for x in xs)
+    if var_x == 0:
+        return mean_y, 0.0
+    slope = sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / var_x
+    return mean_y - slope * mean_x, slope
+
+
+def fit_curve(points: Sequence[Tuple[int, int, int]]) -> Optional[ImpactCurve]:
+    """Fit an ImpactCurve to (amount_in, amount_out, slippage_bp) quote points.
+
+    Points with no output (no pool, errors) are ignored; None if nothing is left.
+    Points over the slippage limit are kept: they locate the limit.
+    """
+    pts = [(x, out, slip) for x, out, slip in points if x > 0 and out > 0]
+    if not pts:
+        return None
+    xs = [p[0] for p in pts]
+
+    # out = a x / (1 + b x)  <=>  x / out = 1/a + (b/a) x  (linear in x)
+    if len(pts) >= 2 and len(set(xs)) >= 2:
+        intercept, slope = _least_squares(xs, [x / out for x, out, _ in pts])
+    else:
+        intercept = slope = None
+    if intercept is None or intercept <= 0 or slope < 0:
+        # One point (or noisy points): take b from the observed slippage, which for this
+        # curve shape is b x / (1 + b x), then match the largest point's output exactly
+        x, out, slip = max(pts)
+        s = min(max(slip, 0), 9999) / 10000
+        b = s / (1 - s) / x
+        a = out * (1 + b * x) / x
+    else:
+        a = 1 / intercept
+        b = slope * a
+
+    c0, c1 = _least_squares(xs, [p[2] for p in pts]) if len(set(xs)) >= 2 else (0.0, pts[0][2] / pts[0][0])
+    if c1 < 0:
+        c0, c1 = sum(p[2] for p in pts) / len(pts), 0.0
+    return ImpactCurve(a, b, c0, c1, max(xs))
+
+
+@dataclass
+class SplitPlan:
+    kong_pct: int       # Share of the trade in bp (kong_pct + icp_pct < 10000 for partials)
+    icp_pct: int
+    expected_out: int   # Predicted total output
+    partial: bool
+
+    @property
+    def result_type(self) -> str:
+        if self.kong_pct == 10000:
+            return "SINGLE_KONG"
+        if self.icp_pct == 10000:
+            return "SINGLE_ICP"
+        return "PARTIAL" if self.partial else "SPLIT"
+
+
+def optimize_split(kong: Optional[ImpactCurve], icp: Optional[ImpactCurve], base_amount: int,
+                   icp_fee: int, max_slippage_bp: int) -> Optional[SplitPlan]:
+    """Output-maximizing split of base_amount between Kong and ICPSwap.
+
+    Kong receives base * kong_pct / 10000; ICPSwap swaps its share minus icp_fee
+    (the sell token's transfer fee), like the harness quotes them. Returns a full
+    split when one keeps both legs within max_slippage_bp, otherwise the largest
+    partial, or None when neither exchange can take any amount.
+    """
+    def kong_in(pct: int) -> int:
+        return base_amount * pct // 10000
+
+    def icp_in(pct: int) -> int:
+        return max(0, base_amount * pct // 10000 - icp_fee)
+
+    kong_max = kong.max_input(max_slippage_bp) if kong else 0.0
+    icp_max = icp.max_input(max_slippage_bp) if icp else 0.0
+
+    def total(kong_pct: int) -> float:
+        out = 0.0
+        if kong_pct > 0:
+            out += kong.output(kong_in(kong_pct))
+        if kong_pct < 10000:
+            out += icp.output(icp_in(10000 - kong_pct))
+        return out
+
+    # Feasible full splits: Kong's slippage grows with kong_pct, ICPSwap's shrinks
+    candidates: List[int] = []
+    if kong and kong_in(10000) <= kong_max:
+        candidates.append(10000)
+    if icp and icp_in(10000) <= icp_max:
+        candidates.append(0)
+    if kong and icp:
+        lo = _first_feasible(1, 10000, lambda p: icp_in(10000 - p) <= icp_max)
+        hi = _last_feasible(lo, 9999, lambda p: kong_in(p) <= kong_max) if lo <= 9999 else lo - 1
+        if lo <= hi:
+            candidates.append(_argmax_concave(total, lo, hi))
+
+    if candidates:
+        best = max(candidates, key=total)
+        return SplitPlan(best, 10000 - best, int(total(best)), False)
+
+    # No full split: trade as much as the slippage limits allow on each exchange
+    kong_pct = _last_feasible(0, 10000, lambda p: kong_in(p) <= kong_max) if kong else 0
+    icp_pct = 0
+    if icp:
+        icp_pct = _last_feasible(0, 10000 - kong_pct, lambda p: icp_in(p) <= icp_max)
+    if kong_pct == 0 and icp_pct == 0:
+        return None
+    out = (kong.output(kong_in(kong_pct)) if kong_pct else 0.0) + (icp.output(icp_in(icp_pct)) if icp_pct else 0.0)
+    return SplitPlan(kong_pct, icp_pct, int(out), True)
+
+
+def _first_feasible(lo: int, hi: int, feasible) -> int:
+    """Smallest p in [lo, hi] with feasible(p) (feasible is monotone increasing), or hi + 1 when none."""
+    if not feasible(hi):
+        return hi + 1
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if feasible(mid):
+            hi = mid
+        else:
+            lo = mid + 1
+    return lo
+
+
+def _last_feasible(lo: int, hi: int, feasible) -> int:
+    """Largest p in [lo, hi] with feasible(p) (feasible is monotone decreasing), or lo - 1 when none."""
+    if not feasible(lo):
+        return lo - 1
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if feasible(mid):
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def _argmax_concave(f, lo: int, hi: int) -> int:
+    """Integer argmax of a concave function on [lo, hi] (ternary search)."""
+    while hi - lo > 2:
+        m1 = lo + (hi - lo) // 3
+        m2 = hi - (hi - lo) // 3
+        if f(m1) < f(m2):
+            lo = m1 + 1
+        else:
+            hi = m2
+    return max(range(lo, hi + 1), key=f)
+
+
+def concave_bounds(known: Sequence[Tuple[int, int]], x: int) -> Tuple[float, float]:
+    """Bounds on f(x) for a monotone concave f through the known (x, f(x)) points (sorted by x,
+    starting with (0, 0)): the chord between the neighbours below, and the neighbouring chords
+    extended (or the next known value) above."""
+    left = [p for p in known if p[0] <= x]
+    right = [p for p in known if p[0] >= x]
+    xl, yl = left[-1]
+    if right and right[0][0] == xl:
+        return yl, yl
+    if right:
+        xr, yr = right[0]
+        lo = yl + (yr - yl) * (x - xl) / (xr - xl)
+        hi = float(yr)
+    else:
+        lo, hi = float(yl), float("inf")
+    if len(left) >= 2:
+        xa, ya = left[-2]
+        hi = min(hi, yl + (yl - ya) / (xl - xa) * (x - xl))
+    if len(right) >= 2:
+        xb, yb = right[1]
+        hi = min(hi, yr - (yb - yr) / (xb - xr) * (xr - x))
+    return lo, hi
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""
+SQLite work queue for sharded pair sweeps (--shards / --worker).
+
+The coordinator enqueues the (sell, buy, amount) matrix once; worker processes
+(local, or on other hosts that see the same file) claim contiguous batches,
+run them with their own quote cache and rate limiters, and hand the finished
+TestResult records back in one transaction per batch. The coordinator reads
+results in the order they were committed and feeds them to the same live
+statistics and summary as a single-process sweep.
+
+Claims are leases: a batch that is not finished within LEASE_SECONDS (worker
+killed, host lost) is handed out again, and a result for a task that is
+already done is dropped, so every task is counted exactly once. The queue file
+is also the checkpoint: rerunning the coordinator on it continues the sweep.
+
+Uses the default rollback journal rather than WAL so the file can live on a
+network filesystem, as long as that filesystem implements POSIX locks.
+"""
+
+import json
+import os
+import socket
+import sqlite3
+import time
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+LEASE_SECONDS = 600.0  # A claimed batch not finished within this is handed out again
+BUSY_TIMEOUT = 60.0    # Seconds a connection waits for another process's write lock
+
+Task = Tuple[str, str, int]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    seq INTEGER PRIMARY KEY,
+    sell TEXT NOT NULL,
+    buy TEXT NOT NULL,
+    amount INTEGER NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',  -- pending | claimed | done
+    worker TEXT,
+    lease_until REAL,
+    UNIQUE (sell, buy, amount)
+);
+CREATE TABLE IF NOT EXISTS results (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    worker TEXT NOT NULL,
+    record TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS workers (
+    worker TEXT PRIMARY KEY,
+    started REAL NOT NULL,
+    last_seen REAL NOT NULL,
+    finished REAL,
+    completed INTEGER NOT NULL DEFAULT 0,
+    call_stats TEXT
+);
+"""
+
+
+def worker_name() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class SweepQueue:
+    """One connection to a queue file (each process opens its own)."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._db = sqlite3.connect(path, timeout=BUSY_TIMEOUT, isolation_level=None)
+        self._db.executescript(SCHEMA)
+
+    def close(self) -> None:
+        self._db.close()
+
+    def _write(self, statements):
+        """Run statements(cursor) in one write transaction and return its result."""
+        cur = self._db.cursor()
+        cur.execute("BEGIN IMMEDIATE")
+        try:
+            result = statements(cur)
+        except BaseException:
+            cur.execute("ROLLBACK")
+            raise
+        cur.execute("COMMIT")
+        return result
+
+    # ---- coordinator ----
+
+    def enqueue(self, tasks: Sequence[Task]) -> int:
+        """Add tasks not already queued (in order); returns how many were new."""
+        def insert(cur):
+            before = self._db.total_changes
+            cur.executemany("INSERT OR IGNORE INTO tasks (sell, buy, amount) VALUES (?, ?, ?)", tasks)
+            return self._db.total_changes - before
+        return self._write(insert)
+
+    def counts(self) -> Dict[str, int]:
+        return dict(self._db.execute("SELECT state, COUNT(*) FROM tasks GROUP BY state").fetchall())
+
+    def results_since(self, last_id: int) -> Iterator[Tuple[int, Dict[str, Any]]]:
+        """(id, record) of the results committed after last_id, oldest first."""
+        for row_id, record in self._db.execute(
+                "SELECT id, record FROM results WHERE id > ? ORDER BY id", (last_id,)).fetchall():
+            yield row_id, json.loads(record)
+
+    def workers(self) -> List[Dict[str, Any]]:
+        cur = self._db.execute("SELECT worker, started, last_seen, finished, completed, call_stats "
+                               "FROM workers ORDER BY started")
+        names = [d[0] for d in cur.description]
+        return [dict(zip(names, row)) for row in cur.fetchall()]
+
+    # ---- worker ----
+
+    def register(self, worker: str) -> None:
+        now = time.time()
+        self._write(lambda cur: cur.execute(
+            "INSERT OR REPLACE INTO workers (worker, started, last_seen) VALUES (?, ?, ?)", (worker, now, now)))
+
+    def claim(self, worker: str, size: int) -> List[Task]:
+        """Lease up to `size` pending (or expired) tasks, in queue order."""
+        def take(cur):
+            now = time.time()
+            rows = cur.execute(
+                "SELECT seq, sell, buy, amount FROM tasks "
+                "WHERE state = 'pending' OR (state = 'claimed' AND lease_until < ?) ORDER BY seq LIMIT ?",
+                (now, size)).fetchall()
+            cur.executemany("UPDATE tasks SET state = 'claimed', worker = ?, lease_until = ? WHERE seq = ?",
+                            [(worker, now + LEASE_SECONDS, seq) for seq, *_ in rows])
+            cur.execute("UPDATE workers SET last_seen = ? WHERE worker = ?", (now, worker))
+            return [(sell, buy, amount) for _, sell, buy, amount in rows]
+        return self._write(take)
+
+    def complete(self, worker: str, results: Sequence[Tuple[Task, Optional[Dict[str, Any]]]]) -> int:
+        """Record finished tasks; a task someone else already finished is dropped. Returns how many counted.
+
+        A None record marks a task done without a result (none came back for it), as a
+        single-process sweep would leave it out rather than retry it.
+        """
+        def finish(cur):
+            counted = 0
+            for (sell, buy, amount), record in results:
+                cur.execute("UPDATE tasks SET state = 'done', worker = ? "
+                            "WHERE sell = ? AND buy = ? AND amount = ? AND state != 'done'",
+                            (worker, sell, buy, amount))
+                if cur.rowcount and record is not None:
+                    cur.execute("INSERT INTO results (worker, record) VALUES (?, ?)", (worker, json.dumps(record)))
+                    counted += 1
+            cur.execute("UPDATE workers SET last_seen = ?, completed = completed + ? WHERE worker = ?",
+                        (time.time(), counted, worker))
+            return counted
+        return self._write(finish)
+
+    def release(self, worker: str, tasks: Sequence[Task]) -> None:
+        """Give back claimed tasks that were not run (worker stopping)."""
+        self._write(lambda cur: cur.executemany(
+            "UPDATE tasks SET state = 'pending', worker = NULL, lease_until = NULL "
+            "WHERE sell = ? AND buy = ? AND amount = ? AND state = 'claimed' AND worker = ?",
+            [(sell, buy, amount, worker) for sell, buy, amount in tasks]))
+
+    def finish(self, worker: str, call_stats: Optional[str]) -> None:
+        now = time.time()
+        self._write(lambda cur: cur.execute(
+            "UPDATE workers SET last_seen = ?, finished = ?, call_stats = ? WHERE worker = ?",
+            (now, now, call_stats, worker)))
+
+    def unfinished(self) -> int:
+        """Tasks not done yet (pending or leased)."""
+        return self._db.execute("SELECT COUNT(*) FROM tasks WHERE state != 'done'").fetchone()[0]
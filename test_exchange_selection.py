@@ -23,14 +23,43 @@ Result types:
 - ICP_FB_EXEC: Execution failed after quote succeeded, ICP fallback used (ICPSwap only)
 """
 
-import subprocess
-import re
+import heapq
+import io
+import itertools
+import atexit
+import contextlib
+import glob
+import json
+import math
+import os
+import queue
 import random
+import subprocess
+import sys
+import tempfile
 import time
-from dataclasses import dataclass, field
+from collections import Counter, OrderedDict, defaultdict, deque
+from dataclasses import asdict, dataclass, field, replace
 from typing import Optional, Tuple, List, Dict
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 import threading
+import asyncio
+import bisect
+import signal
+
+try:
+    import numpy as np  # Optional: only run_algorithm_batch / --bench-algorithm need it
+except ImportError:
+    np = None
+
+import candid_codec
+import ic_agent
+import local_quotes
+import price_history
+import result_sink
+import split_optimizer
+import sweep_queue
+import trade_history
 
 # Shared executor for parallel quote fetching within tests
 quote_executor = ThreadPoolExecutor(max_workers=30)
@@ -43,8 +72,26 @@ NETWORK = "ic"
 KONGSWAP_CANISTER = "2ipq2-uqaaa-aaaar-qailq-cai"
 ICPSWAP_FACTORY = "4mmnk-kiaaa-aaaag-qbllq-cai"
 MAX_SLIPPAGE_BP = 100  # 4.5% (450bp = 0.45%) - matches treasury production config
-CALL_TIMEOUT = 25
+CALL_TIMEOUT = 25  # Upper bound; once a method has latency history its timeout follows p99 (--fixed-timeouts)
 MAX_PARALLEL = 12  # More parallel tests since quotes are now fetched in parallel too
+PLAN_MAX_IN_FLIGHT = 30  # Quote calls the sweep planner keeps in flight (the size of quote_executor)
+SHARD_BATCH = 48  # Tests a --worker claims at a time (queue order keeps one sell token's pairs together)
+SHARD_POLL_INTERVAL = 0.5  # Seconds between queue polls (coordinator progress, idle workers)
+MONTE_CARLO_CHUNK = 25  # Portfolios per --monte-carlo process-pool task
+STATUS_REFRESH_INTERVAL = 0.2  # Min seconds between redraws of the live status line
+QUOTE_CACHE_TTL = 30.0  # Seconds a quote (and pool sqrtPriceX96) is reused; 0 disables (--cache-ttl)
+QUOTE_CACHE_SIZE = 4096  # Max cached quotes (least recently used evicted first)
+# Per-exchange quote source: 'remote' | 'local' (--local, --local-kong, --local-icpswap)
+# | 'validate' (--validate-local: live quotes, compared against the local engine)
+QUOTE_MODES = {"kong": "remote", "icpswap": "remote"}
+LOCAL_SNAPSHOT_MAX_AGE = 30.0  # Seconds before a local pool snapshot (Kong pools, ICPSwap ticks) is re-fetched
+ICPSWAP_TICK_PAGE = 500  # Initialized ticks fetched per getTickInfos call
+# Pair sweep: quote points per exchange for the continuous split optimizer (--optimizer [N]);
+# 0 keeps the fixed 20/40/60/80/100% grid and run_algorithm
+SPLIT_OPTIMIZER_POINTS = 0
+# Adaptive quote sampling (--adaptive [BUDGET]): max quote calls per split decision; 0 fetches the full grid
+ADAPTIVE_BUDGET = 0
+ADAPTIVE_CHECK = False  # --adaptive-check: also fetch the full grid and count decision agreement
 
 # Token data: symbol -> (principal, decimals, transfer_fee)
 # Transfer fees are in the token's smallest unit
@@ -69,6 +116,14 @@ PRINCIPAL_TO_SYMBOL = {v[0]: k for k, v in TOKENS.items()}
 
 # ICPSwap pools: (sell_symbol, buy_symbol) -> (pool_id, zero_for_one)
 ICPSWAP_POOLS: Dict[Tuple[str, str], Tuple[str, bool]] = {}
+# Static per-pool metadata from getPools: pool_id -> {token0, token1, fee}
+ICPSWAP_POOL_INFO: Dict[str, Dict] = {}
+
+# On-disk ICPSwap pool registry (shared by the sweep, --full and --exec-fallback)
+POOL_CACHE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".icpswap_pools.json")
+POOL_CACHE_MAX_AGE = 6 * 3600  # Seconds before a cached registry is refreshed in the background (--pool-cache-age)
+POOL_MISS_REFRESH_INTERVAL = 600  # Min seconds between background refreshes triggered by a pair with no pool
+POOL_CACHE_ENABLED = True  # Off for --record/--replay: the pool list comes from the recorded getPools reply
 
 # Test amounts in ICP equivalent
 TRADE_SIZES = [1, 5, 10, 20]
@@ -119,13 +174,92 @@ class TokenDetails:
     price_in_icp: int      # Price in e8s (1 ICP = 10^8)
     target_allocation_bp: int  # Target allocation in basis points (0-10000)
 
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        portfolio = self.__dict__.get("_portfolio")
+        if portfolio is not None and name in PortfolioState.TRACKED:
+            portfolio._update(self.__dict__["_index"], name, value)
+
+    def __copy__(self):
+        # A copy is detached: it must not write into the arrays of the original's PortfolioState
+        return replace(self)
+
 
 @dataclass
 class PortfolioState:
-    """Portfolio state tracking - matches treasury.mo rebalanceState"""
+    """Portfolio state tracking - matches treasury.mo rebalanceState
+
+    tokens stays the editable view; the state mirrors it in parallel integer
+    arrays (index = position in tokens) with each token's value in ICP cached.
+    Setting a token's balance, price_in_icp or target_allocation_bp refreshes
+    only that token's cached value, and current_bp / diff_bp / the imbalance
+    are recomputed lazily: for the touched tokens while the total is unchanged,
+    for all tokens when it moved (every token's share depends on the total).
+    The integer formulas are the ones treasury.mo uses; --check-portfolio
+    checks them against fixed treasury.mo vectors and a full walk of tokens.
+
+    The token set is fixed at construction: adding or removing entries of
+    tokens afterwards trips an assertion in total_value(), and a token
+    replaced under the same symbol is not tracked (set its fields instead).
+    Copies of a token (copy.copy, dataclasses.replace) are detached from it.
+    """
     tokens: Dict[str, TokenDetails]  # symbol -> details
     total_value_icp: int             # Total portfolio value in e8s
 
+    TRACKED = {"balance": "balances", "price_in_icp": "prices", "target_allocation_bp": "targets",
+               "decimals": "scales"}
+
+    def __post_init__(self):
+        details = list(self.tokens.values())
+        self.symbols = list(self.tokens)
+        self.balances = [d.balance for d in details]
+        self.prices = [d.price_in_icp for d in details]
+        self.scales = [10 ** d.decimals for d in details]
+        self.targets = [d.target_allocation_bp for d in details]
+        self.values = [b * p // sc for b, p, sc in zip(self.balances, self.prices, self.scales)]
+        self.value_sum = sum(self.values)
+        self.current_bp = [0] * len(details)
+        self.diff_bp = [0] * len(details)
+        self.imbalance = 0
+        self._dirty = set()           # Tokens whose cached value is stale
+        self._bp_dirty = set()        # Tokens whose current_bp / diff_bp are stale
+        self._bp_total: Optional[int] = None  # Total the bp arrays were computed against
+        for i, d in enumerate(details):
+            object.__setattr__(d, "_portfolio", self)
+            object.__setattr__(d, "_index", i)
+
+    def _update(self, i: int, name: str, value: int) -> None:
+        getattr(self, self.TRACKED[name])[i] = 10 ** value if name == "decimals" else value
+        self._dirty.add(i)
+        self._bp_dirty.add(i)
+
+    def total_value(self) -> int:
+        """Sum of token values in ICP e8s (refreshing the cached values of touched tokens)."""
+        assert len(self.tokens) == len(self.symbols), "tokens added to or removed from a built PortfolioState"
+        for i in self._dirty:
+            value = self.balances[i] * self.prices[i] // self.scales[i]
+            self.value_sum += value - self.values[i]
+            self.values[i] = value
+        self._dirty.clear()
+        return self.value_sum
+
+    def allocations(self, total: int) -> Tuple[List[int], List[int]]:
+        """(current_bp, diff_bp) of every token against `total` (> 0), kept up to date incrementally."""
+        self.total_value()
+        if total == self._bp_total:
+            changed = self._bp_dirty
+        else:
+            changed = range(len(self.symbols))
+            self._bp_total = total
+        for i in changed:
+            current = self.values[i] * 10000 // total
+            diff = self.targets[i] - current
+            self.imbalance += abs(diff) - abs(self.diff_bp[i])
+            self.current_bp[i] = current
+            self.diff_bp[i] = diff
+        self._bp_dirty.clear()
+        return self.current_bp, self.diff_bp
+
 
 @dataclass
 class Quote:
@@ -148,7 +282,7 @@ class Scenario:
 class TestResult:
     pair: str
     amount: int
-    result_type: str  # 'SINGLE_KONG', 'SINGLE_ICP', 'SPLIT', 'SPLIT_INTERP', 'ICP_FALLBACK', 'ICP_FB_SPLIT', 'ICP_FB_EXEC', 'REDUCED', 'FAILURE'
+    result_type: str  # 'SINGLE_KONG', 'SINGLE_ICP', 'SPLIT', 'SPLIT_INTERP', 'SPLIT_OPT', 'ICP_FALLBACK', 'ICP_FB_SPLIT', 'ICP_FB_EXEC', 'REDUCED', 'FAILURE'
     # Note: ICP_FB_EXEC = ICP fallback after execution failure (quote succeeded but swap failed with "slippage over range")
     # This is handled in treasury.mo at line 4110 - only for ICPSwap failures where tokens are recovered immediately
     algorithm_output: int = 0
@@ -164,110 +298,525 @@ class TestResult:
 # ============================================
 
 results_lock = threading.Lock()
+# Finished tests, kept in memory only when they aren't streamed to a --results file
 all_results: List[TestResult] = []
 completed_count = 0
 total_tests = 0
 stop_requested = False
 
 # ============================================
-# DFX Helpers
+# Live Statistics
 # ============================================
+#
+# Status lines and summaries read counters that are updated once per finished test
+# (or trade), instead of re-scanning every result on each refresh.
 
-def get_kong_quote(sell_symbol: str, buy_symbol: str, amount: int, max_retries: int = 2) -> Quote:
-    """Get a KongSwap quote. Uses IC. prefix for all tokens.
+class QuantileSketch:
+    """Streaming percentiles with bounded relative error.
 
-    Calculates slippage from mid_price like treasury.mo (not Kong's raw slippage).
-    Kong's mid_price is in human units but amountIn/receive_amount are in raw token units,
-    so we must normalize using decimals before calculating slippage.
+    Values are counted in log-spaced buckets by magnitude (bucket i covers
+    (gamma^(i-1), gamma^i]), negative values in buckets of their own, so any quantile
+    is within relative_accuracy of an exact one, in O(buckets) memory.
+    """
 
-    Retries on transient failures (timeout, dfx_error) with exponential backoff.
+    def __init__(self, relative_accuracy: float = 0.01):
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.buckets: Dict[int, int] = {}
+        self.negative_buckets: Dict[int, int] = {}  # By magnitude (signed errors)
+        self.zeros = 0
+        self.count = 0
+
+    def add(self, value: float) -> None:
+        self.count += 1
+        if value == 0:
+            self.zeros += 1
+            return
+        buckets = self.buckets if value > 0 else self.negative_buckets
+        i = math.ceil(math.log(abs(value)) / self._log_gamma)
+        buckets[i] = buckets.get(i, 0) + 1
+
+    def quantile(self, q: float) -> float:
+        if not self.count:
+            return 0.0
+        rank = q * (self.count - 1)
+        seen = 0
+        # Most negative first, then zeros, then positive values (the index is by magnitude:
+        # it is <= 0 for |value| <= 1, so the sign lives in which dict a bucket came from)
+        ordered = [(-1, i, n) for i, n in sorted(self.negative_buckets.items(), reverse=True)]
+        ordered += [(0, 0, self.zeros)] + [(1, i, n) for i, n in sorted(self.buckets.items())]
+        for sign, i, n in ordered:
+            seen += n
+            if rank < seen:
+                break
+        return sign * 2 * self.gamma ** i / (self.gamma + 1)
+
+
+def check_quantile_sketch() -> None:
+    """Assert QuantileSketch matches exact percentiles within its accuracy, below 1 and below 0 too."""
+    for values in ([0.2, 0.3, 0.5], [0.01, 0.05, 0.12, 0.4], [-1.0], [-0.5, -0.2, 0.0, 0.3, 7.0],
+                   [-9999.0, -12.5, -0.04, 3.0, 250.0]):
+        sketch = QuantileSketch()
+        for v in values:
+            sketch.add(v)
+        ordered = sorted(values)
+        for q in (0.0, 0.5, 0.95, 1.0):
+            exact = ordered[int(q * (len(ordered) - 1))]
+            got = sketch.quantile(q)
+            assert abs(got - exact) <= 0.011 * abs(exact), f"QuantileSketch p{q * 100:g} of {values}: {got} != {exact}"
+
+
+class RunningStat:
+    """Count, sum, min, max and percentile sketch of a stream of values."""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.min = 0
+        self.max = 0
+        self.sketch = QuantileSketch()
+
+    def add(self, value) -> None:
+        self.count += 1
+        self.total += value
+        self.min = value if self.count == 1 else min(self.min, value)
+        self.max = value if self.count == 1 else max(self.max, value)
+        self.sketch.add(value)
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+
+class SweepStats:
+    """Per-result-type counters and split error statistics of the pair sweep.
+
+    Updated by record_result() under results_lock; print_status() redraws from it
+    at most every STATUS_REFRESH_INTERVAL seconds.
     """
-    kong_sell = f"IC.{sell_symbol}"
-    kong_buy = f"IC.{buy_symbol}"
-    args = f'("{kong_sell}", {amount}, "{kong_buy}")'
-    cmd = f'dfx canister call {KONGSWAP_CANISTER} swap_amounts \'{args}\' --network {NETWORK} --identity anonymous'
 
+    ERROR_TYPES = ('SPLIT_INTERP', 'SPLIT_OPT')
+    # Results listed in the final summary, kept bounded: the largest by a key, or the first few
+    TOP_LISTS = {'SPLIT_INTERP': (15, lambda r: r.error_pct), 'SPLIT_OPT': (15, lambda r: r.error_pct),
+                 'REDUCED': (15, lambda r: r.max_tradeable_icp)}
+    FIRST_LISTS = {'ICP_FALLBACK': 10, 'ICP_FB_SPLIT': 10, 'ICP_FB_EXEC': 10, 'FAILURE': 10}
+
+    def __init__(self):
+        self.by_type: Counter = Counter()
+        self.errors = {rtype: RunningStat() for rtype in self.ERROR_TYPES}
+        self._top: Dict[str, list] = {rtype: [] for rtype in self.TOP_LISTS}
+        self._first: Dict[str, List[TestResult]] = {rtype: [] for rtype in self.FIRST_LISTS}
+        self._seq = itertools.count()
+        self._last_draw = 0.0
+
+    def add(self, result: TestResult) -> None:
+        rtype = result.result_type
+        self.by_type[rtype] += 1
+        if rtype in self.errors:
+            self.errors[rtype].add(result.error_pct)
+        if rtype in self._top:
+            size, key = self.TOP_LISTS[rtype]
+            entry = (key(result), -next(self._seq), result)  # Ties: earlier result ranks higher
+            if len(self._top[rtype]) < size:
+                heapq.heappush(self._top[rtype], entry)
+            elif entry > self._top[rtype][0]:
+                heapq.heapreplace(self._top[rtype], entry)
+        elif rtype in self._first and len(self._first[rtype]) < self.FIRST_LISTS[rtype]:
+            self._first[rtype].append(result)
+
+    def top(self, rtype: str) -> List[TestResult]:
+        """The TOP_LISTS results of rtype, largest key first."""
+        return [r for *_, r in sorted(self._top[rtype], reverse=True)]
+
+    def first(self, rtype: str) -> List[TestResult]:
+        return self._first[rtype]
+
+    def redraw_due(self, force: bool = False) -> bool:
+        now = time.monotonic()
+        if force or now - self._last_draw >= STATUS_REFRESH_INTERVAL:
+            self._last_draw = now
+            return True
+        return False
+
+
+sweep_stats = SweepStats()
+
+# --results PATH: stream every TestResult (sweep) or trade record (--full) to disk as it completes
+RESULT_COLUMNS = [('pair', 'str'), ('amount', 'int'), ('result_type', 'str'), ('algorithm_output', 'bigint'),
+                  ('actual_output', 'bigint'), ('error_pct', 'float'), ('split_pct', 'int_pair'),
+                  ('interpolated', 'bool'), ('details', 'str'), ('max_tradeable_icp', 'float')]
+TRADE_COLUMNS = [('cycle', 'int'), ('attempt', 'int'), ('sell', 'str'), ('buy', 'str'), ('intended_buy', 'str'),
+                 ('amount_sold', 'bigint'), ('amount_bought', 'bigint'), ('intended_icp', 'int'), ('actual_icp', 'int'),
+                 ('is_exact', 'bool'), ('slippage_bp', 'int'), ('sell_diff_bp', 'int'), ('buy_diff_bp', 'int'),
+                 ('route', 'str'), ('split_pct', 'int_pair'), ('fail_reason', 'str'),
+                 ('imbalance_before', 'int'), ('imbalance_after', 'int'), ('imbalance_change', 'int')]
+results_sink: Optional[result_sink.ResultSink] = None
+
+
+def default_checkpoint_path() -> str:
+    """Where a pair sweep checkpoints its results when no .jsonl --results file is given."""
+    return f"sweep_{time.strftime('%Y%m%d_%H%M%S')}.jsonl"
+
+
+def latest_checkpoint() -> Optional[str]:
+    """--resume without a path: the newest default checkpoint in the working directory."""
+    paths = glob.glob("sweep_*.jsonl") + glob.glob("sweep_*.jsonl.gz")
+    return max(paths, key=os.path.getmtime) if paths else None
+
+
+def load_checkpoint(path: str, tasks: set) -> set:
+    """--resume: the (sell, buy, amount) tasks already in a sweep's results file.
+
+    Their results go into sweep_stats, so the final summary covers the whole sweep;
+    results for tasks outside the current matrix (other TRADE_SIZES) are ignored.
+    """
+    done = set()
+    if not os.path.exists(path):
+        return done
+    for record in result_sink.read_records(path):
+        if 'result_type' not in record:
+            raise SystemExit(f"{path} holds --full trade records, not sweep results")
+        result = result_from_record(record)
+        sell, buy = result.pair.split("/", 1)
+        task = (sell, buy, result.amount)
+        if task in tasks and task not in done:
+            done.add(task)
+            sweep_stats.add(result)
+    return done
+
+
+def open_results_sink(paths: List[str], columns) -> None:
+    """Start streaming records to `paths` (closed, and Parquet footers written, at exit)."""
+    global results_sink
+    results_sink = result_sink.ResultSink(paths, columns)
+    atexit.register(results_sink.close)
+
+
+def result_from_record(record: Dict) -> TestResult:
+    record = dict(record)
+    record['split_pct'] = tuple(record.get('split_pct') or (0, 0))
+    return TestResult(**{name: record[name] for name, _ in RESULT_COLUMNS if record.get(name) is not None})
+
+# ============================================
+# Canister Call Helpers
+# ============================================
+
+# Canister-call backend (see ic_agent.py). Default: native HTTP query calls with
+# `dfx canister call` as fallback. main() rebuilds it from --transport / --ic-url.
+# Identical concurrent calls (shared pool metadata, sell->ICP fallback legs) are
+# coalesced into one request by the single-flight layer.
+transport = ic_agent.SingleFlightTransport(ic_agent.make_transport("auto", NETWORK))
+
+# Marker returned by reply parsers when a reply had an unexpected shape (retried as parse_error)
+RETRY_PARSE = object()
+
+
+def canister_call(canister_id: str, method: str, args: str = "()", timeout: float = CALL_TIMEOUT) -> ic_agent.CallResult:
+    """Call a canister method through the active transport. Raises TimeoutError on timeout."""
+    return transport.call(canister_id, method, args, timeout)
+
+
+async def canister_call_async(canister_id: str, method: str, args: str = "()", timeout: float = CALL_TIMEOUT) -> ic_agent.CallResult:
+    """Async twin of canister_call, used by the --async engine."""
+    return await transport.acall(canister_id, method, args, timeout)
+
+
+def _call_with_retries(canister_id: str, method: str, args: str, parse, give_up, max_retries: int):
+    """Call a canister and parse the reply, retrying transient failures with exponential backoff.
+
+    parse(reply) gets the reply as Candid values (CallResult.reply()) and returns the final
+    value, or RETRY_PARSE if the reply had an unexpected shape.
+    give_up(reason) builds the value returned once retries are exhausted
+    (reason: 'dfx_error', 'parse_error', 'timeout' or a truncated exception message).
+    """
     last_error = "unknown"
     for attempt in range(max_retries + 1):
         try:
-            result = subprocess.run(cmd, shell=True, capture_output=True, text=True, timeout=CALL_TIMEOUT)
-            if result.returncode != 0:
+            result = canister_call(canister_id, method, args)
+            if result.ok:
+                value = parse(result.reply())
+                if value is not RETRY_PARSE:
+                    return value
+                last_error = "parse_error"
+            else:
                 last_error = "dfx_error"
-                if attempt < max_retries:
-                    time.sleep(0.5 * (2 ** attempt))  # Exponential backoff: 0.5s, 1s, 2s
-                    continue
-                return Quote(amount, 0, 10000, False, "dfx_error")
-
-            output = result.stdout
-            receive_matches = re.findall(r'receive_amount\s*=\s*(\d[_\d]*)', output)
-            mid_price_match = re.search(r'mid_price\s*=\s*([\d.e+-]+)', output)
-
-            if receive_matches:
-                receive_amount = int(receive_matches[-1].replace('_', ''))  # Use LAST match (top-level)
-
-                # Calculate slippage from mid_price like treasury.mo
-                # Kong's mid_price is in human units (buyToken per sellToken)
-                # but amountIn and receive_amount are in raw token units (e8s, sats, etc.)
-                if mid_price_match:
-                    mid_price = float(mid_price_match.group(1))
-                    if mid_price > 0:
-                        # Get decimals for normalization
-                        sell_decimals = TOKENS[sell_symbol][1]
-                        buy_decimals = TOKENS[buy_symbol][1]
-
-                        # Normalize to human units
-                        sell_factor = 10 ** sell_decimals
-                        buy_factor = 10 ** buy_decimals
-
-                        amount_in_human = amount / sell_factor
-                        actual_out_human = receive_amount / buy_factor
-
-                        # Calculate expected output at spot price
-                        spot_amount_out = amount_in_human * mid_price
-
-                        # Slippage = (spot - actual) / spot * 100
-                        if spot_amount_out > actual_out_human:
-                            slippage_pct = (spot_amount_out - actual_out_human) / spot_amount_out * 100
-                        else:
-                            slippage_pct = 0.0
-                    else:
-                        # mid_price is 0, use Kong's raw slippage as fallback
-                        slippage_match = re.search(r'slippage\s*=\s*([\d.]+)', output)
-                        slippage_pct = float(slippage_match.group(1)) if slippage_match else 100.0
-                else:
-                    # No mid_price found, use Kong's raw slippage as fallback
-                    slippage_match = re.search(r'slippage\s*=\s*([\d.]+)', output)
-                    slippage_pct = float(slippage_match.group(1)) if slippage_match else 100.0
+        except TimeoutError:
+            last_error = "timeout"
+        except candid_codec.CandidError:
+            last_error = "parse_error"
+        except Exception as e:
+            last_error = str(e)[:20]
+        if attempt < max_retries:
+            time.sleep(ic_agent.backoff_delay(attempt))  # Jittered exponential backoff: ~0.5s, 1s, 2s
+    return give_up(last_error)
 
-                slippage_bp = int(slippage_pct * 100)
-                valid = slippage_bp <= MAX_SLIPPAGE_BP and receive_amount > 0
-                return Quote(amount, receive_amount, slippage_bp, valid)
-            else:
-                if "Err" in output:
-                    return Quote(amount, 0, 10000, False, "no_pool")  # Don't retry - no pool is permanent
+
+async def _call_with_retries_async(canister_id: str, method: str, args: str, parse, give_up, max_retries: int):
+    """Async twin of _call_with_retries."""
+    last_error = "unknown"
+    for attempt in range(max_retries + 1):
+        try:
+            result = await canister_call_async(canister_id, method, args)
+            if result.ok:
+                value = parse(result.reply())
+                if value is not RETRY_PARSE:
+                    return value
                 last_error = "parse_error"
-                if attempt < max_retries:
-                    time.sleep(0.5 * (2 ** attempt))
-                    continue
-                return Quote(amount, 0, 10000, False, "parse_error")
-        except subprocess.TimeoutExpired:
+            else:
+                last_error = "dfx_error"
+        except TimeoutError:
             last_error = "timeout"
-            if attempt < max_retries:
-                time.sleep(0.5 * (2 ** attempt))
-                continue
-            return Quote(amount, 0, 10000, False, "timeout")
+        except candid_codec.CandidError:
+            last_error = "parse_error"
         except Exception as e:
             last_error = str(e)[:20]
-            if attempt < max_retries:
-                time.sleep(0.5 * (2 ** attempt))
-                continue
-            return Quote(amount, 0, 10000, False, str(e)[:20])
+        if attempt < max_retries:
+            await asyncio.sleep(ic_agent.backoff_delay(attempt))
+    return give_up(last_error)
+
+
+# ============================================
+# Quote Cache
+# ============================================
 
-    return Quote(amount, 0, 10000, False, last_error)
+# Quote errors that are real answers from the exchange (safe to cache);
+# transient failures (timeout, dfx_error, parse_error, exceptions) are always refetched
+CACHEABLE_QUOTE_ERRORS = {"no_pool", "icp_error", "zero_output"}
 
 
-# Cache for pool metadata (sqrtPriceX96)
-pool_metadata_cache: Dict[str, int] = {}
+class QuoteCache:
+    """Run-wide TTL + LRU cache of quotes, shared by worker threads and the async engine.
+
+    Keys: ("kong", sell, buy, amount) and ("icpswap", pool_id, amount, zero_for_one).
+    ICPSwap entries for a pool are dropped when its observed sqrtPriceX96 changes,
+    since their slippage was computed against the old spot price.
+    """
+
+    def __init__(self, ttl: float = QUOTE_CACHE_TTL, max_size: int = QUOTE_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._entries: "OrderedDict[tuple, Tuple[float, Quote]]" = OrderedDict()
+        self._pool_prices: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: tuple) -> Optional[Quote]:
+        if self.ttl <= 0:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry[0] < self.ttl:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key: tuple, quote: Quote) -> Quote:
+        if self.ttl > 0 and (quote.error is None or quote.error in CACHEABLE_QUOTE_ERRORS):
+            with self._lock:
+                self._entries[key] = (time.monotonic(), quote)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+                    self.evictions += 1
+        return quote
+
+    def observe_pool_price(self, pool_id: str, sqrt_price_x96: Optional[int]):
+        """Record a pool's sqrtPriceX96, invalidating its quotes if the price moved."""
+        if not sqrt_price_x96:
+            return
+        with self._lock:
+            previous = self._pool_prices.get(pool_id)
+            self._pool_prices[pool_id] = sqrt_price_x96
+            if previous is None or previous == sqrt_price_x96:
+                return
+            stale = [k for k in self._entries if k[0] == "icpswap" and k[1] == pool_id]
+            for key in stale:
+                del self._entries[key]
+            self.invalidations += len(stale)
+
+    def summary(self) -> str:
+        lookups = self.hits + self.misses
+        rate = self.hits / lookups * 100 if lookups else 0.0
+        return (f"Quote cache: {self.hits} hits / {self.misses} misses ({rate:.1f}% hit rate), "
+                f"{self.evictions} evicted, {self.invalidations} invalidated by price moves, ttl={self.ttl:g}s")
+
+
+quote_cache = QuoteCache()
+
+
+def _kong_quote_args(sell_symbol: str, buy_symbol: str, amount: int) -> str:
+    """swap_amounts args. Uses IC. prefix for all tokens."""
+    return f'("IC.{sell_symbol}", {amount}, "IC.{buy_symbol}")'
+
+
+def _parse_kong_quote(sell_symbol: str, buy_symbol: str, amount: int, reply: list):
+    """Parse a swap_amounts reply into a Quote (RETRY_PARSE if unparseable).
+
+    Calculates slippage from mid_price like treasury.mo (not Kong's raw slippage).
+    Kong's mid_price is in human units but amountIn/receive_amount are in raw token units,
+    so we must normalize using decimals before calculating slippage.
+    """
+    result = reply[0] if reply and isinstance(reply[0], dict) else {}
+    if "Err" in result:
+        return Quote(amount, 0, 10000, False, "no_pool")  # Don't retry - no pool is permanent
+    ok = result.get("Ok")
+    if not isinstance(ok, dict) or "receive_amount" not in ok:
+        return RETRY_PARSE
+
+    receive_amount = ok["receive_amount"]  # Top-level amount (txs hold per-hop amounts)
+    mid_price = ok.get("mid_price")
+
+    # Calculate slippage from mid_price like treasury.mo
+    # Kong's mid_price is in human units (buyToken per sellToken)
+    # but amountIn and receive_amount are in raw token units (e8s, sats, etc.)
+    if mid_price is not None:
+        if mid_price > 0:
+            # Get decimals for normalization
+            sell_decimals = TOKENS[sell_symbol][1]
+            buy_decimals = TOKENS[buy_symbol][1]
+
+            # Normalize to human units
+            sell_factor = 10 ** sell_decimals
+            buy_factor = 10 ** buy_decimals
+
+            amount_in_human = amount / sell_factor
+            actual_out_human = receive_amount / buy_factor
+
+            # Calculate expected output at spot price
+            spot_amount_out = amount_in_human * mid_price
+
+            # Slippage = (spot - actual) / spot * 100
+            if spot_amount_out > actual_out_human:
+                slippage_pct = (spot_amount_out - actual_out_human) / spot_amount_out * 100
+            else:
+                slippage_pct = 0.0
+        else:
+            # mid_price is 0, use Kong's raw slippage as fallback
+            slippage_pct = float(ok.get("slippage", 100.0))
+    else:
+        # No mid_price found, use Kong's raw slippage as fallback
+        slippage_pct = float(ok.get("slippage", 100.0))
+
+    slippage_bp = int(slippage_pct * 100)
+    valid = slippage_bp <= MAX_SLIPPAGE_BP and receive_amount > 0
+    return Quote(amount, receive_amount, slippage_bp, valid)
+
+
+def get_kong_quote(sell_symbol: str, buy_symbol: str, amount: int, max_retries: int = 2) -> Quote:
+    """Get a KongSwap quote (see _parse_kong_quote for slippage calculation).
+
+    Served from quote_cache when fresh. Retries on transient failures (timeout, dfx_error)
+    with exponential backoff.
+    """
+    key = ("kong", sell_symbol, buy_symbol, amount)
+    cached = quote_cache.get(key)
+    if cached is not None:
+        return cached
+    return quote_cache.put(key, _call_with_retries(
+        KONGSWAP_CANISTER, "swap_amounts", _kong_quote_args(sell_symbol, buy_symbol, amount),
+        lambda reply: _parse_kong_quote(sell_symbol, buy_symbol, amount, reply),
+        lambda reason: Quote(amount, 0, 10000, False, reason),
+        max_retries))
+
+
+async def get_kong_quote_async(sell_symbol: str, buy_symbol: str, amount: int, max_retries: int = 2) -> Quote:
+    """Async twin of get_kong_quote."""
+    key = ("kong", sell_symbol, buy_symbol, amount)
+    cached = quote_cache.get(key)
+    if cached is not None:
+        return cached
+    return quote_cache.put(key, await _call_with_retries_async(
+        KONGSWAP_CANISTER, "swap_amounts", _kong_quote_args(sell_symbol, buy_symbol, amount),
+        lambda reply: _parse_kong_quote(sell_symbol, buy_symbol, amount, reply),
+        lambda reason: Quote(amount, 0, 10000, False, reason),
+        max_retries))
+
+
+# ============================================
+# Local KongSwap quotes (--local-kong / --validate-local)
+# ============================================
+#
+# One bulk `pools` call replaces every swap_amounts call; quotes are computed in-process
+# by local_quotes.KongPoolBook and fed through the same _parse_kong_quote.
+
+_kong_book: Optional[local_quotes.KongPoolBook] = None
+_kong_book_fetched_at = 0.0
+_kong_book_lock = threading.Lock()
+local_validation = local_quotes.QuoteValidation()
+
+
+def _parse_kong_pools(reply: list):
+    try:
+        return local_quotes.KongPoolBook.from_reply(
+            reply,
+            token_fees={sym: info[2] for sym, info in TOKENS.items()},
+            decimals={sym: info[1] for sym, info in TOKENS.items()})
+    except (ValueError, KeyError, TypeError):
+        return RETRY_PARSE
+
+
+def get_kong_book() -> Optional[local_quotes.KongPoolBook]:
+    """Current KongSwap pool snapshot, re-fetched after LOCAL_SNAPSHOT_MAX_AGE (None if unavailable)."""
+    global _kong_book, _kong_book_fetched_at
+    with _kong_book_lock:
+        if _kong_book is None or time.monotonic() - _kong_book_fetched_at >= LOCAL_SNAPSHOT_MAX_AGE:
+            book = _call_with_retries(KONGSWAP_CANISTER, "pools", "(null)", _parse_kong_pools,
+                                      lambda reason: None, 2)
+            if book is not None or _kong_book is None:
+                _kong_book = book
+            _kong_book_fetched_at = time.monotonic()
+        return _kong_book
+
+
+def get_kong_quote_local(sell_symbol: str, buy_symbol: str, amount: int) -> Quote:
+    """Drop-in for get_kong_quote computed from the local pool snapshot."""
+    book = get_kong_book()
+    if book is None:
+        return Quote(amount, 0, 10000, False, "dfx_error")
+    quote = _parse_kong_quote(sell_symbol, buy_symbol, amount, [book.swap_amounts(sell_symbol, amount, buy_symbol)])
+    return quote if quote is not RETRY_PARSE else Quote(amount, 0, 10000, False, "parse_error")
+
+
+def get_kong_quote_validated(sell_symbol: str, buy_symbol: str, amount: int) -> Quote:
+    """Live quote (returned) compared against the local one (recorded in local_validation)."""
+    live = get_kong_quote(sell_symbol, buy_symbol, amount)
+    local = get_kong_quote_local(sell_symbol, buy_symbol, amount)
+    if live.error not in ("timeout", "dfx_error", "parse_error"):
+        local_validation.record("kong", f"{sell_symbol}->{buy_symbol} {amount:,}", local.amount_out, live.amount_out)
+    return live
+
+
+# Cache for pool metadata: pool_id -> (sqrtPriceX96, fetched_at monotonic time)
+# Expires with the quote cache TTL so long runs pick up price moves.
+pool_metadata_cache: Dict[str, Tuple[int, float]] = {}
+
+
+def _cached_pool_metadata(pool_id: str) -> Optional[int]:
+    entry = pool_metadata_cache.get(pool_id)
+    if entry is None:
+        return None
+    if quote_cache.ttl > 0 and time.monotonic() - entry[1] >= quote_cache.ttl:
+        return None
+    return entry[0]
+
+
+def _parse_pool_metadata(pool_id: str, reply: list) -> Optional[int]:
+    """Parse sqrtPriceX96 from a metadata reply and cache it."""
+    result = reply[0] if reply and isinstance(reply[0], dict) else {}
+    metadata = result.get("ok")
+    if isinstance(metadata, dict) and "sqrtPriceX96" in metadata:
+        sqrt_price = metadata["sqrtPriceX96"]
+        pool_metadata_cache[pool_id] = (sqrt_price, time.monotonic())
+        quote_cache.observe_pool_price(pool_id, sqrt_price)
+        return sqrt_price
+    return None  # Parse succeeded but no sqrtPriceX96 - don't retry
 
 
 def get_pool_metadata(pool_id: str, max_retries: int = 2) -> Optional[int]:
@@ -275,167 +824,626 @@ def get_pool_metadata(pool_id: str, max_retries: int = 2) -> Optional[int]:
 
     Retries on transient failures with exponential backoff.
     """
-    if pool_id in pool_metadata_cache:
-        return pool_metadata_cache[pool_id]
+    cached = _cached_pool_metadata(pool_id)
+    if cached is not None:
+        return cached
 
-    cmd = f'dfx canister call {pool_id} metadata \'()\' --network {NETWORK} --identity anonymous'
-    for attempt in range(max_retries + 1):
-        try:
-            result = subprocess.run(cmd, shell=True, capture_output=True, text=True, timeout=CALL_TIMEOUT)
-            if result.returncode != 0:
-                if attempt < max_retries:
-                    time.sleep(0.5 * (2 ** attempt))
-                    continue
-                return None
-
-            output = result.stdout
-            # Parse sqrtPriceX96 from metadata
-            sqrt_match = re.search(r'sqrtPriceX96\s*=\s*(\d[_\d]*)', output)
-            if sqrt_match:
-                sqrt_price = int(sqrt_match.group(1).replace('_', ''))
-                pool_metadata_cache[pool_id] = sqrt_price
-                return sqrt_price
-            return None  # Parse succeeded but no sqrtPriceX96 - don't retry
-        except subprocess.TimeoutExpired:
-            if attempt < max_retries:
-                time.sleep(0.5 * (2 ** attempt))
-                continue
-            return None
-        except:
-            if attempt < max_retries:
-                time.sleep(0.5 * (2 ** attempt))
-                continue
-            return None
-    return None
+    return _call_with_retries(pool_id, "metadata", "()",
+                              lambda reply: _parse_pool_metadata(pool_id, reply),
+                              lambda reason: None, max_retries)
+
+
+async def get_pool_metadata_async(pool_id: str, max_retries: int = 2) -> Optional[int]:
+    """Async twin of get_pool_metadata."""
+    cached = _cached_pool_metadata(pool_id)
+    if cached is not None:
+        return cached
+
+    return await _call_with_retries_async(pool_id, "metadata", "()",
+                                          lambda reply: _parse_pool_metadata(pool_id, reply),
+                                          lambda reason: None, max_retries)
+
+
+def _icpswap_quote_args(amount: int, zero_for_one: bool) -> str:
+    zfo = "true" if zero_for_one else "false"
+    return f'(record {{ amountIn = "{amount}"; zeroForOne = {zfo}; amountOutMinimum = "0" }})'
+
+
+def _parse_icpswap_quote(amount: int, zero_for_one: bool, sqrt_price_x96: Optional[int], reply: list):
+    """Parse an ICPSwap quote reply into a Quote (RETRY_PARSE if unparseable).
+
+    Slippage is calculated exactly like treasury.mo.
+    """
+    result = reply[0] if reply and isinstance(reply[0], dict) else {}
+    if "err" in result:
+        return Quote(amount, 0, 10000, False, "icp_error")  # Don't retry - valid error response
+    amount_out = result.get("ok")
+    if not isinstance(amount_out, int):
+        return RETRY_PARSE
+
+    if amount_out <= 0:
+        return Quote(amount, 0, 10000, False, "zero_output")  # Don't retry - valid response
+
+    # Calculate slippage exactly like treasury.mo
+    slippage_bp = 0
+    if sqrt_price_x96 and sqrt_price_x96 > 0:
+        # spotPrice = (sqrtPriceX96)^2 / 2^192
+        sqrt_squared = sqrt_price_x96 * sqrt_price_x96
+        spot_price = sqrt_squared / (2 ** 192)
+
+        # effectivePrice = amountIn / amountOut
+        effective_price = amount / amount_out
+
+        # Normalize based on direction
+        if zero_for_one:
+            # Trading token0 for token1, want token0/token1 (inverse)
+            normalized_spot = 1.0 / spot_price if spot_price > 0 else 0
+        else:
+            # Trading token1 for token0, same as spot price
+            normalized_spot = spot_price
+
+        # slippage = (effectivePrice - spotPrice) / spotPrice * 100
+        if normalized_spot > 0:
+            slippage_pct = (effective_price - normalized_spot) / normalized_spot * 100
+            slippage_bp = int(abs(slippage_pct) * 100)  # Convert % to basis points
+
+    valid = slippage_bp <= MAX_SLIPPAGE_BP and amount_out > 0
+    return Quote(amount, amount_out, slippage_bp, valid)
 
 
 def get_icpswap_quote(pool_id: str, amount: int, zero_for_one: bool, sqrt_price_x96: Optional[int] = None, max_retries: int = 2) -> Quote:
     """Get an ICPSwap quote with slippage calculated exactly like treasury.mo.
 
+    Served from quote_cache when fresh and the pool's sqrtPriceX96 is unchanged.
     Retries on transient failures (timeout, dfx_error) with exponential backoff.
     """
-    zfo = "true" if zero_for_one else "false"
-    args = f'(record {{ amountIn = "{amount}"; zeroForOne = {zfo}; amountOutMinimum = "0" }})'
-    cmd = f'dfx canister call {pool_id} quote \'{args}\' --network {NETWORK} --identity anonymous'
+    quote_cache.observe_pool_price(pool_id, sqrt_price_x96)
+    key = ("icpswap", pool_id, amount, zero_for_one)
+    cached = quote_cache.get(key)
+    if cached is not None:
+        return cached
+    return quote_cache.put(key, _call_with_retries(
+        pool_id, "quote", _icpswap_quote_args(amount, zero_for_one),
+        lambda reply: _parse_icpswap_quote(amount, zero_for_one, sqrt_price_x96, reply),
+        lambda reason: Quote(amount, 0, 10000, False, reason),
+        max_retries))
+
+
+async def get_icpswap_quote_async(pool_id: str, amount: int, zero_for_one: bool, sqrt_price_x96: Optional[int] = None, max_retries: int = 2) -> Quote:
+    """Async twin of get_icpswap_quote."""
+    quote_cache.observe_pool_price(pool_id, sqrt_price_x96)
+    key = ("icpswap", pool_id, amount, zero_for_one)
+    cached = quote_cache.get(key)
+    if cached is not None:
+        return cached
+    return quote_cache.put(key, await _call_with_retries_async(
+        pool_id, "quote", _icpswap_quote_args(amount, zero_for_one),
+        lambda reply: _parse_icpswap_quote(amount, zero_for_one, sqrt_price_x96, reply),
+        lambda reason: Quote(amount, 0, 10000, False, reason),
+        max_retries))
 
-    last_error = "unknown"
-    for attempt in range(max_retries + 1):
-        try:
-            result = subprocess.run(cmd, shell=True, capture_output=True, text=True, timeout=CALL_TIMEOUT)
-            if result.returncode != 0:
-                last_error = "dfx_error"
-                if attempt < max_retries:
-                    time.sleep(0.5 * (2 ** attempt))  # Exponential backoff: 0.5s, 1s, 2s
-                    continue
-                return Quote(amount, 0, 10000, False, "dfx_error")
-
-            output = result.stdout
-            amount_match = re.search(r'ok\s*=\s*(\d[_\d]*)', output)
-
-            if amount_match:
-                amount_out = int(amount_match.group(1).replace('_', ''))
-                if amount_out <= 0:
-                    return Quote(amount, 0, 10000, False, "zero_output")  # Don't retry - valid response
-
-                # Calculate slippage exactly like treasury.mo
-                slippage_bp = 0
-                if sqrt_price_x96 and sqrt_price_x96 > 0:
-                    # spotPrice = (sqrtPriceX96)^2 / 2^192
-                    sqrt_squared = sqrt_price_x96 * sqrt_price_x96
-                    spot_price = sqrt_squared / (2 ** 192)
-
-                    # effectivePrice = amountIn / amountOut
-                    effective_price = amount / amount_out
-
-                    # Normalize based on direction
-                    if zero_for_one:
-                        # Trading token0 for token1, want token0/token1 (inverse)
-                        normalized_spot = 1.0 / spot_price if spot_price > 0 else 0
-                    else:
-                        # Trading token1 for token0, same as spot price
-                        normalized_spot = spot_price
 
-                    # slippage = (effectivePrice - spotPrice) / spotPrice * 100
-                    if normalized_spot > 0:
-                        slippage_pct = (effective_price - normalized_spot) / normalized_spot * 100
-                        slippage_bp = int(abs(slippage_pct) * 100)  # Convert % to basis points
+# ============================================
+# Local ICPSwap quotes (--local-icpswap / --validate-local)
+# ============================================
+#
+# Each pool's price, in-range liquidity and initialized ticks are loaded once per
+# LOCAL_SNAPSHOT_MAX_AGE; quotes are then exact v3 swap simulations (local_quotes.V3Pool).
 
-                valid = slippage_bp <= MAX_SLIPPAGE_BP and amount_out > 0
-                return Quote(amount, amount_out, slippage_bp, valid)
+# pool_id -> (V3Pool, fetched_at monotonic time)
+_v3_pools: Dict[str, Tuple[local_quotes.V3Pool, float]] = {}
 
-            if "err" in output.lower():
-                return Quote(amount, 0, 10000, False, "icp_error")  # Don't retry - valid error response
-            last_error = "parse_error"
-            if attempt < max_retries:
-                time.sleep(0.5 * (2 ** attempt))
-                continue
-            return Quote(amount, 0, 10000, False, "parse_error")
-        except subprocess.TimeoutExpired:
-            last_error = "timeout"
-            if attempt < max_retries:
-                time.sleep(0.5 * (2 ** attempt))
-                continue
-            return Quote(amount, 0, 10000, False, "timeout")
-        except Exception as e:
-            last_error = str(e)[:20]
-            if attempt < max_retries:
-                time.sleep(0.5 * (2 ** attempt))
+
+def _tick_page_or_retry(reply: list):
+    try:
+        local_quotes.parse_tick_page(reply)
+        return reply
+    except (ValueError, TypeError):
+        return RETRY_PARSE
+
+
+def get_v3_pool(pool_id: str) -> Optional[local_quotes.V3Pool]:
+    """Current snapshot of an ICPSwap pool (None if it couldn't be loaded)."""
+    entry = _v3_pools.get(pool_id)
+    if entry is not None and time.monotonic() - entry[1] < LOCAL_SNAPSHOT_MAX_AGE:
+        return entry[0]
+
+    metadata = _call_with_retries(pool_id, "metadata", "()", lambda reply: reply, lambda reason: None, 2)
+    if metadata is None:
+        return entry[0] if entry else None
+    _parse_pool_metadata(pool_id, metadata)  # Keeps pool_metadata_cache / quote_cache in step
+    pages = []
+    offset = 0
+    while True:
+        page = _call_with_retries(pool_id, "getTickInfos", f"({offset} : nat, {ICPSWAP_TICK_PAGE} : nat)",
+                                  _tick_page_or_retry, lambda reason: None, 2)
+        if page is None:
+            return entry[0] if entry else None
+        pages.append(page)
+        content, total = local_quotes.parse_tick_page(page)
+        offset += len(content)
+        if not content or offset >= total:
+            break
+    try:
+        pool = local_quotes.V3Pool.from_replies(metadata, pages)
+    except (ValueError, KeyError, TypeError):
+        return entry[0] if entry else None
+    _v3_pools[pool_id] = (pool, time.monotonic())
+    return pool
+
+
+def get_icpswap_quote_local(pool_id: str, amount: int, zero_for_one: bool) -> Quote:
+    """Drop-in for get_icpswap_quote computed from the local pool snapshot."""
+    pool = get_v3_pool(pool_id)
+    if pool is None:
+        return Quote(amount, 0, 10000, False, "dfx_error")
+    return _parse_icpswap_quote(amount, zero_for_one, pool.sqrt_price_x96, [{"ok": pool.quote(amount, zero_for_one)}])
+
+
+def get_icpswap_quote_validated(pool_id: str, amount: int, zero_for_one: bool) -> Quote:
+    """Live quote (returned) compared against the local one (recorded in local_validation)."""
+    live = get_icpswap_quote(pool_id, amount, zero_for_one, get_pool_metadata(pool_id))
+    local = get_icpswap_quote_local(pool_id, amount, zero_for_one)
+    if live.error not in ("timeout", "dfx_error", "parse_error"):
+        local_validation.record("icpswap", f"{pool_id} {amount:,} zfo={zero_for_one}", local.amount_out, live.amount_out)
+    return live
+
+
+# ============================================
+# Quote Requests (shared by threaded and async execution)
+# ============================================
+#
+# Decision logic (test_pair, test_pair_internal, get_real_quote_for_trade) is written
+# once as generator "steps": each step yields a list of QuoteRequests and is resumed
+# with the list of Quotes in the same order. _drive() runs steps on quote_executor
+# threads (the default mode); _drive_async() runs them on one asyncio event loop
+# with per-exchange semaphores (--async mode).
+
+@dataclass(frozen=True)
+class QuoteRequest:
+    """One remote quote needed by a decision."""
+    exchange: str          # 'kong' or 'icpswap'
+    amount: int
+    sell_symbol: str = ""  # Kong only
+    buy_symbol: str = ""   # Kong only
+    pool_id: str = ""      # ICPSwap only
+    zero_for_one: bool = False
+
+
+def kong_request(sell_symbol: str, buy_symbol: str, amount: int) -> QuoteRequest:
+    return QuoteRequest("kong", amount, sell_symbol=sell_symbol, buy_symbol=buy_symbol)
+
+
+def icpswap_request(pool_id: str, amount: int, zero_for_one: bool) -> QuoteRequest:
+    """ICPSwap quote; the pool's sqrtPriceX96 is looked up (cached) when it executes."""
+    return QuoteRequest("icpswap", amount, pool_id=pool_id, zero_for_one=zero_for_one)
+
+
+def execute_request(req: QuoteRequest) -> Quote:
+    mode = QUOTE_MODES[req.exchange]
+    if req.exchange == "kong":
+        if mode == "local":
+            return get_kong_quote_local(req.sell_symbol, req.buy_symbol, req.amount)
+        if mode == "validate":
+            return get_kong_quote_validated(req.sell_symbol, req.buy_symbol, req.amount)
+        return get_kong_quote(req.sell_symbol, req.buy_symbol, req.amount)
+    if mode == "local":
+        return get_icpswap_quote_local(req.pool_id, req.amount, req.zero_for_one)
+    if mode == "validate":
+        return get_icpswap_quote_validated(req.pool_id, req.amount, req.zero_for_one)
+    sqrt_price = get_pool_metadata(req.pool_id)
+    return get_icpswap_quote(req.pool_id, req.amount, req.zero_for_one, sqrt_price)
+
+
+def _drive(steps):
+    """Run decision steps, fetching each yielded batch in parallel on quote_executor."""
+    try:
+        requests = next(steps)
+        while True:
+            if len(requests) == 1:
+                quotes = [execute_request(requests[0])]
+            else:
+                futures = [quote_executor.submit(execute_request, r) for r in requests]
+                quotes = [f.result() for f in futures]
+            requests = steps.send(quotes)
+    except StopIteration as done:
+        return done.value
+
+
+# Max concurrent in-flight quote calls per exchange in --async mode
+ASYNC_EXCHANGE_LIMITS = {"kong": 16, "icpswap": 24}
+_async_semaphores: Dict[str, asyncio.Semaphore] = {}
+
+
+async def execute_request_async(req: QuoteRequest) -> Quote:
+    sem = _async_semaphores.get(req.exchange)
+    if sem is None:
+        sem = _async_semaphores[req.exchange] = asyncio.Semaphore(ASYNC_EXCHANGE_LIMITS[req.exchange])
+    async with sem:
+        if QUOTE_MODES[req.exchange] != "remote":
+            # Local math is CPU-only once the snapshot is loaded; fetching it blocks, so off-loop
+            return await asyncio.get_running_loop().run_in_executor(quote_executor, execute_request, req)
+        if req.exchange == "kong":
+            return await get_kong_quote_async(req.sell_symbol, req.buy_symbol, req.amount)
+        sqrt_price = await get_pool_metadata_async(req.pool_id)
+        return await get_icpswap_quote_async(req.pool_id, req.amount, req.zero_for_one, sqrt_price)
+
+
+async def _drive_async(steps):
+    """Run decision steps on the current event loop, fetching each batch concurrently."""
+    try:
+        requests = next(steps)
+        while True:
+            quotes = await asyncio.gather(*(execute_request_async(r) for r in requests))
+            requests = steps.send(list(quotes))
+    except StopIteration as done:
+        return done.value
+
+
+# ============================================
+# Quote Grid Sampling (full or adaptive)
+# ============================================
+#
+# The split decision reads a grid of num_quotes sizes per exchange. By default every
+# point is fetched. With --adaptive, the 100% point and one probe per exchange come
+# first; after that only points that can still change run_algorithm's top two
+# scenarios (or its partial candidates) are fetched, up to ADAPTIVE_BUDGET calls.
+# Bounds for unfetched points assume output is monotone and concave in size, and
+# slippage monotone (split_optimizer.concave_bounds).
+
+class AdaptiveSamplingStats:
+    """Calls per decision and (with --adaptive-check) agreement with the full grid."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.decisions = 0
+        self.calls = 0
+        self.grid_calls = 0
+        self.checked = 0
+        self.agreed = 0
+        self.disagreements: List[str] = []
+
+    def record(self, calls: int, grid_calls: int, agreed: Optional[bool] = None, label: str = "") -> None:
+        with self._lock:
+            self.decisions += 1
+            self.calls += calls
+            self.grid_calls += grid_calls
+            if agreed is not None:
+                self.checked += 1
+                self.agreed += agreed
+                if not agreed and len(self.disagreements) < 10:
+                    self.disagreements.append(label)
+
+    def summary(self) -> str:
+        if not self.decisions:
+            return "Adaptive sampling: no decisions"
+        line = (f"Adaptive sampling: {self.decisions} decisions, {self.calls / self.decisions:.2f} calls/decision "
+                f"(full grid {self.grid_calls / self.decisions:.2f}, budget {ADAPTIVE_BUDGET})")
+        if self.checked:
+            line += f", agreement with full grid {self.agreed / self.checked * 100:.1f}% of {self.checked}"
+        return line
+
+
+adaptive_stats = AdaptiveSamplingStats()
+
+
+# run_algorithm results after which a failed test can still fall back to a REDUCED trade
+_NO_FULL_ROUTE = ('PARTIAL_CANDIDATES', 'NO_PATH')
+
+
+def _decision_key(algo_result) -> tuple:
+    """The part of a run_algorithm result that is the decision (route and split)."""
+    if algo_result[0] == 'PARTIAL_CANDIDATES':
+        return (algo_result[0], tuple((s.kong_pct, s.icp_pct) for s in algo_result[1]))
+    return tuple(algo_result[:3])
+
+
+def _final_key(kong_quotes: List[Quote], icp_quotes: List[Quote], n: int, reduced=None) -> tuple:
+    """The decision plus, where it can come to that, the REDUCED fallback's (size, exchange)."""
+    result = run_algorithm(kong_quotes, icp_quotes, n)
+    key = _decision_key(result)
+    if reduced is not None and result[0] in _NO_FULL_ROUTE:
+        key += (reduced(kong_quotes, icp_quotes),)
+    return key
+
+
+def _grid_scenarios(n: int) -> List[Tuple[Optional[int], Optional[int]]]:
+    """(kong_idx, icp_idx) of run_algorithm's full scenarios (None = exchange not used)."""
+    step_bp = 10000 // n
+    scenarios = [(n - 1, None), (None, n - 1)]
+    for k in range(n):
+        for i in range(n):
+            kong_pct, icp_pct = (k + 1) * step_bp, (i + 1) * step_bp
+            if kong_pct + icp_pct == 10000 and kong_pct != 10000 and icp_pct != 10000:
+                scenarios.append((k, i))
+    return scenarios
+
+
+def _quote_grid_steps(kong_amounts: List[int], icp_amounts: List[int], make_requests, check=None, label: str = "",
+                      reduced=None):
+    """Fetch the quote grid for a split decision; returns (kong_quotes, icp_quotes).
+
+    make_requests = (kong_request_for(amount), icpswap_request_for(amount) or None without a pool).
+    check(quote, amount_in) may mark fetched quotes invalid (e.g. dust outputs).
+    reduced(kong_quotes, icp_quotes) -> (max_icp, exchange) is the caller's REDUCED estimate;
+    --adaptive-check compares it as well when no full route is found.
+    """
+    n = len(kong_amounts)
+    amounts = (kong_amounts, icp_amounts)
+    got: Tuple[Dict[int, Quote], Dict[int, Quote]] = ({}, {})
+    dead = [make is None for make in make_requests]
+    grid_calls = sum(n for make in make_requests if make is not None)
+
+    def fetch(points):
+        quotes = yield [make_requests[e](amounts[e][j]) for e, j in points]
+        for (e, j), q in zip(points, quotes):
+            got[e][j] = check(q, amounts[e][j]) if check else q
+            if q.error == "no_pool":
+                dead[e] = True  # The pair doesn't exist there; no other size will quote
+
+    def filled(e, j, reason="not_sampled"):
+        if j in got[e]:
+            return got[e][j]
+        return Quote(amounts[e][j], 0, 10000, False, "no_pool" if dead[e] else reason)
+
+    if not ADAPTIVE_BUDGET:
+        yield from fetch([(e, j) for e in (0, 1) if not dead[e] for j in range(n)])
+        return [filled(0, j) for j in range(n)], [filled(1, j) for j in range(n)]
+
+    def usable(q):
+        return q.valid and q.slippage_bp <= MAX_SLIPPAGE_BP
+
+    def state(e, j):
+        """'valid', 'invalid' or 'unknown' for grid point j of exchange e."""
+        if dead[e]:
+            return "invalid"
+        q = got[e].get(j)
+        if q is not None:
+            return "valid" if usable(q) else "invalid"
+        # Slippage grows with size: a smaller size already over the limit rules this one out
+        if any(jj < j and not qq.error and qq.amount_out > 0 and qq.slippage_bp > MAX_SLIPPAGE_BP
+               for jj, qq in got[e].items()):
+            return "invalid"
+        return "unknown"
+
+    def bounds(e, j):
+        q = got[e].get(j)
+        if q is not None:
+            return q.amount_out, q.amount_out
+        known = [(0, 0)] + sorted((amounts[e][jj], qq.amount_out) for jj, qq in got[e].items()
+                                  if not qq.error and qq.amount_out > 0)
+        return split_optimizer.concave_bounds(known, amounts[e][j])
+
+    scenarios = _grid_scenarios(n)
+
+    def uncertain_points():
+        """Unfetched points that could still change the decision, most promising first."""
+        rated = []
+        for k, i in scenarios:
+            legs = [(0, k)] if i is None else [(1, i)] if k is None else [(0, k), (1, i)]
+            states = [state(e, j) for e, j in legs]
+            if "invalid" in states:
                 continue
-            return Quote(amount, 0, 10000, False, str(e)[:20])
+            lo = sum(bounds(e, j)[0] for e, j in legs)
+            hi = sum(bounds(e, j)[1] for e, j in legs)
+            rated.append((hi, lo, all(st == "valid" for st in states), legs))
+        if rated:
+            certain = sorted((lo for _, lo, valid, _ in rated if valid), reverse=True)
+            second = certain[1] if len(certain) > 1 else float("-inf")
+            open_legs = [legs for hi, _, _, legs in sorted(rated, key=lambda r: -r[0]) if hi >= second]
+        else:
+            # No full split can be valid: run_algorithm falls back to partial candidates,
+            # which use every valid point of both exchanges
+            open_legs = [[(e, j)] for j in range(n) for e in (0, 1)] if not any(dead) else []
+        points = []
+        for legs in open_legs:
+            for e, j in legs:
+                if j not in got[e] and state(e, j) != "invalid" and (e, j) not in points:
+                    points.append((e, j))
+        return points
+
+    probe = (n - 1) // 2
+    first = [(e, j) for e in (0, 1) if not dead[e] for j in sorted({n - 1, probe})][:ADAPTIVE_BUDGET]
+    yield from fetch(first)
+    calls = len(first)
+    while calls < ADAPTIVE_BUDGET:
+        points = uncertain_points()[:min(2, ADAPTIVE_BUDGET - calls)]
+        if not points:
+            break
+        yield from fetch(points)
+        calls += len(points)
+
+    # No full route on what was fetched: the caller falls back to a REDUCED trade sized from each
+    # exchange's smallest point (estimate_max_tradeable_icp), so fetch those even past the budget
+    if run_algorithm([filled(0, j) for j in range(n)], [filled(1, j) for j in range(n)], n)[0] in _NO_FULL_ROUTE:
+        smallest = [(e, 0) for e in (0, 1) if not dead[e] and 0 not in got[e]]
+        if smallest:
+            yield from fetch(smallest)
+            calls += len(smallest)
+
+    kong_quotes = [filled(0, j) for j in range(n)]
+    icp_quotes = [filled(1, j) for j in range(n)]
+    agreed = None
+    if ADAPTIVE_CHECK:
+        missing = [(e, j) for e in (0, 1) if not dead[e] for j in range(n) if j not in got[e]]
+        if missing:
+            yield from fetch(missing)
+        full = _final_key([filled(0, j) for j in range(n)], [filled(1, j) for j in range(n)], n, reduced)
+        agreed = full == _final_key(kong_quotes, icp_quotes, n, reduced)
+    adaptive_stats.record(calls, grid_calls, agreed, label)
+    return kong_quotes, icp_quotes
+
+
+def parse_icpswap_pools(reply: list) -> List[Dict]:
+    """Parse an ICPSwap factory getPools reply into [{pool_id, token0, token1, fee}]."""
+    result = reply[0] if reply and isinstance(reply[0], dict) else {}
+    return [{'pool_id': str(pool["canisterId"]), 'token0': pool["token0"]["address"],
+             'token1': pool["token1"]["address"], 'fee': pool.get("fee", 0)}
+            for pool in result.get("ok", [])]
+
+
+def parse_icpswap_pools_text(text: str) -> Optional[List[Dict]]:
+    """parse_icpswap_pools straight from a dfx-style getPools reply (ic_agent.GETPOOLS_TEXT_RE),
+    or None if some pool record didn't match (then parse the reply in full)."""
+    found = ic_agent.GETPOOLS_TEXT_RE.findall(text)
+    if len(found) != text.count("canisterId"):
+        return None
+    return [{'pool_id': pool_id, 'token0': token0, 'token1': token1, 'fee': int(fee.replace("_", ""))}
+            for fee, token0, token1, pool_id in found]
 
-    return Quote(amount, 0, 10000, False, last_error)
 
+def _index_icpswap_pools(pools: List[Dict]) -> int:
+    """Add pools between known tokens to ICPSWAP_POOLS. Returns how many matched."""
+    found = 0
+    for pool in pools:
+        sym0 = PRINCIPAL_TO_SYMBOL.get(pool['token0'])
+        sym1 = PRINCIPAL_TO_SYMBOL.get(pool['token1'])
 
-def fetch_icpswap_pools(max_retries: int = 2):
-    """Fetch ALL ICPSwap pools and store by token pair.
+        if sym0 and sym1:
+            # zeroForOne=true means selling token0 for token1
+            ICPSWAP_POOLS[(sym0, sym1)] = (pool['pool_id'], True)
+            ICPSWAP_POOLS[(sym1, sym0)] = (pool['pool_id'], False)
+            ICPSWAP_POOL_INFO[pool['pool_id']] = pool
+            found += 1
+    return found
 
-    Retries on transient failures with exponential backoff.
+
+# Wall-clock time the pool registry was last fetched from the factory (0 = never)
+pool_registry_fetched_at = 0.0
+_pool_refresh_lock = threading.Lock()
+_pool_refresh_thread: Optional[threading.Thread] = None
+_pool_refresh_started_at = 0.0
+
+
+def fetch_icpswap_pools(max_retries: int = 2, quiet: bool = False) -> bool:
+    """Fetch ALL ICPSwap pools, store by token pair and update the on-disk registry.
+
+    Retries on transient failures with exponential backoff. Returns True on success.
     """
-    global ICPSWAP_POOLS
-    print("Fetching ICPSwap pools from factory...")
-    cmd = f'dfx canister call {ICPSWAP_FACTORY} getPools \'()\' --network {NETWORK} --identity anonymous'
+    global pool_registry_fetched_at
+    log = (lambda *a: None) if quiet else print
+    log("Fetching ICPSwap pools from factory...")
 
     for attempt in range(max_retries + 1):
         try:
-            result = subprocess.run(cmd, shell=True, capture_output=True, text=True, timeout=120)
-            if result.returncode != 0:
-                print(f"  Error (attempt {attempt + 1}): {result.stderr[:100]}")
+            result = canister_call(ICPSWAP_FACTORY, "getPools", timeout=120)
+            if not result.ok:
+                log(f"  Error (attempt {attempt + 1}): {result.error[:100]}")
                 if attempt < max_retries:
-                    time.sleep(1.0 * (2 ** attempt))  # Longer backoff for pool fetch: 1s, 2s, 4s
+                    time.sleep(ic_agent.backoff_delay(attempt, base=1.0))  # Longer backoff for pool fetch: ~1s, 2s, 4s
                     continue
-                return
-
-            output = result.stdout
-            pool_pattern = re.compile(
-                r'token0\s*=\s*record\s*\{\s*address\s*=\s*"([^"]+)"[^}]*\}\s*;\s*'
-                r'token1\s*=\s*record\s*\{\s*address\s*=\s*"([^"]+)"[^}]*\}\s*;\s*'
-                r'canisterId\s*=\s*principal\s*"([^"]+)"'
-            )
-            pool_matches = pool_pattern.findall(output)
-
-            found = 0
-            for token0_principal, token1_principal, pool_id in pool_matches:
-                sym0 = PRINCIPAL_TO_SYMBOL.get(token0_principal)
-                sym1 = PRINCIPAL_TO_SYMBOL.get(token1_principal)
-
-                if sym0 and sym1:
-                    # zeroForOne=true means selling token0 for token1
-                    ICPSWAP_POOLS[(sym0, sym1)] = (pool_id, True)
-                    ICPSWAP_POOLS[(sym1, sym0)] = (pool_id, False)
-                    found += 1
-
-            print(f"  Found {found} pools ({len(ICPSWAP_POOLS)} directions)")
-            return  # Success - exit retry loop
-        except subprocess.TimeoutExpired:
-            print(f"  Timeout (attempt {attempt + 1})")
+                return False
+
+            # Binary replies (HTTP) come decoded; text (dfx) takes the fast path, not a full parse_text
+            pools = parse_icpswap_pools_text(result.output) if result.values is None else None
+            found = _index_icpswap_pools(pools if pools is not None else parse_icpswap_pools(result.reply()))
+            pool_registry_fetched_at = time.time()
+            save_pool_cache()
+
+            log(f"  Found {found} pools ({len(ICPSWAP_POOLS)} directions)")
+            return True  # Success - exit retry loop
+        except TimeoutError:
+            log(f"  Timeout (attempt {attempt + 1})")
             if attempt < max_retries:
-                time.sleep(1.0 * (2 ** attempt))
+                time.sleep(ic_agent.backoff_delay(attempt, base=1.0))
                 continue
         except Exception as e:
-            print(f"  Exception (attempt {attempt + 1}): {e}")
+            log(f"  Exception (attempt {attempt + 1}): {e}")
             if attempt < max_retries:
-                time.sleep(1.0 * (2 ** attempt))
+                time.sleep(ic_agent.backoff_delay(attempt, base=1.0))
                 continue
+    return False
+
+
+def save_pool_cache():
+    """Write the pool registry and last-seen sqrtPriceX96 per pool to POOL_CACHE_FILE."""
+    if not POOL_CACHE_ENABLED:
+        return
+    now_wall, now_mono = time.time(), time.monotonic()
+    data = {
+        'fetched_at': pool_registry_fetched_at,
+        'pools': list(ICPSWAP_POOL_INFO.values()),
+        # pool_id -> [sqrtPriceX96, wall-clock time it was read]
+        'sqrt_prices': {pool_id: [sqrt, now_wall - (now_mono - read_at)]
+                        for pool_id, (sqrt, read_at) in list(pool_metadata_cache.items())},
+    }
+    tmp = POOL_CACHE_FILE + ".tmp"
+    try:
+        with open(tmp, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp, POOL_CACHE_FILE)
+    except OSError as e:
+        print(f"  Could not write pool cache {POOL_CACHE_FILE}: {e}")
+
+
+def load_pool_cache() -> bool:
+    """Load the pool registry from POOL_CACHE_FILE. Returns False if there is no usable cache.
+
+    Cached sqrtPriceX96 values are reused only while younger than the quote cache TTL.
+    """
+    global pool_registry_fetched_at
+    try:
+        with open(POOL_CACHE_FILE) as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return False
+    if not data.get('pools'):
+        return False
+
+    _index_icpswap_pools(data['pools'])
+    pool_registry_fetched_at = data.get('fetched_at', 0.0)
+
+    now_wall, now_mono = time.time(), time.monotonic()
+    for pool_id, (sqrt, read_at) in data.get('sqrt_prices', {}).items():
+        age = now_wall - read_at
+        if 0 <= age < quote_cache.ttl and pool_id not in pool_metadata_cache:
+            pool_metadata_cache[pool_id] = (sqrt, now_mono - age)
+    return True
+
+
+def refresh_icpswap_pools_in_background(reason: str):
+    """Refetch the pool registry on a daemon thread (at most one refresh at a time)."""
+    global _pool_refresh_thread, _pool_refresh_started_at
+
+    def run():
+        before = len(ICPSWAP_POOLS)
+        if fetch_icpswap_pools(quiet=True):
+            print(f"\n  [pools] Registry refreshed ({reason}): {len(ICPSWAP_POOLS)} directions (+{len(ICPSWAP_POOLS) - before})")
+
+    with _pool_refresh_lock:
+        if _pool_refresh_thread is not None and _pool_refresh_thread.is_alive():
+            return
+        _pool_refresh_started_at = time.time()
+        _pool_refresh_thread = threading.Thread(target=run, name="icpswap-pool-refresh", daemon=True)
+        _pool_refresh_thread.start()
+
+
+def load_icpswap_pools():
+    """Make ICPSWAP_POOLS available: instantly from the on-disk registry when present
+    (refreshing it in the background once older than POOL_CACHE_MAX_AGE), otherwise
+    by a blocking factory fetch."""
+    if not POOL_CACHE_ENABLED or not load_pool_cache():
+        fetch_icpswap_pools()
+        return
+
+    age = time.time() - pool_registry_fetched_at
+    print(f"Loaded {len(ICPSWAP_POOL_INFO)} ICPSwap pools ({len(ICPSWAP_POOLS)} directions) "
+          f"from {os.path.basename(POOL_CACHE_FILE)} (age {age / 60:.0f}m)")
+    if age > POOL_CACHE_MAX_AGE:
+        refresh_icpswap_pools_in_background(f"cache older than {POOL_CACHE_MAX_AGE / 3600:g}h")
+
+
+def icpswap_has_pool(pool_key: Tuple[str, str]) -> bool:
+    """Whether ICPSwap has a pool for (sell, buy).
+
+    A miss may mean the pool was created after the registry was fetched, so it
+    schedules a background refresh (at most every POOL_MISS_REFRESH_INTERVAL seconds).
+    """
+    if pool_key in ICPSWAP_POOLS:
+        return True
+    if POOL_CACHE_ENABLED and time.time() - max(pool_registry_fetched_at, _pool_refresh_started_at) > POOL_MISS_REFRESH_INTERVAL:
+        refresh_icpswap_pools_in_background(f"no pool for {pool_key[0]}/{pool_key[1]}")
+    return False
 
 
 # ============================================
@@ -556,6 +1564,186 @@ def run_algorithm(kong_quotes: List[Quote], icp_quotes: List[Quote], num_quotes:
         return ('SPLIT', best.kong_pct, best.icp_pct, best.total_out, no_interp_output, False)
 
 
+# ============================================
+# Batched Algorithm (NumPy)
+# ============================================
+#
+# run_algorithm_batch evaluates many (kong_quotes, icp_quotes) cases at once on arrays of
+# shape (cases, 2, n) - exchange 0 is Kong, 1 is ICPSwap. run_algorithm stays the
+# reference: results are identical, including tie-breaking (first scenario in
+# run_algorithm's list order wins) and the float math of interpolation.
+
+def stack_quotes(cases: List[Tuple[List[Quote], List[Quote]]]):
+    """(amounts, slippage_bp, valid) arrays of shape (cases, 2, n) from (kong_quotes, icp_quotes) pairs."""
+    n = len(cases[0][0]) if cases else 0
+    flat = [q for kong, icp in cases for quotes in (kong, icp) for q in quotes]
+    shape = (len(cases), 2, n)
+    outs = [q.amount_out for q in flat]
+    # Outputs of 18-decimal tokens can overflow int64 once two legs are summed
+    if outs and max(outs) >= 2 ** 62:
+        amounts = np.array(outs, dtype=object).reshape(shape)
+    else:
+        amounts = np.fromiter(outs, dtype=np.int64, count=len(outs)).reshape(shape)
+    return (amounts,
+            np.fromiter((q.slippage_bp for q in flat), dtype=np.int64, count=len(flat)).reshape(shape),
+            np.fromiter((q.valid for q in flat), dtype=bool, count=len(flat)).reshape(shape))
+
+
+def _scenario_columns(n: int):
+    """Static layout of run_algorithm's scenario list for n quotes.
+
+    Returns (full, partial, step_bp): full = (kong_idx, icp_idx, kong_pct, icp_pct) arrays for
+    KONG_100, ICP_100 and then every full split in loop order (index -1 marks "not used");
+    partial = the same for splits summing to less than 100%.
+    """
+    step_bp = 10000 // n
+    pct = (np.arange(n) + 1) * step_bp
+    kong_idx, icp_idx = (a.ravel() for a in np.meshgrid(np.arange(n), np.arange(n), indexing="ij"))
+    total = pct[kong_idx] + pct[icp_idx]
+    usable = (total <= 10000) & (pct[kong_idx] != 10000) & (pct[icp_idx] != 10000)
+    is_full = usable & (total == 10000)
+    is_partial = usable & (total < 10000)
+    full = (np.concatenate(([n - 1, -1], kong_idx[is_full])),
+            np.concatenate(([-1, n - 1], icp_idx[is_full])),
+            np.concatenate(([10000, 0], pct[kong_idx[is_full]])),
+            np.concatenate(([0, 10000], pct[icp_idx[is_full]])))
+    partial = (kong_idx[is_partial], icp_idx[is_partial], pct[kong_idx[is_partial]], pct[icp_idx[is_partial]])
+    return full, partial, step_bp
+
+
+def run_algorithm_batch(amounts, slippage_bp, valid, num_quotes: int = 5) -> list:
+    """Vectorized run_algorithm over stacked quotes (see stack_quotes).
+
+    Returns one run_algorithm result tuple per case, in order.
+    """
+    if np is None:
+        raise RuntimeError("run_algorithm_batch needs numpy (pip install numpy)")
+    n = num_quotes
+    cases = amounts.shape[0]
+    ok = valid & (slippage_bp <= MAX_SLIPPAGE_BP)
+    (f_kong, f_icp, f_kong_pct, f_icp_pct), (p_kong, p_icp, p_kong_pct, p_icp_pct), step_bp = _scenario_columns(n)
+
+    # Full scenarios (cases, F): one leg is "absent" (index -1) for the two singles
+    k_ok = np.where(f_kong >= 0, ok[:, 0, f_kong], True)
+    i_ok = np.where(f_icp >= 0, ok[:, 1, f_icp], True)
+    present = k_ok & i_ok
+    zero = np.zeros((cases, 1), dtype=amounts.dtype)
+    k_amounts = np.concatenate((amounts[:, 0, :], zero), axis=1)  # Index -1 -> 0
+    i_amounts = np.concatenate((amounts[:, 1, :], zero), axis=1)
+    k_slips = np.concatenate((slippage_bp[:, 0, :], np.zeros((cases, 1), dtype=np.int64)), axis=1)
+    i_slips = np.concatenate((slippage_bp[:, 1, :], np.zeros((cases, 1), dtype=np.int64)), axis=1)
+    total = k_amounts[:, f_kong] + i_amounts[:, f_icp]
+    k_slip = k_slips[:, f_kong]
+    i_slip = i_slips[:, f_icp]
+
+    # Best = first maximum in list order (stable descending sort); second = next one
+    rows = np.arange(cases)
+    floor = -1  # Below any real output
+    masked = np.where(present, total, floor)
+    best = np.argmax(masked, axis=1)
+    masked[rows, best] = floor
+    second = np.argmax(masked, axis=1)
+    has_full = present.any(axis=1)
+    has_second = present.sum(axis=1) >= 2
+
+    best_kong_pct = f_kong_pct[best]
+    second_kong_pct = f_kong_pct[second]
+    both_splits = ((0 < best_kong_pct) & (best_kong_pct < 10000)
+                   & (0 < second_kong_pct) & (second_kong_pct < 10000))
+    adjacent = np.abs(best_kong_pct - second_kong_pct) == step_bp
+    avg_kong_slip = (k_slip[rows, best] + k_slip[rows, second]) / 2
+    avg_icp_slip = (i_slip[rows, best] + i_slip[rows, second]) / 2
+    total_slip = avg_kong_slip + avg_icp_slip
+    interpolate = has_full & has_second & both_splits & adjacent & (total_slip > 0)
+
+    kong_ratio = np.divide(avg_icp_slip, total_slip, out=np.zeros(cases), where=total_slip > 0)
+    low_kong = np.minimum(best_kong_pct, second_kong_pct)
+    high_kong = np.maximum(best_kong_pct, second_kong_pct)
+    interp_kong = low_kong + np.trunc(kong_ratio * (high_kong - low_kong)).astype(np.int64)
+    best_out = total[rows, best]
+    second_out = total[rows, second]
+    lower_out = np.where(best_kong_pct < second_kong_pct, best_out, second_out)
+    upper_out = np.where(best_kong_pct < second_kong_pct, second_out, best_out)
+
+    # Partial scenarios (cases, P), only needed where there is no full scenario
+    partial_present = ok[:, 0, p_kong] & ok[:, 1, p_icp]
+
+    results = []
+    for c in range(cases):
+        if not has_full[c]:
+            if not partial_present[c].any():
+                results.append(('NO_PATH', 0, 0, 0, 0, False))
+                continue
+            cols = np.flatnonzero(partial_present[c])
+            k_s = slippage_bp[c, 0, p_kong[cols]]
+            i_s = slippage_bp[c, 1, p_icp[cols]]
+            order = np.argsort(k_s + i_s, kind="stable")
+            partials = [Scenario(f"PARTIAL_{int(p_kong_pct[j]) // 100}_{int(p_icp_pct[j]) // 100}",
+                                 int(p_kong_pct[j]), int(p_icp_pct[j]),
+                                 int(amounts[c, 0, p_kong[j]] + amounts[c, 1, p_icp[j]]),
+                                 int(slippage_bp[c, 0, p_kong[j]]), int(slippage_bp[c, 1, p_icp[j]]))
+                        for j in cols[order]]
+            results.append(('PARTIAL_CANDIDATES', partials, step_bp, 0, 0, False))
+            continue
+        no_interp_output = int(best_out[c])
+        if interpolate[c]:
+            interp_out = int(int(lower_out[c]) + float(kong_ratio[c]) * int(upper_out[c] - lower_out[c]))
+            results.append(('SPLIT', int(interp_kong[c]), 10000 - int(interp_kong[c]), interp_out,
+                            no_interp_output, True))
+        elif best[c] == 0:
+            results.append(('SINGLE_KONG', 10000, 0, no_interp_output, no_interp_output, False))
+        elif best[c] == 1:
+            results.append(('SINGLE_ICP', 0, 10000, no_interp_output, no_interp_output, False))
+        else:
+            results.append(('SPLIT', int(best_kong_pct[c]), int(f_icp_pct[best[c]]), no_interp_output,
+                            no_interp_output, False))
+    return results
+
+
+def bench_algorithm(num_cases: int = 20000, num_quotes: int = 10, seed: int = 0):
+    """Check run_algorithm_batch against run_algorithm on random cases and time both."""
+    if np is None:
+        print("--bench-algorithm needs numpy (pip install numpy)")
+        return
+    rng = random.Random(seed)
+    cases = []
+    for _ in range(num_cases):
+        legs = []
+        for _exchange in range(2):
+            depth = rng.choice([10 ** 9, 10 ** 10, 3 * 10 ** 10, 10 ** 11])
+            unit = rng.choice([1, 1000])  # Coarse units make equal outputs (ties) common
+            quotes = []
+            for i in range(num_quotes):
+                amount_in = (i + 1) * 10 ** 8
+                out = amount_in * depth // (depth * 10 + amount_in) // unit * unit
+                slip = min(10000, amount_in * 10000 // (depth * 10 + amount_in) + rng.randint(0, 20))
+                quotes.append(Quote(amount_in, out, slip, rng.random() > 0.1 and out > 0))
+            legs.append(quotes)
+        cases.append((legs[0], legs[1]))
+
+    start = time.perf_counter()
+    expected = [run_algorithm(k, i, num_quotes) for k, i in cases]
+    scalar_s = time.perf_counter() - start
+    start = time.perf_counter()
+    arrays = stack_quotes(cases)
+    stack_s = time.perf_counter() - start
+    start = time.perf_counter()
+    actual = run_algorithm_batch(*arrays, num_quotes=num_quotes)
+    batch_s = time.perf_counter() - start
+
+    mismatches = [c for c in range(num_cases) if actual[c] != expected[c]]
+    counts: Dict[str, int] = {}
+    for r in expected:
+        counts[r[0] + ("_INTERP" if r[5] else "")] = counts.get(r[0] + ("_INTERP" if r[5] else ""), 0) + 1
+    print(f"{num_cases} cases x {num_quotes} quotes (MAX_SLIPPAGE_BP={MAX_SLIPPAGE_BP}): {counts}")
+    print(f"  run_algorithm:       {scalar_s * 1000:8.1f} ms")
+    print(f"  run_algorithm_batch: {batch_s * 1000:8.1f} ms (+{stack_s * 1000:.1f} ms stack_quotes)"
+          f"  {scalar_s / batch_s:.1f}x")
+    print(f"  mismatches: {len(mismatches)}")
+    for c in mismatches[:5]:
+        print(f"    case {c}: scalar={expected[c]} batch={actual[c]}")
+
+
 # ============================================
 # Treasury Portfolio Logic (matches treasury.mo exactly)
 # ============================================
@@ -587,77 +1775,50 @@ DAO_CANISTER_ID = "vxqw7-iqaaa-aaaan-qzziq-cai"
 TREASURY_CANISTER_ID = "v6t5d-6yaaa-aaaan-qzzja-cai"
 
 
-def parse_production_token_details(output: str) -> Dict[str, Dict]:
+def parse_production_token_details(reply: list) -> Dict[str, Dict]:
     """
-    Parse getTokenDetailsWithoutPastPrices output from DAO canister.
+    Parse getTokenDetailsWithoutPastPrices reply from DAO canister.
+    Reply shape: vec record { principal; record { priceInICP; tokenDecimals; balance; ... } }
     Returns: {principal -> {decimals, balance, priceInICP}}
     """
     tokens = {}
-    # Pattern: principal "xxx"; record { ... priceInICP = N : nat; ... tokenDecimals = N : nat; ... balance = N : nat; ...}
-    # Split by record pairs
-    records = re.findall(r'record\s*\{\s*principal\s*"([^"]+)";\s*record\s*\{([^}]+(?:\{[^}]*\}[^}]*)*)\}', output)
-
-    for principal, record_data in records:
-        # Extract priceInICP
-        price_match = re.search(r'priceInICP\s*=\s*(\d[_\d]*)\s*:\s*nat', record_data)
-        # Extract tokenDecimals
-        decimals_match = re.search(r'tokenDecimals\s*=\s*(\d+)\s*:\s*nat', record_data)
-        # Extract balance
-        balance_match = re.search(r'balance\s*=\s*(\d[_\d]*)\s*:\s*nat', record_data)
-
-        if price_match and decimals_match and balance_match:
-            tokens[principal] = {
-                'priceInICP': int(price_match.group(1).replace('_', '')),
-                'decimals': int(decimals_match.group(1)),
-                'balance': int(balance_match.group(1).replace('_', '')),
+    for entry in (reply[0] if reply else []):
+        principal, details = entry[0], entry[1]
+        if all(k in details for k in ('priceInICP', 'tokenDecimals', 'balance')):
+            tokens[str(principal)] = {
+                'priceInICP': details['priceInICP'],
+                'decimals': details['tokenDecimals'],
+                'balance': details['balance'],
             }
 
     return tokens
 
 
-def parse_production_allocations(output: str) -> Dict[str, int]:
+def parse_production_allocations(reply: list) -> Dict[str, int]:
     """
-    Parse getCurrentAllocations output from Treasury canister.
+    Parse getCurrentAllocations reply from Treasury canister.
+    Reply shape: vec record { principal; nat }
     Returns: {principal -> allocation_bp}
     """
-    allocations = {}
-    # Pattern: record { principal "xxx"; N : nat;}
-    records = re.findall(r'record\s*\{\s*principal\s*"([^"]+)";\s*(\d[_\d]*)\s*:\s*nat;\s*\}', output)
+    return {str(principal): alloc_bp for principal, alloc_bp in (reply[0] if reply else [])}
 
-    for principal, alloc_bp in records:
-        allocations[principal] = int(alloc_bp.replace('_', ''))
 
-    return allocations
+# getSystemParameters field -> TREASURY_CONFIG key
+PRODUCTION_CONFIG_FIELDS = {
+    'maxSlippageBasisPoints': 'max_slippage_bp',
+    'maxTradeValueICP': 'max_trade_value_icp',
+    'minTradeValueICP': 'min_trade_value_icp',
+    'maxTradeAttemptsPerInterval': 'max_trade_attempts',
+}
 
 
-def parse_production_config(output: str) -> Dict[str, int]:
+def parse_production_config(reply: list) -> Dict[str, int]:
     """
-    Parse getSystemParameters output from Treasury canister.
+    Parse getSystemParameters reply from Treasury canister.
     Returns config dict with trade limits.
     """
-    config = {}
-
-    # Extract maxSlippageBasisPoints
-    match = re.search(r'maxSlippageBasisPoints\s*=\s*(\d[_\d]*)\s*:\s*nat', output)
-    if match:
-        config['max_slippage_bp'] = int(match.group(1).replace('_', ''))
-
-    # Extract maxTradeValueICP
-    match = re.search(r'maxTradeValueICP\s*=\s*(\d[_\d]*)\s*:\s*nat', output)
-    if match:
-        config['max_trade_value_icp'] = int(match.group(1).replace('_', ''))
-
-    # Extract minTradeValueICP
-    match = re.search(r'minTradeValueICP\s*=\s*(\d[_\d]*)\s*:\s*nat', output)
-    if match:
-        config['min_trade_value_icp'] = int(match.group(1).replace('_', ''))
-
-    # Extract maxTradeAttemptsPerInterval
-    match = re.search(r'maxTradeAttemptsPerInterval\s*=\s*(\d+)\s*:\s*nat', output)
-    if match:
-        config['max_trade_attempts'] = int(match.group(1))
-
-    return config
+    params = reply[0] if reply and isinstance(reply[0], dict) else {}
+    return {key: params[name] for name, key in PRODUCTION_CONFIG_FIELDS.items() if name in params}
 
 
 def fetch_production_data() -> Tuple[Dict[str, Dict], Dict[str, int], Dict[str, int]]:
@@ -668,25 +1829,22 @@ def fetch_production_data() -> Tuple[Dict[str, Dict], Dict[str, int], Dict[str,
     import concurrent.futures
 
     def fetch_token_details():
-        cmd = f'dfx canister call {DAO_CANISTER_ID} getTokenDetailsWithoutPastPrices "()" --network ic --identity anonymous'
-        result = subprocess.run(cmd, shell=True, capture_output=True, text=True, timeout=30)
-        if result.returncode != 0:
-            raise RuntimeError(f"Failed to fetch token details: {result.stderr}")
-        return parse_production_token_details(result.stdout)
+        result = canister_call(DAO_CANISTER_ID, "getTokenDetailsWithoutPastPrices", timeout=30)
+        if not result.ok:
+            raise RuntimeError(f"Failed to fetch token details: {result.error}")
+        return parse_production_token_details(result.reply())
 
     def fetch_allocations():
-        cmd = f'dfx canister call {TREASURY_CANISTER_ID} getCurrentAllocations "()" --network ic --identity anonymous'
-        result = subprocess.run(cmd, shell=True, capture_output=True, text=True, timeout=30)
-        if result.returncode != 0:
-            raise RuntimeError(f"Failed to fetch allocations: {result.stderr}")
-        return parse_production_allocations(result.stdout)
+        result = canister_call(TREASURY_CANISTER_ID, "getCurrentAllocations", timeout=30)
+        if not result.ok:
+            raise RuntimeError(f"Failed to fetch allocations: {result.error}")
+        return parse_production_allocations(result.reply())
 
     def fetch_config():
-        cmd = f'dfx canister call {TREASURY_CANISTER_ID} getSystemParameters "()" --network ic --identity anonymous'
-        result = subprocess.run(cmd, shell=True, capture_output=True, text=True, timeout=30)
-        if result.returncode != 0:
-            raise RuntimeError(f"Failed to fetch config: {result.stderr}")
-        return parse_production_config(result.stdout)
+        result = canister_call(TREASURY_CANISTER_ID, "getSystemParameters", timeout=30)
+        if not result.ok:
+            raise RuntimeError(f"Failed to fetch config: {result.error}")
+        return parse_production_config(result.reply())
 
     # Fetch all in parallel
     with concurrent.futures.ThreadPoolExecutor(max_workers=3) as executor:
@@ -844,11 +2002,13 @@ NUM_QUOTES = 5
 
 
 def initialize_portfolio_with_random_allocations(
-    total_portfolio_icp: int = 100_00_000_000  # 100 ICP in e8s default
+    total_portfolio_icp: int = 100_00_000_000,  # 100 ICP in e8s default
+    prices: Optional[Dict[str, int]] = None
 ) -> PortfolioState:
     """
     Initialize a portfolio with random held and target allocations.
     Matches treasury.mo portfolio initialization.
+    prices (e8s ICP per token) override TOKEN_APPROX_PRICES_ICP, e.g. a backtest's first prices.
     """
     symbols = list(TOKENS.keys())
 
@@ -861,8 +2021,8 @@ def initialize_portfolio_with_random_allocations(
     tokens: Dict[str, TokenDetails] = {}
 
     for symbol in symbols:
-        principal, decimals = TOKENS[symbol]
-        price_in_icp = TOKEN_APPROX_PRICES_ICP.get(symbol, 100_000)
+        principal, decimals, _ = TOKENS[symbol]
+        price_in_icp = (prices or {}).get(symbol) or TOKEN_APPROX_PRICES_ICP.get(symbol, 100_000)
 
         # Calculate balance based on current allocation
         current_bp = current_allocations[symbol]
@@ -892,11 +2052,108 @@ def calculate_total_portfolio_value(portfolio: PortfolioState) -> int:
     Calculate total portfolio value in ICP (e8s).
     Matches treasury.mo calculateTradeRequirements() Phase 2.
     """
-    total = 0
-    for symbol, details in portfolio.tokens.items():
-        value_in_icp = (details.balance * details.price_in_icp) // (10 ** details.decimals)
-        total += value_in_icp
-    return total
+    return portfolio.total_value()
+
+
+def portfolio_imbalance_bp(portfolio: PortfolioState) -> int:
+    """Sum over tokens of |target_bp - current_bp| against portfolio.total_value_icp (0 when empty)."""
+    total = portfolio.total_value_icp
+    if total <= 0:
+        return sum(portfolio.targets)
+    portfolio.allocations(total)
+    return portfolio.imbalance
+
+
+# treasury.mo calculateTradeRequirements on fixed portfolios, worked out by hand in its Nat/Int
+# arithmetic. Every token is active and unpaused and the targets sum to 10000, so treasury.mo's
+# target normalization ((target * 10000) / totalTargetBasisPoints) leaves them unchanged.
+# They live here only: calculateTradeRequirements is private to the treasury actor and the
+# Motoko side has no unit-test harness to load them.
+# Each entry: (tokens as (symbol, decimals, balance, price_in_icp e8s, target_bp), field updates
+# applied after a first calculateTradeRequirements (exercising the incremental path), min diff bp,
+# expected total value e8s, expected [(symbol, diff_bp, value e8s)], expected imbalance bp).
+_GOLDEN_PORTFOLIO = [("ICP", 8, 1_234_567_891, 100_000_000, 5000),
+                      ("ckBTC", 8, 5_000, 2_280_000_000_000, 3000),
+                      ("ckETH", 18, 3_141_592_653_589_793, 77_000_000_000, 2000)]
+PORTFOLIO_GOLDEN = [
+    # Mixed decimals; ckETH's value truncates (241,902,634.33 e8s)
+    (_GOLDEN_PORTFOLIO, [], 15, 1_590_470_525,
+     [("ICP", -2762, 1_234_567_891), ("ckBTC", 2284, 114_000_000), ("ckETH", 480, 241_902_634)], 5526),
+    # The same portfolio after a price, a balance and a decimals change
+    (_GOLDEN_PORTFOLIO, [("ckETH", "price_in_icp", 80_000_000_000), ("ICP", "balance", 0), ("ckBTC", "decimals", 6)],
+     15, 11_651_327_412,
+     [("ICP", 5000, 0), ("ckBTC", -6784, 11_400_000_000), ("ckETH", 1785, 251_327_412)], 13569),
+    # |diff| == min diff is not traded (treasury.mo uses >)
+    ([("ICP", 8, 4985, 100_000_000, 5000), ("CHAT", 8, 5015, 100_000_000, 5000)], [], 15, 10_000, [], 30),
+    # Current bp truncate to 3333 each (9999 in all)
+    ([("ICP", 8, 1, 100_000_000, 3334), ("CHAT", 8, 1, 100_000_000, 3333), ("GOLDAO", 8, 1, 100_000_000, 3333)],
+     [], 0, 3, [("ICP", 1, 1)], 1),
+    # Nothing held: no trades; the imbalance is every target
+    ([("ICP", 8, 0, 100_000_000, 6000), ("CHAT", 8, 0, 50_000, 4000)], [], 15, 0, [], 10000),
+]
+
+
+def check_portfolio_golden() -> int:
+    """Check calculateTradeRequirements / total value / imbalance against PORTFOLIO_GOLDEN;
+    returns the number of mismatching vectors."""
+    mismatches = 0
+    for n, (tokens, updates, min_diff_bp, total, requirements, imbalance) in enumerate(PORTFOLIO_GOLDEN):
+        portfolio = PortfolioState(tokens={sym: TokenDetails(sym, sym, decimals, balance, price, target)
+                                           for sym, decimals, balance, price, target in tokens},
+                                   total_value_icp=0)
+        if updates:
+            calculate_trade_requirements(portfolio, min_diff_bp)
+            for sym, name, value in updates:
+                setattr(portfolio.tokens[sym], name, value)
+        got = calculate_trade_requirements(portfolio, min_diff_bp)
+        actual = (calculate_total_portfolio_value(portfolio), got, portfolio_imbalance_bp(portfolio))
+        if actual != (total, requirements, imbalance):
+            mismatches += 1
+            print(f"  golden vector {n}: expected={(total, requirements, imbalance)} got={actual}")
+    print(f"{len(PORTFOLIO_GOLDEN)} treasury.mo golden vectors, {mismatches} mismatches")
+    return mismatches
+
+
+def check_portfolio_state(num_portfolios: int = 200, num_cycles: int = 300, seed: int = 0) -> int:
+    """--check-portfolio: check the PortfolioState formulas against PORTFOLIO_GOLDEN, then compare the
+    incremental state with a full walk of its tokens after every simulated cycle; returns the number
+    of mismatches."""
+    golden_mismatches = check_portfolio_golden()
+
+    def walk(portfolio: PortfolioState, min_diff_bp: int):
+        values = {sym: d.balance * d.price_in_icp // (10 ** d.decimals) for sym, d in portfolio.tokens.items()}
+        total = sum(values.values())
+        diffs = {sym: d.target_allocation_bp - values[sym] * 10000 // total for sym, d in portfolio.tokens.items()}
+        requirements = [(sym, diff, values[sym]) for sym, diff in diffs.items()
+                        if abs(diff) > min_diff_bp and not (diff < 0 and portfolio.tokens[sym].balance == 0)]
+        return total, requirements, sum(abs(diff) for diff in diffs.values())
+
+    config = TREASURY_CONFIG
+    checks = mismatches = 0
+    walk_s = state_s = 0.0
+    for n in range(seed, seed + num_portfolios):
+        random.seed(n)
+        portfolio = initialize_portfolio_with_random_allocations()
+        for _ in range(num_cycles):
+            start = time.perf_counter()
+            expected = walk(portfolio, config['min_allocation_diff_bp'])
+            walk_s += time.perf_counter() - start
+            start = time.perf_counter()
+            requirements = calculate_trade_requirements(portfolio, config['min_allocation_diff_bp'])
+            actual = (portfolio.total_value_icp, requirements, portfolio_imbalance_bp(portfolio))
+            state_s += time.perf_counter() - start
+            checks += 1
+            if actual != expected:
+                mismatches += 1
+                if mismatches <= 5:
+                    print(f"  seed {n}: walk={expected} state={actual}")
+            if not requirements or not run_full_trading_cycle_test(1, portfolio, config, quiet=True):
+                break
+    print(f"{checks} portfolio states from {num_portfolios} seeded portfolios (up to {num_cycles} cycles each)")
+    print(f"  full walk:       {walk_s * 1000:8.1f} ms")
+    print(f"  PortfolioState:  {state_s * 1000:8.1f} ms  {walk_s / state_s if state_s else 0:.1f}x")
+    print(f"  mismatches: {mismatches}")
+    return golden_mismatches + mismatches
 
 
 def calculate_trade_requirements(
@@ -919,32 +2176,24 @@ def calculate_trade_requirements(
         return []
 
     # Sanity check: ensure we have valid target allocations
-    if sum(d.target_allocation_bp for d in portfolio.tokens.values()) == 0:
+    if sum(portfolio.targets) == 0:
         return []
 
     trade_pairs = []
 
-    for symbol, details in portfolio.tokens.items():
-        # Calculate current value in ICP
-        value_in_icp = (details.balance * details.price_in_icp) // (10 ** details.decimals)
-
-        # Calculate current basis points
-        current_bp = (value_in_icp * 10000) // total_value_icp
-
-        # Use target allocation directly (already in basis points)
-        # NOTE: Removed buggy normalization that caused 200-1000bp jumps when
-        # total_target_bp != 10000 due to integer truncation in generate_random_allocations()
-        target_bp = details.target_allocation_bp
-
-        # Calculate diff
-        diff_bp = target_bp - current_bp
+    # Current basis points = value_in_icp * 10000 // total; diff = target - current.
+    # Targets are used directly (already in basis points).
+    # NOTE: Removed buggy normalization that caused 200-1000bp jumps when
+    # total_target_bp != 10000 due to integer truncation in generate_random_allocations()
+    _, diffs = portfolio.allocations(total_value_icp)
 
+    for i, diff_bp in enumerate(diffs):
         # Filter by minimum threshold (matches treasury.mo:5190)
         # Also skip tokens with 0 balance that are overweight (can't sell what we don't have)
         if abs(diff_bp) > min_allocation_diff_bp:
-            if diff_bp < 0 and details.balance == 0:
+            if diff_bp < 0 and portfolio.balances[i] == 0:
                 continue  # Can't sell a token with no balance
-            trade_pairs.append((symbol, diff_bp, value_in_icp))
+            trade_pairs.append((portfolio.symbols[i], diff_bp, portfolio.values[i]))
 
     return trade_pairs
 
@@ -1179,32 +2428,46 @@ def update_prices_after_trade(
     portfolio.total_value_icp = calculate_total_portfolio_value(portfolio)
 
 
-def run_full_trading_cycle_test(num_cycles: int = 5) -> List[Dict]:
+def _no_output(*args, **kwargs) -> None:
+    pass
+
+
+def run_full_trading_cycle_test(num_cycles: int = 5, portfolio: Optional[PortfolioState] = None,
+                                config: Optional[Dict[str, int]] = None, quiet: bool = False) -> List[Dict]:
     """
     Run a complete trading cycle test matching treasury.mo logic.
     This simulates the full trading decision process without executing real trades.
 
+    portfolio is updated in place (default: a new random one); config defaults to
+    TREASURY_CONFIG; quiet suppresses all output (--monte-carlo).
+
     Returns list of trade decisions made.
     """
     # Initialize portfolio with random allocations
-    portfolio = initialize_portfolio_with_random_allocations()
-    config = TREASURY_CONFIG
+    if portfolio is None:
+        portfolio = initialize_portfolio_with_random_allocations()
+    config = config or TREASURY_CONFIG
+    log = _no_output if quiet else print
 
     trades = []
 
-    print("\n" + "=" * 80)
-    print("FULL TRADING CYCLE TEST (matches treasury.mo) - SIMULATED")
-    print("=" * 80)
-    print(f"\nInitial Portfolio ({len(portfolio.tokens)} tokens):")
-    print(f"  Total Value: {portfolio.total_value_icp / 1e8:.2f} ICP")
-    print("\nToken Allocations:")
+    log("\n" + "=" * 80)
+    log("FULL TRADING CYCLE TEST (matches treasury.mo) - SIMULATED")
+    log("=" * 80)
+    log(f"\nInitial Portfolio ({len(portfolio.tokens)} tokens):")
+    log(f"  Total Value: {portfolio.total_value_icp / 1e8:.2f} ICP")
+    log("\nToken Allocations:")
     for symbol, details in sorted(portfolio.tokens.items()):
         value = (details.balance * details.price_in_icp) // (10 ** details.decimals)
         current_bp = (value * 10000) // portfolio.total_value_icp if portfolio.total_value_icp > 0 else 0
-        print(f"  {symbol:8} target={details.target_allocation_bp:4}bp current={current_bp:4}bp diff={details.target_allocation_bp - current_bp:+4}bp")
+        log(f"  {symbol:8} target={details.target_allocation_bp:4}bp current={current_bp:4}bp diff={details.target_allocation_bp - current_bp:+4}bp")
 
     for cycle in range(num_cycles):
-        print(f"\n--- Cycle {cycle + 1}/{num_cycles} ---")
+        if quiet and cycle > 0 and (not trades or trades[-1]['cycle'] < cycle):
+            # The previous cycle traded nothing, so the portfolio is unchanged and every later cycle
+            # would end the same way (the random draws only feed trades that are then skipped)
+            break
+        log(f"\n--- Cycle {cycle + 1}/{num_cycles} ---")
 
         for attempt in range(config['max_trade_attempts']):
             # Step 1: Calculate trade requirements
@@ -1214,19 +2477,19 @@ def run_full_trading_cycle_test(num_cycles: int = 5) -> List[Dict]:
             )
 
             if not trade_diffs:
-                print(f"  Attempt {attempt + 1}: No viable trading candidates (all within {config['min_allocation_diff_bp']}bp)")
+                log(f"  Attempt {attempt + 1}: No viable trading candidates (all within {config['min_allocation_diff_bp']}bp)")
                 break
 
-            print(f"  Attempt {attempt + 1}: {len(trade_diffs)} tokens need rebalancing")
+            log(f"  Attempt {attempt + 1}: {len(trade_diffs)} tokens need rebalancing")
 
             # Step 2: Select trading pair
             pair = select_trading_pair(trade_diffs)
             if not pair:
-                print(f"    Could not select trading pair")
+                log(f"    Could not select trading pair")
                 continue
 
             sell_symbol, buy_symbol, sell_diff, buy_diff = pair
-            print(f"    Selected: {sell_symbol} ({sell_diff:+}bp) -> {buy_symbol} ({buy_diff:+}bp)")
+            log(f"    Selected: {sell_symbol} ({sell_diff:+}bp) -> {buy_symbol} ({buy_diff:+}bp)")
 
             # Step 3: Determine trade size strategy
             use_exact = should_use_exact_targeting(
@@ -1262,16 +2525,16 @@ def run_full_trading_cycle_test(num_cycles: int = 5) -> List[Dict]:
 
             # Skip if trade size is 0 (no balance left)
             if trade_size == 0:
-                print(f"    SKIPPED: No {sell_symbol} balance available")
+                log(f"    SKIPPED: No {sell_symbol} balance available")
                 continue
 
             trade_value_icp = (trade_size * sell_token.price_in_icp) // (10 ** sell_token.decimals)
-            print(f"    Trade size: {trade_size} {sell_symbol} (~{trade_value_icp / 1e8:.4f} ICP) [{sizing_method}]")
+            log(f"    Trade size: {trade_size} {sell_symbol} (~{trade_value_icp / 1e8:.4f} ICP) [{sizing_method}]")
 
             # Step 4: Get quotes (this is where we'd call test_pair_internal in a real test)
             # For simulation, we'll estimate the output based on price
             if buy_token.price_in_icp == 0:
-                print(f"    SKIPPED: {buy_symbol} has zero price")
+                log(f"    SKIPPED: {buy_symbol} has zero price")
                 continue
             # Convert trade_size to ICP value, then to buy_token amount
             # This properly handles different token decimals
@@ -1287,7 +2550,7 @@ def run_full_trading_cycle_test(num_cycles: int = 5) -> List[Dict]:
             )
 
             if is_exact and final_size != trade_size:
-                print(f"    Slippage adjustment: {trade_size} -> {final_size} ({slippage_bp}bp)")
+                log(f"    Slippage adjustment: {trade_size} -> {final_size} ({slippage_bp}bp)")
 
             # Step 6: Simulate trade result and update prices
             # Use adjusted expected output as simulated result
@@ -1304,6 +2567,7 @@ def run_full_trading_cycle_test(num_cycles: int = 5) -> List[Dict]:
                 'slippage_bp': slippage_bp,
                 'sell_diff_bp': sell_diff,
                 'buy_diff_bp': buy_diff,
+                'trade_value_icp': (final_size * sell_token.price_in_icp) // (10 ** sell_token.decimals),
             }
             trades.append(trade_record)
 
@@ -1314,26 +2578,513 @@ def run_full_trading_cycle_test(num_cycles: int = 5) -> List[Dict]:
                 final_size, simulated_out
             )
 
-            print(f"    Simulated: {final_size} {sell_symbol} -> {simulated_out} {buy_symbol}")
+            log(f"    Simulated: {final_size} {sell_symbol} -> {simulated_out} {buy_symbol}")
 
             # Show portfolio state after trade
-            print(f"    Portfolio after trade:")
+            if quiet:
+                continue
+            log(f"    Portfolio after trade:")
             for sym, det in sorted(portfolio.tokens.items()):
                 val = (det.balance * det.price_in_icp) // (10 ** det.decimals)
                 cur_bp = (val * 10000) // portfolio.total_value_icp if portfolio.total_value_icp > 0 else 0
                 diff = det.target_allocation_bp - cur_bp
                 if abs(diff) > 50:  # Only show significant imbalances
-                    print(f"      {sym:8} target={det.target_allocation_bp:4}bp current={cur_bp:4}bp diff={diff:+4}bp")
+                    log(f"      {sym:8} target={det.target_allocation_bp:4}bp current={cur_bp:4}bp diff={diff:+4}bp")
 
-    print(f"\n--- Summary ---")
-    print(f"Total trades: {len(trades)}")
+    log(f"\n--- Summary ---")
+    log(f"Total trades: {len(trades)}")
     exact_trades = sum(1 for t in trades if t['is_exact'])
-    print(f"  Exact targeting: {exact_trades}")
-    print(f"  Random sizing: {len(trades) - exact_trades}")
+    log(f"  Exact targeting: {exact_trades}")
+    log(f"  Random sizing: {len(trades) - exact_trades}")
 
     return trades
 
 
+# ============================================
+# Monte Carlo (--monte-carlo)
+# ============================================
+#
+# One --cycle run shows what the rebalancer does to one random portfolio. --monte-carlo
+# runs thousands of seeded portfolios through the same simulation, quietly and across
+# processes, and reports distributions, so a TREASURY_CONFIG change (--config KEY=VALUE)
+# can be judged against the baseline on the same seeds.
+
+def simulate_portfolio(seed: int, num_cycles: int, config: Dict[str, int]) -> Dict:
+    """One Monte Carlo run: the portfolio and slippage draws of `seed`, traded for num_cycles."""
+    random.seed(seed)
+    portfolio = initialize_portfolio_with_random_allocations()
+    portfolio.total_value_icp = calculate_total_portfolio_value(portfolio)
+    initial_value = portfolio.total_value_icp
+    initial_imbalance = portfolio_imbalance_bp(portfolio)
+
+    trades = run_full_trading_cycle_test(num_cycles, portfolio, config, quiet=True)
+
+    # Nothing trades once every token is within min_allocation_diff_bp, so a converged
+    # run made all its trades before converging
+    converged = not calculate_trade_requirements(portfolio, config['min_allocation_diff_bp'])
+    last_cycle = trades[-1]['cycle'] if trades else 0
+    spend = sum(t['trade_value_icp'] * t['slippage_bp'] // 10000 for t in trades)
+    return {
+        'seed': seed,
+        'trades': len(trades),
+        'converged': converged,
+        'stalled': not converged and last_cycle < num_cycles,  # Off target, but no trade is possible
+        'cycles': last_cycle,
+        'exact': sum(1 for t in trades if t['is_exact']),
+        'initial_imbalance': initial_imbalance,
+        'final_imbalance': portfolio_imbalance_bp(portfolio),
+        'slippage_spend_icp': spend,
+        'slippage_spend_bp': spend * 10000 / initial_value if initial_value else 0.0,
+    }
+
+
+def _simulate_portfolios(seeds: List[int], num_cycles: int, config: Dict[str, int]) -> List[Dict]:
+    return [simulate_portfolio(seed, num_cycles, config) for seed in seeds]
+
+
+def run_monte_carlo(num_portfolios: int, num_cycles: int, seed: int = 0,
+                    config_overrides: Optional[Dict[str, int]] = None, processes: Optional[int] = None) -> List[Dict]:
+    """Simulate portfolios seed .. seed + num_portfolios - 1 on a process pool and print their distributions."""
+    config = {**TREASURY_CONFIG, **(config_overrides or {})}
+    seeds = list(range(seed, seed + num_portfolios))
+    chunks = [seeds[i:i + MONTE_CARLO_CHUNK] for i in range(0, len(seeds), MONTE_CARLO_CHUNK)]
+
+    print(f"Monte Carlo: {num_portfolios} portfolios (seeds {seed}..{seed + num_portfolios - 1}) x {num_cycles} cycles")
+    for key, value in (config_overrides or {}).items():
+        print(f"  {key}: {value} (default {TREASURY_CONFIG[key]})")
+
+    runs: List[Dict] = []
+    start = time.time()
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        for chunk in pool.map(_simulate_portfolios, chunks, itertools.repeat(num_cycles), itertools.repeat(config)):
+            runs.extend(chunk)
+            print(f"\r[{len(runs)}/{num_portfolios}] portfolios simulated", end="", flush=True)
+    print(f" in {time.time() - start:.1f}s")
+
+    print_monte_carlo_summary(runs, num_cycles)
+    return runs
+
+
+def print_monte_carlo_summary(runs: List[Dict], num_cycles: int) -> None:
+    def distribution(label: str, values, unit: str = "") -> None:
+        stat = RunningStat()
+        for value in values:
+            stat.add(value)
+        if not stat.count:
+            print(f"  {label:28} -")
+            return
+        q = stat.sketch.quantile
+        print(f"  {label:28} p5={q(0.05):.0f}{unit} p50={q(0.5):.0f}{unit} p95={q(0.95):.0f}{unit} "
+              f"mean={stat.mean:.1f}{unit} max={stat.max:.0f}{unit}")
+
+    converged = [r for r in runs if r['converged']]
+    trades = sum(r['trades'] for r in runs)
+    exact = sum(r['exact'] for r in runs)
+
+    print("\n" + "=" * 80)
+    print("MONTE CARLO SUMMARY")
+    print("=" * 80)
+    stalled = sum(1 for r in runs if r['stalled'])
+
+    def share(n: int) -> str:
+        return f"{n} ({n * 100 // max(len(runs), 1)}%)"
+
+    print(f"\nPortfolios: {len(runs)} | Trades: {trades} | Converged within {num_cycles} cycles: {share(len(converged))}")
+    print(f"  Stalled (off target, no tradable pair left): {share(stalled)}")
+    print(f"  Still trading after {num_cycles} cycles: {share(len(runs) - len(converged) - stalled)}")
+    print("\nConvergence (converged portfolios):")
+    distribution("Trades to convergence", (r['trades'] for r in converged))
+    distribution("Cycles to convergence", (r['cycles'] for r in converged))
+    print("\nImbalance (sum of |target - current|):")
+    distribution("Initial", (r['initial_imbalance'] for r in runs), "bp")
+    distribution("Final", (r['final_imbalance'] for r in runs), "bp")
+    print("\nTrade sizing:")
+    print(f"  Exact targeting: {exact}/{trades} trades ({exact * 100 / trades if trades else 0:.1f}%)")
+    distribution("Exact share per portfolio", (r['exact'] * 100 / r['trades'] for r in runs if r['trades']), "%")
+    print("\nSlippage spend (trade value x slippage):")
+    distribution("Per portfolio (e8s ICP)", (r['slippage_spend_icp'] for r in runs))
+    distribution("Per portfolio (bp of value)", (r['slippage_spend_bp'] for r in runs), "bp")
+
+    slowest = sorted(runs, key=lambda r: (r['converged'], -r['final_imbalance']))[:5]
+    print("\nLeast converged (rerun one with --cycle and --seed):")
+    for r in slowest:
+        state = "converged" if r['converged'] else "stalled" if r['stalled'] else "still trading"
+        print(f"  seed {r['seed']}: {r['trades']} trades, final imbalance {r['final_imbalance']}bp ({state})")
+
+
+# ============================================
+# Virtual-Time Treasury Simulator (--simulate)
+# ============================================
+#
+# executeTradingCycle() runs every rebalanceIntervalNS (60 s) with maxTradeAttemptsPerInterval
+# attempts, after circuit-breaker checks and retryFailedKongswapTransactions()
+# (plan_trading.md). The simulator replays that schedule on a virtual clock: an event queue
+# of trading cycles and market steps, where market steps move token prices (a seeded random
+# walk or a --prices file) and let arbitrage pull constant-product token/ICP pools towards
+# them. Trades are quoted and executed against those pools with the Kong quote math
+# (local_quotes.KongPoolBook), through the same calculate_trade_requirements /
+# select_trading_pair / adjust_trade_for_slippage pipeline as --cycle.
+
+SIMULATION_CONFIG = {
+    'rebalance_interval_s': 60,          # rebalanceIntervalNS
+    'market_step_s': 60,                 # Seconds between price / pool updates
+    'daily_volatility_pct': 4.0,         # Random-walk volatility of each token's ICP price (no --prices)
+    'portfolio_icp': 100_00_000_000,     # Initial portfolio value in e8s
+    'pool_depth_icp': 500_00_000_000,    # ICP side of each token/ICP pool (scaled 0.3x-3x per token)
+    'arbitrage_pct': 50,                 # Share of the pool/market price gap closed per market step
+    'kong_fail_pct': 1.0,                # Swaps that fail into pendingTxs, retried at the next cycles
+    'kong_max_retries': 5,               # Attempts before a pending swap counts as failed
+    'price_alert_pct': 0.0,              # Pause a token whose price moves this much within the window (0: off)
+    'price_alert_window_s': 3600,
+    'portfolio_drop_pct': 0.0,           # Pause trading when portfolio value drops this much within the window
+    'portfolio_window_s': 3600,
+    'pause_s': 6 * 3600,                 # Paused tokens resume after this long (stands in for an admin)
+}
+
+
+def load_price_path(path: str) -> Dict[str, List[Tuple[float, int]]]:
+    """--prices FILE: CSV rows of seconds,symbol,price_e8s (ICP per whole token), any order."""
+    import csv
+    paths: Dict[str, List[Tuple[float, int]]] = {}
+    with open(path, newline="") as f:
+        for row in csv.reader(f):
+            if not row or not row[0].replace(".", "", 1).isdigit():
+                continue  # Header or blank line
+            paths.setdefault(row[1], []).append((float(row[0]), int(row[2])))
+    for points in paths.values():
+        points.sort()
+    return paths
+
+
+class _Window:
+    """Min and max of the values added in the last `span` seconds (monotonic deques)."""
+
+    def __init__(self, span: float):
+        self.span = span
+        self._min = deque()
+        self._max = deque()
+
+    def add(self, t: float, value: float) -> None:
+        for q, worse in ((self._min, lambda v: v >= value), (self._max, lambda v: v <= value)):
+            while q and worse(q[-1][1]):
+                q.pop()
+            q.append((t, value))
+            while q[0][0] < t - self.span:
+                q.popleft()
+
+    def moved_pct(self, value: float) -> Tuple[float, float]:
+        """(drop from the window's max, rise from its min) to `value`, in percent."""
+        high, low = self._max[0][1], self._min[0][1]
+        return ((high - value) * 100 / high if high else 0.0, (value - low) * 100 / low if low else 0.0)
+
+
+class TreasurySimulator:
+    """Virtual-time replay of the treasury's trading cycles against simulated pools."""
+
+    def __init__(self, seed: int = 0, config: Optional[Dict[str, int]] = None,
+                 sim_config: Optional[Dict] = None, price_path: Optional[Dict[str, List[Tuple[float, int]]]] = None):
+        self.config = {**TREASURY_CONFIG, **(config or {})}
+        self.sim = {**SIMULATION_CONFIG, **(sim_config or {})}
+        random.seed(seed)  # Treasury decisions (pair selection, sizing) use the global generator, like --cycle
+        self.market_rng = random.Random(f"{seed}:market")
+        self.price_path = price_path
+        first_prices = {s: points[0][1] for s, points in price_path.items()} if price_path else None
+        self.portfolio = initialize_portfolio_with_random_allocations(self.sim['portfolio_icp'], first_prices)
+        self.symbols = [s for s in self.portfolio.tokens if s != "ICP"]
+        # Market prices are floats: rounding cheap tokens (~10^4 e8s) to whole e8s every step would drift them to 0
+        self.market = {s: float(d.price_in_icp) for s, d in self.portfolio.tokens.items()}
+        self.decimals = {s: TOKENS[s][1] for s in TOKENS}
+
+        pools = []
+        for symbol in self.symbols:
+            depth = int(self.sim['pool_depth_icp'] * self.market_rng.uniform(0.3, 3.0))
+            pools.append(local_quotes.KongPool(symbol, "ICP", TOKENS[symbol][0], TOKENS["ICP"][0],
+                                               depth * 10 ** self.decimals[symbol] // self.portfolio.tokens[symbol].price_in_icp,
+                                               depth, 30))
+        self.pools = {p.symbol_0: p for p in pools}
+        self.book = local_quotes.KongPoolBook(pools, {s: TOKENS[s][2] for s in TOKENS}, self.decimals, hubs=("ICP",))
+
+        self.now = 0.0
+        self._events: List[tuple] = []
+        self._seq = itertools.count()
+        self.paused: Dict[str, float] = {}  # symbol -> resume time
+        self.pending: List[Dict] = []        # Failed Kong swaps awaiting retry
+        self.price_windows = {s: _Window(self.sim['price_alert_window_s']) for s in self.symbols}
+        self.value_window = _Window(self.sim['portfolio_window_s'])
+        self.stats: Counter = Counter()
+        self.slippage_spend = 0   # e8s ICP: trade value at pool mid price minus value received
+        self.days: List[Dict] = []
+        self.schedule(0.0, "market")
+        self.schedule(0.0, "cycle")
+        self.schedule(86400.0, "day")
+
+    # ---- event queue ----
+
+    def schedule(self, t: float, kind: str, payload=None) -> None:
+        heapq.heappush(self._events, (t, next(self._seq), kind, payload))
+
+    def run(self, days: float) -> None:
+        """Process events up to `days` of virtual time (from the start; a later call continues)."""
+        end = days * 86400
+        while self._events and self._events[0][0] <= end:
+            self.now, _, kind, payload = heapq.heappop(self._events)
+            getattr(self, f"_on_{kind}")(payload)
+
+    # ---- market ----
+
+    def _pool_price(self, symbol: str) -> int:
+        pool = self.pools[symbol]
+        return pool.reserve_1 * 10 ** self.decimals[symbol] // pool.reserve_0 if pool.reserve_0 else 0
+
+    def _spot(self, symbol: str) -> int:
+        """Pool mid price in e8s ICP per whole token."""
+        return 10 ** 8 if symbol == "ICP" else self._pool_price(symbol)
+
+    def _on_market(self, _payload) -> None:
+        step = self.sim['market_step_s']
+        sigma = self.sim['daily_volatility_pct'] / 100 * math.sqrt(step / 86400)
+        pull = self.sim['arbitrage_pct'] / 100
+        for symbol in self.symbols:
+            if self.price_path and symbol in self.price_path:
+                points = self.price_path[symbol]
+                i = bisect.bisect_right(points, (self.now, float("inf"))) - 1
+                self.market[symbol] = float(points[max(i, 0)][1])
+            elif not self.price_path and symbol != "cICP":  # cICP tracks ICP; replays hold unlisted tokens
+                self.market[symbol] *= math.exp(self.market_rng.gauss(-sigma * sigma / 2, sigma))
+            # Arbitrage moves the pool price part of the way to the market, along x*y=k
+            pool = self.pools[symbol]
+            current = self._pool_price(symbol)
+            if current > 0:
+                target = current * (self.market[symbol] / current) ** pull
+                k = pool.reserve_0 * pool.reserve_1
+                pool.reserve_1 = max(1, math.isqrt(k * max(1, round(target)) // 10 ** self.decimals[symbol]))
+                pool.reserve_0 = max(1, k // pool.reserve_1)
+            self.price_windows[symbol].add(self.now, self._pool_price(symbol))
+        self.schedule(self.now + step, "market")
+
+    # ---- trading cycle ----
+
+    def _on_cycle(self, _payload) -> None:
+        self.schedule(self.now + self.sim['rebalance_interval_s'], "cycle")
+        self.stats['cycles'] += 1
+        for symbol, resume in list(self.paused.items()):
+            if resume <= self.now:
+                del self.paused[symbol]
+
+        # The treasury sees DEX prices (syncFromDEXs) and retries pending Kong swaps first
+        for symbol in self.symbols:
+            price = self._pool_price(symbol)
+            if price > 0:
+                self.portfolio.tokens[symbol].price_in_icp = price
+        self._retry_pending()
+        self._check_circuit_breakers()
+
+        for _attempt in range(self.config['max_trade_attempts']):
+            trade_diffs = [d for d in calculate_trade_requirements(self.portfolio, self.config['min_allocation_diff_bp'])
+                           if d[0] not in self.paused]
+            if not trade_diffs:
+                self.stats['skip_tokens_filtered'] += 1
+                break
+            pair = select_trading_pair(trade_diffs)
+            if not pair:
+                self.stats['skip_no_pair'] += 1
+                continue
+            self._trade(*pair)
+
+    def _trade(self, sell_symbol: str, buy_symbol: str, sell_diff: int, buy_diff: int) -> None:
+        config = self.config
+        portfolio = self.portfolio
+        sell_token = portfolio.tokens[sell_symbol]
+        buy_token = portfolio.tokens[buy_symbol]
+
+        is_exact = should_use_exact_targeting(sell_diff, buy_diff, portfolio.total_value_icp, config['max_trade_value_icp'])
+        if is_exact:
+            trade_size, is_exact = calculate_exact_target_trade_size(
+                sell_token, buy_token, portfolio.total_value_icp, sell_diff, buy_diff,
+                config['max_trade_value_icp'], config['min_trade_value_icp'])
+        else:
+            trade_size = calculate_trade_size_min_max(config['min_trade_value_icp'], config['max_trade_value_icp'], sell_token)
+        trade_size = min(trade_size, sell_token.balance)
+        if trade_size == 0:
+            self.stats['skip_no_balance'] += 1
+            return
+
+        quote = _parse_kong_quote(sell_symbol, buy_symbol, trade_size,
+                                  [self.book.swap_amounts(sell_symbol, trade_size, buy_symbol)])
+        if quote is RETRY_PARSE or quote.amount_out == 0 or quote.slippage_bp > config['max_slippage_bp']:
+            self.stats['skip_no_execution_path'] += 1
+            return
+        final_size, _expected, min_out = adjust_trade_for_slippage(
+            trade_size, quote.slippage_bp, is_exact, quote.amount_out, config['max_slippage_bp'])
+
+        sell_token.balance -= final_size
+        if self.market_rng.random() * 100 < self.sim['kong_fail_pct']:
+            self.pending.append({'sell': sell_symbol, 'buy': buy_symbol, 'amount': final_size,
+                                 'min_out': min_out, 'attempts': 1})
+            self.stats['kong_pending'] += 1
+            return
+        self._execute(sell_symbol, buy_symbol, final_size, min_out, is_exact)
+
+    def _execute(self, sell_symbol: str, buy_symbol: str, amount: int, min_out: int, is_exact: bool = False) -> bool:
+        """Swap `amount` (already taken from the sell balance) against the pools; False if below min_out."""
+        reply = self.book.swap_amounts(sell_symbol, amount, buy_symbol)
+        record = reply.get("Ok")
+        if record is None or record["receive_amount"] < min_out:
+            self.portfolio.tokens[sell_symbol].balance += amount  # Swap rejected, tokens returned
+            self.stats['failed_min_out'] += 1
+            return False
+        received = record["receive_amount"]
+        mid_value = amount * self._spot(sell_symbol) // 10 ** self.decimals[sell_symbol]
+        self.slippage_spend += max(0, mid_value - received * self._spot(buy_symbol) // 10 ** self.decimals[buy_symbol])
+        self.book.apply_swap(record)
+
+        # update_prices_after_trade also moves the balances; the sold amount is already gone
+        self.portfolio.tokens[sell_symbol].balance += amount
+        update_prices_after_trade(self.portfolio, sell_symbol, buy_symbol, amount, received)
+        self.stats['trades'] += 1
+        self.stats['exact_trades'] += is_exact
+        self.stats['volume_icp'] += mid_value
+        return True
+
+    def _retry_pending(self) -> None:
+        """retryFailedKongswapTransactions(): each pending swap gets one more attempt per cycle."""
+        still_pending = []
+        for tx in self.pending:
+            if self.market_rng.random() * 100 < self.sim['kong_fail_pct']:
+                tx['attempts'] += 1
+                if tx['attempts'] > self.sim['kong_max_retries']:
+                    self.stats['kong_failed'] += 1  # Stays with Kong (failedTxs) until recovered by hand
+                else:
+                    still_pending.append(tx)
+                continue
+            self.stats['kong_retried'] += 1
+            self._execute(tx['sell'], tx['buy'], tx['amount'], tx['min_out'])
+        self.pending = still_pending
+
+    def _check_circuit_breakers(self) -> None:
+        """Price failsafe (per token) and portfolio value circuit breaker, over their time windows."""
+        resume = self.now + self.sim['pause_s']
+        if self.sim['price_alert_pct'] > 0:
+            for symbol in self.symbols:
+                if symbol in self.paused:
+                    continue
+                drop, rise = self.price_windows[symbol].moved_pct(self._pool_price(symbol))
+                if max(drop, rise) >= self.sim['price_alert_pct']:
+                    self.paused[symbol] = resume
+                    self.stats['price_alerts'] += 1
+        value = calculate_total_portfolio_value(self.portfolio)
+        self.value_window.add(self.now, value)
+        if self.sim['portfolio_drop_pct'] > 0 and self.value_window.moved_pct(value)[0] >= self.sim['portfolio_drop_pct']:
+            if len(self.paused) < len(self.portfolio.tokens):
+                self.stats['circuit_breaker_trips'] += 1
+            for symbol in self.portfolio.tokens:
+                self.paused[symbol] = max(self.paused.get(symbol, 0), resume)
+
+    # ---- reporting ----
+
+    def _on_day(self, _payload) -> None:
+        self.days.append(self.snapshot())
+        self.schedule(self.now + 86400, "day")
+
+    def snapshot(self) -> Dict:
+        self.portfolio.total_value_icp = calculate_total_portfolio_value(self.portfolio)
+        return {'day': self.now / 86400, 'trades': self.stats['trades'], 'imbalance': portfolio_imbalance_bp(self.portfolio),
+                'value_icp': self.portfolio.total_value_icp, 'slippage_spend': self.slippage_spend,
+                'paused': len(self.paused), 'pending': len(self.pending)}
+
+
+def run_simulation(days: float, seed: int = 0, config_overrides: Optional[Dict[str, int]] = None,
+                   sim_overrides: Optional[Dict] = None, prices_file: Optional[str] = None,
+                   price_path: Optional[Dict[str, List[Tuple[float, int]]]] = None,
+                   prices_label: Optional[str] = None) -> TreasurySimulator:
+    """--simulate DAYS: run the treasury's cycles for DAYS of virtual time and print a daily report."""
+    if prices_file:
+        price_path, prices_label = load_price_path(prices_file), f"prices from {prices_file}"
+    sim = TreasurySimulator(seed, config_overrides, sim_overrides, price_path)
+    start_imbalance = sim.snapshot()
+    print(f"Simulating {days:g} days of {sim.sim['rebalance_interval_s']}s trading cycles "
+          f"(seed {seed}, {prices_label or 'random-walk prices'})")
+    for key, value in {**(config_overrides or {}), **(sim_overrides or {})}.items():
+        default = TREASURY_CONFIG.get(key, SIMULATION_CONFIG.get(key))
+        print(f"  {key}: {value} (default {default})")
+
+    wall = time.perf_counter()
+    sim.run(days)
+    wall = time.perf_counter() - wall
+    end = sim.snapshot()
+
+    print(f"\n{'Day':>5} {'Trades':>7} {'Imbalance':>10} {'Value ICP':>10} {'Slip spend':>11} {'Paused':>7} {'Pending':>8}")
+    for row in [start_imbalance] + sim.days + ([end] if not sim.days or sim.days[-1]['day'] < end['day'] else []):
+        print(f"{row['day']:5.1f} {row['trades']:7} {row['imbalance']:8}bp {row['value_icp'] / 1e8:10.2f} "
+              f"{row['slippage_spend'] / 1e8:11.4f} {row['paused']:7} {row['pending']:8}")
+
+    n = sim.stats
+    print(f"\nCycles: {n['cycles']} | Trades: {n['trades']} ({n['exact_trades']} exact) | "
+          f"Volume: {n['volume_icp'] / 1e8:.2f} ICP | Slippage spend: {sim.slippage_spend / 1e8:.4f} ICP "
+          f"({sim.slippage_spend * 10000 // max(n['volume_icp'], 1)}bp of volume)")
+    print(f"Skipped attempts: {n['skip_tokens_filtered']} within threshold, {n['skip_no_pair']} no pair, "
+          f"{n['skip_no_execution_path']} slippage over {sim.config['max_slippage_bp']}bp, "
+          f"{n['skip_no_balance']} no balance, {n['failed_min_out']} below min out")
+    print(f"Kong: {n['kong_pending']} swaps pending, {n['kong_retried']} retried, {n['kong_failed']} failed after "
+          f"{sim.sim['kong_max_retries']} attempts | Price alerts: {n['price_alerts']} | "
+          f"Circuit breaker trips: {n['circuit_breaker_trips']}")
+    print(f"Imbalance: {start_imbalance['imbalance']}bp -> {end['imbalance']}bp | "
+          f"{days:g} days simulated in {wall:.1f}s ({days * 86400 / max(wall, 1e-9):,.0f}x real time)")
+    return sim
+
+
+# ============================================
+# Historical Backtest (--backtest)
+# ============================================
+#
+# Same simulator, but token prices follow the price_archive canister's history instead of a
+# random walk. price_history.py keeps a local copy of the archive's ICRC-3 blocks and fetches
+# only new blocks on each run.
+
+def history_price_path(series: Dict[str, List[Tuple[int, int]]], days: Optional[float] = None
+                       ) -> Tuple[Dict[str, List[Tuple[float, int]]], float]:
+    """Turn price_history series (principal -> [(ts_ns, e8s)]) into a simulator price path.
+
+    Covers the last `days` of history (all of it if None), with times in seconds from the
+    window start; each token's last price before the window is carried in at time 0.
+    Returns (path, days covered).
+    """
+    symbols = {principal: symbol for symbol, (principal, _, _) in TOKENS.items() if symbol != "ICP"}
+    series = {symbols[p]: points for p, points in series.items() if p in symbols and points}
+    if not series:
+        return {}, 0.0
+    end = max(points[-1][0] for points in series.values())
+    first = min(points[0][0] for points in series.values())
+    start = max(first, end - int(days * 86400e9)) if days else first
+
+    path = {}
+    for symbol, points in series.items():
+        i = bisect.bisect_right(points, (start, float("inf")))
+        window = points[max(i - 1, 0):]
+        path[symbol] = [(max(0.0, (ts - start) / 1e9), price) for ts, price in window]
+    return path, (end - start) / 86400e9
+
+
+def run_backtest(days: Optional[float], transport, store: str, sync: bool = True, seed: int = 0,
+                 config_overrides: Optional[Dict[str, int]] = None, sim_overrides: Optional[Dict] = None):
+    """--backtest [DAYS]: sync the price archive history, then simulate over its last DAYS."""
+    if sync:
+        started = time.perf_counter()
+        try:
+            price_history.sync(transport, store)
+        except (RuntimeError, candid_codec.CandidError) as e:
+            print(f"Price history sync failed ({e}); using the stored history")
+        print(f"  sync took {time.perf_counter() - started:.1f}s")
+    path, span = history_price_path(price_history.load_price_series(store), days)
+    if not path:
+        raise SystemExit(f"No price history for TOKENS in {store}")
+    missing = [s for s in TOKENS if s != "ICP" and s not in path]
+    print(f"Backtesting {span:.1f} days of archived prices for {len(path)} tokens"
+          + (f" (no history, fixed price: {', '.join(missing)})" if missing else ""))
+    run_simulation(span, seed=seed, config_overrides=config_overrides, sim_overrides=sim_overrides,
+                   price_path=path, prices_label=f"price_archive history in {os.path.basename(store)}")
+
+
 def get_real_quote_for_trade(
     sell_symbol: str,
     buy_symbol: str,
@@ -1350,6 +3101,12 @@ def get_real_quote_for_trade(
     When direct pair fails and ICP fallback is used, routes to ICP only (one-leg).
     Matches treasury.mo: creates ICP overweight that corrects in next cycle.
     """
+    return _drive(_real_quote_steps(sell_symbol, buy_symbol, trade_size, sell_token, buy_token,
+                                    _is_fallback_leg, num_quotes))
+
+
+def _real_quote_steps(sell_symbol, buy_symbol, trade_size, sell_token, buy_token, _is_fallback_leg, num_quotes):
+    """Decision steps of get_real_quote_for_trade (yields QuoteRequest batches)."""
     # Calculate ICP equivalent for quote fetching
     trade_value_icp = (trade_size * sell_token.price_in_icp) // (10 ** sell_token.decimals)
     amount_icp = max(1, trade_value_icp // 100_000_000)  # Convert e8s to ICP units
@@ -1370,27 +3127,7 @@ def get_real_quote_for_trade(
 
     # Check for ICPSwap pool
     pool_key = (sell_symbol, buy_symbol)
-    has_icpswap_pool = pool_key in ICPSWAP_POOLS
-
-    # Fetch ALL quotes in parallel
-    # Kong quotes use full amounts
-    kong_futures = [quote_executor.submit(get_kong_quote, sell_symbol, buy_symbol, amt) for amt in kong_amounts]
-
-    # ICPSwap quotes use fee-adjusted amounts
-    if has_icpswap_pool:
-        pool_id, zero_for_one = ICPSWAP_POOLS[pool_key]
-        sqrt_price = get_pool_metadata(pool_id)
-        icp_futures = [quote_executor.submit(get_icpswap_quote, pool_id, amt, zero_for_one, sqrt_price) for amt in icp_amounts]
-    else:
-        icp_futures = None
-
-    # Collect results
-    kong_quotes = [f.result() for f in kong_futures]
-
-    if icp_futures:
-        icp_quotes = [f.result() for f in icp_futures]
-    else:
-        icp_quotes = [Quote(amt, 0, 10000, False, "no_pool") for amt in icp_amounts]
+    has_icpswap_pool = icpswap_has_pool(pool_key)
 
     # Dust output validation: mark quotes as invalid if output < 1% of expected
     # Matches treasury.mo fix for Kong returning amount=1 with slippage=0%
@@ -1407,10 +3144,22 @@ def get_real_quote_for_trade(
                 # Mark as invalid - dust output
                 return Quote(quote.amount_in, quote.amount_out, 10000, False, "dust_output")
             return quote
+    else:
+        validate_dust = None
 
-        # Use correct amounts for each exchange (Kong=full, ICPSwap=fee-adjusted)
-        kong_quotes = [validate_dust(q, kong_amounts[i]) for i, q in enumerate(kong_quotes)]
-        icp_quotes = [validate_dust(q, icp_amounts[i]) for i, q in enumerate(icp_quotes)]
+    # Fetch ALL quotes in parallel (or adaptively); validate_dust gets each quote's own
+    # amount (Kong=full, ICPSwap=fee-adjusted)
+    if has_icpswap_pool:
+        pool_id, zero_for_one = ICPSWAP_POOLS[pool_key]
+    trade_value_icp_amount = (trade_size * sell_token.price_in_icp) // (10 ** sell_token.decimals) // 100_000_000
+    icp_involved = sell_symbol == "ICP" or buy_symbol == "ICP"
+    kong_quotes, icp_quotes = yield from _quote_grid_steps(
+        kong_amounts, icp_amounts,
+        (lambda amt: kong_request(sell_symbol, buy_symbol, amt),
+         (lambda amt: icpswap_request(pool_id, amt, zero_for_one)) if has_icpswap_pool else None),
+        check=validate_dust, label=f"{sell_symbol}/{buy_symbol} {trade_size:,}",
+        reduced=lambda kq, iq: estimate_max_tradeable_icp(kq, iq, max(1, trade_value_icp_amount),
+                                                          icp_involved, num_quotes))
 
     # Check if any exchange works
     kong_works = any(q.valid for q in kong_quotes)
@@ -1418,8 +3167,6 @@ def get_real_quote_for_trade(
 
     if not kong_works and not icp_works:
         # Step 1: Try REDUCED amount estimation (no extra API call)
-        trade_value_icp_amount = (trade_size * sell_token.price_in_icp) // (10 ** sell_token.decimals) // 100_000_000
-        icp_involved = sell_symbol == "ICP" or buy_symbol == "ICP"
         max_icp, best_exch = estimate_max_tradeable_icp(kong_quotes, icp_quotes, max(1, trade_value_icp_amount), icp_involved, num_quotes)
         if max_icp > 0 and (icp_involved or max_icp >= MIN_TRADE_ICP):
             # Calculate reduced trade size and verify
@@ -1432,12 +3179,11 @@ def get_real_quote_for_trade(
 
             for exch in ([best_exch, "ICP" if best_exch == "Kong" else "Kong"]):
                 if exch == "Kong":
-                    test_verify = get_kong_quote(sell_symbol, buy_symbol, reduced_trade_size)
+                    test_verify, = yield [kong_request(sell_symbol, buy_symbol, reduced_trade_size)]
                 else:
                     if pool_key in ICPSWAP_POOLS:
                         pool_id, zero_for_one = ICPSWAP_POOLS[pool_key]
-                        sqrt_price = get_pool_metadata(pool_id)
-                        test_verify = get_icpswap_quote(pool_id, reduced_trade_size, zero_for_one, sqrt_price)
+                        test_verify, = yield [icpswap_request(pool_id, reduced_trade_size, zero_for_one)]
                     else:
                         test_verify = Quote(reduced_trade_size, 0, 10000, False, "no_pool")
 
@@ -1466,7 +3212,7 @@ def get_real_quote_for_trade(
                 price_in_icp=100_000_000, target_allocation_bp=0
             )
             # Only leg: sell_symbol -> ICP
-            leg1 = get_real_quote_for_trade(sell_symbol, "ICP", trade_size, sell_token, icp_token_for_validation, _is_fallback_leg=True, num_quotes=num_quotes)
+            leg1 = yield from _real_quote_steps(sell_symbol, "ICP", trade_size, sell_token, icp_token_for_validation, True, num_quotes)
             if leg1[0] > 0:
                 # Return ICP as the actual buy (not original buy_symbol)
                 # Route format depends on whether the sell->ICP leg was a split/partial
@@ -1643,12 +3389,11 @@ def get_real_quote_for_trade(
 
             for exch in ([best_exch, "ICP" if best_exch == "Kong" else "Kong"]):
                 if exch == "Kong":
-                    test_verify = get_kong_quote(sell_symbol, buy_symbol, reduced_trade_size)
+                    test_verify, = yield [kong_request(sell_symbol, buy_symbol, reduced_trade_size)]
                 else:
                     if pool_key in ICPSWAP_POOLS:
                         pool_id, zero_for_one = ICPSWAP_POOLS[pool_key]
-                        sqrt_price = get_pool_metadata(pool_id)
-                        test_verify = get_icpswap_quote(pool_id, reduced_trade_size, zero_for_one, sqrt_price)
+                        test_verify, = yield [icpswap_request(pool_id, reduced_trade_size, zero_for_one)]
                     else:
                         test_verify = Quote(reduced_trade_size, 0, 10000, False, "no_pool")
 
@@ -1676,7 +3421,7 @@ def get_real_quote_for_trade(
                 price_in_icp=100_000_000, target_allocation_bp=0
             )
             # Only leg: sell_symbol -> ICP
-            leg1 = get_real_quote_for_trade(sell_symbol, "ICP", trade_size, sell_token, icp_token_for_validation, _is_fallback_leg=True, num_quotes=num_quotes)
+            leg1 = yield from _real_quote_steps(sell_symbol, "ICP", trade_size, sell_token, icp_token_for_validation, True, num_quotes)
             if leg1[0] > 0:
                 # Return ICP as the actual buy (one-leg like treasury.mo)
                 # Route format depends on whether the sell->ICP leg was a split/partial
@@ -1767,14 +3512,14 @@ def run_full_trading_cycle_with_real_quotes(num_cycles: int = 5, use_production_
     """
     global MAX_SLIPPAGE_BP  # May be updated from production config
 
-    # Fetch ICPSwap pools first
+    # Load ICPSwap pools first
     if not ICPSWAP_POOLS:
-        fetch_icpswap_pools()
+        load_icpswap_pools()
 
     # Pre-warm metadata cache for all known pools
     print("  Pre-warming pool metadata cache...")
     meta_futures = [quote_executor.submit(get_pool_metadata, pool_id)
-                    for pool_id, _ in ICPSWAP_POOLS.values()]
+                    for pool_id, _ in list(ICPSWAP_POOLS.values())]
     for f in meta_futures:
         try:
             f.result()
@@ -1807,7 +3552,7 @@ def run_full_trading_cycle_with_real_quotes(num_cycles: int = 5, use_production_
         'reduced_detail': {}, # Track reduced exchange details e.g. {'REDUCED_K': 2, 'REDUCED_I': 1}
         'split_detail': {},   # Track split details e.g. {'SPLIT_60_40': 2, 'SPLIT_40_60_INTERP': 1}
         'partial_detail': {}, # Track partial split details e.g. {'PARTIAL_60_20': 1, 'PARTIAL_50_30_INTERP': 1}
-        'slippages': [],      # Track all slippages for running average
+        'slippage': RunningStat(),  # Running average / p95 of executed trades' slippage
         'last_slip': 0,       # Last slippage for display
         'avg_slip': 0,        # Running average slippage
         'last_fail_reason': '',  # Track last fail reason for display
@@ -1912,15 +3657,12 @@ def run_full_trading_cycle_with_real_quotes(num_cycles: int = 5, use_production_
                 print(f"[{trade_count}/{total_expected}] {sell_symbol} -> {buy_symbol} FAILED: {fail_reason}" + ("\033[K" if is_tty else ""))
                 print(f"  Direct: Kong:{stats['kong']} ICPSwap:{stats['icp']} Split:{stats['split']}(+{stats['split_interp']}i) Partial:{stats['partial']}(+{stats['partial_interp']}i) Reduced:{stats['reduced']}" + ("\033[K" if is_tty else ""))
                 print(f"  Fallback: {stats['icp_fb']}(+{stats['icp_fb_split']}spl +{stats['icp_fb_partial']}par +{stats['icp_fb_reduced']}red) | Failed:{stats['fail']} (last: {fail_reason})" + ("\033[K" if is_tty else ""))
-                print(f"  Slippage: last={stats['last_slip']}bp avg={stats['avg_slip']}bp" + ("\033[K" if is_tty else ""))
+                print(f"  Slippage: last={stats['last_slip']}bp avg={stats['avg_slip']}bp p95={stats['slippage'].sketch.quantile(0.95):.0f}bp" + ("\033[K" if is_tty else ""))
                 print(f"  Imbalance: (calculating...)" + ("\033[K" if is_tty else ""), flush=True)
 
-            # Calculate current imbalance for fail tracking (no balance change on failure)
-            current_imb_for_fail = 0
-            for sym, det in portfolio.tokens.items():
-                val = (det.balance * det.price_in_icp) // (10 ** det.decimals)
-                cur_bp = (val * 10000) // portfolio.total_value_icp if portfolio.total_value_icp > 0 else 0
-                current_imb_for_fail += abs(det.target_allocation_bp - cur_bp)
+            # Imbalance before this attempt: recorded as-is on failure (no balance change) and as
+            # imbalance_before on success (balances don't change until the trade is applied)
+            current_imb_for_fail = portfolio_imbalance_bp(portfolio)
 
             if amount_out == 0:
                 fail_reason = f"NO_QUOTES ({route_type})"
@@ -1942,6 +3684,8 @@ def run_full_trading_cycle_with_real_quotes(num_cycles: int = 5, use_production_
                     'imbalance_after': current_imb_for_fail,  # No change on failure
                     'imbalance_change': 0,
                 })
+                if results_sink is not None:
+                    results_sink.write(trades[-1])
                 print_fail_status(fail_reason)
                 continue
 
@@ -1966,6 +3710,8 @@ def run_full_trading_cycle_with_real_quotes(num_cycles: int = 5, use_production_
                     'imbalance_after': current_imb_for_fail,  # No change on failure
                     'imbalance_change': 0,
                 })
+                if results_sink is not None:
+                    results_sink.write(trades[-1])
                 print_fail_status(fail_reason)
                 continue
 
@@ -1990,12 +3736,7 @@ def run_full_trading_cycle_with_real_quotes(num_cycles: int = 5, use_production_
                     actual_buy_token = portfolio.tokens[actual_buy_symbol]
 
             # Step 6: Record trade and update portfolio state
-            # Calculate imbalance BEFORE the trade for tracking
-            imbalance_before = 0
-            for sym, det in portfolio.tokens.items():
-                val = (det.balance * det.price_in_icp) // (10 ** det.decimals)
-                cur_bp = (val * 10000) // portfolio.total_value_icp if portfolio.total_value_icp > 0 else 0
-                imbalance_before += abs(det.target_allocation_bp - cur_bp)
+            imbalance_before = current_imb_for_fail
 
             # Calculate actual ICP traded based on route type
             intended_icp = trade_value_icp // 100_000_000
@@ -2092,9 +3833,9 @@ def run_full_trading_cycle_with_real_quotes(num_cycles: int = 5, use_production_
             trade_count += 1
 
             # Track slippage for running avg/last display
-            stats['slippages'].append(slippage_bp)
+            stats['slippage'].add(slippage_bp)
             stats['last_slip'] = slippage_bp
-            stats['avg_slip'] = sum(stats['slippages']) // len(stats['slippages'])
+            stats['avg_slip'] = stats['slippage'].total // stats['slippage'].count
 
             # Update balances based on trade execution
             # NOTE: We do NOT update prices here. In production, prices come from external
@@ -2173,18 +3914,15 @@ def run_full_trading_cycle_with_real_quotes(num_cycles: int = 5, use_production_
                 return " [" + ", ".join(parts) + "]" if parts else ""
 
             # Calculate current imbalance after this trade
-            current_imbalance = 0
-            for sym, det in portfolio.tokens.items():
-                val = (det.balance * det.price_in_icp) // (10 ** det.decimals)
-                cur_bp = (val * 10000) // portfolio.total_value_icp if portfolio.total_value_icp > 0 else 0
-                current_imbalance += abs(det.target_allocation_bp - cur_bp)
+            current_imbalance = portfolio_imbalance_bp(portfolio)
 
             # Update trade record with imbalance info
             trade_record['imbalance_after'] = current_imbalance
             trade_record['imbalance_change'] = imbalance_before - current_imbalance  # Positive = improvement
+            if results_sink is not None:
+                results_sink.write(trade_record)
 
             # Use ANSI escape codes for refreshing display (only if stdout is a terminal)
-            import sys
             is_tty = sys.stdout.isatty()
 
             if is_tty and trade_count > 1:
@@ -2193,7 +3931,7 @@ def run_full_trading_cycle_with_real_quotes(num_cycles: int = 5, use_production_
             print(f"[{trade_count}/{total_expected}] {sell_symbol} -> {actual_buy_symbol} via {route_readable(route_type)}" + ("\033[K" if is_tty else ""))
             print(f"  Direct: Kong:{stats['kong']} ICPSwap:{stats['icp']} Split:{stats['split']}(+{stats['split_interp']}i) Partial:{stats['partial']}(+{stats['partial_interp']}i) Reduced:{stats['reduced']}{reduced_breakdown()}" + ("\033[K" if is_tty else ""))
             print(f"  Fallback: {stats['icp_fb']}(+{stats['icp_fb_split']}spl +{stats['icp_fb_partial']}par +{stats['icp_fb_reduced']}red){fb_breakdown()} | Failed:{stats['fail']}" + ("\033[K" if is_tty else ""))
-            print(f"  Slippage: last={stats['last_slip']}bp avg={stats['avg_slip']}bp" + ("\033[K" if is_tty else ""))
+            print(f"  Slippage: last={stats['last_slip']}bp avg={stats['avg_slip']}bp p95={stats['slippage'].sketch.quantile(0.95):.0f}bp" + ("\033[K" if is_tty else ""))
             # Show imbalance progress
             imbalance_change = initial_imbalance - current_imbalance
             imbalance_pct = (imbalance_change * 100) // initial_imbalance if initial_imbalance > 0 else 0
@@ -2274,11 +4012,7 @@ def run_full_trading_cycle_with_real_quotes(num_cycles: int = 5, use_production_
         print(f"  Random sizing: {random_trades}")
 
     # Portfolio convergence analysis
-    final_imbalance = 0
-    for symbol, details in portfolio.tokens.items():
-        value = (details.balance * details.price_in_icp) // (10 ** details.decimals)
-        current_bp = (value * 10000) // portfolio.total_value_icp if portfolio.total_value_icp > 0 else 0
-        final_imbalance += abs(details.target_allocation_bp - current_bp)
+    final_imbalance = portfolio_imbalance_bp(portfolio)
 
     print(f"\nPortfolio Convergence:")
     print(f"  Initial imbalance: {initial_imbalance}bp")
@@ -2307,20 +4041,287 @@ def run_full_trading_cycle_with_real_quotes(num_cycles: int = 5, use_production_
                 t['split_pct'] = f"{kong_bp // 100}/{icp_bp // 100}"
 
         with open(csv_filename, 'w', newline='') as f:
-            writer = csv.DictWriter(f, fieldnames=[
-                'cycle', 'attempt', 'sell', 'buy', 'intended_buy',
-                'amount_sold', 'amount_bought', 'intended_icp', 'actual_icp', 'is_exact',
-                'slippage_bp', 'sell_diff_bp', 'buy_diff_bp',
-                'route', 'split_pct', 'fail_reason',
-                'imbalance_before', 'imbalance_after', 'imbalance_change'
-            ])
+            writer = csv.DictWriter(f, fieldnames=[name for name, _ in TRADE_COLUMNS])
             writer.writeheader()
             writer.writerows(trades)
         print(f"\nTrades exported to: {csv_filename}")
+    if results_sink is not None:
+        results_sink.flush()
+        print(f"Trades streamed to: {', '.join(results_sink.paths)} ({results_sink.written} records)")
 
+    print_call_stats()
+    save_pool_cache()
     return trades
 
 
+# ============================================
+# Realized vs Predicted Slippage (--slippage-report)
+# ============================================
+#
+# trade_history.py keeps an indexed copy of the trading_archive canister's trade blocks.
+# Each execution (the legs recorded with one timestamp and pair) is run back through
+# get_real_quote_for_trade at its recorded size, and the realized output and exchange mix
+# are compared with what run_algorithm picks. The quotes are the current ones (or a
+# --replay recording's), not those the treasury saw at trade time, so the errors measure
+# the model and the market's drift since together. ICPSwap legs record no slippage, so
+# the realized output is the primary measure; recorded slippage is compared only for
+# executions with no ICPSwap leg.
+
+SLIPPAGE_REPORT_TRADES = 500  # Latest executions re-predicted by --slippage-report (0 = all)
+SLIPPAGE_REPORT_PAIRS = 15    # Pairs listed, most traded first
+FULL_AMOUNT_ROUTES = ("KONG_100", "ICP_100", "SPLIT_")  # Predicted routes that trade the whole amount on the pair
+
+
+def quote_source_label(replay_dir: Optional[str] = None) -> str:
+    """Key for cached predictions: the replayed recording, or the quote modes and the day."""
+    if replay_dir:
+        return f"replay:{os.path.basename(os.path.normpath(replay_dir))}"
+    modes = ",".join(f"{exchange}={mode}" for exchange, mode in sorted(QUOTE_MODES.items()))
+    return f"{modes}@{time.strftime('%Y-%m-%d', time.gmtime())}"
+
+
+def _execution_key(execution: Dict) -> Tuple[int, str, str]:
+    return execution["ts"], execution["token_sold"], execution["token_bought"]
+
+
+def _actual_mix(execution: Dict) -> str:
+    return "+".join(sorted({exchange or "?" for exchange, *_ in execution["legs"]}))
+
+
+def _predicted_mix(prediction: Dict) -> str:
+    """Exchange mix of a full-amount prediction, else the route family (PARTIAL, REDUCED, ICP_FB, ...)."""
+    route = prediction["route"]
+    if not route.startswith(FULL_AMOUNT_ROUTES):
+        return next((family for family in ("ICP_FB", "PARTIAL", "REDUCED") if route.startswith(family)), route)
+    exchanges = (["ICPSwap"] if prediction["icp_pct"] else []) + (["KongSwap"] if prediction["kong_pct"] else [])
+    return "+".join(exchanges)
+
+
+def _price_at(series: Dict[str, List[Tuple[int, int]]], symbol: str, ts: int) -> int:
+    """ICP price (e8s) of symbol at ts from the price_history series, else the approximate price."""
+    if symbol == "ICP":
+        return 100_000_000
+    points = series.get(TOKENS[symbol][0])
+    if points:
+        i = bisect.bisect_right(points, (ts, float("inf")))
+        return points[max(i - 1, 0)][1]
+    return TOKEN_APPROX_PRICES_ICP.get(symbol, 100_000)
+
+
+# Quote errors left by give-ups on the transport (not answers from the exchange); a
+# prediction that saw one is reported but not cached, so a later run quotes it again
+TRANSIENT_QUOTE_ERRORS = ("timeout", "dfx_error", "parse_error")
+
+
+def _note_quote_errors(steps, errors: set):
+    """Pass decision steps through, adding the error of every quote they are sent to `errors`."""
+    try:
+        requests = next(steps)
+        while True:
+            quotes = yield requests
+            errors.update(q.error for q in quotes if q.error)
+            requests = steps.send(quotes)
+    except StopIteration as done:
+        return done.value
+
+
+def predict_execution(execution: Dict, series: Dict[str, List[Tuple[int, int]]]) -> Optional[Dict]:
+    """run_algorithm's choice for an execution's pair and total sold amount (None for unknown tokens).
+
+    "transient" is set when a quote behind it failed on the transport (TRANSIENT_QUOTE_ERRORS).
+    """
+    sell, buy = PRINCIPAL_TO_SYMBOL.get(execution["token_sold"]), PRINCIPAL_TO_SYMBOL.get(execution["token_bought"])
+    if sell is None or buy is None:
+        return None
+    sell_token, buy_token = (
+        TokenDetails(TOKENS[s][0], s, TOKENS[s][1], 0, _price_at(series, s, execution["ts"]), 0) for s in (sell, buy))
+    errors: set = set()
+    amount_out, slippage_bp, route, (kong_pct, icp_pct), actual_buy = _drive(_note_quote_errors(
+        _real_quote_steps(sell, buy, execution["amount_sold"], sell_token, buy_token, False, NUM_QUOTES), errors))
+    return {"route": route, "kong_pct": kong_pct, "icp_pct": icp_pct, "amount_out": amount_out,
+            "slippage_bp": slippage_bp, "actual_buy": actual_buy,
+            "transient": any(e in TRANSIENT_QUOTE_ERRORS for e in errors)}
+
+
+class SlippageGroup:
+    """Route agreement and error distributions of one group of executions."""
+
+    def __init__(self):
+        self.count = 0
+        self.agree = 0
+        self.output_error = RunningStat()    # bp, (realized - predicted output) / predicted
+        self.slippage_error = RunningStat()  # bp, recorded - predicted slippage
+
+    def add(self, agrees: bool, output_error: Optional[float], slippage_error: Optional[float]) -> None:
+        self.count += 1
+        self.agree += agrees
+        if output_error is not None:
+            self.output_error.add(output_error)
+        if slippage_error is not None:
+            self.slippage_error.add(slippage_error)
+
+
+class SlippageReport:
+    """Realized executions against their predictions, by actual exchange mix and by pair."""
+
+    def __init__(self):
+        self.all = SlippageGroup()
+        self.by_mix: Dict[str, SlippageGroup] = defaultdict(SlippageGroup)
+        self.by_pair: Dict[str, SlippageGroup] = defaultdict(SlippageGroup)
+        self.mixes: Counter = Counter()  # (actual mix, predicted mix)
+        self.unpredicted = 0
+
+    def add(self, execution: Dict, prediction: Optional[Dict]) -> None:
+        if prediction is None:
+            self.unpredicted += 1
+            return
+        sell, buy = (PRINCIPAL_TO_SYMBOL[execution[k]] for k in ("token_sold", "token_bought"))
+        actual, predicted = _actual_mix(execution), _predicted_mix(prediction)
+        self.mixes[actual, predicted] += 1
+
+        # Only predictions quoted at the full amount are scored: an interpolated split's amount_out
+        # is not a quote at its percentages, and FAILURE / NO_PATH carry a placeholder 10000bp
+        route = prediction["route"]
+        quoted = (route.startswith(FULL_AMOUNT_ROUTES) and not route.endswith("_INTERP")
+                  and prediction["actual_buy"] == buy and prediction["amount_out"] > 0)
+        output_error = slippage_error = None
+        if quoted:
+            output_error = (execution["amount_bought"] - prediction["amount_out"]) * 10000 / prediction["amount_out"]
+        legs = execution["legs"]
+        if quoted and all(exchange != "ICPSwap" and slippage is not None for exchange, _, _, slippage in legs):
+            sold = sum(amount for _, amount, _, _ in legs) or 1
+            recorded_bp = sum(slippage * 100 * amount for _, amount, _, slippage in legs) / sold
+            slippage_error = recorded_bp - prediction["slippage_bp"]
+
+        for group in (self.all, self.by_mix[actual], self.by_pair[f"{sell}/{buy}"]):
+            group.add(actual == predicted, output_error, slippage_error)
+
+    def print(self) -> None:
+        def row(name: str, group: SlippageGroup) -> str:
+            out, slip = group.output_error, group.slippage_error
+            line = f"  {name:<18} {group.count:7,} {group.agree * 100 / max(group.count, 1):6.1f}%"
+            if out.count:
+                line += (f" {out.sketch.quantile(0.1):8.0f} {out.sketch.quantile(0.5):7.0f}"
+                         f" {out.sketch.quantile(0.9):7.0f} {out.mean:7.0f} {out.count:6,}")
+            else:
+                line += f" {'-':>8} {'-':>7} {'-':>7} {'-':>7} {0:6,}"
+            if slip.count:
+                line += f"   {slip.sketch.quantile(0.5):7.0f} {slip.sketch.quantile(0.9):7.0f} {slip.count:6,}"
+            return line
+
+        header = (f"  {'':<18} {'Trades':>7} {'Agree':>7} {'Out p10':>8} {'p50':>7} {'p90':>7} {'mean':>7} {'n':>6}"
+                  f"   {'Slip p50':>7} {'p90':>7} {'n':>6}")
+        print(f"\nRoute agreement: {self.all.agree * 100 / max(self.all.count, 1):.1f}% "
+              f"of {self.all.count:,} executions" + (f" ({self.unpredicted:,} with tokens not in TOKENS skipped)"
+                                                     if self.unpredicted else ""))
+        print("  Actual mix -> predicted:")
+        for actual in sorted({a for a, _ in self.mixes}, key=lambda a: -self.by_mix[a].count):
+            predicted = sorted(((n, p) for (a, p), n in self.mixes.items() if a == actual), reverse=True)
+            print(f"    {actual:<18} " + ", ".join(f"{p} {n:,}" for n, p in predicted))
+        print("\nErrors in bp: Out = realized vs predicted output (+ = better than predicted; full-amount, quoted routes),")
+        print("Slip = recorded vs predicted slippage (executions without ICPSwap legs, which record none)")
+        print("\nBy actual exchange mix:")
+        print(header)
+        for mix, group in sorted(self.by_mix.items(), key=lambda kv: -kv[1].count):
+            print(row(mix, group))
+        print(row("all", self.all))
+        print(f"\nBy pair (top {SLIPPAGE_REPORT_PAIRS}):")
+        print(header)
+        for pair, group in sorted(self.by_pair.items(), key=lambda kv: -kv[1].count)[:SLIPPAGE_REPORT_PAIRS]:
+            print(row(pair, group))
+
+
+def synthetic_trades(num_trades: int, seed: int = 0) -> List[Dict]:
+    """--standin: trade legs shaped like the treasury's (pairs from TOKENS, 0.02-0.1 ICP each).
+
+    Executions go 60% to KongSwap, 30% to ICPSwap and 10% split over both (two legs);
+    3% fail. ICPSwap legs record 0 slippage, as the treasury does.
+    """
+    rng = random.Random(seed)
+    symbols = list(TOKENS)
+    ts = int((time.time() - num_trades * 60) * 1e9)
+    trades: List[Dict] = []
+    while len(trades) < num_trades:
+        ts += rng.randrange(10, 110) * 1_000_000_000
+        sell, buy = rng.sample(symbols, 2)
+        value = rng.randrange(TREASURY_CONFIG['min_trade_value_icp'], TREASURY_CONFIG['max_trade_value_icp'])
+        r = rng.random()
+        shares = [("KongSwap", 1.0)] if r < 0.6 else [("ICPSwap", 1.0)] if r < 0.9 else \
+            [("KongSwap", 0.6), ("ICPSwap", 0.4)]
+        success = rng.random() >= 0.03
+        for exchange, share in shares:
+            slippage = rng.uniform(0.05, 1.5)
+            sold = int(value * share * 10 ** TOKENS[sell][1] / TOKEN_APPROX_PRICES_ICP[sell])
+            bought = int(value * share * (1 - slippage / 100) * 10 ** TOKENS[buy][1] / TOKEN_APPROX_PRICES_ICP[buy])
+            trades.append({
+                "ts": ts, "token_sold": TOKENS[sell][0], "token_bought": TOKENS[buy][0],
+                "amount_sold": sold, "amount_bought": bought if success else 0, "exchange": exchange,
+                "success": success, "slippage_pct": slippage if success and exchange != "ICPSwap" else 0.0,
+                "fee": TOKENS[sell][2], "error": None if success else "Slippage exceeds maximum",
+            })
+    return trades[:num_trades]
+
+
+def run_slippage_report(limit: int, store_path: str, sync_transport=None,
+                        canister_id: str = trade_history.TRADING_ARCHIVE_CANISTER_ID,
+                        history_store: str = price_history.DEFAULT_STORE, quotes: str = "") -> SlippageReport:
+    """--slippage-report [N]: sync the trade archive, re-predict the latest N executions, report the errors.
+
+    sync_transport None uses the store as it is. Predictions are cached in the store per
+    quote source (quote_source_label()), so a rerun only quotes new executions.
+    """
+    check_quantile_sketch()  # Every percentile below comes from it
+    store = trade_history.TradeStore(store_path)
+    if sync_transport is not None:
+        started = time.perf_counter()
+        try:
+            blocks, rows = trade_history.sync(sync_transport, store, canister_id)
+        except (RuntimeError, candid_codec.CandidError) as e:
+            print(f"Trade history sync failed ({e}); using the stored trades")
+            blocks = 0
+        wall = time.perf_counter() - started
+        print(f"  sync took {wall:.1f}s" + (f" ({blocks / max(wall, 1e-9):,.0f} blocks/s)" if blocks else ""))
+    counts = store.counts()
+    print(f"{counts['trades']:,} trade legs stored ({counts['successful']:,} successful, {counts['failed']:,} failed)"
+          + "".join(f", {exchange or '?'} {n:,}" for exchange, n in store.by_exchange()))
+
+    executions = store.executions(limit or None)
+    if not executions:
+        store.close()
+        raise SystemExit(f"No successful trades in {store_path}")
+    quotes = quotes or quote_source_label()
+    predictions = store.predictions(quotes)
+    todo = [ex for ex in executions if _execution_key(ex) not in predictions
+            and ex["token_sold"] in PRINCIPAL_TO_SYMBOL and ex["token_bought"] in PRINCIPAL_TO_SYMBOL]
+    print(f"Comparing the latest {len(executions):,} executions with predictions from quotes: {quotes} "
+          f"({len(executions) - len(todo):,} cached)")
+
+    if todo:
+        series = price_history.load_price_series(history_store) if os.path.isdir(history_store) else {}
+        if not series:
+            print("  (no price history: dust checks use approximate token prices)")
+        load_icpswap_pools()
+        started = time.perf_counter()
+        done = 0
+        with ThreadPoolExecutor(max_workers=MAX_PARALLEL) as pool:
+            for ex, prediction in zip(todo, pool.map(lambda ex: predict_execution(ex, series), todo)):
+                predictions[_execution_key(ex)] = prediction
+                done += 1
+                if done % 20 == 0 or done == len(todo):
+                    print(f"\r  predicted {done:,}/{len(todo):,}", end="", flush=True)
+        print(f" in {time.perf_counter() - started:.1f}s")
+        store.add_predictions(quotes, [(_execution_key(ex), predictions[_execution_key(ex)]) for ex in todo
+                                       if not predictions[_execution_key(ex)]["transient"]])
+        save_pool_cache()
+    store.close()
+
+    report = SlippageReport()
+    for ex in executions:
+        report.add(ex, predictions.get(_execution_key(ex)))
+    report.print()
+    return report
+
+
 # ============================================
 # Test Function
 # ============================================
@@ -2449,42 +4450,40 @@ def test_pair_internal(sell_symbol: str, buy_symbol: str, amount_icp: int, base_
     Does NOT attempt ICP fallback - caller handles that.
     Returns: (result, kong_quotes, icp_quotes) - quotes needed for reduced amount estimation
     """
+    return _drive(_test_pair_internal_steps(sell_symbol, buy_symbol, amount_icp, base_amount))
+
+
+def _test_pair_internal_steps(sell_symbol: str, buy_symbol: str, amount_icp: int, base_amount: int):
+    """Decision steps of test_pair_internal (yields QuoteRequest batches)."""
     # Get transfer fee for sell token (needed for ICPSwap quote adjustment)
     # ICPSwap executes swaps with (amountIn - fee), so quotes must reflect this
     sell_token_fee = TOKENS.get(sell_symbol, (None, None, 0))[2]
 
-    # Quote amounts: 20%, 40%, 60%, 80%, 100%
+    # Quote amounts: 20%, 40%, 60%, 80%, 100% (or N evenly spaced points for the optimizer)
     # Kong uses full amounts (handles fee internally via pay_tx_id)
-    kong_amounts = [base_amount * p // 10 for p in [2, 4, 6, 8, 10]]
+    if SPLIT_OPTIMIZER_POINTS:
+        kong_amounts = [base_amount * p // SPLIT_OPTIMIZER_POINTS for p in range(1, SPLIT_OPTIMIZER_POINTS + 1)]
+    else:
+        kong_amounts = [base_amount * p // 10 for p in [2, 4, 6, 8, 10]]
 
     # ICPSwap uses fee-adjusted amounts (fee deducted before swap in pool)
     icp_amounts = [max(0, amt - sell_token_fee) for amt in kong_amounts]
 
     # Check for ICPSwap pool
     pool_key = (sell_symbol, buy_symbol)
-    has_icpswap_pool = pool_key in ICPSWAP_POOLS
+    has_icpswap_pool = icpswap_has_pool(pool_key)
 
-    # Fetch ALL quotes in parallel (5 Kong + up to 5 ICPSwap = 10 requests)
-    # Kong quotes use full amounts
-    kong_futures = [quote_executor.submit(get_kong_quote, sell_symbol, buy_symbol, amt) for amt in kong_amounts]
-
-    # ICPSwap quotes use fee-adjusted amounts
+    # Fetch ALL quotes in parallel (5 Kong + up to 5 ICPSwap = 10 requests), or adaptively
+    # Kong quotes use full amounts; ICPSwap quotes use fee-adjusted amounts
+    # (each uses the pool's sqrtPriceX96 metadata for slippage calculation, like treasury.mo)
     if has_icpswap_pool:
         pool_id, zero_for_one = ICPSWAP_POOLS[pool_key]
-        # Fetch pool metadata for slippage calculation (like treasury.mo)
-        sqrt_price = get_pool_metadata(pool_id)
-        # Fetch ICPSwap quotes in parallel with sqrt_price for slippage calc
-        icp_futures = [quote_executor.submit(get_icpswap_quote, pool_id, amt, zero_for_one, sqrt_price) for amt in icp_amounts]
-    else:
-        icp_futures = None
-
-    # Collect results
-    kong_quotes = [f.result() for f in kong_futures]
-
-    if icp_futures:
-        icp_quotes = [f.result() for f in icp_futures]
-    else:
-        icp_quotes = [Quote(amt, 0, 10000, False, "no_pool") for amt in icp_amounts]
+    kong_quotes, icp_quotes = yield from _quote_grid_steps(
+        kong_amounts, icp_amounts,
+        (lambda amt: kong_request(sell_symbol, buy_symbol, amt),
+         (lambda amt: icpswap_request(pool_id, amt, zero_for_one)) if has_icpswap_pool else None),
+        label=f"{sell_symbol}/{buy_symbol} @{amount_icp}ICP",
+        reduced=lambda kq, iq: estimate_max_tradeable_icp(kq, iq, amount_icp, sell_symbol == "ICP" or buy_symbol == "ICP"))
 
     # Check if any exchange works
     kong_works = any(q.valid for q in kong_quotes)
@@ -2498,6 +4497,10 @@ def test_pair_internal(sell_symbol: str, buy_symbol: str, amount_icp: int, base_
         return (TestResult(f"{sell_symbol}/{buy_symbol}", amount_icp, 'FAILURE',
                           details=f"Both failed: {err_info}"), kong_quotes, icp_quotes)
 
+    if SPLIT_OPTIMIZER_POINTS:
+        return (yield from _test_pair_optimized_steps(sell_symbol, buy_symbol, amount_icp, base_amount,
+                                                      kong_quotes, icp_quotes))
+
     # Run algorithm
     result_type, kong_pct, icp_pct, expected_out, no_interp_out, was_interpolated = run_algorithm(kong_quotes, icp_quotes)
 
@@ -2520,14 +4523,13 @@ def test_pair_internal(sell_symbol: str, buy_symbol: str, amount_icp: int, base_
     kong_amount = base_amount * kong_pct // 10000
     icp_amount = base_amount - kong_amount
 
-    verify_kong_future = quote_executor.submit(get_kong_quote, sell_symbol, buy_symbol, kong_amount)
+    verify_requests = [kong_request(sell_symbol, buy_symbol, kong_amount)]
     if has_icpswap_pool:
-        verify_icp_future = quote_executor.submit(get_icpswap_quote, pool_id, icp_amount, zero_for_one, sqrt_price)
-    else:
-        verify_icp_future = None
+        verify_requests.append(icpswap_request(pool_id, icp_amount, zero_for_one))
 
-    actual_kong = verify_kong_future.result()
-    actual_icp = verify_icp_future.result() if verify_icp_future else Quote(icp_amount, 0, 10000, False, "no_pool")
+    verified = yield verify_requests
+    actual_kong = verified[0]
+    actual_icp = verified[1] if has_icpswap_pool else Quote(icp_amount, 0, 10000, False, "no_pool")
 
     actual_total = 0
     if actual_kong.valid:
@@ -2553,8 +4555,73 @@ def test_pair_internal(sell_symbol: str, buy_symbol: str, amount_icp: int, base_
     ), kong_quotes, icp_quotes)
 
 
+def _test_pair_optimized_steps(sell_symbol: str, buy_symbol: str, amount_icp: int, base_amount: int,
+                               kong_quotes: List[Quote], icp_quotes: List[Quote]):
+    """Optimizer variant of the split decision (--optimizer): fit price-impact curves to the
+    quote points, solve for the best split directly, then check it with verify quotes."""
+    pair = f"{sell_symbol}/{buy_symbol}"
+    sell_token_fee = TOKENS.get(sell_symbol, (None, None, 0))[2]
+    pool_key = (sell_symbol, buy_symbol)
+
+    def curve(quotes):
+        return split_optimizer.fit_curve([(q.amount_in, q.amount_out, q.slippage_bp) for q in quotes if not q.error])
+
+    plan = split_optimizer.optimize_split(curve(kong_quotes), curve(icp_quotes), base_amount,
+                                          sell_token_fee, MAX_SLIPPAGE_BP)
+    if plan is None:
+        return (TestResult(pair, amount_icp, 'FAILURE', details="No viable path (fitted slippage too high)"),
+                kong_quotes, icp_quotes)
+
+    # Verify quotes at the chosen amounts (reusing a sampled point when it is the same amount)
+    kong_amount = base_amount * plan.kong_pct // 10000
+    icp_amount = max(0, base_amount * plan.icp_pct // 10000 - sell_token_fee)
+    sampled_kong = {q.amount_in: q for q in kong_quotes}
+    sampled_icp = {q.amount_in: q for q in icp_quotes}
+    requests = []
+    if plan.kong_pct and kong_amount not in sampled_kong:
+        requests.append(kong_request(sell_symbol, buy_symbol, kong_amount))
+    if plan.icp_pct and icp_amount not in sampled_icp:
+        pool_id, zero_for_one = ICPSWAP_POOLS[pool_key]
+        requests.append(icpswap_request(pool_id, icp_amount, zero_for_one))
+    fetched = iter((yield requests) if requests else [])
+    legs = []
+    if plan.kong_pct:
+        legs.append(sampled_kong[kong_amount] if kong_amount in sampled_kong else next(fetched))
+    if plan.icp_pct:
+        legs.append(sampled_icp[icp_amount] if icp_amount in sampled_icp else next(fetched))
+
+    actual_total = sum(q.amount_out for q in legs if q.valid)
+    if not any(q.valid for q in legs):
+        return (TestResult(pair, amount_icp, 'FAILURE',
+                           details=f"Optimized split failed verify (Kong:{plan.kong_pct / 100:.1f}% ICP:{plan.icp_pct / 100:.1f}%)"),
+                kong_quotes, icp_quotes)
+    if plan.result_type in ('SINGLE_KONG', 'SINGLE_ICP'):
+        return (TestResult(pair, amount_icp, plan.result_type, algorithm_output=actual_total,
+                           split_pct=(plan.kong_pct, plan.icp_pct),
+                           details="Kong 100%" if plan.kong_pct == 10000 else "ICPSwap 100%"),
+                kong_quotes, icp_quotes)
+
+    error_pct = abs(plan.expected_out - actual_total) / actual_total * 100 if actual_total > 0 else 0
+    kind = "OPT PARTIAL" if plan.partial else "OPT"
+    return (TestResult(pair, amount_icp, 'SPLIT_OPT',
+                       algorithm_output=plan.expected_out, actual_output=actual_total,
+                       error_pct=error_pct, split_pct=(plan.kong_pct, plan.icp_pct),
+                       details=f"{kind} Kong:{plan.kong_pct / 100:.2f}% ICP:{plan.icp_pct / 100:.2f}%"),
+            kong_quotes, icp_quotes)
+
+
 def test_pair(sell_symbol: str, buy_symbol: str, amount_icp: int) -> TestResult:
     """Test a single pair at a given amount, with reduced amount and ICP fallbacks."""
+    return _drive(_test_pair_steps(sell_symbol, buy_symbol, amount_icp))
+
+
+async def test_pair_async(sell_symbol: str, buy_symbol: str, amount_icp: int) -> TestResult:
+    """Async twin of test_pair (--async mode)."""
+    return await _drive_async(_test_pair_steps(sell_symbol, buy_symbol, amount_icp))
+
+
+def _test_pair_steps(sell_symbol: str, buy_symbol: str, amount_icp: int):
+    """Decision steps of test_pair (yields QuoteRequest batches)."""
     if sell_symbol == buy_symbol:
         return TestResult(f"{sell_symbol}/{buy_symbol}", amount_icp, 'SKIP')
 
@@ -2570,7 +4637,7 @@ def test_pair(sell_symbol: str, buy_symbol: str, amount_icp: int) -> TestResult:
         base_amount = amount_icp * (10 ** decimals)
 
     # Try direct pair first
-    result, kong_quotes, icp_quotes = test_pair_internal(sell_symbol, buy_symbol, amount_icp, base_amount)
+    result, kong_quotes, icp_quotes = yield from _test_pair_internal_steps(sell_symbol, buy_symbol, amount_icp, base_amount)
 
     # If direct pair failed, try fallbacks
     if result and result.result_type == 'FAILURE':
@@ -2588,12 +4655,11 @@ def test_pair(sell_symbol: str, buy_symbol: str, amount_icp: int) -> TestResult:
 
             for exch in ([best_exch, "ICP" if best_exch == "Kong" else "Kong"]):
                 if exch == "Kong":
-                    test_verify = get_kong_quote(sell_symbol, buy_symbol, reduced_base)
+                    test_verify, = yield [kong_request(sell_symbol, buy_symbol, reduced_base)]
                 else:
                     if pool_key in ICPSWAP_POOLS:
                         pool_id, zfo = ICPSWAP_POOLS[pool_key]
-                        sqrt_price = get_pool_metadata(pool_id)
-                        test_verify = get_icpswap_quote(pool_id, reduced_base, zfo, sqrt_price)
+                        test_verify, = yield [icpswap_request(pool_id, reduced_base, zfo)]
                     else:
                         test_verify = Quote(reduced_base, 0, 10000, False, "no_pool")
 
@@ -2620,10 +4686,10 @@ def test_pair(sell_symbol: str, buy_symbol: str, amount_icp: int) -> TestResult:
                               details=f"Direct: {result.details} | No fallback (buy=ICP)")
         else:
             # Try sell_symbol -> ICP fallback
-            fallback_result, fb_kong, fb_icp = test_pair_internal(sell_symbol, "ICP", amount_icp, base_amount)
+            fallback_result, fb_kong, fb_icp = yield from _test_pair_internal_steps(sell_symbol, "ICP", amount_icp, base_amount)
             if fallback_result and fallback_result.result_type not in ['FAILURE', 'SKIP']:
                 # Distinguish ICP fallback single vs split
-                is_split = fallback_result.result_type in ['SPLIT', 'SPLIT_INTERP']
+                is_split = fallback_result.result_type in ['SPLIT', 'SPLIT_INTERP', 'SPLIT_OPT']
                 fb_type = 'ICP_FB_SPLIT' if is_split else 'ICP_FALLBACK'
                 return TestResult(
                     f"{sell_symbol}/{buy_symbol}", amount_icp, fb_type,
@@ -2641,13 +4707,12 @@ def test_pair(sell_symbol: str, buy_symbol: str, amount_icp: int) -> TestResult:
                 # Verify with actual quote at reduced amount for ICP route
                 reduced_base = int(base_amount * fb_max_icp / amount_icp)
                 if fb_best_exch == "Kong":
-                    verify_quote = get_kong_quote(sell_symbol, "ICP", reduced_base)
+                    verify_quote, = yield [kong_request(sell_symbol, "ICP", reduced_base)]
                 else:
                     pool_key = (sell_symbol, "ICP")
                     if pool_key in ICPSWAP_POOLS:
                         pool_id, zfo = ICPSWAP_POOLS[pool_key]
-                        sqrt_price = get_pool_metadata(pool_id)
-                        verify_quote = get_icpswap_quote(pool_id, reduced_base, zfo, sqrt_price)
+                        verify_quote, = yield [icpswap_request(pool_id, reduced_base, zfo)]
                     else:
                         verify_quote = Quote(reduced_base, 0, 10000, False, "no_pool")
 
@@ -2666,142 +4731,830 @@ def test_pair(sell_symbol: str, buy_symbol: str, amount_icp: int) -> TestResult:
     return result
 
 
-def print_status():
-    """Print current status."""
+def print_status(force: bool = False):
+    """Print current status (throttled to one redraw per STATUS_REFRESH_INTERVAL unless force)."""
     with results_lock:
-        singles_kong = sum(1 for r in all_results if r.result_type == 'SINGLE_KONG')
-        singles_icp = sum(1 for r in all_results if r.result_type == 'SINGLE_ICP')
-        splits = sum(1 for r in all_results if r.result_type in ['SPLIT', 'SPLIT_INTERP'])
-        icp_fb_single = sum(1 for r in all_results if r.result_type == 'ICP_FALLBACK')
-        icp_fb_split = sum(1 for r in all_results if r.result_type == 'ICP_FB_SPLIT')
-        icp_fb_exec = sum(1 for r in all_results if r.result_type == 'ICP_FB_EXEC')
-        reduced = sum(1 for r in all_results if r.result_type == 'REDUCED')
-        failures = sum(1 for r in all_results if r.result_type == 'FAILURE')
-
-        status = f"\r[{completed_count}/{total_tests}] Kong:{singles_kong} ICP:{singles_icp} Split:{splits} ICP_FB:{icp_fb_single}({icp_fb_split}) ExecFB:{icp_fb_exec} Red:{reduced} Fail:{failures}"
+        if not sweep_stats.redraw_due(force):
+            return
+        n = sweep_stats.by_type
+        splits = n['SPLIT'] + n['SPLIT_INTERP'] + n['SPLIT_OPT']
+        status = (f"\r[{completed_count}/{total_tests}] Kong:{n['SINGLE_KONG']} ICP:{n['SINGLE_ICP']} Split:{splits} "
+                  f"ICP_FB:{n['ICP_FALLBACK']}({n['ICP_FB_SPLIT']}) ExecFB:{n['ICP_FB_EXEC']} Red:{n['REDUCED']} Fail:{n['FAILURE']}")
         print(status, end="", flush=True)
 
 
-def worker(sell: str, buy: str, amount: int) -> TestResult:
-    """Worker function."""
-    global completed_count, stop_requested
+def record_result(result: TestResult) -> None:
+    """Add a finished test to all_results and the live counters, and refresh the status line."""
+    global completed_count
 
+    with results_lock:
+        if results_sink is not None:
+            results_sink.write(asdict(result))
+        else:
+            all_results.append(result)
+        sweep_stats.add(result)
+        completed_count += 1
+
+    print_status()
+
+
+def worker(sell: str, buy: str, amount: int) -> TestResult:
+    """Worker function (--per-test engine)."""
     if stop_requested:
         return TestResult(f"{sell}/{buy}", amount, 'SKIP', details="Stopped")
 
     result = test_pair(sell, buy, amount)
+    record_result(result)
+    return result
 
-    with results_lock:
-        all_results.append(result)
-        completed_count += 1
 
-    print_status()
+async def worker_async(sell: str, buy: str, amount: int) -> TestResult:
+    """Async worker: same bookkeeping as worker(), but runs on the event loop."""
+    result = await test_pair_async(sell, buy, amount)
+    record_result(result)
     return result
 
 
+async def run_tests_async(tasks: List[Tuple[str, str, int]], window: int = MAX_PARALLEL):
+    """
+    Run the test matrix on one event loop with at most `window` tests in flight.
+    Tasks are created lazily as slots free up; Ctrl+C cancels everything in flight.
+    """
+    global stop_requested
+
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    try:
+        loop.add_signal_handler(signal.SIGINT, stop.set)
+    except (NotImplementedError, RuntimeError):
+        pass  # e.g. Windows: KeyboardInterrupt is handled by the caller instead
+
+    pending_tasks = iter(tasks)
+    in_flight = set()
+    stop_waiter = asyncio.ensure_future(stop.wait())
+    try:
+        while True:
+            while len(in_flight) < window and not stop.is_set():
+                task = next(pending_tasks, None)
+                if task is None:
+                    break
+                in_flight.add(asyncio.ensure_future(worker_async(*task)))
+            if not in_flight or stop.is_set():
+                break
+
+            done, in_flight = await asyncio.wait(in_flight | {stop_waiter}, return_when=asyncio.FIRST_COMPLETED)
+            in_flight.discard(stop_waiter)
+            for future in done - {stop_waiter}:
+                if not future.cancelled() and future.exception():
+                    print(f"\nError: {future.exception()}")
+    finally:
+        if stop.is_set():
+            print("\n\n*** Ctrl+C pressed - stopping tests and showing results ***")
+            stop_requested = True
+        for future in in_flight:
+            future.cancel()
+        await asyncio.gather(*in_flight, return_exceptions=True)
+        stop_waiter.cancel()
+        try:
+            loop.remove_signal_handler(signal.SIGINT)
+        except (NotImplementedError, RuntimeError):
+            pass
+
+
+# ============================================
+# Sweep Planner (default threaded engine)
+# ============================================
+#
+# Tests of the pair matrix ask for many of the same quotes: the X->ICP grid is both
+# the X/ICP test and the ICP fallback of every X/Y test that fails, and grid points
+# of one pair coincide across trade sizes (40% of 5 ICP = 20% of 10 ICP). The planner
+# runs every test's decision steps against one shared graph of quote requests, so
+# each distinct request is fetched once per sweep.
+
+class _PlannedTest:
+    __slots__ = ("task", "steps", "batch", "missing", "depth")
+
+    def __init__(self, task: Tuple[str, str, int]):
+        self.task = task
+        self.steps = _test_pair_steps(*task)
+        self.batch: List[QuoteRequest] = []
+        self.missing = 0  # Distinct requests of `batch` not fetched yet
+        self.depth = 0    # Batches yielded so far
+
+
+class QuotePlan:
+    """The pair sweep as one graph of quote requests.
+
+    Every test is started up front, so the first batch of each (its direct quote
+    grid) is known before any call is made; later batches (verify quotes,
+    fallbacks) join the graph as tests reach them. Identical requests become one
+    node, fetched once and handed to every test waiting on it. Nodes wanted by
+    more tests run first, then those of tests furthest along; remote ICPSwap
+    quotes wait for one pool metadata node per pool. A test resumes as soon as
+    its batch is complete, and its TestResult is recorded the moment it returns.
+
+    Quotes are kept for the whole sweep: a request that comes up again later
+    reuses the first answer rather than the (TTL-bound) quote cache.
+    """
+
+    def __init__(self, tasks: List[Tuple[str, str, int]], max_in_flight: int = PLAN_MAX_IN_FLIGHT):
+        self.tasks = tasks
+        self.max_in_flight = max_in_flight
+        self.quotes: Dict[QuoteRequest, Quote] = {}
+        self.waiting: Dict[QuoteRequest, List[_PlannedTest]] = {}
+        self.metadata_ready = set()                            # Pool ids whose metadata node has run
+        self.metadata_waiting: Dict[str, List[QuoteRequest]] = {}
+        self.naive_calls = 0     # Quote requests yielded by all tests (what per-test execution fetches)
+        self.unique_calls = 0    # Distinct quote requests (nodes)
+        self.planned_calls = 0   # ... of which known before the first call
+        self.metadata_calls = 0
+        self._heap = []
+        self._seq = itertools.count()
+        self._started = set()
+
+    @staticmethod
+    def _needs_metadata(req: QuoteRequest) -> bool:
+        return req.exchange == "icpswap" and QUOTE_MODES["icpswap"] == "remote"
+
+    def _push(self, node, tier: int, fanout: int, depth: int) -> None:
+        # Re-pushed whenever its fan-out grows; stale entries are skipped when popped
+        heapq.heappush(self._heap, (tier, -fanout, -depth, next(self._seq), node))
+
+    def _pop(self):
+        while self._heap:
+            node = heapq.heappop(self._heap)[-1]
+            if node in self._started:
+                continue
+            self._started.add(node)
+            return node
+        return None
+
+    def _want(self, req: QuoteRequest, test: _PlannedTest) -> None:
+        waiters = self.waiting.get(req)
+        if waiters is None:
+            waiters = self.waiting[req] = []
+            self.unique_calls += 1
+            if self._needs_metadata(req) and req.pool_id not in self.metadata_ready:
+                self.metadata_waiting.setdefault(req.pool_id, []).append(req)
+        waiters.append(test)
+        if req in self._started:
+            return
+        if self._needs_metadata(req) and req.pool_id not in self.metadata_ready:
+            blocked = self.metadata_waiting[req.pool_id]
+            self._push(("pool_metadata", req.pool_id), 0, sum(len(self.waiting[r]) for r in blocked), test.depth)
+        else:
+            self._push(req, 1, len(waiters), test.depth)
+
+    def _advance(self, test: _PlannedTest, quotes: Optional[List[Quote]] = None) -> None:
+        """Resume a test with its batch's quotes (start it when None) until it waits on an unfetched quote or returns."""
+        while True:
+            try:
+                batch = next(test.steps) if quotes is None else test.steps.send(quotes)
+            except StopIteration as done:
+                record_result(done.value)
+                return
+            except Exception as e:
+                # Counted like any other result, so the sweep's totals (and a --worker's queue) stay whole
+                sell, buy, amount = test.task
+                record_result(TestResult(f"{sell}/{buy}", amount, 'FAILURE',
+                                         details=f"Test raised {type(e).__name__}: {e}"))
+                return
+            test.depth += 1
+            test.batch = batch
+            self.naive_calls += len(batch)
+            missing = {r for r in batch if r not in self.quotes}
+            if missing:
+                test.missing = len(missing)
+                for req in missing:
+                    self._want(req, test)
+                return
+            quotes = [self.quotes[r] for r in batch]
+
+    def _resolve(self, node, quote: Optional[Quote]) -> None:
+        if isinstance(node, QuoteRequest):
+            self.quotes[node] = quote
+            for test in self.waiting.pop(node):
+                test.missing -= 1
+                if test.missing == 0:
+                    self._advance(test, [self.quotes[r] for r in test.batch])
+            return
+        pool_id = node[1]
+        self.metadata_ready.add(pool_id)
+        for req in self.metadata_waiting.pop(pool_id, []):
+            waiters = self.waiting[req]
+            self._push(req, 1, len(waiters), max(t.depth for t in waiters))
+
+    def _execute(self, node) -> Optional[Quote]:
+        if isinstance(node, QuoteRequest):
+            try:
+                return execute_request(node)
+            except Exception as e:
+                return Quote(node.amount, 0, 10000, False, str(e)[:20])
+        try:
+            get_pool_metadata(node[1])  # Lands in the metadata cache that the pool's quotes read
+        except Exception:
+            pass  # The quotes fetch it again themselves
+        return None
+
+    def run(self) -> None:
+        """Run the sweep until every test has returned (or stop_requested is set)."""
+        for task in self.tasks:
+            self._advance(_PlannedTest(task))
+        self.planned_calls = self.unique_calls
+
+        done: "queue.Queue[tuple]" = queue.Queue()
+        in_flight = 0
+        while True:
+            while in_flight < self.max_in_flight and not stop_requested:
+                node = self._pop()
+                if node is None:
+                    break
+                if not isinstance(node, QuoteRequest):
+                    self.metadata_calls += 1
+                quote_executor.submit(lambda n=node: done.put((n, self._execute(n))))
+                in_flight += 1
+            if in_flight == 0:
+                break
+            node, quote = done.get()
+            in_flight -= 1
+            self._resolve(node, quote)
+
+    def merge_counters(self, other: "QuotePlan") -> None:
+        """Add another plan's counters to this one (a --worker runs one plan per claimed batch)."""
+        self.tasks = self.tasks + other.tasks
+        for name in ("naive_calls", "unique_calls", "planned_calls", "metadata_calls"):
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+
+    def summary(self) -> str:
+        merged = self.naive_calls - self.unique_calls
+        rate = merged / self.naive_calls * 100 if self.naive_calls else 0.0
+        line = (f"Quote plan: {len(self.tasks)} tests asked for {self.naive_calls} quotes, {self.unique_calls} unique "
+                f"({merged} merged, {rate:.1f}%; {self.planned_calls} known before the first call)")
+        if self.metadata_calls:
+            line += f", plus {self.metadata_calls} pool metadata calls"
+        return line
+
+
+# Set by main() for the planned sweep; its counters are printed with the call stats
+quote_plan: Optional[QuotePlan] = None
+
+
+# ============================================
+# Sharded Sweep (--shards / --worker)
+# ============================================
+#
+# One process is bound by the GIL (Candid parsing, the algorithm) and by one network
+# egress. --shards N puts the matrix in a sweep_queue file and runs it on N worker
+# processes, each with its own transport stack, quote cache and rate limiters; more
+# workers can join from other hosts with --worker on the same file. The coordinator
+# feeds committed results to record_result(), so status, --results files and the
+# final summary are the same as for a single-process sweep.
+
+def worker_argv(argv: List[str]) -> List[str]:
+    """The coordinator's flags a --worker should run with (quote modes, transport, optimizer, ...)."""
+    own_flags = {"--shards", "--queue", "--results", "--resume"}  # Followed by a value
+    out, skip = [], False
+    for arg in argv:
+        if skip:
+            skip = False
+        elif arg in own_flags:
+            skip = True
+        elif arg not in ("--async", "--per-test"):
+            out.append(arg)
+    return out
+
+
+def run_sweep_worker(queue_path: str) -> None:
+    """--worker QUEUE: claim and run batches of a sharded sweep until its queue is drained."""
+    global quote_plan, total_tests, stop_requested
+
+    work = sweep_queue.SweepQueue(queue_path)
+    name = sweep_queue.worker_name()
+    work.register(name)
+    print(f"Worker {name} on {queue_path}")
+    load_icpswap_pools()
+    total_tests = sum(work.counts().values())
+    quote_plan = QuotePlan([])
+
+    def finished_tasks():
+        return {(*r.pair.split("/", 1), r.amount): asdict(r) for r in all_results}
+
+    batch: List[Tuple[str, str, int]] = []
+    try:
+        while True:
+            batch = work.claim(name, SHARD_BATCH)
+            if not batch:
+                if work.unfinished() == 0:
+                    break
+                time.sleep(SHARD_POLL_INTERVAL)  # Wait for leases held by other workers to finish or expire
+                continue
+            del all_results[:]
+            plan = QuotePlan(batch)
+            plan.run()
+            quote_plan.merge_counters(plan)
+            results = finished_tasks()
+            work.complete(name, [(task, results.get(task)) for task in batch])
+            batch = []
+    except KeyboardInterrupt:
+        stop_requested = True
+        results = finished_tasks()
+        work.complete(name, [(task, results[task]) for task in batch if task in results])
+        work.release(name, [task for task in batch if task not in results])
+        print(f"\nStopped: {len(results)} tests of the current batch kept, the rest returned to the queue")
+
+    stats = io.StringIO()
+    with contextlib.redirect_stdout(stats):
+        print_call_stats()
+    print("\n" + stats.getvalue(), end="")
+    work.finish(name, stats.getvalue())
+    work.close()
+    save_pool_cache()
+
+
+def run_sharded_sweep(tasks: List[Tuple[str, str, int]], shards: int, queue_path: str, argv: List[str]) -> None:
+    """--shards N: queue the sweep in queue_path, run it on N local --worker processes (plus any
+    started elsewhere on the same file) and merge their results as they are committed.
+
+    Rerunning on an existing queue file continues it: its results count towards the
+    summary and only unfinished tests are handed out.
+    """
+    global completed_count, stop_requested
+
+    work = sweep_queue.SweepQueue(queue_path)
+    added = work.enqueue(tasks)
+    last_id = 0
+    for last_id, record in work.results_since(last_id):
+        sweep_stats.add(result_from_record(record))  # Earlier runs on this queue (already streamed by them)
+        completed_count += 1
+    print(f"Queue {queue_path}: {added} tests added, {completed_count} already done, {work.unfinished()} to run")
+
+    procs = []
+    for i in range(shards):
+        with open(f"{queue_path}.worker{i}.log", "w") as log:
+            procs.append(subprocess.Popen([sys.executable, os.path.abspath(__file__), *worker_argv(argv),
+                                           "--worker", queue_path], stdout=log, stderr=subprocess.STDOUT))
+    if procs:
+        print(f"Started {shards} workers (logs: {queue_path}.worker*.log)")
+    else:
+        print(f"Waiting for workers: python {os.path.basename(__file__)} --worker {queue_path}")
+    print()
+
+    try:
+        while True:
+            for last_id, record in work.results_since(last_id):
+                record_result(result_from_record(record))
+            if work.unfinished() == 0:
+                break
+            if procs and all(p.poll() is not None for p in procs):
+                print(f"\n\nAll workers exited with {work.unfinished()} tests left (see their logs); "
+                      f"rerun with --queue {queue_path} to continue")
+                break
+            time.sleep(SHARD_POLL_INTERVAL)
+    except KeyboardInterrupt:
+        print("\n\n*** Ctrl+C pressed - stopping workers and showing results ***")
+        stop_requested = True  # Local workers got the same SIGINT and return their unfinished batches
+
+    for p in procs:
+        try:
+            p.wait(timeout=60)
+        except subprocess.TimeoutExpired:
+            p.terminate()
+    for last_id, record in work.results_since(last_id):
+        record_result(result_from_record(record))
+
+    print_final_summary(call_stats=False)
+    print("\nWorkers:")
+    for w in work.workers():
+        state = "finished" if w["finished"] else f"last seen {time.time() - w['last_seen']:.0f}s ago"
+        print(f"  {w['worker']}: {w['completed']} tests, {state}")
+        for line in (w["call_stats"] or "").splitlines():
+            print(f"    {line}")
+    work.close()
+
+
 # ============================================
 # Main
 # ============================================
 
-def print_final_summary():
-    """Print final summary of results."""
+def print_final_summary(call_stats: bool = True):
+    """Print final summary of results (from sweep_stats, so it needs no per-result history)."""
+    print_status(force=True)
     print("\n\n" + "=" * 80)
     print("RESULTS SUMMARY")
     print("=" * 80)
 
-    singles_kong = [r for r in all_results if r.result_type == 'SINGLE_KONG']
-    singles_icp = [r for r in all_results if r.result_type == 'SINGLE_ICP']
-    splits_fixed = [r for r in all_results if r.result_type == 'SPLIT']
-    splits_interp = [r for r in all_results if r.result_type == 'SPLIT_INTERP']
-    icp_fb_single = [r for r in all_results if r.result_type == 'ICP_FALLBACK']
-    icp_fb_split = [r for r in all_results if r.result_type == 'ICP_FB_SPLIT']
-    icp_fb_exec = [r for r in all_results if r.result_type == 'ICP_FB_EXEC']
-    reduced = [r for r in all_results if r.result_type == 'REDUCED']
-    failures = [r for r in all_results if r.result_type == 'FAILURE']
-    skipped = [r for r in all_results if r.result_type == 'SKIP']
+    n = sweep_stats.by_type
+
+    def error_line(stat: RunningStat) -> str:
+        return f"avg={stat.mean:.3f}% p95={stat.sketch.quantile(0.95):.3f}% max={stat.max:.3f}%"
 
     print(f"\nTotal tests: {completed_count}/{total_tests}")
-    print(f"  SINGLE_KONG: {len(singles_kong)} (100% via KongSwap)")
-    print(f"  SINGLE_ICP:  {len(singles_icp)} (100% via ICPSwap)")
-    print(f"  SPLITS (fixed %): {len(splits_fixed)} (exact 20/40/60/80%)")
-
-    if splits_interp:
-        errors = [r.error_pct for r in splits_interp]
-        print(f"  SPLITS (interpolated): {len(splits_interp)}")
-        print(f"    - Interpolation error: avg={sum(errors)/len(errors):.3f}% max={max(errors):.3f}%")
+    print(f"  SINGLE_KONG: {n['SINGLE_KONG']} (100% via KongSwap)")
+    print(f"  SINGLE_ICP:  {n['SINGLE_ICP']} (100% via ICPSwap)")
+    print(f"  SPLITS (fixed %): {n['SPLIT']} (exact 20/40/60/80%)")
+
+    if n['SPLIT_INTERP']:
+        print(f"  SPLITS (interpolated): {n['SPLIT_INTERP']}")
+        print(f"    - Interpolation error: {error_line(sweep_stats.errors['SPLIT_INTERP'])}")
     else:
         print(f"  SPLITS (interpolated): 0")
 
-    print(f"  ICP_FALLBACK (single): {len(icp_fb_single)} (direct failed, routed via ICP)")
-    print(f"  ICP_FALLBACK (split):  {len(icp_fb_split)} (direct failed, split via ICP route)")
-    print(f"  ICP_FB_EXEC: {len(icp_fb_exec)} (execution failed, ICP fallback succeeded)")
-    print(f"  REDUCED: {len(reduced)} (slippage too high, estimated max tradeable)")
-    print(f"  FAILURES: {len(failures)} (no viable route)")
-    if skipped:
-        print(f"  SKIPPED: {len(skipped)}")
+    if SPLIT_OPTIMIZER_POINTS or n['SPLIT_OPT']:
+        points = f", {SPLIT_OPTIMIZER_POINTS} quote points/exchange" if SPLIT_OPTIMIZER_POINTS else ""
+        print(f"  SPLITS (optimized{points}): {n['SPLIT_OPT']}")
+        if n['SPLIT_OPT']:
+            print(f"    - Error vs verify quote: {error_line(sweep_stats.errors['SPLIT_OPT'])}")
+
+    print(f"  ICP_FALLBACK (single): {n['ICP_FALLBACK']} (direct failed, routed via ICP)")
+    print(f"  ICP_FALLBACK (split):  {n['ICP_FB_SPLIT']} (direct failed, split via ICP route)")
+    print(f"  ICP_FB_EXEC: {n['ICP_FB_EXEC']} (execution failed, ICP fallback succeeded)")
+    print(f"  REDUCED: {n['REDUCED']} (slippage too high, estimated max tradeable)")
+    print(f"  FAILURES: {n['FAILURE']} (no viable route)")
+    if n['SKIP']:
+        print(f"  SKIPPED: {n['SKIP']}")
 
     # Show interpolated splits (the ones we actually care about)
-    if splits_interp:
+    if n['SPLIT_INTERP']:
         print("\n" + "-" * 80)
-        print(f"Interpolated splits ({len(splits_interp)}):")
-        for r in sorted(splits_interp, key=lambda x: x.error_pct, reverse=True)[:15]:
+        print(f"Interpolated splits ({n['SPLIT_INTERP']}):")
+        for r in sweep_stats.top('SPLIT_INTERP'):
+            print(f"  {r.pair:15} @{r.amount:2}ICP: exp={r.algorithm_output:,} act={r.actual_output:,} err={r.error_pct:.3f}% ({r.details})")
+
+    if n['SPLIT_OPT']:
+        print("\n" + "-" * 80)
+        print(f"Optimized splits ({n['SPLIT_OPT']}):")
+        for r in sweep_stats.top('SPLIT_OPT'):
             print(f"  {r.pair:15} @{r.amount:2}ICP: exp={r.algorithm_output:,} act={r.actual_output:,} err={r.error_pct:.3f}% ({r.details})")
 
     # Show ICP fallbacks (single)
-    if icp_fb_single:
+    if n['ICP_FALLBACK']:
         print("\n" + "-" * 80)
-        print(f"ICP Fallbacks - Single ({len(icp_fb_single)}):")
-        for r in icp_fb_single[:10]:
+        print(f"ICP Fallbacks - Single ({n['ICP_FALLBACK']}):")
+        for r in sweep_stats.first('ICP_FALLBACK'):
             print(f"  {r.pair:15} @{r.amount:2}ICP: {r.details}")
 
     # Show ICP fallbacks (split)
-    if icp_fb_split:
+    if n['ICP_FB_SPLIT']:
         print("\n" + "-" * 80)
-        print(f"ICP Fallbacks - Split ({len(icp_fb_split)}):")
-        for r in icp_fb_split[:10]:
+        print(f"ICP Fallbacks - Split ({n['ICP_FB_SPLIT']}):")
+        for r in sweep_stats.first('ICP_FB_SPLIT'):
             print(f"  {r.pair:15} @{r.amount:2}ICP: {r.details}")
 
     # Show ICP fallbacks after execution failure (ICPSwap "slippage over range" etc)
-    if icp_fb_exec:
+    if n['ICP_FB_EXEC']:
         print("\n" + "-" * 80)
-        print(f"ICP Fallbacks - After Execution Failure ({len(icp_fb_exec)}):")
+        print(f"ICP Fallbacks - After Execution Failure ({n['ICP_FB_EXEC']}):")
         print("  (These are trades where findBestExecution succeeded but executeTrade failed)")
         print("  (Only ICPSwap failures trigger this - tokens recovered immediately)")
-        for r in icp_fb_exec[:10]:
+        for r in sweep_stats.first('ICP_FB_EXEC'):
             print(f"  {r.pair:15} @{r.amount:2}ICP: {r.details}")
 
     # Show reduced amount suggestions
-    if reduced:
+    if n['REDUCED']:
         print("\n" + "-" * 80)
-        print(f"Reduced Amount ({len(reduced)}) - trades possible at smaller size:")
-        for r in sorted(reduced, key=lambda x: x.max_tradeable_icp, reverse=True)[:15]:
+        print(f"Reduced Amount ({n['REDUCED']}) - trades possible at smaller size:")
+        for r in sweep_stats.top('REDUCED'):
             print(f"  {r.pair:15} @{r.amount:2}ICP: max ~{r.max_tradeable_icp:.1f} ICP ({r.details})")
 
     # Show some failures
-    if failures:
+    if n['FAILURE']:
         print("\n" + "-" * 80)
-        print(f"Failures ({len(failures)}):")
-        for r in failures[:10]:
+        print(f"Failures ({n['FAILURE']}):")
+        for r in sweep_stats.first('FAILURE'):
             print(f"  {r.pair:15} @{r.amount:2}ICP: {r.details}")
 
+    if results_sink is not None:
+        results_sink.flush()
+        print(f"\nResults streamed to: {', '.join(results_sink.paths)} ({results_sink.written} records)")
+
+    if call_stats:
+        print()
+        print_call_stats()
+
+
+def print_trade_records_summary(records) -> None:
+    """Route, slippage, sizing and convergence summary of --full trade records (streamed)."""
+    routes: Counter = Counter()
+    slippage = RunningStat()
+    buckets = [(0, 25), (25, 50), (50, 100), (100, 200), (200, 500)]
+    histogram: Counter = Counter()
+    exact = 0
+    initial_imbalance = final_imbalance = None
+    for t in records:
+        routes[t['route']] += 1
+        slippage.add(t['slippage_bp'])
+        for low, high in buckets:
+            if low <= t['slippage_bp'] < high:
+                histogram[low] += 1
+        exact += bool(t['is_exact'])
+        if initial_imbalance is None:
+            initial_imbalance = t['imbalance_before']
+        final_imbalance = t['imbalance_after']
+
+    total = slippage.count
+    print(f"\nRoute Distribution ({total} trade attempts):")
+    for route, count in routes.most_common():
+        print(f"  {route:24} {count:4} ({count * 100 // total if total else 0}%)")
+    if total:
+        print("\nSlippage Distribution:")
+        for low, high in buckets:
+            bar = "█" * min(histogram[low] * 2, 40)
+            print(f"  {low:3}-{high:3}bp: {bar} ({histogram[low]})")
+        print("\nSlippage Stats:")
+        print(f"  Min: {slippage.min}bp | Max: {slippage.max}bp | Avg: {slippage.total // total}bp | "
+              f"p95: {slippage.sketch.quantile(0.95):.0f}bp")
+        print("\nTrade Sizing:")
+        print(f"  Exact targeting: {exact}")
+        print(f"  Random sizing: {total - exact}")
+        print("\nPortfolio Convergence:")
+        print(f"  Initial imbalance: {initial_imbalance}bp")
+        print(f"  Final imbalance:   {final_imbalance}bp")
+        if initial_imbalance:
+            print(f"  Improvement:       {(initial_imbalance - final_imbalance) * 100 // initial_imbalance}%")
+
+
+def summarize_results_file(path: str) -> None:
+    """--summary-from: print the summary of a --results file, streaming it in constant memory."""
+    global completed_count, total_tests
+
+    records = result_sink.read_records(path)
+    first = next(records, None)
+    if first is None:
+        print(f"{path}: no records")
+        return
+    records = itertools.chain([first], records)
+    if 'result_type' not in first:
+        print(f"Trade records from {path}")
+        print_trade_records_summary(records)
+        return
+    for record in records:
+        sweep_stats.add(result_from_record(record))
+    completed_count = total_tests = sum(sweep_stats.by_type.values())
+    print(f"Sweep results from {path}", end="")
+    print_final_summary(call_stats=False)
+
+
+def print_call_stats():
+    """Print quote plan, quote cache, request coalescing, latency/hedging and replay counters."""
+    if quote_plan is not None:
+        print(quote_plan.summary())
+    print(quote_cache.summary())
+    print(transport.summary())
+    for layer in (ic_agent.ReplayTransport, ic_agent.TailLatencyTransport, ic_agent.AdaptiveLimitTransport,
+                  ic_agent.FallbackTransport):
+        found = ic_agent.find_layer(transport, layer)
+        if found is not None:
+            print(found.summary())
+    for line in local_validation.summary():
+        print(line)
+    if ADAPTIVE_BUDGET:
+        print(adaptive_stats.summary())
+        for label in adaptive_stats.disagreements:
+            print(f"  differs from full grid: {label}")
+
 
 def main():
-    global total_tests, completed_count, all_results, stop_requested
-
-    import sys
+    global total_tests, completed_count, all_results, stop_requested, transport, POOL_CACHE_MAX_AGE, POOL_CACHE_ENABLED, \
+        SPLIT_OPTIMIZER_POINTS, ADAPTIVE_BUDGET, ADAPTIVE_CHECK, quote_plan, sweep_stats
 
     # Parse command line arguments
     args = sys.argv[1:]
+    argv = list(args)
     use_production = "--prod" in args or "-p" in args
     if use_production:
         args = [a for a in args if a not in ("--prod", "-p")]
 
+    if "--pool-cache-age" in args:
+        i = args.index("--pool-cache-age")
+        POOL_CACHE_MAX_AGE = float(args[i + 1])
+        del args[i:i + 2]
+
+    if "--cache-ttl" in args:
+        i = args.index("--cache-ttl")
+        quote_cache.ttl = float(args[i + 1])
+        del args[i:i + 2]
+
+    for flag, exchanges, mode in (("--local", QUOTE_MODES, "local"),
+                                  ("--local-kong", ["kong"], "local"),
+                                  ("--local-icpswap", ["icpswap"], "local"),
+                                  ("--validate-local", QUOTE_MODES, "validate")):
+        if flag in args:
+            for exchange in list(exchanges):
+                QUOTE_MODES[exchange] = mode
+            args = [a for a in args if a != flag]
+
+    if "--optimizer" in args:
+        i = args.index("--optimizer")
+        if i + 1 < len(args) and args[i + 1].isdigit():
+            SPLIT_OPTIMIZER_POINTS = max(1, int(args[i + 1]))
+            del args[i:i + 2]
+        else:
+            SPLIT_OPTIMIZER_POINTS = 3
+            del args[i]
+
+    if "--adaptive" in args:
+        i = args.index("--adaptive")
+        if i + 1 < len(args) and args[i + 1].isdigit():
+            ADAPTIVE_BUDGET = max(1, int(args[i + 1]))
+            del args[i:i + 2]
+        else:
+            ADAPTIVE_BUDGET = 10
+            del args[i]
+    if "--adaptive-check" in args:
+        ADAPTIVE_CHECK = True
+        ADAPTIVE_BUDGET = ADAPTIVE_BUDGET or 10
+        args = [a for a in args if a != "--adaptive-check"]
+
+    use_async = "--async" in args
+    if use_async:
+        args = [a for a in args if a != "--async"]
+    per_test = "--per-test" in args
+    if per_test:
+        args = [a for a in args if a != "--per-test"]
+
+    resume_path = None
+    if "--resume" in args:
+        i = args.index("--resume")
+        if i + 1 < len(args) and not args[i + 1].startswith("-"):
+            resume_path = args[i + 1]
+            del args[i:i + 2]
+        else:
+            resume_path = latest_checkpoint()
+            if resume_path is None:
+                raise SystemExit("--resume: no sweep_*.jsonl checkpoint here; pass the sweep's results file")
+            del args[i]
+        if resume_path.endswith(".parquet"):
+            raise SystemExit("--resume needs the sweep's .jsonl / .jsonl.gz results file")
+
+    seed_arg = None
+    if "--seed" in args:
+        i = args.index("--seed")
+        seed_arg = int(args[i + 1])
+        del args[i:i + 2]
+
+    config_overrides: Dict[str, int] = {}
+    sim_overrides: Dict[str, float] = {}
+    while "--config" in args:
+        i = args.index("--config")
+        key, _, value = args[i + 1].partition("=")
+        if key in SIMULATION_CONFIG:
+            try:
+                sim_overrides[key] = type(SIMULATION_CONFIG[key])(value)
+            except ValueError:
+                raise SystemExit(f"--config {key} needs a number")
+        elif key not in TREASURY_CONFIG or not value.lstrip("-").isdigit():
+            raise SystemExit(f"--config needs KEY=INTEGER with KEY one of: {', '.join(TREASURY_CONFIG)} "
+                             f"(or, for --simulate, {', '.join(SIMULATION_CONFIG)})")
+        else:
+            config_overrides[key] = int(value)
+        del args[i:i + 2]
+
+    prices_file = None
+    if "--prices" in args:
+        i = args.index("--prices")
+        prices_file = args[i + 1]
+        del args[i:i + 2]
+
+    history_store = price_history.DEFAULT_STORE
+    if "--history" in args:
+        i = args.index("--history")
+        history_store = args[i + 1]
+        del args[i:i + 2]
+    sync_history = "--no-sync" not in args
+    if not sync_history:
+        args.remove("--no-sync")
+
+    trades_db = archive_id = standin_trades = None
+    if "--trades-db" in args:
+        i = args.index("--trades-db")
+        trades_db = args[i + 1]
+        del args[i:i + 2]
+    if "--archive" in args:
+        i = args.index("--archive")
+        archive_id = args[i + 1]
+        del args[i:i + 2]
+    if "--standin" in args:
+        i = args.index("--standin")
+        standin_trades = int(args[i + 1])
+        del args[i:i + 2]
+
+    shards = queue_path = None
+    if "--shards" in args:
+        i = args.index("--shards")
+        shards = int(args[i + 1])
+        del args[i:i + 2]
+    if "--queue" in args:
+        i = args.index("--queue")
+        queue_path = args[i + 1]
+        shards = shards or 0
+        del args[i:i + 2]
+    if shards is not None and resume_path:
+        raise SystemExit("--resume does not apply to --shards: rerun with the same --queue file to continue")
+
+    results_paths = [resume_path] if resume_path else []
+    while "--results" in args:
+        i = args.index("--results")
+        if i + 1 >= len(args):
+            raise SystemExit("--results needs a path (.jsonl, .jsonl.gz or .parquet)")
+        if args[i + 1] not in results_paths:
+            results_paths.append(args[i + 1])
+        del args[i:i + 2]
+
+    transport_opts = ic_agent.pop_transport_flags(args)
+    if transport_opts["record"] and "--worker" in args:
+        # Workers record next to the coordinator, each into its own file
+        transport_opts["record_part"] = sweep_queue.worker_name().replace(":", "_")
+    transport = ic_agent.SingleFlightTransport(ic_agent.make_transport(network=NETWORK, **transport_opts))
+
+    # A recording pins the market snapshot: replay must see the same pools and
+    # the same random portfolios, so the seed travels with the recording.
+    snapshot_dir = transport_opts["record"] or transport_opts["replay"]
+    if snapshot_dir:
+        POOL_CACHE_ENABLED = False
+        seed = ic_agent.read_recording_meta(snapshot_dir).get("seed")
+        if seed is None:
+            seed = random.randrange(2 ** 32)
+            if transport_opts["record"]:
+                ic_agent.update_recording_meta(snapshot_dir, seed=seed)
+        random.seed(seed)
+    if seed_arg is not None:
+        random.seed(seed_arg)
+
+    # A pair sweep always checkpoints to a .jsonl file (--resume continues it after Ctrl+C or a crash);
+    # a --shards sweep checkpoints in its queue file instead
+    if (use_async or per_test) and args:
+        raise SystemExit("--async and --per-test choose the pair sweep's engine; they don't apply to " + args[0])
+
+    checkpoint_path = None
+    if not args and shards is None:
+        checkpoint_path = next((p for p in results_paths if p.endswith((".jsonl", ".jsonl.gz"))), None)
+        if checkpoint_path is None:
+            checkpoint_path = default_checkpoint_path()
+            results_paths.append(checkpoint_path)
+
+    # Only the pair sweep (no subcommand) and --full produce records
+    if results_paths and (not args or args[0] in ("--full", "-f")):
+        open_results_sink(results_paths, TRADE_COLUMNS if args else RESULT_COLUMNS)
+
     # Check for command line arguments
     if args:
-        if args[0] == "--cycle" or args[0] == "-c":
+        if args[0] == "--summary-from":
+            if len(args) < 2:
+                raise SystemExit("--summary-from needs a --results file")
+            summarize_results_file(args[1])
+            return
+        elif args[0] == "--worker":
+            # Run batches of a sharded sweep (started by --shards, or by hand on another host)
+            if len(args) < 2:
+                raise SystemExit("--worker needs the coordinator's --queue file")
+            run_sweep_worker(args[1])
+            return
+        elif args[0] == "--cycle" or args[0] == "-c":
             # Run full trading cycle simulation (no real quotes)
             num_cycles = int(args[1]) if len(args) > 1 else 5
-            run_full_trading_cycle_test(num_cycles)
+            run_full_trading_cycle_test(num_cycles, config={**TREASURY_CONFIG, **config_overrides})
+            return
+        elif args[0] == "--monte-carlo":
+            # Simulated cycles over many seeded portfolios, on a process pool
+            num_portfolios = int(args[1]) if len(args) > 1 else 1000
+            num_cycles = int(args[2]) if len(args) > 2 else 1000
+            run_monte_carlo(num_portfolios, num_cycles, seed=seed_arg or 0, config_overrides=config_overrides)
+            return
+        elif args[0] == "--simulate":
+            # Weeks of trading cycles on a virtual clock against simulated pools
+            days = float(args[1]) if len(args) > 1 else 30
+            run_simulation(days, seed=seed_arg or 0, config_overrides=config_overrides,
+                           sim_overrides=sim_overrides, prices_file=prices_file)
+            return
+        elif args[0] == "--backtest":
+            # The simulator driven by the price_archive canister's history
+            days = float(args[1]) if len(args) > 1 else None
+            run_backtest(days, transport, history_store, sync=sync_history, seed=seed_arg or 0,
+                         config_overrides=config_overrides, sim_overrides=sim_overrides)
+            return
+        elif args[0] == "--slippage-report":
+            # Executed trades from the trading_archive canister against rebuilt predictions
+            limit = int(args[1]) if len(args) > 1 else SLIPPAGE_REPORT_TRADES
+            sync_transport = transport if sync_history else None
+            standin = standin_store = None
+            if standin_trades:
+                # Stub replica serving synthetic trades; keep them out of the real store
+                standin = trade_history.ArchiveStandin(
+                    [trade_history.trade_block(t) for t in synthetic_trades(standin_trades, seed_arg or 0)])
+                sync_transport = ic_agent.make_transport("http", url=standin.start())
+                if not trades_db:
+                    trades_db = standin_store = os.path.join(tempfile.gettempdir(),
+                                                             f"trade_history_standin_{os.getpid()}.sqlite")
+                print(f"Archive stand-in serving {standin_trades:,} synthetic trades (store: {trades_db})")
+            try:
+                run_slippage_report(limit, trades_db or trade_history.DEFAULT_STORE, sync_transport,
+                                    archive_id or trade_history.TRADING_ARCHIVE_CANISTER_ID, history_store,
+                                    quote_source_label(transport_opts["replay"]))
+            finally:
+                if standin is not None:
+                    standin.stop()
+                if standin_store and os.path.exists(standin_store):
+                    os.remove(standin_store)
             return
         elif args[0] == "--full" or args[0] == "-f":
             # Run full trading cycle with REAL DEX quotes
@@ -2817,9 +5570,8 @@ def main():
             print("Treasury.mo line 4110-4276 handles this by attempting ICP fallback")
             print()
 
-            # Discover ICPSwap pools first
-            print("Discovering ICPSwap pools...")
-            discover_icpswap_pools()
+            # Load ICPSwap pools first
+            load_icpswap_pools()
             print(f"Found {len(ICPSWAP_POOLS)} ICPSwap pools")
             print()
 
@@ -2853,19 +5605,78 @@ def main():
             print()
             print(f"Total pairs with ICP execution fallback: {len(exec_fallback_results)}")
             return
+        elif args[0] == "--check-portfolio":
+            # Check the incremental PortfolioState against the treasury.mo formulas
+            if check_portfolio_state(int(args[1]) if len(args) > 1 else 200):
+                sys.exit(1)
+            return
+        elif args[0] == "--bench-algorithm":
+            # Verify and time the NumPy batched algorithm against the scalar reference
+            bench_algorithm(int(args[1]) if len(args) > 1 else 20000)
+            return
         elif args[0] == "--help" or args[0] == "-h":
             print("Usage:")
             print("  python test_exchange_selection.py              # Run exchange selection tests with real quotes")
             print("  python test_exchange_selection.py --cycle 5    # Run 5 trading cycle simulations (no real quotes)")
             print("  python test_exchange_selection.py -c 10        # Run 10 trading cycle simulations")
+            print("  python test_exchange_selection.py --monte-carlo 5000 1000  # 5000 seeded portfolios x 1000 simulated cycles")
+            print("  python test_exchange_selection.py --simulate 30  # 30 days of 60s cycles on a virtual clock")
+            print("  python test_exchange_selection.py --backtest 30  # Simulate the last 30 days of price_archive prices")
+            print("  python test_exchange_selection.py --slippage-report 500  # Latest 500 archived trades vs predictions")
             print("  python test_exchange_selection.py --full 5     # Run 5 trading cycles with REAL DEX quotes")
             print("  python test_exchange_selection.py -f 10        # Run 10 trading cycles with REAL DEX quotes")
             print("  python test_exchange_selection.py --full --prod # Use REAL prices/config from production canisters")
             print("  python test_exchange_selection.py -f -p 10      # Production data with 10 cycles")
             print("  python test_exchange_selection.py --exec-fallback  # Test execution failure ICP fallback")
+            print("  python test_exchange_selection.py --bench-algorithm 20000  # Check/time batched run_algorithm (numpy)")
+            print("  python test_exchange_selection.py --check-portfolio 200   # Check/time incremental PortfolioState")
+            print("  python test_exchange_selection.py --summary-from results.jsonl  # Summarize a --results file")
+            print("  python test_exchange_selection.py --worker sweep.sqlite  # Join a sharded sweep (see --shards)")
             print("\nFlags:")
             print("  --prod, -p   Use REAL prices/decimals/config from production DAO/Treasury canisters")
             print("               (Target allocations remain random for test diversity)")
+            print("  --seed N     Random seed (--cycle / --simulate portfolio; first --monte-carlo portfolio, default 0)")
+            print("  --config KEY=VALUE  Override a treasury setting for --cycle / --monte-carlo / --simulate (repeatable;")
+            print("               --simulate also takes SIMULATION_CONFIG keys, e.g. daily_volatility_pct=8)")
+            print("  --prices FILE.csv  --simulate: replay token prices (rows of seconds,symbol,price_e8s)")
+            print("  --history DIR  --backtest / --slippage-report: local price_archive store (default {})".format(
+                os.path.basename(price_history.DEFAULT_STORE)))
+            print("  --no-sync    --backtest / --slippage-report: use the stored history without fetching new blocks")
+            print("  --trades-db PATH  --slippage-report: local trading_archive store (default {})".format(
+                os.path.basename(trade_history.DEFAULT_STORE)))
+            print("  --archive CANISTER_ID  --slippage-report: trade archive to sync from (default trading_archive)")
+            print("  --standin TRADES  --slippage-report: sync from an in-process stand-in serving TRADES synthetic")
+            print("               trades (into a temporary store unless --trades-db is given)")
+            print("  --transport auto|http|dfx  Canister call backend (default auto: native HTTP, dfx fallback)")
+            print("  --cache-ttl SECONDS  Reuse quotes for this long (default {:g}s, 0 disables)".format(QUOTE_CACHE_TTL))
+            print("  --pool-cache-age SECONDS  Refresh the on-disk ICPSwap pool registry in the background when older")
+            print("               (default {:g}s; registry: {})".format(POOL_CACHE_MAX_AGE, os.path.basename(POOL_CACHE_FILE)))
+            print("  --local      Compute all quotes in-process from pool snapshots (--local-kong / --local-icpswap for one)")
+            print("  --local-kong Compute KongSwap quotes from one bulk `pools` snapshot")
+            print("  --local-icpswap  Compute ICPSwap quotes by simulating each pool's v3 ticks")
+            print("  --validate-local  Use live quotes but report the local engines' deviation (bp)")
+            print("  --optimizer [N]  Pair sweep: fit price-impact curves to N quote points per exchange (default 3)")
+            print("               and solve for the best split directly instead of the 20% grid")
+            print("  --adaptive [BUDGET]  Fetch quote-grid points only where the split decision is still open")
+            print("               (max BUDGET calls per decision, default 10)")
+            print("  --adaptive-check  With --adaptive: also fetch the full grid and report decision agreement")
+            print("  --async      Run the pair sweep on one asyncio event loop (bounded per-exchange concurrency)")
+            print("  --per-test   Run each test on its own worker thread instead of the shared quote plan")
+            print("  --shards N   Run the pair sweep on N worker processes sharing a SQLite work queue")
+            print("               (each with its own quote cache and rate limits; --shards 0 waits for --worker hosts)")
+            print("  --queue PATH Work queue file for --shards (default sweep_<time>.sqlite); rerun on it to continue")
+            print("  --record DIR Save every canister reply (and the random seed) to DIR")
+            print("  --replay DIR Re-run against replies saved with --record (no network I/O)")
+            print("  --results PATH  Stream each sweep result / --full trade to PATH as it completes")
+            print("               (.jsonl, .jsonl.gz or .parquet with pyarrow; repeatable)")
+            print("  --resume [PATH] Skip the tests already in sweep results file PATH (.jsonl) and append the rest")
+            print("               (a pair sweep always checkpoints to sweep_<time>.jsonl, or to its .jsonl --results;")
+            print("               without PATH, the newest sweep_*.jsonl here)")
+            print("               (Parquet --results files are rewritten per run; the .jsonl holds the whole sweep)")
+            print("  --fixed-concurrency  Turn off per-canister adaptive concurrency/rate limits")
+            print("  --fixed-timeouts     Always wait the full CALL_TIMEOUT instead of a p99-based timeout")
+            print("  --hedge              Duplicate quotes still pending at their p95 latency; first answer wins")
+            print("  --ic-url URL Replica URL for the HTTP transport (e.g. http://127.0.0.1:4943 or a stub)")
             print("\nTreasury Configuration (matches treasury.mo):")
             for key, value in TREASURY_CONFIG.items():
                 print(f"  {key}: {value}")
@@ -2874,7 +5685,9 @@ def main():
     print("=" * 80)
     print("Exchange Selection Algorithm Test")
     print("=" * 80)
-    print(f"Max slippage: {MAX_SLIPPAGE_BP}bp | Parallel: {MAX_PARALLEL} | Timeout: {CALL_TIMEOUT}s")
+    print(f"Max slippage: {MAX_SLIPPAGE_BP}bp | Parallel: {MAX_PARALLEL} | Timeout: {CALL_TIMEOUT}s | Transport: {transport.name}"
+          f"{' | Engine: asyncio' if use_async else ''}{f' | Shards: {shards}' if shards is not None else ''}{' | Hedged' if transport_opts['hedge'] else ''}"
+          f"{''.join(f' | {ex} quotes: {mode}' for ex, mode in QUOTE_MODES.items() if mode != 'remote')}")
     print()
     print("Modes:")
     print("  - Run with no args: Test all pairs with real DEX quotes")
@@ -2884,8 +5697,8 @@ def main():
     print("Press Ctrl+C at any time to stop and show results")
     print()
 
-    # Fetch ICPSwap pools
-    fetch_icpswap_pools()
+    # Load ICPSwap pools (on-disk registry, refreshed in the background when stale)
+    load_icpswap_pools()
     print()
 
     # Build ALL token pair combinations
@@ -2900,28 +5713,56 @@ def main():
     total_tests = len(tasks)
     completed_count = 0
     all_results = []
+    sweep_stats = SweepStats()
     stop_requested = False
 
     print(f"Testing {len(symbols)} tokens × {len(symbols)-1} pairs × {len(TRADE_SIZES)} amounts = {total_tests} tests")
+    if resume_path:
+        done = load_checkpoint(resume_path, set(tasks))
+        tasks = [task for task in tasks if task not in done]
+        completed_count = len(done)
+        print(f"Resuming from {resume_path}: {len(done)} tests already done, {len(tasks)} to go")
+    if checkpoint_path:
+        print(f"Checkpoint: {checkpoint_path} (continue an interrupted sweep with --resume {checkpoint_path})")
     print()
 
+    if shards is not None:
+        run_sharded_sweep(tasks, shards, queue_path or f"sweep_{time.strftime('%Y%m%d_%H%M%S')}.sqlite", argv)
+        save_pool_cache()
+        return
+
     # Run tests with keyboard interrupt handling
+    if use_async:
+        try:
+            asyncio.run(run_tests_async(tasks))
+        except KeyboardInterrupt:
+            print("\n\n*** Ctrl+C pressed - stopping tests and showing results ***")
+            stop_requested = True
+        print_final_summary()
+        save_pool_cache()
+        return
+
     try:
-        with ThreadPoolExecutor(max_workers=MAX_PARALLEL) as executor:
-            futures = {executor.submit(worker, s, b, a): (s, b, a) for s, b, a in tasks}
-            for future in as_completed(futures):
-                if stop_requested:
-                    break
-                try:
-                    future.result()
-                except Exception as e:
-                    print(f"\nError: {e}")
+        if per_test:
+            with ThreadPoolExecutor(max_workers=MAX_PARALLEL) as executor:
+                futures = {executor.submit(worker, s, b, a): (s, b, a) for s, b, a in tasks}
+                for future in as_completed(futures):
+                    if stop_requested:
+                        break
+                    try:
+                        future.result()
+                    except Exception as e:
+                        print(f"\nError: {e}")
+        else:
+            quote_plan = QuotePlan(tasks)
+            quote_plan.run()
     except KeyboardInterrupt:
         print("\n\n*** Ctrl+C pressed - stopping tests and showing results ***")
         stop_requested = True
 
     # Final summary
     print_final_summary()
+    save_pool_cache()
 
 
 if __name__ == "__main__":
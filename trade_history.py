@@ -0,0 +1,380 @@
+#!/usr/bin/env python3
+"""
+Local, indexed copy of the trading_archive canister's ICRC-3 trade blocks.
+
+The archive (src/archives/trading_archive) stores one block per trade leg the
+treasury executed or attempted: tx = { operation = "3trade"; timestamp;
+data = { token_sold; token_bought; amount_sold; amount_bought; exchange;
+success; slippage; fee; error?; ... } }. A split execution is two blocks
+(one per exchange) with the same timestamp and pair. sync() pages through
+icrc3_get_blocks with price_history's parallel reader and inserts each page
+into a SQLite file in one transaction, together with the block it reached, so
+a rerun fetches only new blocks and an interrupted sync resumes cleanly.
+
+Trades are indexed by pair and by exchange (the keys the slippage report in
+test_exchange_selection.py --slippage-report groups by), and the report's
+rebuilt run_algorithm predictions are cached next to them.
+
+ArchiveStandin is a stub replica that serves synthetic trade blocks over the
+same HTTP query interface, binary-encoded as a real archive would, so the
+whole ingest path can be exercised offline.
+
+Run standalone to sync and summarize the store:
+    python trade_history.py [STORE.sqlite] [--transport ...] [--ic-url URL] [--archive CANISTER_ID]
+"""
+
+import functools
+import os
+import sqlite3
+import sys
+import threading
+from itertools import groupby
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import candid_codec
+import ic_agent
+import price_history
+from price_history import map_entries, variant_value
+
+TRADING_ARCHIVE_CANISTER_ID = "jmze3-hiaaa-aaaan-qz4xq-cai"
+NETWORK = "ic"
+DEFAULT_STORE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "trade_history.sqlite")
+
+# Token amounts are Nat and can exceed SQLite's int64 (ckETH has 18 decimals),
+# so they are stored as decimal text.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS trades (
+    block INTEGER PRIMARY KEY,
+    ts INTEGER NOT NULL,                 -- Trade time, ns since epoch
+    token_sold TEXT NOT NULL,
+    token_bought TEXT NOT NULL,
+    amount_sold TEXT NOT NULL,
+    amount_bought TEXT NOT NULL,
+    exchange TEXT,                       -- KongSwap | ICPSwap | TACO
+    success INTEGER NOT NULL,
+    slippage_pct REAL,                   -- As recorded by the treasury (ICPSwap legs record 0)
+    fee TEXT,
+    error TEXT,
+    trader TEXT
+);
+CREATE INDEX IF NOT EXISTS trades_by_pair ON trades (token_sold, token_bought, ts);
+CREATE INDEX IF NOT EXISTS trades_by_exchange ON trades (exchange, ts);
+CREATE INDEX IF NOT EXISTS trades_by_time ON trades (ts);
+CREATE TABLE IF NOT EXISTS sync (
+    canister TEXT PRIMARY KEY,
+    synced_until INTEGER NOT NULL        -- First block not ingested yet
+);
+CREATE TABLE IF NOT EXISTS predictions (
+    ts INTEGER NOT NULL,                 -- Execution key: (ts, token_sold, token_bought)
+    token_sold TEXT NOT NULL,
+    token_bought TEXT NOT NULL,
+    quotes TEXT NOT NULL,                -- Where the quotes came from (live / local / replay:DIR)
+    route TEXT NOT NULL,
+    kong_pct INTEGER NOT NULL,
+    icp_pct INTEGER NOT NULL,
+    amount_out TEXT NOT NULL,
+    slippage_bp INTEGER NOT NULL,
+    actual_buy TEXT NOT NULL,
+    PRIMARY KEY (ts, token_sold, token_bought, quotes)
+);
+"""
+
+_COLUMNS = ("block", "ts", "token_sold", "token_bought", "amount_sold", "amount_bought",
+            "exchange", "success", "slippage_pct", "fee", "error", "trader")
+
+
+@functools.lru_cache(maxsize=4096)
+def _principal_text(raw: bytes) -> str:
+    return str(candid_codec.Principal.from_bytes(raw))  # A store holds few distinct tokens; skip the base32 work
+
+
+def trade_row(block_id: int, block) -> Optional[Dict[str, Any]]:
+    """Decode a 3trade block into a row, or None for any other block."""
+    fields = dict(map_entries(dict(map_entries(block)).get("tx")))
+    if variant_value(fields.get("operation", {})) != "3trade":
+        return None
+    data = {k: variant_value(v) for k, v in map_entries(fields.get("data"))}
+    sold, bought = data.get("token_sold"), data.get("token_bought")
+    if not isinstance(sold, bytes) or not isinstance(bought, bytes):
+        return None
+    try:
+        slippage = float(data.get("slippage") or 0)
+    except ValueError:
+        slippage = None
+    trader = data.get("trader")
+    return {
+        "block": block_id,
+        "ts": data.get("ts", variant_value(fields.get("timestamp", {}))) or 0,
+        "token_sold": _principal_text(sold),
+        "token_bought": _principal_text(bought),
+        "amount_sold": str(data.get("amount_sold") or 0),
+        "amount_bought": str(data.get("amount_bought") or 0),
+        "exchange": data.get("exchange"),
+        "success": int(bool(data.get("success"))),
+        "slippage_pct": slippage,
+        "fee": str(data.get("fee") or 0),
+        "error": data.get("error"),
+        "trader": _principal_text(trader) if isinstance(trader, bytes) else None,
+    }
+
+
+class TradeStore:
+    """One connection to a trade store file."""
+
+    def __init__(self, path: str = DEFAULT_STORE):
+        self.path = path
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript(SCHEMA)
+
+    def close(self) -> None:
+        self._db.close()
+
+    def synced_until(self, canister_id: str) -> int:
+        row = self._db.execute("SELECT synced_until FROM sync WHERE canister = ?", (canister_id,)).fetchone()
+        return row[0] if row else 0
+
+    def add_page(self, canister_id: str, page_end: int, rows: Sequence[Dict[str, Any]]) -> None:
+        """Store a fetched page and the block it reached, in one transaction."""
+        with self._db:
+            self._db.executemany(f"INSERT OR REPLACE INTO trades VALUES ({', '.join('?' * len(_COLUMNS))})",
+                                 [tuple(row[c] for c in _COLUMNS) for row in rows])
+            self._db.execute("INSERT OR REPLACE INTO sync VALUES (?, ?)", (canister_id, page_end))
+
+    def counts(self) -> Dict[str, int]:
+        total, ok = self._db.execute("SELECT COUNT(*), COALESCE(SUM(success), 0) FROM trades").fetchone()
+        return {"trades": total, "successful": ok, "failed": total - ok}
+
+    def by_exchange(self) -> List[Tuple[Optional[str], int]]:
+        return self._db.execute("SELECT exchange, COUNT(*) FROM trades GROUP BY exchange ORDER BY 2 DESC").fetchall()
+
+    def executions(self, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Successful executions, newest last: legs with the same (ts, token_sold, token_bought) merged.
+
+        Each has ts, token_sold, token_bought, amount_sold, amount_bought (ints, summed over
+        legs) and legs: [(exchange, amount_sold, amount_bought, slippage_pct)]. With limit,
+        only the latest `limit` executions.
+        """
+        where = "success = 1"
+        args: Tuple = ()
+        if limit:
+            # Cut at the limit-th newest execution key
+            cut = self._db.execute(
+                "SELECT ts FROM (SELECT DISTINCT ts, token_sold, token_bought FROM trades WHERE success = 1 "
+                "ORDER BY ts DESC LIMIT ?) ORDER BY ts LIMIT 1", (limit,)).fetchone()
+            if cut:
+                where += " AND ts >= ?"
+                args = (cut[0],)
+        rows = self._db.execute(
+            f"SELECT ts, token_sold, token_bought, exchange, amount_sold, amount_bought, slippage_pct "
+            f"FROM trades WHERE {where} ORDER BY ts, token_sold, token_bought, block", args)
+        executions = []
+        for (ts, sold, bought), legs in groupby(rows, key=lambda r: r[:3]):
+            legs = [(exchange, int(a_sold), int(a_bought), slip) for _, _, _, exchange, a_sold, a_bought, slip in legs]
+            executions.append({"ts": ts, "token_sold": sold, "token_bought": bought, "legs": legs,
+                               "amount_sold": sum(leg[1] for leg in legs),
+                               "amount_bought": sum(leg[2] for leg in legs)})
+        return executions[-limit:] if limit else executions
+
+    def predictions(self, quotes: str) -> Dict[Tuple[int, str, str], Dict[str, Any]]:
+        """Cached predictions for one quote source, by execution key."""
+        cur = self._db.execute("SELECT ts, token_sold, token_bought, route, kong_pct, icp_pct, amount_out, "
+                               "slippage_bp, actual_buy FROM predictions WHERE quotes = ?", (quotes,))
+        return {row[:3]: {"route": row[3], "kong_pct": row[4], "icp_pct": row[5], "amount_out": int(row[6]),
+                          "slippage_bp": row[7], "actual_buy": row[8]} for row in cur.fetchall()}
+
+    def add_predictions(self, quotes: str, predictions: Sequence[Tuple[Tuple[int, str, str], Dict[str, Any]]]) -> None:
+        with self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [(*key, quotes, p["route"], p["kong_pct"], p["icp_pct"], str(p["amount_out"]),
+                  p["slippage_bp"], p["actual_buy"]) for key, p in predictions])
+
+
+def sync(transport, store: TradeStore, canister_id: str = TRADING_ARCHIVE_CANISTER_ID, log=print) -> Tuple[int, int]:
+    """Fetch the blocks the store doesn't have yet. Returns (new blocks, new trade rows)."""
+    reader = price_history.ArchiveReader(transport, canister_id, trade_row)
+    start = store.synced_until(canister_id)
+    end = reader.log_length()
+    if end <= start:
+        log(f"Trade history: {start:,} blocks, up to date")
+        return 0, 0
+    added = 0
+    fetched_until = start
+    for fetched_until, rows in price_history.fetch_pages(reader, start, end, log):
+        store.add_page(canister_id, fetched_until, rows)
+        added += len(rows)
+    log(f"Trade history: +{fetched_until - start:,} blocks, +{added:,} trades (store: {store.path})")
+    return fetched_until - start, added
+
+
+# ============================================
+# Archive stand-in (stub replica)
+# ============================================
+#
+# candid_codec.encode_args can't express the recursive ICRC-3 Value type, so the stand-in
+# encodes GetBlocksResult itself. Blocks are encoded once; a page is a concatenation.
+
+def _idl_fields(names: Sequence[str]) -> List[str]:
+    return sorted(names, key=candid_codec.idl_hash)
+
+
+_VALUE_TAGS = _idl_fields(["Nat", "Int", "Text", "Blob", "Map", "Array"])
+_BLOCK_FIELDS = _idl_fields(["id", "block"])
+_RESULT_FIELDS = _idl_fields(["log_length", "blocks", "archived_blocks"])
+
+
+def _get_blocks_types() -> bytes:
+    """DIDL type table and argument list of a GetBlocksResult."""
+    uleb, sleb = candid_codec.encode_nat, candid_codec.encode_int
+    value_types = {"Nat": candid_codec.T_NAT, "Int": candid_codec.T_INT, "Text": candid_codec.T_TEXT,
+                   "Blob": 1, "Map": 2, "Array": 4}
+    field_types = {"id": candid_codec.T_NAT, "block": 0,
+                   "log_length": candid_codec.T_NAT, "blocks": 6, "archived_blocks": 7}
+
+    def record(op, names, types):
+        return sleb(op) + uleb(len(names)) + b"".join(uleb(candid_codec.idl_hash(n)) + sleb(types[n]) for n in names)
+
+    table = [
+        record(candid_codec.T_VARIANT, _VALUE_TAGS, value_types),             # 0: Value
+        sleb(candid_codec.T_VEC) + sleb(candid_codec.T_NAT8),                 # 1: blob
+        sleb(candid_codec.T_VEC) + sleb(3),                                   # 2: vec (text, Value)
+        sleb(candid_codec.T_RECORD) + uleb(2) + uleb(0) + sleb(candid_codec.T_TEXT) + uleb(1) + sleb(0),  # 3
+        sleb(candid_codec.T_VEC) + sleb(0),                                   # 4: vec Value
+        record(candid_codec.T_RECORD, _BLOCK_FIELDS, field_types),            # 5: { id; block }
+        sleb(candid_codec.T_VEC) + sleb(5),                                   # 6
+        sleb(candid_codec.T_VEC) + sleb(candid_codec.T_NAT),                  # 7: archived_blocks (always empty)
+        record(candid_codec.T_RECORD, _RESULT_FIELDS, field_types),           # 8: GetBlocksResult
+    ]
+    return b"DIDL" + uleb(len(table)) + b"".join(table) + uleb(1) + sleb(8)
+
+
+def encode_value(value) -> bytes:
+    """Binary Candid of an ICRC-3 Value given as {tag: payload} (Map: [(key, value)], Array: [value])."""
+    uleb = candid_codec.encode_nat
+    (tag, payload), = value.items()
+    out = uleb(_VALUE_TAGS.index(tag))
+    if tag == "Nat":
+        return out + uleb(payload)
+    if tag == "Int":
+        return out + candid_codec.encode_int(payload)
+    if tag in ("Text", "Blob"):
+        raw = payload.encode() if tag == "Text" else payload
+        return out + uleb(len(raw)) + raw
+    if tag == "Map":
+        return out + uleb(len(payload)) + b"".join(
+            uleb(len(k.encode())) + k.encode() + encode_value(v) for k, v in payload)
+    return out + uleb(len(payload)) + b"".join(encode_value(v) for v in payload)
+
+
+def trade_block(trade: Dict[str, Any]) -> Dict[str, Any]:
+    """ICRC-3 Value of a trade as trading_archive stores it (tradeToValue inside ArchiveBase.storeBlock)."""
+    def blob(principal):
+        return {"Blob": candid_codec.Principal(principal).to_bytes()}
+
+    data = [
+        ("btype", {"Text": "3trade"}),
+        ("ts", {"Int": trade["ts"]}),
+        ("trader", blob(trade.get("trader", TRADING_ARCHIVE_CANISTER_ID))),
+        ("token_sold", blob(trade["token_sold"])),
+        ("token_bought", blob(trade["token_bought"])),
+        ("amount_sold", {"Nat": trade["amount_sold"]}),
+        ("amount_bought", {"Nat": trade["amount_bought"]}),
+        ("exchange", {"Text": trade["exchange"]}),
+        ("success", {"Nat": int(trade["success"])}),
+        ("slippage", {"Text": repr(float(trade.get("slippage_pct") or 0))}),
+        ("fee", {"Nat": trade.get("fee", 0)}),
+    ]
+    if trade.get("error"):
+        data.append(("error", {"Text": trade["error"]}))
+    tx = [("operation", {"Text": "3trade"}), ("timestamp", {"Int": trade["ts"]}), ("data", {"Map": data})]
+    return {"Map": [("tx", {"Map": tx})]}
+
+
+class ArchiveStandin:
+    """Stub replica answering icrc3_get_blocks from a list of ICRC-3 block Values.
+
+    Replies are capped at max_reply blocks, like a canister's per-call limit.
+    """
+
+    def __init__(self, blocks: Sequence[Dict[str, Any]], max_reply: int = 2000):
+        uleb = candid_codec.encode_nat
+        self.max_reply = max_reply
+        self._types = _get_blocks_types()
+        # Encoded {id; block} records in field order
+        parts = {"id": None, "block": None}
+        self._records = []
+        for i, block in enumerate(blocks):
+            parts["id"], parts["block"] = uleb(i), encode_value(block)
+            self._records.append(b"".join(parts[f] for f in _BLOCK_FIELDS))
+        self.server = None
+
+    def get_blocks(self, ranges: Sequence[Dict[str, int]]) -> bytes:
+        uleb = candid_codec.encode_nat
+        records = []
+        for rng in ranges:
+            start = rng["start"]
+            end = min(start + rng["length"], len(self._records), start + self.max_reply - len(records))
+            records.extend(self._records[start:end])
+        values = {"log_length": uleb(len(self._records)), "archived_blocks": uleb(0),
+                  "blocks": uleb(len(records)) + b"".join(records)}
+        return self._types + b"".join(values[f] for f in _RESULT_FIELDS)
+
+    def start(self, port: int = 0) -> str:
+        """Serve on 127.0.0.1 in a daemon thread; returns the URL (port 0 picks a free one)."""
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                request = ic_agent.cbor_decode(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                content = request.get("content", {})
+                if content.get("method_name") == "icrc3_get_blocks":
+                    _, _, args = candid_codec.decode(content["arg"])
+                    reply = {"status": "replied", "reply": {"arg": standin.get_blocks(args[0])}}
+                else:
+                    reply = {"status": "rejected", "reject_code": 3,
+                             "reject_message": f"Stand-in has no method {content.get('method_name')}"}
+                body = ic_agent.SELF_DESCRIBE_TAG + ic_agent.cbor_encode(reply)
+                self.send_response(200)
+                self.send_header("Content-Type", "application/cbor")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def stop(self) -> None:
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+
+
+def main():
+    args = sys.argv[1:]
+    transport_opts = ic_agent.pop_transport_flags(args)
+    canister_id = TRADING_ARCHIVE_CANISTER_ID
+    if "--archive" in args:
+        i = args.index("--archive")
+        canister_id = args[i + 1]
+        del args[i:i + 2]
+    transport = ic_agent.make_transport(network=NETWORK, identity=None, **transport_opts)
+    store = TradeStore(args[0] if args else DEFAULT_STORE)
+    sync(transport, store, canister_id)
+    counts = store.counts()
+    print(f"{counts['trades']:,} trades ({counts['successful']:,} successful, {counts['failed']:,} failed)")
+    for exchange, n in store.by_exchange():
+        print(f"  {exchange or '?':<10} {n:10,}")
+
+
+if __name__ == "__main__":
+    main()